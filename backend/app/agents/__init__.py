@@ -7,6 +7,7 @@ UbD-PBL Course Architect Agents
 from app.agents.project_foundation_v3 import ProjectFoundationAgentV3
 from app.agents.assessment_framework_v3 import AssessmentFrameworkAgentV3
 from app.agents.learning_blueprint_v3 import LearningBlueprintAgentV3
+from app.agents.section_edit_agent import SectionEditAgent
 
 # V1 Agents (legacy, for backwards compatibility)
 try:
@@ -24,6 +25,7 @@ __all__ = [
     "ProjectFoundationAgentV3",
     "AssessmentFrameworkAgentV3",
     "LearningBlueprintAgentV3",
+    "SectionEditAgent",
     # V1 (legacy)
     "ProjectFoundationAgent",
     "AssessmentFrameworkAgent",
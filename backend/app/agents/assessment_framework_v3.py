@@ -4,15 +4,24 @@ UbD Stage Two: 确定可接受的证据 (驱动性问题 + 表现性任务 + 评
 """
 import json
 import time
-from typing import Dict, Any, List, AsyncGenerator
-from pathlib import Path
+from typing import AsyncContextManager, Callable, Dict, Any, List, AsyncGenerator, Optional
 import logging
 
+from app.core.admission import no_admission
 from app.core.openai_client import openai_client
+from app.core.stream_coalescer import coalesce_stream
+from app.core.generation_cache import get_generation_cache, replay_cached_markdown
 from app.core.config import settings
+from app.core.llm_transport import resolve_model
+from app.core.retry import stage_retry_budget
+from app.core.token_usage import TokenUsage
+from app.core.prompt_registry import get_prompt_registry
+from app.core.tracing import set_span_attributes, start_span, traced_stream
 
 logger = logging.getLogger(__name__)
 
+PHR_NAME = "assessment_framework_v3_markdown"
+
 
 class AssessmentFrameworkAgentV3:
     """
@@ -24,48 +33,21 @@ class AssessmentFrameworkAgentV3:
     def __init__(self):
         self.agent_name = "The Assessor"
         self.timeout = settings.agent2_timeout or 35
-        self.phr_version = "v3.0-markdown"
+        self.temperature = 0.7
+
+    @property
+    def phr_version(self) -> str:
+        """PHR版本号 + 提示词内容摘要，作为生成缓存键的一部分"""
+        return get_prompt_registry().get(PHR_NAME).fingerprint
 
     def _load_phr_prompt(self) -> str:
         """
-        从PHR文件加载System Prompt
-        """
-        phr_path = (
-            Path(__file__).parent.parent
-            / "prompts"
-            / "phr"
-            / "assessment_framework_v3_markdown.md"
-        )
-
-        if not phr_path.exists():
-            logger.error(f"PHR file not found: {phr_path}")
-            raise FileNotFoundError(f"PHR v3-markdown prompt file not found: {phr_path}")
-
-        with open(phr_path, "r", encoding="utf-8") as f:
-            content = f.read()
-
-        # 提取System Prompt部分
-        try:
-            start_marker = "## System Prompt\n\n```"
-            end_marker = "```\n\n---"
-
-            start_idx = content.find(start_marker)
-            if start_idx == -1:
-                raise ValueError("System Prompt section not found")
+        从提示词注册表获取System Prompt（启动时已解析，文件变化时热重载）
 
-            start_idx += len(start_marker)
-            end_idx = content.find(end_marker, start_idx)
-
-            if end_idx == -1:
-                raise ValueError("End of System Prompt not found")
-
-            system_prompt = content[start_idx:end_idx].strip()
-            logger.info(f"Loaded PHR v3-markdown prompt ({len(system_prompt)} chars)")
-            return system_prompt
-
-        except Exception as e:
-            logger.error(f"Error parsing PHR file: {e}")
-            raise ValueError(f"Failed to parse PHR file: {e}")
+        Returns:
+            str: System prompt内容
+        """
+        return get_prompt_registry().get_system_prompt(PHR_NAME)
 
     def _build_system_prompt(self) -> str:
         """
@@ -105,7 +87,12 @@ class AssessmentFrameworkAgentV3:
 直接输出Markdown内容，不要任何包裹或额外说明。"""
 
     async def generate(
-        self, stage_one_data: str, course_info: Dict[str, Any]
+        self,
+        stage_one_data: str,
+        course_info: Dict[str, Any],
+        use_cache: bool = True,
+        admit: Optional[Callable[[], AsyncContextManager]] = None,
+        usage: Optional[TokenUsage] = None,
     ) -> Dict[str, Any]:
         """
         生成Stage Two的Markdown文档 (驱动性问题 + 表现性任务 + 评估量规)
@@ -113,6 +100,9 @@ class AssessmentFrameworkAgentV3:
         Args:
             stage_one_data: Stage One的Markdown数据
             course_info: 课程基本信息 {title, duration_weeks, ...}
+            use_cache: 是否读取生成缓存（False时强制重新生成，结果仍写入缓存）
+            admit: 缓存未命中、调用LLM前进入的准入控制（返回异步上下文管理器），默认不限制
+            usage: token用量累计（调用方传入时可在完成后读取本次消耗的token）
 
         Returns:
             {
@@ -120,10 +110,12 @@ class AssessmentFrameworkAgentV3:
                 "markdown": str,  # Markdown文档字符串
                 "generation_time": float,
                 "model": str,
+                "token_usage": dict,  # 本次请求的token用量
                 "error": str (if failed)
             }
         """
         start_time = time.time()
+        usage = usage if usage is not None else TokenUsage()
 
         try:
             logger.info(
@@ -134,15 +126,35 @@ class AssessmentFrameworkAgentV3:
             user_prompt = self._build_user_prompt(stage_one_data, course_info)
 
             # 调用AI API
-            model = settings.agent2_model or settings.openai_model
-            response = await openai_client.generate_response(
-                prompt=user_prompt,
-                system_prompt=system_prompt,
-                model=model,
-                max_tokens=3500,
-                temperature=0.7,
-                timeout=self.timeout,
+            model = resolve_model("agent2")
+
+            # 命中生成缓存时直接返回
+            cache = get_generation_cache()
+            cache_key = cache.make_key(
+                self.agent_name, model, self.phr_version, user_prompt, self.temperature
             )
+            cached = await cache.get_async(cache_key) if use_cache else None
+            if cached is not None:
+                return {
+                    "success": True,
+                    "markdown": cached,
+                    "generation_time": time.time() - start_time,
+                    "model": model,
+                    "cached": True,
+                }
+
+            # 缓存未命中：调用LLM前进入准入控制
+            async with (admit or no_admission)():
+                response = await openai_client.generate_response(
+                    prompt=user_prompt,
+                    system_prompt=system_prompt,
+                    model=model,
+                    max_tokens=3500,
+                    temperature=self.temperature,
+                    timeout=self.timeout,
+                    retry_budget=stage_retry_budget("agent2"),
+                    usage=usage,
+                )
 
             generation_time = time.time() - start_time
 
@@ -153,6 +165,7 @@ class AssessmentFrameworkAgentV3:
                     "error": response.get("error", "AI generation failed"),
                     "generation_time": generation_time,
                     "model": model,
+                    "token_usage": usage.to_dict(),
                 }
 
             # 直接返回Markdown内容，无需JSON解析
@@ -175,11 +188,14 @@ class AssessmentFrameworkAgentV3:
                 f"Generated markdown length: {len(markdown_content)} characters"
             )
 
+            await cache.set_async(cache_key, markdown_content, self.agent_name, model, self.phr_version)
+
             return {
                 "success": True,
                 "markdown": markdown_content,
                 "generation_time": generation_time,
                 "model": model,
+                "token_usage": usage.to_dict(),
             }
 
         except Exception as e:
@@ -189,11 +205,17 @@ class AssessmentFrameworkAgentV3:
                 "success": False,
                 "error": str(e),
                 "generation_time": generation_time,
-                "model": settings.agent2_model or settings.openai_model,
+                "model": resolve_model("agent2"),
+                "token_usage": usage.to_dict(),
             }
 
+    @traced_stream("agent2.generate_stream")
     async def generate_stream(
-        self, stage_one_data: str, course_info: Dict[str, Any]
+        self,
+        stage_one_data: str,
+        course_info: Dict[str, Any],
+        use_cache: bool = True,
+        usage: Optional[TokenUsage] = None,
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """
         流式生成Stage Two的Markdown文档
@@ -201,31 +223,60 @@ class AssessmentFrameworkAgentV3:
         Args:
             stage_one_data: Stage One的Markdown数据
             course_info: 课程基本信息
+            use_cache: 是否读取生成缓存（False时强制重新生成，结果仍写入缓存）
+            usage: token用量累计（调用方传入时可在取消后读取已消耗的token）
 
         Yields:
             Dict[str, Any]: 流式事件 {"type", "content", "chunk", "progress"}
+            缓存未命中时先产出 {"type": "llm_call"}，再调用LLM
         """
         start_time = time.time()
         accumulated_content = ""
-        model = settings.agent2_model or settings.openai_model
+        stream = None
+        model = resolve_model("agent2")
+        usage = usage if usage is not None else TokenUsage()
 
         try:
             logger.info(f"Streaming Stage Two Markdown for: {course_info.get('title', 'Unknown')}")
 
-            system_prompt = self._build_system_prompt()
-            user_prompt = self._build_user_prompt(stage_one_data, course_info)
+            with start_span("agent2.build_prompt"):
+                system_prompt = self._build_system_prompt()
+                user_prompt = self._build_user_prompt(stage_one_data, course_info)
+
+            # 命中生成缓存时全速回放已生成的Markdown
+            cache = get_generation_cache()
+            cache_key = cache.make_key(
+                self.agent_name, model, self.phr_version, user_prompt, self.temperature
+            )
+            cached = await cache.get_async(cache_key) if use_cache else None
+            set_span_attributes(**{"llm.model": model, "cache.hit": cached is not None})
+            if cached is not None:
+                logger.info(f"[STREAM] {self.agent_name} replaying cached Markdown ({len(cached)} chars)")
+                async for event in replay_cached_markdown(cached, model, start_time):
+                    yield event
+                return
+
+            # 缓存未命中：通知调用方即将调用LLM（准入控制在此时申请槽位）
+            yield {"type": "llm_call"}
 
             chunk_count = 0
             logger.info("[STREAM] Agent 2 starting OpenAI streaming...")
 
-            async for chunk in openai_client.generate_response_stream(
-                prompt=user_prompt,
-                system_prompt=system_prompt,
-                model=model,
-                max_tokens=4000,
-                temperature=0.7,
-                timeout=self.timeout,
-            ):
+            # 合并逐token增量（按时间/字节阈值），减少下游事件数
+            stream = coalesce_stream(
+                openai_client.generate_response_stream(
+                    prompt=user_prompt,
+                    system_prompt=system_prompt,
+                    model=model,
+                    max_tokens=4000,
+                    temperature=self.temperature,
+                    timeout=self.timeout,
+                    retry_budget=stage_retry_budget("agent2"),
+                    usage=usage,
+                )
+            )
+
+            async for chunk in stream:
                 accumulated_content += chunk
                 chunk_count += 1
 
@@ -233,7 +284,7 @@ class AssessmentFrameworkAgentV3:
                 if chunk_count % 10 == 0:
                     logger.info(f"[STREAM] Agent 2 chunk #{chunk_count}, chars: {len(accumulated_content)}")
 
-                # 每个chunk都发送（实时流式）
+                # 每个合并后的chunk都发送（实时流式）
                 estimated_progress = min(len(accumulated_content) / 3000, 0.99)
                 yield {
                     "type": "progress",
@@ -257,12 +308,15 @@ class AssessmentFrameworkAgentV3:
             generation_time = time.time() - start_time
             logger.info(f"Stage Two Markdown streaming complete in {generation_time:.2f}s")
 
+            await cache.set_async(cache_key, final_content, self.agent_name, model, self.phr_version)
+
             yield {
                 "type": "complete",
                 "content": final_content,
                 "progress": 1.0,
                 "generation_time": generation_time,
                 "model": model,
+                "token_usage": usage.to_dict(),
             }
 
         except Exception as e:
@@ -274,4 +328,9 @@ class AssessmentFrameworkAgentV3:
                 "content": accumulated_content,
                 "generation_time": generation_time,
                 "model": model,
+                "token_usage": usage.to_dict(),
             }
+        finally:
+            # 被取消（客户端断开）时立即关闭LLM流，而不是等待垃圾回收
+            if stream is not None:
+                await stream.aclose()
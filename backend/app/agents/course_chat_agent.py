@@ -10,68 +10,27 @@ Course Chat Agent - 课程设计专业对话Agent
 - 解释设计理由
 - 协助修改和完善
 """
+import asyncio
 import json
 import logging
-from typing import List, Dict, Any, Optional, AsyncIterator
-from openai import AsyncOpenAI
-
-logger = logging.getLogger(__name__)
-
-
-class CourseChatAgent:
-    """
-    课程设计对话Agent
-
-    专业能力：
-    - UbD逆向设计理论
-    - PBL项目式学习方法
-    - 课程设计最佳实践
-    - 教学评估框架
-    """
+from typing import List, Dict, Any, Iterable, Optional, AsyncIterator
 
-    def __init__(
-        self,
-        api_key: str,
-        model: str = "deepseek-chat",
-        base_url: str = "https://api.deepseek.com/v1",
-        temperature: float = 0.7,
-    ):
-        """
-        初始化Chat Agent
+from openai import AsyncOpenAI
 
-        Args:
-            api_key: OpenAI API密钥
-            model: 模型名称
-            base_url: API基础URL
-            temperature: 生成温度（0.7适合对话）
-        """
-        self.client = AsyncOpenAI(
-            api_key=api_key,
-            base_url=base_url,
-        )
-        self.model = model
-        self.temperature = temperature
+from app.core.cancellation import close_upstream, estimate_tokens, get_cancellation_stats
+from app.core.context_builder import ChatContextBuilder, count_tokens
+from app.core.llm_transport import get_llm_transport
+from app.core.metrics import OUTCOME_CANCELLED, OUTCOME_COMPLETED, OUTCOME_ERROR, LLMCallTimer
+from app.core.prompt_cache import PromptPrefixCache, get_prompt_cache_stats, stage_version, stream_usage_options
+from app.core.token_usage import TokenUsage
+from app.core.tracing import SpanKind, add_span_event, set_span_attributes, start_span, traced_stream
 
-    def _build_system_prompt(
-        self,
-        current_step: int,
-        course_info: Optional[Dict[str, Any]] = None,
-        stage_one_data: Optional[str] = None,
-        stage_two_data: Optional[str] = None,
-        stage_three_data: Optional[str] = None,
-    ) -> str:
-        """
-        构建系统提示词（V3版本 - 接收 Markdown 字符串）
+logger = logging.getLogger(__name__)
 
-        根据当前阶段和已有数据，动态构建上下文
 
-        Args:
-            stage_one_data: Stage One Markdown 字符串
-            stage_two_data: Stage Two Markdown 字符串
-            stage_three_data: Stage Three Markdown 字符串
-        """
-        # 基础身份定义
-        prompt = """你是一位资深的课程设计专家，精通UbD（为理解而设计）逆向设计理论和PBL（项目式学习）教学法。
+# 静态部分：角色、对话风格与REGENERATE协议
+# 所有课程、所有轮次逐字节相同，放在提示词最前面以命中服务端前缀缓存
+CHAT_RULES_PROMPT = """你是一位资深的课程设计专家，精通UbD（为理解而设计）逆向设计理论和PBL（项目式学习）教学法。
 
 你的角色：
 - 帮助教师设计高质量的UbD-PBL课程
@@ -85,58 +44,6 @@ class CourseChatAgent:
 - 引用教育理论
 - 给出可行建议
 
-"""
-
-        # 添加课程信息上下文
-        if course_info:
-            prompt += f"""
-当前课程信息：
-- 课程名称：{course_info.get('title', 'N/A')}
-- 学科领域：{course_info.get('subject', 'N/A')}
-- 年级水平：{course_info.get('grade_level', 'N/A')}
-- 总课时：{course_info.get('total_class_hours', 'N/A')}课时
-- 上课周期：{course_info.get('schedule_description', 'N/A')}
-- 课程简介：{course_info.get('description', 'N/A')}
-
-"""
-
-        # 添加当前阶段说明
-        stage_names = {
-            1: "Stage 1: 确定预期学习结果 (Goals/Understandings/Questions/Knowledge/Skills)",
-            2: "Stage 2: 设计评估证据 (驱动性问题/表现性任务/评估量规)",
-            3: "Stage 3: 规划PBL学习体验 (学习活动/WHERETO原则)"
-        }
-
-        prompt += f"""
-当前阶段：{stage_names.get(current_step, f'Stage {current_step}')}
-
-"""
-
-        # 添加已有Stage数据作为上下文（Markdown格式）
-        if stage_one_data:
-            prompt += f"""
-已完成 Stage 1 数据（预期学习结果 - Markdown格式）：
-{stage_one_data}
-
-"""
-
-        if stage_two_data:
-            prompt += f"""
-已完成 Stage 2 数据（评估框架 - Markdown格式）：
-{stage_two_data}
-
-"""
-
-        if stage_three_data:
-            prompt += f"""
-已完成 Stage 3 数据（学习蓝图 - Markdown格式）：
-{stage_three_data}
-
-"""
-
-        prompt += """
-请基于以上上下文回答用户的问题。如果用户询问当前课程的内容，请参考上述数据。
-
 【重要】当用户明确要求修改课程方案时，你需要触发重新生成：
 1. 在回复的**第一行**添加特殊标记：[REGENERATE:STAGE_X:修改说明]
    - X是阶段编号（1/2/3）
@@ -194,8 +101,201 @@ class CourseChatAgent:
 注意：标记必须独占第一行，格式严格遵守，否则系统无法识别。
 """
 
-        return prompt
+STAGE_NAMES = {
+    1: "Stage 1: 确定预期学习结果 (Goals/Understandings/Questions/Knowledge/Skills)",
+    2: "Stage 2: 设计评估证据 (驱动性问题/表现性任务/评估量规)",
+    3: "Stage 3: 规划PBL学习体验 (学习活动/WHERETO原则)",
+}
+
+STAGE_LABELS = {1: "预期学习结果", 2: "评估框架", 3: "学习蓝图"}
+
+
+class CourseChatAgent:
+    """
+    课程设计对话Agent
+
+    专业能力：
+    - UbD逆向设计理论
+    - PBL项目式学习方法
+    - 课程设计最佳实践
+    - 教学评估框架
+    """
 
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "deepseek-chat",
+        base_url: str = "https://api.deepseek.com/v1",
+        temperature: float = 0.7,
+    ):
+        """
+        初始化Chat Agent
+
+        Args:
+            api_key: OpenAI API密钥
+            model: 模型名称
+            base_url: API基础URL
+            temperature: 生成温度（0.7适合对话）
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.temperature = temperature
+        self.context_builder = ChatContextBuilder()
+        self.prefix_cache = PromptPrefixCache()
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """复用进程内共享连接池的AsyncOpenAI实例（每次从传输层获取，连接池关闭重建后不会失效）"""
+        return get_llm_transport().get_client(api_key=self.api_key, base_url=self.base_url)
+
+    def _build_prompt_prefix(
+        self,
+        course_info: Optional[Dict[str, Any]],
+        stages: Dict[int, Optional[str]],
+    ) -> str:
+        """
+        构建稳定前缀：规则 + 课程信息 + 完整的阶段文档
+
+        同一课程的阶段文档不变时前缀逐字节一致，按（课程信息, 各阶段版本）缓存渲染结果。
+        """
+        course_key = tuple(sorted((course_info or {}).items()))
+        versions = tuple((step, stage_version(stages.get(step))) for step in (1, 2, 3))
+
+        def render() -> str:
+            prompt = CHAT_RULES_PROMPT
+
+            if course_info:
+                prompt += f"""
+当前课程信息：
+- 课程名称：{course_info.get('title', 'N/A')}
+- 学科领域：{course_info.get('subject', 'N/A')}
+- 年级水平：{course_info.get('grade_level', 'N/A')}
+- 总课时：{course_info.get('total_class_hours', 'N/A')}课时
+- 上课周期：{course_info.get('schedule_description', 'N/A')}
+- 课程简介：{course_info.get('description', 'N/A')}
+"""
+
+            # 阶段文档按固定顺序排列，与当前步骤无关
+            for step in (1, 2, 3):
+                markdown = stages.get(step)
+                if markdown:
+                    prompt += f"""
+已完成 Stage {step} 数据（{STAGE_LABELS[step]} - Markdown格式）：
+{markdown}
+"""
+            return prompt
+
+        return self.prefix_cache.get_or_render((course_key, versions), render)
+
+    def _build_prompt_suffix(
+        self,
+        current_step: int,
+        excerpts: Optional[Dict[int, Optional[str]]] = None,
+        history_summary: Optional[str] = None,
+    ) -> str:
+        """
+        构建易变后缀：按问题筛选的章节摘录、历史摘要、当前步骤
+        """
+        suffix = ""
+
+        for step, excerpt in sorted((excerpts or {}).items()):
+            if excerpt:
+                suffix += f"""
+Stage {step} 相关章节（{STAGE_LABELS[step]}，已按当前问题筛选）：
+{excerpt}
+"""
+
+        if history_summary:
+            suffix += f"""
+更早的对话摘要（仅供参考，近期对话见消息记录）：
+{history_summary}
+"""
+
+        suffix += f"""
+当前阶段：{STAGE_NAMES.get(current_step, f'Stage {current_step}')}
+
+请基于以上上下文回答用户的问题。如果用户询问当前课程的内容，请参考上述数据。
+"""
+        return suffix
+
+    def _build_system_prompt(
+        self,
+        current_step: int,
+        course_info: Optional[Dict[str, Any]] = None,
+        stage_one_data: Optional[str] = None,
+        stage_two_data: Optional[str] = None,
+        stage_three_data: Optional[str] = None,
+        history_summary: Optional[str] = None,
+        partial_stages: Iterable[int] = (),
+    ) -> str:
+        """
+        构建系统提示词（V3版本 - 接收 Markdown 字符串）
+
+        布局为稳定前缀 + 易变后缀，见 _build_prompt_prefix / _build_prompt_suffix
+
+        Args:
+            stage_one_data: Stage One Markdown 字符串
+            stage_two_data: Stage Two Markdown 字符串
+            stage_three_data: Stage Three Markdown 字符串
+            history_summary: 更早对话的摘要
+            partial_stages: 只包含部分章节的阶段，放入后缀而不是前缀
+        """
+        stages = {1: stage_one_data, 2: stage_two_data, 3: stage_three_data}
+        partial = set(partial_stages)
+        prefix = self._build_prompt_prefix(
+            course_info, {step: text for step, text in stages.items() if step not in partial}
+        )
+        suffix = self._build_prompt_suffix(
+            current_step, {step: stages[step] for step in partial}, history_summary
+        )
+        return prefix + suffix
+
+    def _build_messages(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        current_step: int,
+        course_info: Optional[Dict[str, Any]],
+        stage_one_data: Optional[str],
+        stage_two_data: Optional[str],
+        stage_three_data: Optional[str],
+    ) -> List[Dict[str, str]]:
+        """
+        按token预算组装消息列表
+
+        阶段数据与历史由 ChatContextBuilder 裁剪：当前阶段优先，其余阶段只保留
+        与问题相关的章节，更早的历史压缩为摘要。
+
+        消息顺序按前缀缓存排列：系统消息只含稳定前缀，之后是追加式的历史，
+        易变后缀随当前用户消息一起放在最后。
+        """
+        base_tokens = count_tokens(self._build_system_prompt(current_step=current_step, course_info=course_info))
+        context = self.context_builder.build(
+            user_message=user_message,
+            conversation_history=conversation_history,
+            current_step=current_step,
+            stages={1: stage_one_data, 2: stage_two_data, 3: stage_three_data},
+            base_tokens=base_tokens,
+        )
+
+        prefix = self._build_prompt_prefix(
+            course_info,
+            {step: text for step, text in context.stages.items() if step not in context.partial_stages},
+        )
+        suffix = self._build_prompt_suffix(
+            current_step,
+            {step: context.stages[step] for step in context.partial_stages},
+            context.history_summary,
+        )
+
+        return [
+            {"role": "system", "content": prefix},
+            *context.history,
+            {"role": "user", "content": f"{suffix.strip()}\n\n用户消息：\n{user_message}"},
+        ]
+
+    @traced_stream("chat.stream")
     async def chat_stream(
         self,
         user_message: str,
@@ -205,6 +305,7 @@ class CourseChatAgent:
         stage_one_data: Optional[str] = None,
         stage_two_data: Optional[str] = None,
         stage_three_data: Optional[str] = None,
+        usage: Optional[TokenUsage] = None,
     ) -> AsyncIterator[str]:
         """
         流式对话（SSE）- V3版本（接收 Markdown 字符串）
@@ -217,61 +318,93 @@ class CourseChatAgent:
             stage_one_data: Stage 1 Markdown字符串
             stage_two_data: Stage 2 Markdown字符串
             stage_three_data: Stage 3 Markdown字符串
+            usage: token用量累计（结束、失败或取消时累加本次请求；没有usage时按本地分词器估算）
 
         Yields:
             str: AI回复的文本片段（流式输出）
         """
-        try:
-            # 构建系统提示词
-            system_prompt = self._build_system_prompt(
-                current_step=current_step,
-                course_info=course_info,
-                stage_one_data=stage_one_data,
-                stage_two_data=stage_two_data,
-                stage_three_data=stage_three_data,
+        stream = None
+        reply = ""
+        timer = LLMCallTimer("chat", self.model)
+        messages: List[Dict[str, str]] = []
+        reported: Optional[Dict[str, int]] = None
+        call_usage: Optional[TokenUsage] = None
+
+        def finish(outcome: str) -> None:
+            """结算本次请求的token（已建立流才会消耗token），只结算一次"""
+            nonlocal call_usage
+            if call_usage is None:
+                call_usage = TokenUsage()
+                if stream is not None:
+                    call_usage.add_request(reported, messages, reply)
+                if usage is not None:
+                    usage.merge(call_usage)
+            timer.finish(
+                outcome,
+                prompt_tokens=call_usage.prompt_tokens,
+                completion_tokens=call_usage.completion_tokens,
             )
 
-            # 构建消息列表
-            messages = [
-                {"role": "system", "content": system_prompt}
-            ]
-
-            # 添加历史对话（最多保留最近10轮）
-            recent_history = conversation_history[-20:] if len(conversation_history) > 20 else conversation_history
-            for msg in recent_history:
-                if msg['role'] in ['user', 'assistant']:
-                    messages.append({
-                        "role": msg['role'],
-                        "content": msg['content']
-                    })
-
-            # 添加当前用户消息
-            messages.append({
-                "role": "user",
-                "content": user_message
-            })
+        set_span_attributes(**{"llm.model": self.model, "chat.step": current_step})
+        try:
+            # 构建消息列表（按token预算裁剪阶段数据与历史）
+            with start_span("chat.build_prompt"):
+                messages = self._build_messages(
+                    user_message=user_message,
+                    conversation_history=conversation_history,
+                    current_step=current_step,
+                    course_info=course_info,
+                    stage_one_data=stage_one_data,
+                    stage_two_data=stage_two_data,
+                    stage_three_data=stage_three_data,
+                )
 
             logger.info(f"[CourseChatAgent] Starting stream chat, message count: {len(messages)}")
 
             # 流式调用LLM
-            stream = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-                stream=True,
-            )
+            with start_span(
+                "llm.chat.completions.create", kind=SpanKind.CLIENT,
+                **{"llm.model": self.model, "llm.agent": "chat", "llm.stream": True},
+            ):
+                stream = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                    stream=True,
+                    extra_body=stream_usage_options() or None,
+                )
 
             # 流式输出
             async for chunk in stream:
+                # include_usage 时最后一个chunk不含choices，只带usage
+                chunk_usage = getattr(chunk, "usage", None)
+                if chunk_usage:
+                    reported = get_prompt_cache_stats().record(self.model, chunk_usage)
                 if chunk.choices and len(chunk.choices) > 0:
                     delta = chunk.choices[0].delta
                     if delta.content:
+                        if timer.first_token_at is None:
+                            add_span_event("first_token")
+                        timer.token()
+                        reply += delta.content
                         yield delta.content
 
+            get_cancellation_stats().record_completed(self.model, estimate_tokens(reply))
+            finish(OUTCOME_COMPLETED)
+
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端断开：停止拉取上游token
+            saved = get_cancellation_stats().record_cancelled(self.model, estimate_tokens(reply))
+            finish(OUTCOME_CANCELLED)
+            logger.info(f"[CourseChatAgent] Stream chat cancelled after {len(reply)} chars, ~{saved} tokens saved")
+            raise
         except Exception as e:
             logger.error(f"[CourseChatAgent] Stream chat error: {e}", exc_info=True)
+            finish(OUTCOME_ERROR)
             error_msg = f"抱歉，遇到了一些技术问题：{str(e)}"
             yield error_msg
+        finally:
+            await close_upstream(stream)
 
     async def chat_non_stream(
         self,
@@ -289,7 +422,9 @@ class CourseChatAgent:
         主要用于测试或特殊场景
         """
         try:
-            system_prompt = self._build_system_prompt(
+            messages = self._build_messages(
+                user_message=user_message,
+                conversation_history=conversation_history,
                 current_step=current_step,
                 course_info=course_info,
                 stage_one_data=stage_one_data,
@@ -297,22 +432,18 @@ class CourseChatAgent:
                 stage_three_data=stage_three_data,
             )
 
-            messages = [{"role": "system", "content": system_prompt}]
-
-            recent_history = conversation_history[-20:] if len(conversation_history) > 20 else conversation_history
-            for msg in recent_history:
-                if msg['role'] in ['user', 'assistant']:
-                    messages.append({"role": msg['role'], "content": msg['content']})
-
-            messages.append({"role": "user", "content": user_message})
-
-            response = await self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=self.temperature,
-                stream=False,
-            )
-
+            with start_span(
+                "llm.chat.completions.create", kind=SpanKind.CLIENT,
+                **{"llm.model": self.model, "llm.agent": "chat", "llm.stream": False},
+            ):
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                    stream=False,
+                )
+
+            get_prompt_cache_stats().record(self.model, getattr(response, "usage", None))
             return response.choices[0].message.content
 
         except Exception as e:
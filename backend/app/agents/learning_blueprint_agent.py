@@ -6,6 +6,7 @@ import time
 from typing import Dict, Any
 from app.core.openai_client import openai_client
 from app.core.config import settings
+from app.core.llm_transport import resolve_model
 
 
 class LearningBlueprintAgent:
@@ -125,7 +126,7 @@ class LearningBlueprintAgent:
             user_prompt = self._build_user_prompt(foundation_data, assessment_data)
 
             # 调用OpenAI API
-            model = settings.agent3_model or settings.openai_model
+            model = resolve_model("agent3")
             response = await openai_client.generate_response(
                 prompt=user_prompt,
                 system_prompt=system_prompt,
@@ -4,15 +4,24 @@ UbD Stage One: 确定预期学习结果 (G/U/Q/K/S框架)
 Markdown版本 - 直接生成Markdown文档
 """
 import time
-from typing import Dict, Any, AsyncGenerator
-from pathlib import Path
+from typing import AsyncContextManager, Callable, Dict, Any, AsyncGenerator, Optional
 import logging
 
+from app.core.admission import no_admission
 from app.core.openai_client import openai_client
+from app.core.stream_coalescer import coalesce_stream
+from app.core.generation_cache import get_generation_cache, replay_cached_markdown
 from app.core.config import settings
+from app.core.llm_transport import resolve_model
+from app.core.retry import stage_retry_budget
+from app.core.token_usage import TokenUsage
+from app.core.prompt_registry import get_prompt_registry
+from app.core.tracing import set_span_attributes, start_span, traced_stream
 
 logger = logging.getLogger(__name__)
 
+PHR_NAME = "project_foundation_v3_markdown"
+
 
 class ProjectFoundationAgentV3:
     """
@@ -24,51 +33,21 @@ class ProjectFoundationAgentV3:
     def __init__(self):
         self.agent_name = "The Strategist"
         self.timeout = settings.agent1_timeout or 30
-        self.phr_version = "v3.0-markdown"
+        self.temperature = 0.7
+
+    @property
+    def phr_version(self) -> str:
+        """PHR版本号 + 提示词内容摘要，作为生成缓存键的一部分"""
+        return get_prompt_registry().get(PHR_NAME).fingerprint
 
     def _load_phr_prompt(self) -> str:
         """
-        从PHR文件加载System Prompt
+        从提示词注册表获取System Prompt（启动时已解析，文件变化时热重载）
 
         Returns:
             str: System prompt内容
         """
-        phr_path = (
-            Path(__file__).parent.parent
-            / "prompts"
-            / "phr"
-            / "project_foundation_v3_markdown.md"
-        )
-
-        if not phr_path.exists():
-            logger.error(f"PHR file not found: {phr_path}")
-            raise FileNotFoundError(f"PHR v3-markdown prompt file not found: {phr_path}")
-
-        with open(phr_path, "r", encoding="utf-8") as f:
-            content = f.read()
-
-        # 提取System Prompt部分 (在```和```之间的第一个代码块)
-        try:
-            start_marker = "## System Prompt\n\n```"
-            end_marker = "```\n\n---"
-
-            start_idx = content.find(start_marker)
-            if start_idx == -1:
-                raise ValueError("System Prompt section not found")
-
-            start_idx += len(start_marker)
-            end_idx = content.find(end_marker, start_idx)
-
-            if end_idx == -1:
-                raise ValueError("End of System Prompt not found")
-
-            system_prompt = content[start_idx:end_idx].strip()
-            logger.info(f"Loaded PHR v3-markdown prompt ({len(system_prompt)} chars)")
-            return system_prompt
-
-        except Exception as e:
-            logger.error(f"Error parsing PHR file: {e}")
-            raise ValueError(f"Failed to parse PHR file: {e}")
+        return get_prompt_registry().get_system_prompt(PHR_NAME)
 
     def _build_system_prompt(self) -> str:
         """
@@ -130,6 +109,9 @@ class ProjectFoundationAgentV3:
         total_class_hours: int = None,
         schedule_description: str = "",
         description: str = "",
+        use_cache: bool = True,
+        admit: Optional[Callable[[], AsyncContextManager]] = None,
+        usage: Optional[TokenUsage] = None,
     ) -> Dict[str, Any]:
         """
         生成Stage One的Markdown文档 (G/U/Q/K/S)
@@ -141,6 +123,9 @@ class ProjectFoundationAgentV3:
             total_class_hours: 总课时数（按45分钟标准课时）
             schedule_description: 上课周期描述
             description: 课程简介
+            use_cache: 是否读取生成缓存（False时强制重新生成，结果仍写入缓存）
+            admit: 缓存未命中、调用LLM前进入的准入控制（返回异步上下文管理器），默认不限制
+            usage: token用量累计（调用方传入时可在完成后读取本次消耗的token）
 
         Returns:
             {
@@ -148,10 +133,12 @@ class ProjectFoundationAgentV3:
                 "markdown": str,  # Markdown文档字符串
                 "generation_time": float,
                 "model": str,
+                "token_usage": dict,  # 本次请求的token用量
                 "error": str (if failed)
             }
         """
         start_time = time.time()
+        usage = usage if usage is not None else TokenUsage()
 
         try:
             logger.info(f"Generating Stage One Markdown for: {title}")
@@ -162,15 +149,35 @@ class ProjectFoundationAgentV3:
             )
 
             # 调用AI API
-            model = settings.agent1_model or settings.openai_model
-            response = await openai_client.generate_response(
-                prompt=user_prompt,
-                system_prompt=system_prompt,
-                model=model,
-                max_tokens=3000,
-                temperature=0.7,
-                timeout=self.timeout,
+            model = resolve_model("agent1")
+
+            # 命中生成缓存时直接返回
+            cache = get_generation_cache()
+            cache_key = cache.make_key(
+                self.agent_name, model, self.phr_version, user_prompt, self.temperature
             )
+            cached = await cache.get_async(cache_key) if use_cache else None
+            if cached is not None:
+                return {
+                    "success": True,
+                    "markdown": cached,
+                    "generation_time": time.time() - start_time,
+                    "model": model,
+                    "cached": True,
+                }
+
+            # 缓存未命中：调用LLM前进入准入控制
+            async with (admit or no_admission)():
+                response = await openai_client.generate_response(
+                    prompt=user_prompt,
+                    system_prompt=system_prompt,
+                    model=model,
+                    max_tokens=3000,
+                    temperature=self.temperature,
+                    timeout=self.timeout,
+                    retry_budget=stage_retry_budget("agent1"),
+                    usage=usage,
+                )
 
             generation_time = time.time() - start_time
 
@@ -181,6 +188,7 @@ class ProjectFoundationAgentV3:
                     "error": response.get("error", "AI generation failed"),
                     "generation_time": generation_time,
                     "model": model,
+                    "token_usage": usage.to_dict(),
                 }
 
             # 直接返回Markdown内容，无需JSON解析
@@ -203,11 +211,14 @@ class ProjectFoundationAgentV3:
                 f"Generated markdown length: {len(markdown_content)} characters"
             )
 
+            await cache.set_async(cache_key, markdown_content, self.agent_name, model, self.phr_version)
+
             return {
                 "success": True,
                 "markdown": markdown_content,
                 "generation_time": generation_time,
                 "model": model,
+                "token_usage": usage.to_dict(),
             }
 
         except Exception as e:
@@ -217,9 +228,11 @@ class ProjectFoundationAgentV3:
                 "success": False,
                 "error": str(e),
                 "generation_time": generation_time,
-                "model": settings.agent1_model or settings.openai_model,
+                "model": resolve_model("agent1"),
+                "token_usage": usage.to_dict(),
             }
 
+    @traced_stream("agent1.generate_stream")
     async def generate_stream(
         self,
         title: str,
@@ -228,6 +241,8 @@ class ProjectFoundationAgentV3:
         total_class_hours: int = None,
         schedule_description: str = "",
         description: str = "",
+        use_cache: bool = True,
+        usage: Optional[TokenUsage] = None,
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """
         流式生成Stage One的Markdown文档 (G/U/Q/K/S)
@@ -239,11 +254,13 @@ class ProjectFoundationAgentV3:
             total_class_hours: 总课时数（按45分钟标准课时）
             schedule_description: 上课周期描述
             description: 课程简介
+            use_cache: 是否读取生成缓存（False时强制重新生成，结果仍写入缓存）
+            usage: token用量累计（调用方传入时可在取消后读取已消耗的token）
 
         Yields:
             Dict[str, Any]: 流式事件
             {
-                "type": "progress",  # "progress" | "complete" | "error"
+                "type": "progress",  # "llm_call" | "progress" | "complete" | "error"
                 "content": str,      # 当前累积的markdown内容
                 "chunk": str,        # 本次新增的文本块（仅progress事件）
                 "progress": float,   # 0.0-1.0 估算进度
@@ -251,29 +268,55 @@ class ProjectFoundationAgentV3:
         """
         start_time = time.time()
         accumulated_content = ""
-        model = settings.agent1_model or settings.openai_model
+        stream = None
+        model = resolve_model("agent1")
+        usage = usage if usage is not None else TokenUsage()
 
         try:
             logger.info(f"Streaming Stage One Markdown for: {title}")
 
-            system_prompt = self._build_system_prompt()
-            user_prompt = self._build_user_prompt(
-                title, subject, grade_level, total_class_hours, schedule_description, description
+            with start_span("agent1.build_prompt"):
+                system_prompt = self._build_system_prompt()
+                user_prompt = self._build_user_prompt(
+                    title, subject, grade_level, total_class_hours, schedule_description, description
+                )
+
+            # 命中生成缓存时全速回放已生成的Markdown
+            cache = get_generation_cache()
+            cache_key = cache.make_key(
+                self.agent_name, model, self.phr_version, user_prompt, self.temperature
             )
+            cached = await cache.get_async(cache_key) if use_cache else None
+            set_span_attributes(**{"llm.model": model, "cache.hit": cached is not None})
+            if cached is not None:
+                logger.info(f"[STREAM] {self.agent_name} replaying cached Markdown ({len(cached)} chars)")
+                async for event in replay_cached_markdown(cached, model, start_time):
+                    yield event
+                return
+
+            # 缓存未命中：通知调用方即将调用LLM（准入控制在此时申请槽位）
+            yield {"type": "llm_call"}
 
             # 调用流式AI API
             chunk_count = 0
             start_stream = time.time()
             logger.info("[STREAM] Agent 1 starting OpenAI streaming...")
 
-            async for chunk in openai_client.generate_response_stream(
-                prompt=user_prompt,
-                system_prompt=system_prompt,
-                model=model,
-                max_tokens=3000,
-                temperature=0.7,
-                timeout=self.timeout,
-            ):
+            # 合并逐token增量（按时间/字节阈值），减少下游事件数
+            stream = coalesce_stream(
+                openai_client.generate_response_stream(
+                    prompt=user_prompt,
+                    system_prompt=system_prompt,
+                    model=model,
+                    max_tokens=3000,
+                    temperature=self.temperature,
+                    timeout=self.timeout,
+                    retry_budget=stage_retry_budget("agent1"),
+                    usage=usage,
+                )
+            )
+
+            async for chunk in stream:
                 accumulated_content += chunk
                 chunk_count += 1
                 elapsed = time.time() - start_stream
@@ -282,17 +325,15 @@ class ProjectFoundationAgentV3:
                 if chunk_count % 10 == 0:
                     logger.info(f"[STREAM] Agent 1 chunk #{chunk_count} @ {elapsed:.2f}s, chars: {len(accumulated_content)}")
 
-                # 🔑 关键：每个chunk都发送进度事件并yield（实时）
+                # 🔑 关键：每个合并后的chunk都发送进度事件并yield（实时）
                 estimated_progress = min(len(accumulated_content) / 2000, 0.99)
 
-                logger.info(f"[STREAM] Agent 1 yielding progress event #{chunk_count}")
                 yield {
                     "type": "progress",
                     "content": accumulated_content,
                     "chunk": chunk,
                     "progress": estimated_progress,
                 }
-                logger.info(f"[STREAM] Agent 1 yielded event #{chunk_count}")
 
             logger.info(f"[STREAM] Agent 1 finished! Total chunks: {chunk_count}, elapsed: {time.time() - start_stream:.2f}s")
 
@@ -316,6 +357,8 @@ class ProjectFoundationAgentV3:
                 f"Generated markdown length: {len(final_content)} characters"
             )
 
+            await cache.set_async(cache_key, final_content, self.agent_name, model, self.phr_version)
+
             # 发送完成事件
             yield {
                 "type": "complete",
@@ -323,6 +366,7 @@ class ProjectFoundationAgentV3:
                 "progress": 1.0,
                 "generation_time": generation_time,
                 "model": model,
+                "token_usage": usage.to_dict(),
             }
 
         except Exception as e:
@@ -335,5 +379,10 @@ class ProjectFoundationAgentV3:
                 "content": accumulated_content,  # 返回已生成的部分
                 "generation_time": generation_time,
                 "model": model,
+                "token_usage": usage.to_dict(),
             }
+        finally:
+            # 被取消（客户端断开）时立即关闭LLM流，而不是等待垃圾回收
+            if stream is not None:
+                await stream.aclose()
 
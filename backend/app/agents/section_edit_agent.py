@@ -0,0 +1,220 @@
+"""
+SectionEditAgent - 章节级局部修改
+对话中的修改指令（[REGENERATE:STAGE_X:...]）只重写受影响的章节，
+以章节补丁流式输出并合并回已保存的阶段文档
+"""
+import time
+from typing import Any, AsyncGenerator, Dict, Iterable, List, Optional
+import logging
+
+from app.core.config import settings
+from app.core.llm_transport import resolve_model
+from app.core.openai_client import openai_client
+from app.core.prompt_registry import get_prompt_registry
+from app.core.retry import stage_retry_budget
+from app.core.token_usage import TokenUsage
+from app.core.tracing import set_span_attributes, start_span, traced_stream
+from app.core.stage_sections import (
+    SectionPatchParser,
+    StageSection,
+    format_numbered_document,
+    merge_sections,
+    resolve_sections,
+    split_stage_sections,
+)
+from app.core.stream_coalescer import coalesce_stream
+
+logger = logging.getLogger(__name__)
+
+PHR_NAME = "section_editor_v1"
+
+STAGE_TITLES = {1: "阶段一：确定预期学习结果", 2: "阶段二：确定可接受的证据", 3: "阶段三：规划学习体验"}
+
+
+class SectionEditAgent:
+    """
+    章节级修改Agent
+
+    把阶段文档按标题编号后交给模型，模型只输出需要修改的章节，
+    输出token与等待时间随修改范围而不是文档长度增长。
+    """
+
+    def __init__(self):
+        self.agent_name = "The Editor"
+        self.timeout = settings.max_timeout
+        self.temperature = 0.4
+
+    def _build_system_prompt(self) -> str:
+        """
+        构建系统提示词
+
+        Prompt版本: backend/app/prompts/phr/section_editor_v1.md
+        """
+        return get_prompt_registry().get_system_prompt(PHR_NAME)
+
+    def _build_user_prompt(
+        self,
+        stage: int,
+        sections: List[StageSection],
+        edit_instructions: str,
+        course_info: Optional[Dict[str, Any]] = None,
+        allowed: Optional[List[int]] = None,
+    ) -> str:
+        """构建用户提示词：课程信息 + 带编号的文档 + 修改要求"""
+        info = course_info or {}
+        duration = ""
+        if info.get("total_class_hours"):
+            duration = f"{info['total_class_hours']}课时"
+        if info.get("schedule_description"):
+            duration += f"（{info['schedule_description']}）" if duration else info["schedule_description"]
+
+        prompt = f"""# COURSE INFO
+课程名称: {info.get("title") or "未指定"}
+学科领域: {info.get("subject") or "未指定"}
+年级水平: {info.get("grade_level") or "未指定"}
+课程时长: {duration or "未指定"}
+课程简介: {info.get("description") or "无"}
+
+# CURRENT DOCUMENT ({STAGE_TITLES.get(stage, f"阶段{stage}")}，按章节编号)
+{format_numbered_document(sections)}
+
+# MODIFICATION REQUEST
+{edit_instructions}
+"""
+        if allowed:
+            prompt += f"""
+# EDITABLE SECTIONS
+只允许修改以下章节：{", ".join(f"@@ {index}" for index in allowed)}
+"""
+        prompt += "\n只输出需要修改的章节（\"@@ 编号\" + 完整的新章节内容），不要输出未修改的章节。"
+        return prompt
+
+    @traced_stream("section_edit.edit_stream")
+    async def edit_stream(
+        self,
+        stage: int,
+        markdown: str,
+        edit_instructions: str,
+        course_info: Optional[Dict[str, Any]] = None,
+        sections: Optional[Iterable[str]] = None,
+        usage: Optional[TokenUsage] = None,
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        流式生成章节补丁
+
+        Args:
+            stage: 阶段编号（决定使用的模型与重试预算）
+            markdown: 当前已保存的阶段文档
+            edit_instructions: 修改指令
+            course_info: 课程基本信息
+            sections: 限定可修改的章节（编号、G/U/Q/K/S代码或标题片段），默认由模型判断
+            usage: token用量累计（调用方传入时可在取消后读取已消耗的token）
+
+        Yields:
+            Dict[str, Any]: 流式事件
+            - {"type": "llm_call"}: 即将调用LLM（调用方此时申请准入槽位）
+            - {"type": "progress", "section": 正在输出的章节编号, "delta": 该章节新增的内容, "chunk", "progress"}
+            - {"type": "section", "index", "heading", "code", "markdown"}: 一个章节补丁完成
+            - {"type": "complete", "content": 合并后的文档, "sections": [...], "generation_time", "model", "token_usage"}
+            - {"type": "error", "error", "generation_time", "model", "token_usage"}
+        """
+        start_time = time.time()
+        model = resolve_model(f"agent{stage}")
+        usage = usage if usage is not None else TokenUsage()
+        stream = None
+        patches: Dict[int, str] = {}
+
+        try:
+            parsed = split_stage_sections(markdown)
+            allowed = resolve_sections(parsed, sections) if sections else None
+            if sections and not allowed:
+                raise ValueError(f"未找到指定的章节: {', '.join(map(str, sections))}")
+            parser = SectionPatchParser(parsed, allowed=allowed)
+
+            logger.info(
+                f"[SectionEdit] Stage {stage}: {len(parsed) - 1} sections, "
+                f"editable={allowed or 'all'}, instructions: {edit_instructions}"
+            )
+
+            set_span_attributes(**{"llm.model": model, "workflow.stage": stage, "section_edit.sections": len(parsed) - 1})
+            with start_span("section_edit.build_prompt"):
+                system_prompt = self._build_system_prompt()
+                user_prompt = self._build_user_prompt(stage, parsed, edit_instructions, course_info, allowed)
+
+            # 通知调用方即将调用LLM（准入控制在此时申请槽位）
+            yield {"type": "llm_call"}
+
+            stream = coalesce_stream(
+                openai_client.generate_response_stream(
+                    prompt=user_prompt,
+                    system_prompt=system_prompt,
+                    model=model,
+                    max_tokens=4000,
+                    temperature=self.temperature,
+                    timeout=self.timeout,
+                    retry_budget=stage_retry_budget(f"agent{stage}"),
+                    usage=usage,
+                )
+            )
+
+            produced = 0
+            # 已发送预览的章节编号与内容长度：progress 只携带该章节新增的内容，
+            # 完整文档只在结束时合并一次
+            previewed = (None, 0)
+            async for chunk in stream:
+                produced += len(chunk)
+                for event in self._section_events(parsed, parser.feed(chunk), patches):
+                    yield event
+
+                index, text = parser.current or (None, "")
+                offset = previewed[1] if previewed[0] == index else 0
+                if index is None or len(text) <= offset:
+                    continue
+                previewed = (index, len(text))
+                yield {
+                    "type": "progress",
+                    "section": index,
+                    "delta": text[offset:],
+                    "chunk": chunk,
+                    "progress": min(produced / max(len(markdown), 1), 0.99),
+                }
+
+            for event in self._section_events(parsed, parser.finish(), patches):
+                yield event
+
+            if parser.ignored:
+                logger.warning(f"[SectionEdit] Stage {stage}: ignored patches for sections {parser.ignored}")
+
+            generation_time = time.time() - start_time
+            logger.info(
+                f"[SectionEdit] Stage {stage}: patched {sorted(patches)} with {produced} output chars "
+                f"(document {len(markdown)} chars) in {generation_time:.2f}s"
+            )
+            yield {
+                "type": "complete",
+                "content": merge_sections(parsed, patches),
+                "sections": [parsed[index].to_dict() for index in sorted(patches)],
+                "progress": 1.0,
+                "generation_time": generation_time,
+                "model": model,
+                "token_usage": usage.to_dict(),
+            }
+
+        except Exception as e:
+            logger.error(f"[SectionEdit] Stage {stage} failed: {e}", exc_info=True)
+            yield {
+                "type": "error",
+                "error": str(e),
+                "generation_time": time.time() - start_time,
+                "model": model,
+                "token_usage": usage.to_dict(),
+            }
+        finally:
+            if stream is not None:
+                await stream.aclose()
+
+    def _section_events(self, parsed: List[StageSection], finished, patches: Dict[int, str]):
+        """记录完成的补丁并转换为section事件"""
+        for index, patch in finished:
+            patches[index] = patch
+            yield {"type": "section", **parsed[index].to_dict(), "markdown": patch}
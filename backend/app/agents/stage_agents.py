@@ -3,7 +3,7 @@
 这些Agent专门用于人工参与式工作流,接受自由文本输入,返回Markdown格式输出
 """
 from app.core.openai_client import openai_client
-from app.core.config import settings
+from app.core.llm_transport import resolve_model
 import time
 
 
@@ -47,7 +47,7 @@ class Stage1Agent:
             response = await openai_client.generate_response(
                 prompt=user_prompt,
                 system_prompt=system_prompt,
-                model=settings.agent1_model or settings.openai_model,
+                model=resolve_model("agent1"),
                 max_tokens=1500,
                 temperature=0.7,
                 timeout=30
@@ -119,7 +119,7 @@ class Stage2Agent:
             response = await openai_client.generate_response(
                 prompt=user_prompt,
                 system_prompt=system_prompt,
-                model=settings.agent2_model or settings.openai_model,
+                model=resolve_model("agent2"),
                 max_tokens=2000,
                 temperature=0.7,
                 timeout=60
@@ -195,7 +195,7 @@ class Stage3Agent:
             response = await openai_client.generate_response(
                 prompt=user_prompt,
                 system_prompt=system_prompt,
-                model=settings.agent3_model or settings.openai_model,
+                model=resolve_model("agent3"),
                 max_tokens=3000,
                 temperature=0.7,
                 timeout=120
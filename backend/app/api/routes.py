@@ -348,7 +348,8 @@ import json
 async def generate_stage3_stream_content(input_data: Stage3Input):
     """生成Stage3的流式内容"""
     from app.core.openai_streaming import openai_streaming_client
-    from app.core.config import settings
+    from app.core.stream_coalescer import coalesce_stream
+    from app.core.llm_transport import resolve_model
 
     system_prompt = """你是一位资深的PBL课程设计师。
 你的任务是根据已确定的项目基础和评估框架,生成详细的逐日教学计划。
@@ -382,16 +383,19 @@ async def generate_stage3_stream_content(input_data: Stage3Input):
 
 使用Markdown格式,结构清晰。"""
 
-    # 流式生成
+    # 流式生成（合并逐token增量后再发送SSE帧）
     full_content = ""
-    async for chunk in openai_streaming_client.generate_stream(
-        prompt=user_prompt,
-        system_prompt=system_prompt,
-        model=settings.agent3_model or settings.openai_model,
-        max_tokens=3000,
-        temperature=0.7,
-        timeout=120
-    ):
+    stream = coalesce_stream(
+        openai_streaming_client.generate_stream(
+            prompt=user_prompt,
+            system_prompt=system_prompt,
+            model=resolve_model("agent3"),
+            max_tokens=3000,
+            temperature=0.7,
+            timeout=120
+        )
+    )
+    async for chunk in stream:
         full_content += chunk
         # 发送SSE格式数据
         yield f"data: {json.dumps({'chunk': chunk, 'done': False})}\n\n"
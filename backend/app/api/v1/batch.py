@@ -0,0 +1,99 @@
+"""
+V3 API: 批量课程生成端点
+提交课程清单后在后台以有限并发生成，结果写入课程库，可查询进度、取消与续跑
+"""
+import asyncio
+import logging
+from typing import List, Optional
+
+from fastapi import APIRouter, File, HTTPException, Query, UploadFile, status
+from pydantic import BaseModel, Field
+
+from app.services.batch_generation import CourseSpec, get_batch_service, parse_course_specs
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/v1/batches", tags=["batches"])
+
+
+class BatchCreateRequest(BaseModel):
+    """批量生成请求"""
+
+    courses: List[CourseSpec] = Field(..., min_length=1, description="课程清单")
+    concurrency: Optional[int] = Field(None, ge=1, description="同时生成的课程数（默认见 batch_default_concurrency）")
+    use_cache: bool = Field(default=True, description="是否使用生成缓存")
+
+
+async def _create_and_start(specs: List[CourseSpec], concurrency: Optional[int], use_cache: bool) -> dict:
+    service = get_batch_service()
+    try:
+        batch_id = await asyncio.to_thread(service.create, specs, concurrency, use_cache)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    service.start(batch_id)
+    return await asyncio.to_thread(service.status, batch_id)
+
+
+@router.post("", status_code=status.HTTP_202_ACCEPTED)
+async def create_batch(request: BatchCreateRequest):
+    """
+    创建并启动批量生成任务
+
+    每门课程依次生成三个阶段，完成后写入课程库（courses[].course_id）。
+    通过 GET /api/v1/batches/{batch_id} 查询每门课程的状态与失败原因。
+    """
+    return await _create_and_start(request.courses, request.concurrency, request.use_cache)
+
+
+@router.post("/upload", status_code=status.HTTP_202_ACCEPTED)
+async def upload_batch(
+    file: UploadFile = File(..., description="CSV（表头为课程字段）或JSON课程清单"),
+    concurrency: Optional[int] = Query(None, ge=1, description="同时生成的课程数"),
+    use_cache: bool = Query(True, description="是否使用生成缓存"),
+):
+    """
+    上传CSV/JSON课程清单并启动批量生成
+
+    CSV列 / JSON字段：title, subject, grade_level, total_class_hours, schedule_description, description
+    """
+    content = (await file.read()).decode("utf-8-sig", errors="replace")
+    fmt = None
+    if file.filename:
+        suffix = file.filename.rsplit(".", 1)[-1].lower()
+        fmt = suffix if suffix in ("csv", "json") else None
+    try:
+        specs = parse_course_specs(content, fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return await _create_and_start(specs, concurrency, use_cache)
+
+
+@router.get("/{batch_id}")
+async def get_batch(batch_id: str):
+    """查询批量任务进度：整体计数与每门课程的状态、课程ID、错误"""
+    result = await asyncio.to_thread(get_batch_service().status, batch_id)
+    if result is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Batch {batch_id} not found")
+    return result
+
+
+@router.post("/{batch_id}/resume")
+async def resume_batch(
+    batch_id: str,
+    retry_failed: bool = Query(False, description="同时重新生成失败的课程"),
+):
+    """续跑批量任务：已完成的课程不会重新生成"""
+    service = get_batch_service()
+    if await asyncio.to_thread(service.status, batch_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Batch {batch_id} not found")
+    started = service.start(batch_id, retry_failed=retry_failed)
+    return {"batch_id": batch_id, "started": started}
+
+
+@router.delete("/{batch_id}")
+async def cancel_batch(batch_id: str):
+    """取消批量任务；已完成的课程保留，之后可续跑"""
+    service = get_batch_service()
+    if not await service.cancel(batch_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Batch {batch_id} not found")
+    return await asyncio.to_thread(service.status, batch_id)
@@ -3,18 +3,26 @@ Chat API - 课程设计对话端点
 
 提供ChatGPT式的流式对话API
 """
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import json
 import logging
 import re
 
-from app.core.database import get_db
+from app.core.admission import PRIORITY_INTERACTIVE, QueueFullError, get_admission_controller
+from app.core.cancellation import stream_until_disconnect
+from app.core.config import settings
+from app.core.database import get_async_db
+from app.core.metrics import get_metrics
+from app.core.stream_coalescer import coalesce_stream
+from app.core.token_usage import TokenUsage
+from app.core.tracing import current_trace_id, trace_sse, trace_stream
 from app.models.course_project import CourseProject
 from app.agents.course_chat_agent import get_chat_agent
+from app.services.usage_recorder import OPERATION_CHAT, get_usage_recorder
 
 logger = logging.getLogger(__name__)
 
@@ -52,6 +60,7 @@ async def stream_chat_response(
     stage_one_data: Optional[str],
     stage_two_data: Optional[str],
     stage_three_data: Optional[str],
+    course_id: Optional[int] = None,
 ):
     """
     生成流式对话响应（SSE格式）- V4版本（支持Artifact事件）
@@ -60,31 +69,54 @@ async def stream_chat_response(
         stage_one_data: Stage 1 Markdown字符串
         stage_two_data: Stage 2 Markdown字符串
         stage_three_data: Stage 3 Markdown字符串
+        course_id: 课程ID（准入控制中按课程公平排队；结束后按课程记录token用量）
+
+    对话走准入控制的优先通道，等待槽位期间发送 queued 事件。
 
     SSE格式：
+    data: {"type": "queued", "position": 1}\\n\\n
     data: {"type": "chunk", "content": "文本片段"}\\n\\n
     data: {"type": "artifact", "action": "regenerate", "stage": 1, "instructions": "..."}\\n\\n
-    data: {"type": "done"}\\n\\n
+    data: {"type": "done", "token_usage": {...}}\\n\\n
     """
+    ticket = None
+    stream = None
+    usage = TokenUsage()
     try:
         chat_agent = get_chat_agent()
 
-        # 开始事件
-        yield f"data: {json.dumps({'type': 'start'}, ensure_ascii=False)}\n\n"
+        # 开始事件（携带trace_id，便于按trace排查慢请求）
+        start_event = {'type': 'start'}
+        trace_id = current_trace_id()
+        if trace_id:
+            start_event['trace_id'] = trace_id
+        yield f"data: {json.dumps(start_event, ensure_ascii=False)}\n\n"
+
+        # 准入控制：对话使用优先通道
+        ticket = get_admission_controller().enqueue(
+            chat_agent.model, tenant=f"course:{course_id}", priority=PRIORITY_INTERACTIVE
+        )
+        async for position in trace_stream("admission.wait", ticket.wait(), **{"llm.model": chat_agent.model}):
+            yield f"data: {json.dumps({'type': 'queued', 'position': position}, ensure_ascii=False)}\n\n"
+        get_metrics().observe_queue_wait("chat", chat_agent.model, ticket.wait_seconds)
 
         # 累积完整的AI回复（用于检测REGENERATE标记）
         full_response = ""
 
-        # 流式输出AI回复
-        async for chunk in chat_agent.chat_stream(
-            user_message=user_message,
-            conversation_history=conversation_history,
-            current_step=current_step,
-            course_info=course_info,
-            stage_one_data=stage_one_data,
-            stage_two_data=stage_two_data,
-            stage_three_data=stage_three_data,
-        ):
+        # 流式输出AI回复（合并逐token增量后再发送SSE帧）
+        stream = coalesce_stream(
+            chat_agent.chat_stream(
+                user_message=user_message,
+                conversation_history=conversation_history,
+                current_step=current_step,
+                course_info=course_info,
+                stage_one_data=stage_one_data,
+                stage_two_data=stage_two_data,
+                stage_three_data=stage_three_data,
+                usage=usage,
+            )
+        )
+        async for chunk in stream:
             # 累积完整回复
             full_response += chunk
 
@@ -111,16 +143,24 @@ async def stream_chat_response(
             yield f"data: {json.dumps(artifact_event, ensure_ascii=False)}\n\n"
 
         # 完成事件
-        yield f"data: {json.dumps({'type': 'done'}, ensure_ascii=False)}\n\n"
+        yield f"data: {json.dumps({'type': 'done', 'token_usage': usage.to_dict()}, ensure_ascii=False)}\n\n"
 
     except Exception as e:
         logger.error(f"[ChatAPI] Stream error: {e}", exc_info=True)
         # 发送错误事件
         yield f"data: {json.dumps({'type': 'error', 'message': str(e)}, ensure_ascii=False)}\n\n"
+    finally:
+        # 客户端断开时先关闭LLM流再释放槽位
+        if stream is not None:
+            await stream.aclose()
+        if ticket is not None:
+            ticket.release()
+        if course_id is not None:
+            get_usage_recorder().record(course_id, OPERATION_CHAT, usage, model=get_chat_agent().model)
 
 
 @router.post("/chat/stream")
-async def chat_stream(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_stream(request: ChatRequest, http_request: Request, db: AsyncSession = Depends(get_async_db)):
     """
     流式对话API（SSE）
 
@@ -158,9 +198,7 @@ async def chat_stream(request: ChatRequest, db: Session = Depends(get_db)):
     """
     try:
         # 获取课程信息和数据
-        course = db.query(CourseProject).filter(
-            CourseProject.id == request.course_id
-        ).first()
+        course = await db.get(CourseProject, request.course_id)
 
         if not course:
             raise HTTPException(
@@ -184,17 +222,29 @@ async def chat_stream(request: ChatRequest, db: Session = Depends(get_db)):
             for msg in request.conversation_history
         ]
 
+        if get_admission_controller().is_full(get_chat_agent().model, PRIORITY_INTERACTIVE):
+            raise HTTPException(
+                status_code=429,
+                detail="对话请求过多，请稍后重试",
+                headers={"Retry-After": str(settings.llm_queue_retry_after_seconds)},
+            )
+
         # 返回流式响应
         return StreamingResponse(
-            stream_chat_response(
-                user_message=request.message,
-                conversation_history=conversation_history,
-                current_step=request.current_step,
-                course_info=course_info,
-                stage_one_data=course.stage_one_data,
-                stage_two_data=course.stage_two_data,
-                stage_three_data=course.stage_three_data,
-            ),
+            trace_sse(stream_until_disconnect(
+                http_request,
+                stream_chat_response(
+                    user_message=request.message,
+                    conversation_history=conversation_history,
+                    current_step=request.current_step,
+                    course_info=course_info,
+                    stage_one_data=course.stage_one_data,
+                    stage_two_data=course.stage_two_data,
+                    stage_three_data=course.stage_three_data,
+                    course_id=request.course_id,
+                ),
+                route="chat",
+            )),
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
@@ -212,16 +262,14 @@ async def chat_stream(request: ChatRequest, db: Session = Depends(get_db)):
 
 
 @router.post("/chat")
-async def chat_non_stream(request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_non_stream(request: ChatRequest, db: AsyncSession = Depends(get_async_db)):
     """
     非流式对话API
 
     返回完整的AI回复（不推荐，建议使用流式）
     """
     try:
-        course = db.query(CourseProject).filter(
-            CourseProject.id == request.course_id
-        ).first()
+        course = await db.get(CourseProject, request.course_id)
 
         if not course:
             raise HTTPException(
@@ -245,15 +293,18 @@ async def chat_non_stream(request: ChatRequest, db: Session = Depends(get_db)):
 
         chat_agent = get_chat_agent()
 
-        response = await chat_agent.chat_non_stream(
-            user_message=request.message,
-            conversation_history=conversation_history,
-            current_step=request.current_step,
-            course_info=course_info,
-            stage_one_data=course.stage_one_data,
-            stage_two_data=course.stage_two_data,
-            stage_three_data=course.stage_three_data,
-        )
+        async with get_admission_controller().slot(
+            chat_agent.model, tenant=f"course:{request.course_id}", priority=PRIORITY_INTERACTIVE
+        ):
+            response = await chat_agent.chat_non_stream(
+                user_message=request.message,
+                conversation_history=conversation_history,
+                current_step=request.current_step,
+                course_info=course_info,
+                stage_one_data=course.stage_one_data,
+                stage_two_data=course.stage_two_data,
+                stage_three_data=course.stage_three_data,
+            )
 
         return {
             "message": response,
@@ -263,6 +314,12 @@ async def chat_non_stream(request: ChatRequest, db: Session = Depends(get_db)):
 
     except HTTPException:
         raise
+    except QueueFullError:
+        raise HTTPException(
+            status_code=429,
+            detail="对话请求过多，请稍后重试",
+            headers={"Retry-After": str(settings.llm_queue_retry_after_seconds)},
+        )
     except Exception as e:
         logger.error(f"[ChatAPI] Error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,15 +1,22 @@
 """
 V3 API: 课程项目CRUD和对话历史API
 """
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import String, and_, delete, or_, select, type_coerce
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, Field
 from datetime import datetime
+import base64
+import json
 import logging
 
-from app.core.database import get_db
+from app.core.database import get_async_db
+from app.core.stage_dependencies import STATUS_STALE, content_hash, course_state, evaluate_staleness
+from app.models.conversation_message import CourseConversationMessage
 from app.models.course_project import CourseProject
+from app.models.llm_usage import LLMUsageRecord
+from app.services.usage_recorder import course_usage_summary
 
 logger = logging.getLogger(__name__)
 
@@ -67,6 +74,13 @@ class ConversationAddRequest(BaseModel):
     messages: List[ConversationMessage] = Field(..., description="消息列表")
 
 
+class ConversationAddResponse(BaseModel):
+    """添加对话消息响应"""
+
+    course_id: int
+    messages: List[Dict[str, Any]] = Field(..., description="新增的消息（含id和timestamp）")
+
+
 class CourseResponse(BaseModel):
     """课程响应 - Markdown版本"""
 
@@ -83,7 +97,7 @@ class CourseResponse(BaseModel):
     stage_one_data: Optional[str]  # Markdown字符串
     stage_two_data: Optional[str]  # Markdown字符串
     stage_three_data: Optional[str]  # Markdown字符串
-    conversation_history: Optional[List[Dict[str, Any]]]
+    conversation_history: Optional[List[Dict[str, Any]]]  # 已迁移到 /courses/{id}/conversation，仅兼容旧数据
     stage_one_version: Optional[datetime]
     stage_two_version: Optional[datetime]
     stage_three_version: Optional[datetime]
@@ -94,11 +108,76 @@ class CourseResponse(BaseModel):
         from_attributes = True
 
 
+class CourseSummary(BaseModel):
+    """课程列表摘要 - 只包含元数据，不含Markdown正文和对话历史"""
+
+    id: int
+    title: str
+    subject: Optional[str]
+    grade_level: Optional[str]
+    total_class_hours: Optional[int]
+    schedule_description: Optional[str]
+    has_stage_one: bool = Field(..., description="是否已有Stage One内容")
+    has_stage_two: bool = Field(..., description="是否已有Stage Two内容")
+    has_stage_three: bool = Field(..., description="是否已有Stage Three内容")
+    stage_one_version: Optional[datetime]
+    stage_two_version: Optional[datetime]
+    stage_three_version: Optional[datetime]
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class CourseSummaryPage(BaseModel):
+    """课程摘要分页结果"""
+
+    items: List[CourseSummary]
+    next_cursor: Optional[str] = Field(None, description="下一页游标；为空表示没有更多数据")
+
+
+# ========== Keyset Pagination ==========
+
+
+def _has_content(column):
+    """只判断文本列是否非空，不读取正文"""
+    return and_(column.isnot(None), column != "").label(f"has_{column.key.replace('_data', '')}")
+
+
+# 按数据库中的原始值比较 updated_at：SQLite中 CURRENT_TIMESTAMP 写入的文本不带微秒，
+# 与SQLAlchemy绑定参数的格式不同，直接用datetime比较会导致翻页重复或遗漏
+_UPDATED_AT_RAW = type_coerce(CourseProject.updated_at, String)
+
+
+def _encode_cursor(updated_at_raw: Any, course_id: int) -> str:
+    if isinstance(updated_at_raw, datetime):
+        payload = {"dt": updated_at_raw.isoformat(), "id": course_id}
+    else:
+        payload = {"raw": str(updated_at_raw), "id": course_id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+
+def _cursor_condition(cursor: str):
+    """(updated_at, id) 严格小于游标位置的条件（按 updated_at DESC, id DESC 排序）"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        course_id = int(payload["id"])
+        if "dt" in payload:
+            column, value = CourseProject.updated_at, datetime.fromisoformat(payload["dt"])
+        else:
+            column, value = _UPDATED_AT_RAW, str(payload["raw"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+    return or_(column < value, and_(column == value, CourseProject.id < course_id))
+
+
 # ========== CRUD Endpoints ==========
 
 
 @router.post("", response_model=CourseResponse, status_code=status.HTTP_201_CREATED)
-def create_course(request: CourseCreateRequest, db: Session = Depends(get_db)):
+async def create_course(request: CourseCreateRequest, db: AsyncSession = Depends(get_async_db)):
     """
     创建新课程项目
     """
@@ -113,14 +192,14 @@ def create_course(request: CourseCreateRequest, db: Session = Depends(get_db)):
             conversation_history=[],  # 初始化为空列表
         )
         db.add(course)
-        db.commit()
-        db.refresh(course)
+        await db.commit()
+        await db.refresh(course)
 
         logger.info(f"Created course: {course.id} - {course.title}")
         return course
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error creating course: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -128,12 +207,61 @@ def create_course(request: CourseCreateRequest, db: Session = Depends(get_db)):
         )
 
 
+@router.get("/summary", response_model=CourseSummaryPage)
+async def list_course_summaries(
+    limit: int = Query(20, ge=1, le=100, description="每页数量"),
+    cursor: Optional[str] = Query(None, description="上一页返回的next_cursor"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    获取课程列表摘要（键集分页）
+
+    只查询元数据列，按 (updated_at, id) 倒序；翻页使用 next_cursor，
+    耗时与课程总数无关（依赖 ix_course_projects_updated_at_id 索引）。
+    """
+    query = select(
+        CourseProject.id,
+        CourseProject.title,
+        CourseProject.subject,
+        CourseProject.grade_level,
+        CourseProject.total_class_hours,
+        CourseProject.schedule_description,
+        _has_content(CourseProject.stage_one_data),
+        _has_content(CourseProject.stage_two_data),
+        _has_content(CourseProject.stage_three_data),
+        CourseProject.stage_one_version,
+        CourseProject.stage_two_version,
+        CourseProject.stage_three_version,
+        CourseProject.created_at,
+        CourseProject.updated_at,
+        _UPDATED_AT_RAW.label("updated_at_raw"),
+    )
+    if cursor:
+        query = query.where(_cursor_condition(cursor))
+
+    # 多取一行判断是否还有下一页
+    result = await db.execute(
+        query.order_by(CourseProject.updated_at.desc(), CourseProject.id.desc()).limit(limit + 1)
+    )
+    rows = result.all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].updated_at_raw, rows[-1].id)
+
+    return CourseSummaryPage(
+        items=[CourseSummary.model_validate(row) for row in rows],
+        next_cursor=next_cursor,
+    )
+
+
 @router.get("/{course_id}", response_model=CourseResponse)
-def get_course(course_id: int, db: Session = Depends(get_db)):
+async def get_course(course_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     获取课程详情
     """
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
+    course = await db.get(CourseProject, course_id)
 
     if not course:
         raise HTTPException(
@@ -144,30 +272,29 @@ def get_course(course_id: int, db: Session = Depends(get_db)):
 
 
 @router.get("", response_model=List[CourseResponse])
-def list_courses(
-    skip: int = 0, limit: int = 100, db: Session = Depends(get_db)
+async def list_courses(
+    skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_db)
 ):
     """
-    获取课程列表
+    获取课程列表（包含完整Markdown与对话历史；列表页请使用 /courses/summary）
     """
-    courses = (
-        db.query(CourseProject)
+    result = await db.execute(
+        select(CourseProject)
         .order_by(CourseProject.updated_at.desc())
         .offset(skip)
         .limit(limit)
-        .all()
     )
-    return courses
+    return result.scalars().all()
 
 
 @router.put("/{course_id}", response_model=CourseResponse)
-def update_course(
-    course_id: int, request: CourseUpdateRequest, db: Session = Depends(get_db)
+async def update_course(
+    course_id: int, request: CourseUpdateRequest, db: AsyncSession = Depends(get_async_db)
 ):
     """
     更新课程基本信息
     """
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
+    course = await db.get(CourseProject, course_id)
 
     if not course:
         raise HTTPException(
@@ -180,13 +307,13 @@ def update_course(
         setattr(course, key, value)
 
     try:
-        db.commit()
-        db.refresh(course)
+        await db.commit()
+        await db.refresh(course)
         logger.info(f"Updated course: {course_id}")
         return course
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error updating course: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -195,11 +322,11 @@ def update_course(
 
 
 @router.delete("/{course_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_course(course_id: int, db: Session = Depends(get_db)):
+async def delete_course(course_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     删除课程
     """
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
+    course = await db.get(CourseProject, course_id)
 
     if not course:
         raise HTTPException(
@@ -207,12 +334,17 @@ def delete_course(course_id: int, db: Session = Depends(get_db)):
         )
 
     try:
-        db.delete(course)
-        db.commit()
+        # SQLite默认不启用外键级联，显式删除对话消息与用量记录
+        await db.execute(
+            delete(CourseConversationMessage).where(CourseConversationMessage.course_id == course_id)
+        )
+        await db.execute(delete(LLMUsageRecord).where(LLMUsageRecord.course_id == course_id))
+        await db.delete(course)
+        await db.commit()
         logger.info(f"Deleted course: {course_id}")
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error deleting course: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -224,13 +356,13 @@ def delete_course(course_id: int, db: Session = Depends(get_db)):
 
 
 @router.put("/{course_id}/stage-one", response_model=CourseResponse)
-def update_stage_one(
-    course_id: int, request: StageDataUpdate, db: Session = Depends(get_db)
+async def update_stage_one(
+    course_id: int, request: StageDataUpdate, db: AsyncSession = Depends(get_async_db)
 ):
     """
     更新Stage One数据 (Markdown格式)
     """
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
+    course = await db.get(CourseProject, course_id)
 
     if not course:
         raise HTTPException(
@@ -238,15 +370,17 @@ def update_stage_one(
         )
 
     try:
+        # 仅空白变化的编辑不更新版本（下游阶段不因此过期）
+        if content_hash(request.markdown) != content_hash(course.stage_one_data):
+            course.stage_one_version = datetime.utcnow()
         course.stage_one_data = request.markdown
-        course.stage_one_version = datetime.utcnow()
-        db.commit()
-        db.refresh(course)
+        await db.commit()
+        await db.refresh(course)
         logger.info(f"Updated stage one (Markdown) for course: {course_id}, length: {len(request.markdown)}")
         return course
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error updating stage one: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -255,13 +389,13 @@ def update_stage_one(
 
 
 @router.put("/{course_id}/stage-two", response_model=CourseResponse)
-def update_stage_two(
-    course_id: int, request: StageDataUpdate, db: Session = Depends(get_db)
+async def update_stage_two(
+    course_id: int, request: StageDataUpdate, db: AsyncSession = Depends(get_async_db)
 ):
     """
     更新Stage Two数据 (Markdown格式)
     """
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
+    course = await db.get(CourseProject, course_id)
 
     if not course:
         raise HTTPException(
@@ -269,15 +403,17 @@ def update_stage_two(
         )
 
     try:
+        # 仅空白变化的编辑不更新版本（下游阶段不因此过期）
+        if content_hash(request.markdown) != content_hash(course.stage_two_data):
+            course.stage_two_version = datetime.utcnow()
         course.stage_two_data = request.markdown
-        course.stage_two_version = datetime.utcnow()
-        db.commit()
-        db.refresh(course)
+        await db.commit()
+        await db.refresh(course)
         logger.info(f"Updated stage two (Markdown) for course: {course_id}, length: {len(request.markdown)}")
         return course
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error updating stage two: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -286,13 +422,13 @@ def update_stage_two(
 
 
 @router.put("/{course_id}/stage-three", response_model=CourseResponse)
-def update_stage_three(
-    course_id: int, request: StageDataUpdate, db: Session = Depends(get_db)
+async def update_stage_three(
+    course_id: int, request: StageDataUpdate, db: AsyncSession = Depends(get_async_db)
 ):
     """
     更新Stage Three数据 (Markdown格式)
     """
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
+    course = await db.get(CourseProject, course_id)
 
     if not course:
         raise HTTPException(
@@ -300,15 +436,17 @@ def update_stage_three(
         )
 
     try:
+        # 仅空白变化的编辑不更新版本（下游阶段不因此过期）
+        if content_hash(request.markdown) != content_hash(course.stage_three_data):
+            course.stage_three_version = datetime.utcnow()
         course.stage_three_data = request.markdown
-        course.stage_three_version = datetime.utcnow()
-        db.commit()
-        db.refresh(course)
+        await db.commit()
+        await db.refresh(course)
         logger.info(f"Updated stage three (Markdown) for course: {course_id}, length: {len(request.markdown)}")
         return course
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error updating stage three: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -316,11 +454,51 @@ def update_stage_three(
         )
 
 
+@router.get("/{course_id}/staleness")
+async def get_course_staleness(course_id: int, db: AsyncSession = Depends(get_async_db)):
+    """
+    查询各阶段是否过期
+
+    比较每个阶段生成时记录的输入哈希（课程信息 + 上游阶段）与当前内容：
+    - missing: 阶段尚无内容
+    - fresh: 输入未变化
+    - stale: 输入已变化，changed_inputs 列出变化的输入（"info" 或上游阶段编号）
+
+    没有哈希记录的旧数据按 stage_*_version 判断（basis="version"）。
+    重新生成时传 only_stale=true 即只生成过期的阶段。
+    """
+    course = await db.get(CourseProject, course_id)
+
+    if not course:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Course {course_id} not found"
+        )
+
+    statuses = evaluate_staleness(**course_state(course))
+    return {
+        "course_id": course_id,
+        "stages": [statuses[stage].to_dict() for stage in sorted(statuses)],
+        "stale_stages": [stage for stage in sorted(statuses) if statuses[stage].status == STATUS_STALE],
+    }
+
+
+@router.get("/{course_id}/usage")
+async def get_course_usage(course_id: int, db: AsyncSession = Depends(get_async_db)):
+    """
+    查询课程的LLM token用量
+
+    按操作（generate / section_edit / chat）、阶段和模型汇总，total 为全部合计。
+    estimated=true 表示其中部分请求没有供应商usage，按本地分词器估算。
+    """
+    await _ensure_course_exists(db, course_id)
+    return {"course_id": course_id, **await course_usage_summary(db, course_id)}
+
+
 # ========== Export Endpoints ==========
 
 
 @router.get("/{course_id}/export/markdown")
-async def export_course_markdown(course_id: int, db: Session = Depends(get_db)):
+async def export_course_markdown(course_id: int, db: AsyncSession = Depends(get_async_db)):
     """
     导出课程为Markdown格式
 
@@ -331,7 +509,7 @@ async def export_course_markdown(course_id: int, db: Session = Depends(get_db)):
     from urllib.parse import quote
     from app.services.export_service import get_export_service
 
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
+    course = await db.get(CourseProject, course_id)
 
     if not course:
         raise HTTPException(
@@ -388,47 +566,68 @@ async def export_course_markdown(course_id: int, db: Session = Depends(get_db)):
 # ========== Conversation History Endpoints ==========
 
 
-@router.post("/{course_id}/conversation", response_model=CourseResponse)
-def add_conversation_messages(
-    course_id: int, request: ConversationAddRequest, db: Session = Depends(get_db)
-):
-    """
-    添加对话消息到历史记录
-    """
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
-
-    if not course:
+async def _ensure_course_exists(db: AsyncSession, course_id: int) -> None:
+    """只查询主键判断课程是否存在，不加载Markdown正文"""
+    exists = await db.scalar(select(CourseProject.id).where(CourseProject.id == course_id))
+    if exists is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail=f"Course {course_id} not found"
         )
 
+
+def _encode_message_cursor(message: CourseConversationMessage) -> str:
+    payload = {"created_at": message.created_at.isoformat(), "id": message.id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+
+def _message_cursor_condition(cursor: str):
+    """(created_at, id) 严格大于游标位置的条件（按时间正序）"""
     try:
-        # 获取现有对话历史
-        history = course.conversation_history or []
-
-        # 添加新消息
-        for msg in request.messages:
-            history.append(
-                {
-                    "id": f"{datetime.utcnow().timestamp()}_{len(history)}",
-                    "role": msg.role,
-                    "content": msg.content,
-                    "step": msg.step,
-                    "timestamp": datetime.utcnow().isoformat(),
-                }
-            )
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        created_at = datetime.fromisoformat(payload["created_at"])
+        message_id = int(payload["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+    return or_(
+        CourseConversationMessage.created_at > created_at,
+        and_(
+            CourseConversationMessage.created_at == created_at,
+            CourseConversationMessage.id > message_id,
+        ),
+    )
+
+
+@router.post("/{course_id}/conversation", response_model=ConversationAddResponse)
+async def add_conversation_messages(
+    course_id: int, request: ConversationAddRequest, db: AsyncSession = Depends(get_async_db)
+):
+    """
+    添加对话消息到历史记录（只追加新行，不读取已有历史）
+    """
+    await _ensure_course_exists(db, course_id)
 
-        course.conversation_history = history
-        db.commit()
-        db.refresh(course)
+    try:
+        messages = [
+            CourseConversationMessage(
+                course_id=course_id,
+                role=msg.role,
+                content=msg.content,
+                step=msg.step,
+                created_at=datetime.utcnow(),
+            )
+            for msg in request.messages
+        ]
+        db.add_all(messages)
+        await db.commit()
 
         logger.info(
             f"Added {len(request.messages)} messages to course {course_id} conversation"
         )
-        return course
+        return {"course_id": course_id, "messages": [msg.to_dict() for msg in messages]}
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error adding conversation messages: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -437,58 +636,69 @@ def add_conversation_messages(
 
 
 @router.get("/{course_id}/conversation")
-def get_conversation_history(
-    course_id: int, step: Optional[int] = None, db: Session = Depends(get_db)
+async def get_conversation_history(
+    course_id: int,
+    step: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1, le=500, description="每页消息数；不指定时返回全部"),
+    cursor: Optional[str] = Query(None, description="上一页返回的next_cursor"),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     获取对话历史
-    可选过滤特定步骤的对话
+    可选过滤特定步骤的对话；指定limit时按时间正序游标分页
     """
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
-
-    if not course:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail=f"Course {course_id} not found"
-        )
+    await _ensure_course_exists(db, course_id)
 
-    history = course.conversation_history or []
+    query = select(CourseConversationMessage).where(CourseConversationMessage.course_id == course_id)
 
     # 过滤特定步骤
     if step is not None:
-        history = [msg for msg in history if msg.get("step") == step]
+        query = query.where(CourseConversationMessage.step == step)
+    if cursor:
+        query = query.where(_message_cursor_condition(cursor))
+
+    query = query.order_by(CourseConversationMessage.created_at, CourseConversationMessage.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
 
-    return {"course_id": course_id, "messages": history}
+    messages = list((await db.scalars(query)).all())
+
+    next_cursor = None
+    if limit is not None and len(messages) > limit:
+        messages = messages[:limit]
+        next_cursor = _encode_message_cursor(messages[-1])
+
+    return {
+        "course_id": course_id,
+        "messages": [msg.to_dict() for msg in messages],
+        "next_cursor": next_cursor,
+    }
 
 
 @router.delete("/{course_id}/conversation", status_code=status.HTTP_204_NO_CONTENT)
-def clear_conversation_history(
-    course_id: int, step: Optional[int] = None, db: Session = Depends(get_db)
+async def clear_conversation_history(
+    course_id: int, step: Optional[int] = None, db: AsyncSession = Depends(get_async_db)
 ):
     """
     清除对话历史
     如果指定step，则只清除该步骤的对话
     """
-    course = db.query(CourseProject).filter(CourseProject.id == course_id).first()
-
-    if not course:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND, detail=f"Course {course_id} not found"
-        )
+    await _ensure_course_exists(db, course_id)
 
     try:
-        if step is None:
-            # 清除所有对话
-            course.conversation_history = []
-        else:
+        statement = delete(CourseConversationMessage).where(
+            CourseConversationMessage.course_id == course_id
+        )
+        if step is not None:
             # 只清除特定步骤
-            history = course.conversation_history or []
-            course.conversation_history = [msg for msg in history if msg.get("step") != step]
+            statement = statement.where(CourseConversationMessage.step == step)
 
-        db.commit()
+        await db.execute(statement)
+        await db.commit()
         logger.info(f"Cleared conversation for course {course_id}, step: {step}")
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error clearing conversation: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
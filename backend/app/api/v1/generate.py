@@ -2,13 +2,29 @@
 V3 API: 工作流生成端点 (Server-Sent Events)
 支持流式生成三个UbD阶段，带进度事件 - 集成真实的Agent V3
 """
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Optional, List, Dict, Any, Literal
 import json
 import logging
 
+from app.core.admission import get_admission_controller
+from app.core.cancellation import get_cancellation_stats, stream_until_disconnect
+from app.core.config import settings
+from app.core.context_builder import get_context_stats
+from app.core.database import get_async_db
+from app.core.llm_transport import get_llm_transport, resolve_model
+from app.core.prompt_cache import get_prompt_cache_stats
+from app.core.prompt_registry import get_prompt_registry
+from app.core.stage_dependencies import course_state
+from app.core.tracing import trace_sse
+from app.models.course_project import CourseProject
+from app.services.generation_jobs import get_job_manager
+from app.services.stage_writer import STAGE_COLUMNS
+
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/v1", tags=["workflow"])
@@ -49,14 +65,54 @@ class WorkflowRequest(BaseModel):
         None, description="AI对话中提出的修改指令，用于引导Agent进行局部修改而非完全重新生成"
     )
 
+    edit_mode: Literal["section", "full"] = Field(
+        default="section",
+        description="编辑指令的处理方式：section=提供course_id且只生成一个已有阶段时，只重写受影响的章节；full=整阶段重新生成",
+    )
+    edit_sections: Optional[List[str]] = Field(
+        None, description="局部修改时限定可修改的章节（编号、G/U/Q/K/S代码或标题片段），默认由模型判断"
+    )
+
+    # 流式输出模式
+    stream_mode: Literal["full", "delta"] = Field(
+        default="full",
+        description="progress事件格式：full=每次携带完整markdown_preview；delta=仅携带增量delta和序号seq，周期性附带完整快照",
+    )
+    pipelined: bool = Field(
+        default=False,
+        description="流水线模式：Stage 1的G/U/Q完成后即启动Stage 2，Stage 2表现性任务完成后即启动Stage 3，事件按stage交错输出",
+    )
+    use_cache: bool = Field(
+        default=True,
+        description="是否使用生成缓存；相同课程信息命中缓存时全速回放，设为false强制重新生成",
+    )
+    course_id: Optional[int] = Field(
+        None,
+        description="课程ID；提供时每个阶段完成后自动保存到该课程（后台写入，不阻塞流），无需再调用PUT /courses/{id}/stage-xxx",
+    )
+    only_stale: bool = Field(
+        default=False,
+        description="选择性重新生成（需提供course_id）：只重新生成输入内容发生变化的阶段，未变化的阶段沿用已保存内容并发送stage_skipped事件",
+    )
+
 
 # ========== SSE Stream Generator ==========
 
 
-async def stream_workflow_events(request: WorkflowRequest):
+async def stream_workflow_events(
+    request: WorkflowRequest,
+    stage_markdown: Optional[str] = None,
+    stored_state: Optional[Dict[str, Any]] = None,
+):
     """
     生成工作流SSE事件流 - 使用真实的WorkflowServiceV3
 
+    stage_markdown 非空时（见 load_section_edit_target）按编辑指令只重写受影响的章节，
+    额外发送 section_patch 事件 (stage, index, heading, code, markdown)
+
+    stored_state 非空时（见 load_stored_state）只重新生成过期的阶段，
+    沿用的阶段发送 stage_skipped 事件 (stage, reason, changed_inputs)
+
     事件格式:
     data: {"event": "...", "data": {...}}
 
@@ -72,6 +128,26 @@ async def stream_workflow_events(request: WorkflowRequest):
     try:
         workflow_service = get_workflow_service_v3()
 
+        if stage_markdown:
+            async for sse_event in workflow_service.stream_section_edit(
+                stage=request.stages_to_generate[0],
+                markdown=stage_markdown,
+                edit_instructions=request.edit_instructions,
+                course_info={
+                    "title": request.title,
+                    "subject": request.subject or "",
+                    "grade_level": request.grade_level or "",
+                    "total_class_hours": request.total_class_hours,
+                    "schedule_description": request.schedule_description or "",
+                    "description": request.description or "",
+                },
+                sections=request.edit_sections,
+                course_id=request.course_id,
+                stream_mode=request.stream_mode,
+            ):
+                yield sse_event
+            return
+
         # 使用真实的workflow service进行流式生成
         async for sse_event in workflow_service.stream_workflow(
             title=request.title,
@@ -84,6 +160,11 @@ async def stream_workflow_events(request: WorkflowRequest):
             stage_one_data=request.stage_one_data,
             stage_two_data=request.stage_two_data,
             edit_instructions=request.edit_instructions,  # 🎯 传递编辑指令
+            stream_mode=request.stream_mode,
+            pipelined=request.pipelined,
+            use_cache=request.use_cache,
+            course_id=request.course_id,
+            stored_state=stored_state,
         ):
             yield sse_event
 
@@ -103,8 +184,65 @@ def format_sse_event(event_data: dict) -> str:
     return f"data: {json.dumps(event_data, ensure_ascii=False)}\n\n"
 
 
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",  # 禁用Nginx缓冲
+    "Access-Control-Allow-Origin": "*",  # CORS
+}
+
+
+async def check_workflow_request(request: WorkflowRequest, db: AsyncSession) -> None:
+    """
+    生成前检查：课程不存在返回404；相关模型的等待队列已满时直接返回429，
+    而不是让请求排在无望的队尾
+    """
+    if request.course_id is not None:
+        exists = await db.scalar(select(CourseProject.id).where(CourseProject.id == request.course_id))
+        if exists is None:
+            raise HTTPException(status_code=404, detail=f"Course {request.course_id} not found")
+
+    admission = get_admission_controller()
+    for stage in request.stages_to_generate:
+        if admission.is_full(resolve_model(f"agent{stage}")):
+            raise HTTPException(
+                status_code=429,
+                detail="生成请求过多，请稍后重试",
+                headers={"Retry-After": str(settings.llm_queue_retry_after_seconds)},
+            )
+
+
+async def load_section_edit_target(request: WorkflowRequest, db: AsyncSession) -> Optional[str]:
+    """
+    局部修改的目标文档：带编辑指令、提供course_id、只生成一个阶段且该阶段已有内容时
+    返回已保存的Markdown，否则返回None（整阶段重新生成）
+    """
+    if (
+        request.edit_mode != "section"
+        or not request.edit_instructions
+        or request.course_id is None
+        or len(request.stages_to_generate) != 1
+    ):
+        return None
+    stage = request.stages_to_generate[0]
+    if stage not in STAGE_COLUMNS:
+        return None
+    column = getattr(CourseProject, STAGE_COLUMNS[stage][0])
+    return await db.scalar(select(column).where(CourseProject.id == request.course_id)) or None
+
+
+async def load_stored_state(request: WorkflowRequest, db: AsyncSession) -> Optional[Dict[str, Any]]:
+    """选择性重新生成（only_stale + course_id）时读取课程已保存的阶段与输入哈希"""
+    if not request.only_stale or request.course_id is None:
+        return None
+    course = await db.get(CourseProject, request.course_id)
+    return course_state(course) if course is not None else None
+
+
 @router.post("/workflow/stream")
-async def stream_workflow(request: WorkflowRequest):
+async def stream_workflow(
+    request: WorkflowRequest, http_request: Request, db: AsyncSession = Depends(get_async_db)
+):
     """
     流式生成完整工作流
 
@@ -117,6 +255,37 @@ async def stream_workflow(request: WorkflowRequest):
     - stage_complete: 阶段完成 (stage, result)
     - error: 错误 (message, stage)
     - complete: 全部完成
+    - queued: 等待LLM槽位 (stage, position)，获得槽位后继续输出progress
+
+    队列已满时返回 HTTP 429（带 Retry-After 头）
+
+    客户端断开后立即停止生成并关闭上游LLM流（需要断线续传请使用 /workflow/jobs）
+
+    自动保存 (course_id):
+    - 每个阶段完成后由后台写入器保存Markdown并更新版本时间戳
+    - 对应的stage_complete事件带 autosaved=true，前端无需再回传文档
+
+    流式模式 (stream_mode):
+    - full: progress事件携带完整的markdown_preview（默认）
+    - delta: progress事件携带 seq + delta（新增文本），每隔固定事件数
+      携带一次 snapshot=true + markdown_preview 完整快照；
+      客户端收到快照时替换本地文档，否则追加delta
+
+    流水线模式 (pipelined=true):
+    - 各阶段的progress事件交错输出，按 data.stage 区分
+    - 基于上游部分数据启动的阶段，其stage_complete带有 upstream_partial=true
+    - 基于上游前缀生成的Stage 2/3草稿在上游完成后按完整内容校准（发送section_patch），
+      其stage_complete带有 reconciled=true
+
+    局部修改 (edit_instructions + course_id + 单个已有阶段，edit_mode=section):
+    - 只重写受影响的章节，每个章节完成时发送 section_patch
+    - progress 只描述正在修改的章节：section + section_preview（full）或 delta（delta）
+    - stage_complete 携带合并后的完整markdown，mode="section"，patched_sections 列出修改的章节
+
+    选择性重新生成 (only_stale=true + course_id):
+    - 比较各阶段生成时记录的输入哈希与当前内容，只重新生成过期或缺失的阶段及其下游
+    - 只改动空白（空行、缩进）的编辑不会使下游阶段过期
+    - 沿用的阶段发送 stage_skipped (stage, reason, changed_inputs)，start 事件带 skipped_stages
 
     示例 (fetch with stream):
     ```javascript
@@ -145,22 +314,168 @@ async def stream_workflow(request: WorkflowRequest):
     }
     ```
     """
+    await check_workflow_request(request, db)
+    stage_markdown = await load_section_edit_target(request, db)
+    stored_state = await load_stored_state(request, db)
+
     try:
         return StreamingResponse(
-            stream_workflow_events(request),
+            trace_sse(stream_until_disconnect(
+                http_request,
+                stream_workflow_events(request, stage_markdown, stored_state),
+                route="workflow",
+            )),
             media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",  # 禁用Nginx缓冲
-                "Access-Control-Allow-Origin": "*",  # CORS
-            },
+            headers=SSE_HEADERS,
         )
     except Exception as e:
         logger.error(f"Stream workflow endpoint error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class SectionEditRequest(BaseModel):
+    """章节级局部修改请求"""
+
+    course_id: int = Field(..., description="课程ID（读取并保存该课程的阶段文档）")
+    stage: int = Field(..., ge=1, le=3, description="要修改的阶段")
+    instructions: str = Field(..., min_length=1, description="修改指令（如对话中REGENERATE标记的修改说明）")
+    sections: Optional[List[str]] = Field(
+        None, description="限定可修改的章节（编号、G/U/Q/K/S代码或标题片段），默认由模型判断"
+    )
+    stream_mode: Literal["full", "delta"] = Field(
+        default="full",
+        description="progress事件格式：full=携带正在修改章节的section_preview；delta=仅携带该章节新增的delta",
+    )
+
+
+@router.post("/workflow/edit")
+async def stream_section_edit(
+    request: SectionEditRequest, http_request: Request, db: AsyncSession = Depends(get_async_db)
+):
+    """
+    章节级局部修改 (SSE)
+
+    读取课程已保存的阶段文档，只重写受修改指令影响的章节，合并后自动保存。
+    事件与 /workflow/stream 的局部修改相同：section_patch (stage, index, heading, code, markdown)，
+    progress 只描述正在修改的章节 (section + section_preview 或 delta)。
+
+    课程不存在返回404；该阶段尚无内容时返回409（请先生成该阶段）。
+    """
+    course = await db.get(CourseProject, request.course_id)
+    if course is None:
+        raise HTTPException(status_code=404, detail=f"Course {request.course_id} not found")
+
+    markdown = getattr(course, STAGE_COLUMNS[request.stage][0])
+    if not markdown:
+        raise HTTPException(status_code=409, detail=f"Stage {request.stage} has no content to edit")
+
+    if get_admission_controller().is_full(resolve_model(f"agent{request.stage}")):
+        raise HTTPException(
+            status_code=429,
+            detail="生成请求过多，请稍后重试",
+            headers={"Retry-After": str(settings.llm_queue_retry_after_seconds)},
+        )
+
+    from app.services.workflow_service_v3 import get_workflow_service_v3
+
+    events = get_workflow_service_v3().stream_section_edit(
+        stage=request.stage,
+        markdown=markdown,
+        edit_instructions=request.instructions,
+        course_info={
+            "title": course.title,
+            "subject": course.subject,
+            "grade_level": course.grade_level,
+            "total_class_hours": course.total_class_hours,
+            "schedule_description": course.schedule_description,
+            "description": course.description,
+        },
+        sections=request.sections,
+        course_id=course.id,
+        stream_mode=request.stream_mode,
+    )
+    return StreamingResponse(
+        trace_sse(stream_until_disconnect(http_request, events, route="workflow_edit")),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+# ========== 可恢复的生成任务 ==========
+
+
+@router.post("/workflow/jobs")
+async def create_workflow_job(request: WorkflowRequest, db: AsyncSession = Depends(get_async_db)):
+    """
+    创建后台生成任务（与HTTP连接解耦）
+
+    返回 job_id 后通过 GET /workflow/jobs/{job_id}/events 订阅事件；
+    浏览器刷新或断网后带 Last-Event-ID 重新订阅即可从断点继续，生成不会重启。
+    所有订阅者断开超过 job_orphan_grace_seconds 后任务自动取消。
+    """
+    await check_workflow_request(request, db)
+    stage_markdown = await load_section_edit_target(request, db)
+    stored_state = await load_stored_state(request, db)
+
+    job = get_job_manager().create(lambda: stream_workflow_events(request, stage_markdown, stored_state))
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        "events_url": f"/api/v1/workflow/jobs/{job.job_id}/events",
+    }
+
+
+@router.get("/workflow/jobs/{job_id}/events")
+async def stream_workflow_job_events(
+    job_id: str,
+    last_event_id: Optional[int] = Query(None, ge=0, description="从该事件ID之后开始回放（EventSource可用Last-Event-ID头）"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """
+    订阅生成任务事件 (SSE)
+
+    每个事件带 `id: <seq>` 行，事件体与 /workflow/stream 相同。额外事件类型:
+    - gap: 请求的起点早于服务端保留的事件日志 (missed_from, missed_to)，客户端应以下一个快照为准
+    - cancelled: 任务已取消
+    """
+    manager = get_job_manager()
+    if manager.get(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    start = last_event_id
+    if start is None and last_event_id_header:
+        try:
+            start = int(last_event_id_header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+
+    return StreamingResponse(
+        trace_sse(manager.subscribe(job_id, last_event_id=start or 0)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+@router.get("/workflow/jobs/{job_id}")
+async def get_workflow_job(job_id: str):
+    """查询生成任务状态"""
+    job = get_job_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
+
+
+@router.delete("/workflow/jobs/{job_id}")
+async def cancel_workflow_job(job_id: str):
+    """取消生成任务"""
+    manager = get_job_manager()
+    job = manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    cancelled = manager.cancel(job_id)
+    return {"job_id": job_id, "cancelled": cancelled, "status": job.status}
+
+
 # ========== 健康检查 ==========
 
 
@@ -175,5 +490,62 @@ async def health_check():
         "service": "UbD-PBL Course Architect V3",
         "endpoints": {
             "workflow_stream": "/api/v1/workflow/stream",
+            "workflow_jobs": "/api/v1/workflow/jobs",
+            "workflow_edit": "/api/v1/workflow/edit",
+            "batches": "/api/v1/batches",
+            "prompt_versions": "/api/v1/prompts",
+            "llm_pool": "/api/v1/llm/pool",
+            "llm_queue": "/api/v1/llm/queue",
+            "llm_cancellations": "/api/v1/llm/cancellations",
+            "llm_context": "/api/v1/llm/context",
+            "llm_prompt_cache": "/api/v1/llm/prompt-cache",
         },
     }
+
+
+@router.get("/prompts")
+async def list_prompts():
+    """
+    已加载的PHR提示词及其版本（name / version / checksum / chars）
+    """
+    return {"prompts": get_prompt_registry().list_prompts()}
+
+
+@router.get("/llm/pool")
+async def llm_pool_stats():
+    """
+    共享LLM连接池指标（连接数 / 空闲 / 排队请求等）
+    """
+    return get_llm_transport().pool_stats()
+
+
+@router.get("/llm/cancellations")
+async def llm_cancellation_stats():
+    """
+    客户端断开导致的提前取消指标（断开次数、取消的LLM流、估算节省的输出token）
+    """
+    return get_cancellation_stats().stats()
+
+
+@router.get("/llm/context")
+async def llm_context_stats():
+    """
+    对话上下文组装指标（各部分平均token、裁剪/摘要次数）
+    """
+    return get_context_stats().stats()
+
+
+@router.get("/llm/prompt-cache")
+async def llm_prompt_cache_stats():
+    """
+    服务端提示词前缀缓存命中指标（各模型的提示词token与缓存命中token）
+    """
+    return get_prompt_cache_stats().stats()
+
+
+@router.get("/llm/queue")
+async def llm_queue_stats():
+    """
+    LLM准入控制指标（各模型的并发占用、排队数、拒绝数）
+    """
+    return get_admission_controller().stats()
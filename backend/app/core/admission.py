@@ -0,0 +1,334 @@
+"""
+LLM调用准入控制 - 按模型限流 + 跨课程公平排队
+
+突发的工作流请求会同时打开大量上游连接，触发供应商限流后所有流一起失败。
+这里在LLM调用前加一层准入控制：
+- 每个模型一个并发上限（相当于按模型的信号量）
+- 等待者按优先级分道：对话（interactive）优先于批量生成（bulk），
+  并为对话保留若干并发槽位
+- 同一优先级内按课程（tenant）加权轮转，单个课程的多个请求不会饿死其他课程
+- 队列已满时立即抛出 QueueFullError，由API层返回429
+- 等待中的调用方可以持续获得自己的排队位置，用于发送queued SSE事件
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Deque, Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0  # 对话
+PRIORITY_BULK = 1  # 批量生成
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+
+
+class QueueFullError(Exception):
+    """模型等待队列已满"""
+
+    def __init__(self, model: str, queue_size: int):
+        self.model = model
+        self.queue_size = queue_size
+        super().__init__(f"LLM queue for {model} is full ({queue_size} waiting)")
+
+
+class AdmissionTicket:
+    """
+    一次LLM调用的准入凭证
+
+    通过 wait() 等待获得槽位（期间产出排队位置），使用完毕后必须调用 release()。
+    """
+
+    def __init__(self, lane: "_ModelLane", tenant: str, priority: int, weight: int):
+        self.lane = lane
+        self.tenant = tenant
+        self.priority = priority
+        self.weight = weight
+        self.admitted = False
+        self.released = False
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self._signal = asyncio.Event()
+
+    @property
+    def model(self) -> str:
+        return self.lane.model
+
+    @property
+    def position(self) -> int:
+        """当前排队位置（1表示下一个获得槽位），已获得槽位时为0"""
+        if self.admitted:
+            return 0
+        return self.lane.position_of(self)
+
+    @property
+    def wait_seconds(self) -> float:
+        """从入队到获得槽位的时间（仍在排队时为至今的等待时间）"""
+        end = self.admitted_at if self.admitted_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+    async def wait(self) -> AsyncGenerator[int, None]:
+        """
+        等待获得槽位
+
+        Yields:
+            排队位置（仅在位置变化时产出）；直接获得槽位时不产出任何值
+        """
+        last_position = None
+        while not self.admitted:
+            self._signal.clear()
+            position = self.position
+            if position != last_position:
+                last_position = position
+                yield position
+            if not self.admitted:
+                await self._signal.wait()
+
+    def release(self) -> None:
+        """释放槽位；仍在排队时从队列中移除（幂等）"""
+        if self.released:
+            return
+        self.released = True
+        self.lane.release(self)
+
+    def _notify(self) -> None:
+        self._signal.set()
+
+
+class _ModelLane:
+    """单个模型的并发计数与等待队列"""
+
+    def __init__(self, model: str, limit: int, max_queue: int, reserved_interactive: int):
+        self.model = model
+        self.limit = limit
+        self.max_queue = max_queue
+        # 保留槽位不能超过总并发，且至少给批量生成留一个槽位
+        self.reserved_interactive = max(0, min(reserved_interactive, limit - 1))
+        self.active = 0
+        # priority -> OrderedDict[tenant -> deque[ticket]]，字典顺序即轮转顺序
+        self.waiting: Dict[int, "OrderedDict[str, Deque[AdmissionTicket]]"] = {
+            p: OrderedDict() for p in PRIORITIES
+        }
+        # 当前轮转中各tenant剩余的连续获得次数（加权轮转）
+        self._credits: Dict[str, int] = {}
+        self.admitted_total = 0
+        self.rejected_total = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for lanes in self.waiting.values() for q in lanes.values())
+
+    def _has_capacity(self, priority: int) -> bool:
+        if self.limit <= 0:
+            return True
+        if priority == PRIORITY_INTERACTIVE:
+            return self.active < self.limit
+        return self.active < self.limit - self.reserved_interactive
+
+    def enqueue(self, ticket: AdmissionTicket) -> None:
+        if self.max_queue > 0 and self.queued >= self.max_queue and not self._can_admit_now(ticket):
+            self.rejected_total += 1
+            raise QueueFullError(self.model, self.queued)
+
+        self.waiting[ticket.priority].setdefault(ticket.tenant, deque()).append(ticket)
+        self._dispatch()
+
+    def _can_admit_now(self, ticket: AdmissionTicket) -> bool:
+        ahead = any(self.waiting[p] for p in PRIORITIES if p <= ticket.priority)
+        return self._has_capacity(ticket.priority) and not ahead
+
+    def _dispatch_order(self, priority: int) -> List[AdmissionTicket]:
+        """模拟加权轮转，返回该优先级下等待者的获得顺序"""
+        tenants = [(tenant, deque(queue)) for tenant, queue in self.waiting[priority].items()]
+        credits = {tenant: self._credits.get(tenant, 0) for tenant, _ in tenants}
+        order = []
+        while tenants:
+            tenant, queue = tenants[0]
+            if credits[tenant] <= 0:
+                credits[tenant] = queue[0].weight
+            order.append(queue.popleft())
+            credits[tenant] -= 1
+            if not queue:
+                tenants.pop(0)
+            elif credits[tenant] <= 0:
+                tenants.append(tenants.pop(0))
+        return order
+
+    def position_of(self, ticket: AdmissionTicket) -> int:
+        position = 0
+        for priority in PRIORITIES:
+            order = self._dispatch_order(priority)
+            if priority == ticket.priority:
+                return position + order.index(ticket) + 1
+            position += len(order)
+        return position
+
+    def _pop_next(self, priority: int) -> AdmissionTicket:
+        lanes = self.waiting[priority]
+        tenant, queue = next(iter(lanes.items()))
+        if self._credits.get(tenant, 0) <= 0:
+            self._credits[tenant] = queue[0].weight
+        ticket = queue.popleft()
+        self._credits[tenant] -= 1
+
+        if not queue:
+            del lanes[tenant]
+            self._credits.pop(tenant, None)
+        elif self._credits[tenant] <= 0:
+            lanes.move_to_end(tenant)
+        return ticket
+
+    def _dispatch(self) -> None:
+        changed = False
+        for priority in PRIORITIES:
+            while self.waiting[priority] and self._has_capacity(priority):
+                ticket = self._pop_next(priority)
+                ticket.admitted = True
+                ticket.admitted_at = time.monotonic()
+                self.active += 1
+                self.admitted_total += 1
+                ticket._notify()
+                changed = True
+            if self.waiting[priority]:
+                # 高优先级仍有等待者时，低优先级不能插队
+                break
+
+        if changed:
+            self._notify_waiting()
+
+    def _notify_waiting(self) -> None:
+        for lanes in self.waiting.values():
+            for queue in lanes.values():
+                for ticket in queue:
+                    ticket._notify()
+
+    def release(self, ticket: AdmissionTicket) -> None:
+        if ticket.admitted:
+            self.active -= 1
+        else:
+            queue = self.waiting[ticket.priority].get(ticket.tenant)
+            if queue and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self.waiting[ticket.priority][ticket.tenant]
+                    self._credits.pop(ticket.tenant, None)
+            self._notify_waiting()
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.queued,
+            "queued_interactive": sum(len(q) for q in self.waiting[PRIORITY_INTERACTIVE].values()),
+            "queued_bulk": sum(len(q) for q in self.waiting[PRIORITY_BULK].values()),
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+        }
+
+
+class AdmissionController:
+    """
+    LLM调用准入控制器
+
+    使用方式：
+        ticket = controller.enqueue(model, tenant="course:1", priority=PRIORITY_BULK)
+        try:
+            async for position in ticket.wait():
+                ...  # 向客户端发送排队位置
+            ...  # 调用LLM
+        finally:
+            ticket.release()
+    """
+
+    def __init__(
+        self,
+        default_limit: Optional[int] = None,
+        model_limits: Optional[Dict[str, int]] = None,
+        max_queue: Optional[int] = None,
+        reserved_interactive: Optional[int] = None,
+    ):
+        self.default_limit = default_limit if default_limit is not None else settings.llm_concurrency_per_model
+        self.model_limits = model_limits if model_limits is not None else dict(settings.llm_model_concurrency)
+        self.max_queue = max_queue if max_queue is not None else settings.llm_queue_max_size
+        self.reserved_interactive = (
+            reserved_interactive if reserved_interactive is not None else settings.llm_interactive_reserved_slots
+        )
+        self._lanes: Dict[str, _ModelLane] = {}
+
+    def _lane(self, model: str) -> _ModelLane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            lane = _ModelLane(
+                model,
+                limit=self.model_limits.get(model, self.default_limit),
+                max_queue=self.max_queue,
+                reserved_interactive=self.reserved_interactive,
+            )
+            self._lanes[model] = lane
+        return lane
+
+    def enqueue(
+        self, model: str, tenant: str = "default", priority: int = PRIORITY_BULK, weight: int = 1
+    ) -> AdmissionTicket:
+        """
+        申请槽位（有空闲槽位时立即获得）
+
+        Raises:
+            QueueFullError: 等待队列已满
+        """
+        lane = self._lane(model)
+        ticket = AdmissionTicket(lane, tenant=tenant, priority=priority, weight=max(1, weight))
+        lane.enqueue(ticket)
+        if not ticket.admitted:
+            logger.info(
+                f"[Admission] Queued {tenant} for {model} "
+                f"(priority={priority}, position={ticket.position}, active={lane.active}/{lane.limit})"
+            )
+        return ticket
+
+    def is_full(self, model: str, priority: int = PRIORITY_BULK) -> bool:
+        """该模型的等待队列是否已满（API层据此快速返回429）"""
+        lane = self._lane(model)
+        return (
+            lane.max_queue > 0
+            and lane.queued >= lane.max_queue
+            and not lane._has_capacity(priority)
+        )
+
+    @asynccontextmanager
+    async def slot(
+        self, model: str, tenant: str = "default", priority: int = PRIORITY_BULK
+    ) -> AsyncGenerator[AdmissionTicket, None]:
+        """等待并占用一个槽位（不关心排队位置的调用方使用）"""
+        ticket = self.enqueue(model, tenant=tenant, priority=priority)
+        try:
+            async for _ in ticket.wait():
+                pass
+            yield ticket
+        finally:
+            ticket.release()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {model: lane.stats() for model, lane in self._lanes.items()}
+
+
+@asynccontextmanager
+async def no_admission() -> AsyncGenerator[None, None]:
+    """不经准入控制直接调用LLM（未提供 admit 的调用方使用）"""
+    yield None
+
+
+# 全局单例
+_admission_controller = None
+
+
+def get_admission_controller() -> AdmissionController:
+    """获取准入控制器单例"""
+    global _admission_controller
+    if _admission_controller is None:
+        _admission_controller = AdmissionController()
+    return _admission_controller
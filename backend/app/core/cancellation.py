@@ -0,0 +1,179 @@
+"""
+流式生成的断开检测与提前取消
+
+浏览器关闭或刷新后，SSE生成器不应继续从LLM拉取token：
+- stream_until_disconnect 包装SSE生成器，轮询客户端连接，断开后逐层关闭生成器链
+- 各层生成器在关闭时主动关闭上游HTTP流，释放连接与准入槽位
+- CancellationStats 记录提前取消次数及估算节省的输出token
+"""
+import asyncio
+import logging
+import re
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# 中日韩字符大致按1字符≈1 token估算，其余按4字符≈1 token
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数（无需分词器）"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+@asynccontextmanager
+async def aclosing(agen):
+    """退出时关闭异步生成器（Python 3.9 没有 contextlib.aclosing）"""
+    try:
+        yield agen
+    finally:
+        await agen.aclose()
+
+
+async def close_upstream(stream: Any) -> None:
+    """关闭OpenAI流式响应底层的HTTP响应，使连接立即归还连接池"""
+    response = getattr(stream, "response", None)
+    if response is None:
+        return
+    try:
+        await response.aclose()
+    except Exception as e:
+        logger.debug(f"[Cancellation] Failed to close upstream response: {e}")
+
+
+class CancellationStats:
+    """
+    提前取消指标
+
+    节省的token按"该模型完整输出的平均token数 - 取消前已输出token数"估算；
+    尚无完整输出样本时使用本次请求的 max_tokens 作为上限估计。
+    """
+
+    # 完整输出token数的指数滑动平均系数
+    EMA_ALPHA = 0.2
+
+    def __init__(self):
+        self.client_disconnects: Dict[str, int] = {}
+        self._models: Dict[str, Dict[str, float]] = {}
+
+    def _model(self, model: str) -> Dict[str, float]:
+        return self._models.setdefault(model, {
+            "completed_streams": 0,
+            "avg_completed_tokens": 0.0,
+            "cancelled_streams": 0,
+            "tokens_before_cancel": 0,
+            "tokens_saved_estimate": 0,
+        })
+
+    def record_completed(self, model: str, tokens: int) -> None:
+        stats = self._model(model)
+        if stats["completed_streams"] == 0:
+            stats["avg_completed_tokens"] = float(tokens)
+        else:
+            stats["avg_completed_tokens"] += self.EMA_ALPHA * (tokens - stats["avg_completed_tokens"])
+        stats["completed_streams"] += 1
+
+    def record_cancelled(self, model: str, tokens: int, max_tokens: Optional[int] = None) -> int:
+        """记录一次提前取消，返回估算节省的token数"""
+        stats = self._model(model)
+        expected = stats["avg_completed_tokens"] if stats["completed_streams"] else (max_tokens or 0)
+        saved = max(0, int(expected) - tokens)
+        stats["cancelled_streams"] += 1
+        stats["tokens_before_cancel"] += tokens
+        stats["tokens_saved_estimate"] += saved
+        return saved
+
+    def record_disconnect(self, route: str) -> None:
+        self.client_disconnects[route] = self.client_disconnects.get(route, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        models = {
+            model: {**values, "avg_completed_tokens": round(values["avg_completed_tokens"], 1)}
+            for model, values in self._models.items()
+        }
+        return {
+            "client_disconnects": dict(self.client_disconnects),
+            "cancelled_streams_total": sum(m["cancelled_streams"] for m in models.values()),
+            "tokens_saved_estimate_total": sum(m["tokens_saved_estimate"] for m in models.values()),
+            "models": models,
+        }
+
+
+async def stream_until_disconnect(
+    request,
+    chunks: AsyncIterator[str],
+    route: str = "sse",
+    poll_interval: Optional[float] = None,
+) -> AsyncGenerator[str, None]:
+    """
+    转发SSE生成器，客户端断开后立即停止并关闭上游生成器
+
+    即使上游长时间没有输出（排队等待槽位、等待首个token），也会按 poll_interval
+    检查连接状态，而不是等到下一次写入失败才发现断开。
+
+    Args:
+        request: Starlette Request
+        chunks: SSE字符串异步迭代器
+        route: 指标中的路由标识
+        poll_interval: 检查间隔（秒），默认使用 sse_disconnect_poll_interval_seconds
+    """
+    interval = settings.sse_disconnect_poll_interval_seconds if poll_interval is None else poll_interval
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    pending = None
+    next_check = loop.time() + interval
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+
+            done, _ = await asyncio.wait({pending}, timeout=max(0.0, next_check - loop.time()))
+
+            # 上游持续输出时也按间隔检查，避免每个事件都读取一次连接状态
+            if loop.time() >= next_check:
+                next_check = loop.time() + interval
+                if await request.is_disconnected():
+                    logger.info(f"[Cancellation] Client disconnected from {route}, cancelling generation")
+                    get_cancellation_stats().record_disconnect(route)
+                    return
+
+            if not done:
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+
+    finally:
+        if pending is not None:
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, Exception):
+                pass
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+# 全局单例
+_cancellation_stats = None
+
+
+def get_cancellation_stats() -> CancellationStats:
+    """获取提前取消指标单例"""
+    global _cancellation_stats
+    if _cancellation_stats is None:
+        _cancellation_stats = CancellationStats()
+    return _cancellation_stats
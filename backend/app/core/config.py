@@ -1,7 +1,7 @@
 """
 应用配置管理
 """
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
@@ -23,6 +23,31 @@ class Settings(BaseSettings):
     agent2_model: Optional[str] = None
     agent3_model: Optional[str] = None
 
+    # LLM连接池配置（所有客户端共享一个httpx连接池）
+    llm_max_connections: int = 100
+    llm_max_keepalive_connections: int = 20
+    llm_keepalive_expiry_seconds: float = 30.0
+    llm_http2: bool = True  # 需要安装h2，未安装时回退到HTTP/1.1
+    llm_request_timeout_seconds: float = 600.0
+    llm_connect_timeout_seconds: float = 5.0
+    llm_pool_timeout_seconds: float = 10.0  # 等待空闲连接的最长时间
+
+    # LLM准入控制（按模型限流 + 公平排队）
+    llm_concurrency_per_model: int = 8  # 每个模型同时进行的上游调用数，<=0不限制
+    llm_model_concurrency: Dict[str, int] = {}  # 按模型覆盖并发上限，如 {"gpt-4o": 4}
+    llm_queue_max_size: int = 50  # 每个模型的最大等待数，超过时返回429，<=0不限制
+    llm_interactive_reserved_slots: int = 1  # 为对话保留的并发槽位
+    llm_queue_retry_after_seconds: int = 10  # 429响应的Retry-After
+
+    # LLM重试配置（429/5xx/连接中断，指数退避 + 抖动）
+    llm_retry_max_retries: int = 3  # 每个阶段的重试预算
+    llm_retry_base_delay_seconds: float = 0.5
+    llm_retry_max_delay_seconds: float = 8.0
+    llm_stream_continuation: bool = True  # 中途断流时基于已输出内容续写，而不是从头失败
+    agent1_max_retries: Optional[int] = None  # 如果不指定，使用llm_retry_max_retries
+    agent2_max_retries: Optional[int] = None
+    agent3_max_retries: Optional[int] = None
+
     # 服务器配置
     host: str = "localhost"
     port: int = 48097
@@ -30,6 +55,10 @@ class Settings(BaseSettings):
 
     # 数据库配置
     database_url: str = "sqlite:///./app.db"
+    db_pool_size: int = 5  # 数据库连接池大小（同步引擎；异步引擎仅PostgreSQL使用连接池）
+    db_max_overflow: int = 10  # 连接池满时允许额外创建的连接数
+    db_pool_timeout_seconds: float = 30.0  # 等待空闲连接的超时时间
+    db_pool_recycle_seconds: int = 1800  # 连接最长复用时间，避免数据库端断开的陈旧连接
 
     # CORS配置
     cors_origins: List[str] = [
@@ -45,6 +74,54 @@ class Settings(BaseSettings):
     agent2_timeout: int = 25  # Agent2超时时间
     agent3_timeout: int = 40  # Agent3超时时间
 
+    # 流式输出配置
+    stream_snapshot_interval: int = 50  # delta模式下每N个progress事件发送一次完整快照
+    stream_flush_interval_ms: int = 50  # LLM增量合并：最长缓冲时间（毫秒），<=0禁用
+    stream_flush_bytes: int = 512  # LLM增量合并：缓冲达到该字节数立即刷新，<=0禁用
+    sse_disconnect_poll_interval_seconds: float = 1.0  # SSE客户端断开检测间隔，断开后取消上游LLM生成
+    llm_stream_include_usage: bool = True  # 流式请求附带 stream_options.include_usage，记录前缀缓存命中token
+
+    # 链路追踪配置（OpenTelemetry，响应头 X-Trace-Id 与 start 事件携带trace_id）
+    tracing_enabled: bool = True
+    tracing_exporter: str = "none"  # none/file/console/otlp；otlp需要安装 opentelemetry-exporter-otlp-proto-http
+    tracing_file_path: str = "./traces.jsonl"  # file导出：每行一个span的JSON
+    tracing_otlp_endpoint: str = "http://localhost:4318/v1/traces"  # OTLP/HTTP collector地址
+    tracing_sample_ratio: float = 1.0  # 采样比例（按trace），未采样的请求仍返回trace_id
+    tracing_sse_spans: bool = True  # 为每次SSE写出创建span
+    tracing_db_statement_max_chars: int = 500  # 数据库span中SQL语句的截断长度
+
+    # 生成结果缓存配置
+    generation_cache_enabled: bool = True
+    generation_cache_max_entries: int = 500  # LRU上限，<=0不限制
+    generation_cache_ttl_seconds: int = 7 * 24 * 3600  # 过期时间，<=0不过期
+
+    # 提示词注册表配置
+    prompt_reload_interval_seconds: float = 2.0  # PHR文件mtime轮询间隔（秒），<=0禁用热重载
+
+    # 生成任务配置（断线重连）
+    job_event_log_max_events: int = 2000  # 每个任务在内存中保留的事件数
+    job_event_spill_enabled: bool = False  # 超出内存上限的事件写入SQLite，支持更早的Last-Event-ID回放
+    job_orphan_grace_seconds: float = 30.0  # 所有订阅者断开后等待重连的时间，超时取消任务
+    job_retention_seconds: int = 900  # 任务结束后保留事件日志的时间
+
+    # 批量生成配置
+    batch_default_concurrency: int = 2  # 批量任务默认同时生成的课程数
+    batch_max_concurrency: int = 8  # 单个批量任务允许的最大并发
+    batch_max_courses: int = 200  # 单个批量任务的课程数上限
+    batch_resume_on_startup: bool = True  # 启动时续跑中断的批量任务（跳过已完成的课程）
+
+    # 对话上下文预算配置
+    chat_context_max_tokens: int = 6000  # 系统提示词+历史+当前消息的token预算
+    chat_context_history_tokens: int = 1500  # 原文保留的近期对话token上限
+    chat_context_history_messages: int = 20  # 原文保留的近期对话条数上限
+    chat_context_summary_tokens: int = 300  # 更早对话摘要的token上限
+    chat_context_full_stage_tokens: int = 500  # 非当前阶段不超过该token数时整体保留，不按章节筛选
+
+    # 语义验证配置（ValidationService，需要安装 sentence-transformers）
+    validation_model_name: str = "paraphrase-multilingual-MiniLM-L12-v2"
+    validation_embedding_cache_dir: str = "./.cache/embeddings"  # 参考示例向量的磁盘缓存，空字符串禁用
+    validation_warmup_on_startup: bool = True  # 启动时在后台加载模型并预计算参考向量
+
     # 系统行为配置
     use_chinese_response: bool = True  # 默认使用中文回答
 
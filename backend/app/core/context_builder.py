@@ -0,0 +1,389 @@
+"""
+对话上下文组装（按token预算）
+
+CourseChatAgent 原先每轮都把三个阶段的完整Markdown和最近20条历史拼进提示词，
+课程越长提示词越大。ChatContextBuilder 在本地计算token并按预算填充：
+- 当前步骤对应的阶段优先，放不下时按章节取舍
+- 其余阶段只保留与用户问题相关的章节（按标题切分），其余仅列出标题
+- 近期对话原文保留，更早的对话压缩为摘要
+每次组装的预算分配写入日志，并汇总到 ContextStats。
+"""
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.core.cancellation import estimate_tokens
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+_HEADING_PATTERN = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+_WORD_PATTERN = re.compile(r"[a-zA-Z0-9]+|[\u4e00-\u9fff]+")
+
+# 摘要中每条历史消息保留的字符数
+_SUMMARY_SNIPPET_CHARS = 60
+# 省略章节提示中最多列出的标题数
+_MAX_OMITTED_HEADINGS = 8
+
+_encoding = None
+_encoding_loaded = False
+
+
+def count_tokens(text: str) -> int:
+    """
+    本地计算token数
+
+    安装了 tiktoken 时使用 cl100k_base 编码，否则退回字符数估算。
+    """
+    global _encoding, _encoding_loaded
+    if not text:
+        return 0
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.info(f"[ContextBuilder] tiktoken unavailable ({e}), falling back to estimated token counts")
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return estimate_tokens(text)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """截断文本使其不超过 max_tokens（二分查找字符长度）"""
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid] + "…") <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "…" if low else ""
+
+
+@dataclass
+class MarkdownSection:
+    """按标题切分的Markdown章节"""
+
+    heading: str
+    text: str
+    index: int
+    tokens: int = 0
+
+
+def split_sections(markdown: str) -> List[MarkdownSection]:
+    """按标题行切分Markdown，标题之前的内容作为无标题章节"""
+    sections: List[MarkdownSection] = []
+    heading, lines = "", []
+
+    def flush():
+        text = "\n".join(lines).strip()
+        if text:
+            sections.append(MarkdownSection(heading=heading, text=text, index=len(sections)))
+
+    in_code = False
+    for line in markdown.splitlines():
+        if line.lstrip().startswith("```"):
+            in_code = not in_code
+        match = None if in_code else _HEADING_PATTERN.match(line)
+        if match:
+            flush()
+            heading, lines = match.group(2), [line]
+        else:
+            lines.append(line)
+    flush()
+    return sections
+
+
+def _terms(text: str) -> set:
+    """提取检索词：英文单词/数字整体，中文按相邻两字切分"""
+    terms = set()
+    for word in _WORD_PATTERN.findall(text.lower()):
+        if word.isascii():
+            if len(word) > 1:
+                terms.add(word)
+        elif len(word) == 1:
+            terms.add(word)
+        else:
+            terms.update(word[i:i + 2] for i in range(len(word) - 1))
+    return terms
+
+
+def relevance(query_terms: set, section: MarkdownSection) -> int:
+    """章节与问题的相关度：命中的检索词数，标题命中加倍"""
+    if not query_terms:
+        return 0
+    heading_terms = _terms(section.heading)
+    body_terms = _terms(section.text)
+    return len(query_terms & body_terms) + len(query_terms & heading_terms)
+
+
+@dataclass
+class ChatContext:
+    """组装结果：裁剪后的阶段Markdown、保留的历史与预算明细"""
+
+    stages: Dict[int, Optional[str]]
+    history: List[Dict[str, str]]
+    history_summary: Optional[str]
+    breakdown: Dict[str, int] = field(default_factory=dict)
+    # 只保留了部分章节的阶段（内容随问题变化，不应放入可缓存的提示词前缀）
+    partial_stages: Set[int] = field(default_factory=set)
+
+
+class ChatContextBuilder:
+    """
+    按token预算组装对话上下文
+
+    分配顺序：固定部分（基础提示词、当前消息）→ 近期历史 → 更早历史摘要 →
+    当前阶段 → 其余阶段的相关章节。
+    """
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        history_tokens: Optional[int] = None,
+        history_messages: Optional[int] = None,
+        summary_tokens: Optional[int] = None,
+        full_stage_tokens: Optional[int] = None,
+    ):
+        self.max_tokens = settings.chat_context_max_tokens if max_tokens is None else max_tokens
+        self.history_tokens = settings.chat_context_history_tokens if history_tokens is None else history_tokens
+        self.history_messages = (
+            settings.chat_context_history_messages if history_messages is None else history_messages
+        )
+        self.summary_tokens = settings.chat_context_summary_tokens if summary_tokens is None else summary_tokens
+        self.full_stage_tokens = (
+            settings.chat_context_full_stage_tokens if full_stage_tokens is None else full_stage_tokens
+        )
+
+    def build(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        current_step: int,
+        stages: Dict[int, Optional[str]],
+        base_tokens: int = 0,
+    ) -> ChatContext:
+        """
+        组装上下文
+
+        Args:
+            user_message: 当前用户消息
+            conversation_history: 历史对话（不包含当前消息）
+            current_step: 当前步骤（1-3）
+            stages: {阶段编号: Markdown}
+            base_tokens: 不含阶段数据的系统提示词token数
+        """
+        user_tokens = count_tokens(user_message)
+        remaining = max(0, self.max_tokens - base_tokens - user_tokens)
+        breakdown = {"budget": self.max_tokens, "base": base_tokens, "user_message": user_tokens}
+
+        history, history_used, older = self._recent_history(conversation_history, remaining)
+        remaining -= history_used
+        summary = self._summarize(older, min(self.summary_tokens, remaining))
+        summary_used = count_tokens(summary) if summary else 0
+        remaining -= summary_used
+
+        query_terms = _terms(user_message)
+        trimmed: Dict[int, Optional[str]] = {}
+        dropped = 0
+
+        current = stages.get(current_step)
+        current_used = 0
+        if current:
+            trimmed[current_step], current_used, omitted = self._fit_stage(
+                current, remaining, query_terms, relevant_only=False
+            )
+            dropped += omitted
+            remaining -= current_used
+
+        other_used = 0
+        for step in sorted(stages, key=lambda s: (abs(s - current_step), s)):
+            markdown = stages[step]
+            if step == current_step or not markdown:
+                continue
+            trimmed[step], used, omitted = self._fit_stage(markdown, remaining, query_terms, relevant_only=True)
+            dropped += omitted
+            other_used += used
+            remaining -= used
+
+        breakdown.update({
+            "current_stage": current_used,
+            "other_stages": other_used,
+            "history": history_used,
+            "history_summary": summary_used,
+            "dropped_sections": dropped,
+            "summarized_messages": len(older),
+        })
+        breakdown["total"] = base_tokens + user_tokens + history_used + summary_used + current_used + other_used
+
+        context = ChatContext(
+            stages={step: trimmed.get(step) for step in stages},
+            history=history,
+            history_summary=summary,
+            breakdown=breakdown,
+            partial_stages={step for step, text in trimmed.items() if text and text != stages[step]},
+        )
+        get_context_stats().record(breakdown)
+        logger.info(f"[ContextBuilder] step={current_step} breakdown={breakdown}")
+        return context
+
+    def _recent_history(
+        self, conversation_history: List[Dict[str, str]], budget: int
+    ) -> Tuple[List[Dict[str, str]], int, List[Dict[str, str]]]:
+        """从最新一条往前保留原文，返回（保留的历史, 已用token, 更早的历史）"""
+        messages = [m for m in conversation_history if m.get("role") in ("user", "assistant")]
+        budget = min(budget, self.history_tokens)
+        kept: List[Dict[str, str]] = []
+        used = 0
+        for message in reversed(messages):
+            if len(kept) >= self.history_messages:
+                break
+            tokens = count_tokens(message["content"])
+            if used + tokens > budget:
+                break
+            kept.append({"role": message["role"], "content": message["content"]})
+            used += tokens
+        kept.reverse()
+        return kept, used, messages[:len(messages) - len(kept)]
+
+    def _summarize(self, messages: List[Dict[str, str]], budget: int) -> Optional[str]:
+        """把更早的对话压缩为逐条摘录，超出预算时优先保留较新的摘录"""
+        if not messages or budget <= 0:
+            return None
+        lines = []
+        for message in messages:
+            speaker = "用户" if message["role"] == "user" else "助手"
+            content = " ".join(message["content"].split())
+            if len(content) > _SUMMARY_SNIPPET_CHARS:
+                content = content[:_SUMMARY_SNIPPET_CHARS] + "…"
+            lines.append(f"- {speaker}：{content}")
+
+        kept: List[str] = []
+        used = 0
+        for line in reversed(lines):
+            tokens = count_tokens(line) + 1
+            if used + tokens > budget:
+                break
+            kept.append(line)
+            used += tokens
+        if not kept:
+            return None
+        kept.reverse()
+        skipped = len(lines) - len(kept)
+        if skipped:
+            note = f"- （更早的{skipped}条对话已省略）"
+            if used + count_tokens(note) + 1 <= budget:
+                kept.insert(0, note)
+        return "\n".join(kept)
+
+    def _fit_stage(
+        self, markdown: str, budget: int, query_terms: set, relevant_only: bool
+    ) -> Tuple[Optional[str], int, int]:
+        """
+        在预算内选取阶段内容，返回（文本, 已用token, 省略的章节数）
+
+        当前阶段能放下就原样保留；否则与其余阶段一样按相关度选章节。
+        其余阶段较短（不超过 full_stage_tokens）时整体保留，否则只保留相关度大于0的章节。
+        """
+        if budget <= 0:
+            return None, 0, len(split_sections(markdown))
+        tokens = count_tokens(markdown)
+        if tokens <= budget and (not relevant_only or tokens <= self.full_stage_tokens):
+            return markdown, tokens, 0
+
+        sections = split_sections(markdown)
+        scored = []
+        for section in sections:
+            score = relevance(query_terms, section)
+            if relevant_only and score == 0:
+                continue
+            section.tokens = count_tokens(section.text)
+            scored.append((score, section))
+        scored.sort(key=lambda item: (-item[0], item[1].index))
+
+        chosen: List[MarkdownSection] = []
+        used = 0
+        for _, section in scored:
+            if used + section.tokens <= budget:
+                chosen.append(section)
+                used += section.tokens
+            elif not relevant_only and not chosen:
+                # 当前阶段至少保留最相关章节的开头
+                section.text = truncate_to_tokens(section.text, budget)
+                section.tokens = count_tokens(section.text)
+                if section.text:
+                    chosen.append(section)
+                    used += section.tokens
+
+        chosen.sort(key=lambda s: s.index)
+        chosen_ids = {s.index for s in chosen}
+        omitted = [s.heading for s in sections if s.index not in chosen_ids and s.heading]
+        text = "\n\n".join(s.text for s in chosen)
+
+        if omitted:
+            listed = "、".join(omitted[:_MAX_OMITTED_HEADINGS])
+            if len(omitted) > _MAX_OMITTED_HEADINGS:
+                listed += f" 等{len(omitted)}节"
+            note = f"（以下章节与当前问题关系不大，已省略：{listed}）"
+            note_tokens = count_tokens(note)
+            if used + note_tokens <= budget:
+                text = f"{text}\n\n{note}" if text else note
+                used += note_tokens
+
+        dropped = len(sections) - len(chosen)
+        return (text or None), used, dropped
+
+
+class ContextStats:
+    """上下文组装指标：累计各部分token及裁剪次数"""
+
+    PARTS = ("base", "user_message", "current_stage", "other_stages", "history", "history_summary", "total")
+
+    def __init__(self):
+        self.builds = 0
+        self.trimmed_builds = 0
+        self.summarized_builds = 0
+        self.max_total = 0
+        self.tokens: Dict[str, int] = {part: 0 for part in self.PARTS}
+
+    def record(self, breakdown: Dict[str, int]) -> None:
+        self.builds += 1
+        if breakdown.get("dropped_sections"):
+            self.trimmed_builds += 1
+        if breakdown.get("summarized_messages"):
+            self.summarized_builds += 1
+        self.max_total = max(self.max_total, breakdown.get("total", 0))
+        for part in self.PARTS:
+            self.tokens[part] += breakdown.get(part, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "builds": self.builds,
+            "trimmed_builds": self.trimmed_builds,
+            "summarized_builds": self.summarized_builds,
+            "max_total_tokens": self.max_total,
+            "avg_tokens": {
+                part: round(total / self.builds, 1) if self.builds else 0.0
+                for part, total in self.tokens.items()
+            },
+        }
+
+
+# 全局单例
+_context_stats = None
+
+
+def get_context_stats() -> ContextStats:
+    """获取上下文组装指标单例"""
+    global _context_stats
+    if _context_stats is None:
+        _context_stats = ContextStats()
+    return _context_stats
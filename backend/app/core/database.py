@@ -2,19 +2,63 @@
 数据库配置和会话管理
 """
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from typing import AsyncGenerator, Optional
+import asyncio
 import os
 
+from app.core.config import settings
+from app.core.tracing import instrument_engine
+
 # 从环境变量获取数据库URL，默认使用SQLite
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./app.db")
 
+# 同步驱动 -> 异步驱动（本地SQLite使用aiosqlite，PostgreSQL使用asyncpg）
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    """把同步数据库URL转换为对应的异步驱动URL"""
+    scheme, sep, rest = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}{sep}{rest}"
+
+
+def _is_memory_sqlite(url: str) -> bool:
+    return url.startswith("sqlite") and (":memory:" in url or url.split("://", 1)[-1] in ("", "/"))
+
+
+def _pool_options(url: str) -> dict:
+    """连接池参数（来自Settings）；内存SQLite只有一个连接，不使用连接池参数"""
+    if _is_memory_sqlite(url):
+        return {}
+    return {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout_seconds,
+        "pool_recycle": settings.db_pool_recycle_seconds,
+        "pool_pre_ping": True,
+    }
+
+
+# 异步引擎URL，可通过 ASYNC_DATABASE_URL 单独指定
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+
 # 创建数据库引擎
 engine = create_engine(
     DATABASE_URL,
     connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {},
-    echo=False  # 生产环境设为False
+    echo=False,  # 生产环境设为False
+    **_pool_options(DATABASE_URL),
 )
+instrument_engine(engine)
 
 # 创建SessionLocal类
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -40,3 +84,63 @@ def init_db():
     初始化数据库表
     """
     Base.metadata.create_all(bind=engine)
+
+
+# ========== 异步引擎（async def 端点使用，避免阻塞事件循环） ==========
+
+_async_engine = None
+_async_engine_loop = None
+_async_session_factory: Optional[async_sessionmaker] = None
+
+
+def get_async_engine():
+    """
+    获取异步数据库引擎（首次使用时创建）
+
+    异步连接绑定创建它的事件循环；事件循环变化时（如测试中多个TestClient）
+    丢弃旧连接池并重新创建引擎。
+    """
+    global _async_engine, _async_engine_loop, _async_session_factory
+    loop = asyncio.get_running_loop()
+    if _async_engine is not None and _async_engine_loop is not loop:
+        _async_engine.sync_engine.dispose(close=False)
+        _async_engine = None
+        _async_session_factory = None
+    if _async_engine is None:
+        # aiosqlite每个连接占用一个后台线程，SQLite沿用SQLAlchemy默认的NullPool（用完即关），
+        # 连接池参数只作用于PostgreSQL等服务端数据库
+        options = {} if ASYNC_DATABASE_URL.startswith("sqlite") else _pool_options(ASYNC_DATABASE_URL)
+        _async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=False, **options)
+        instrument_engine(_async_engine)
+        _async_engine_loop = loop
+    return _async_engine
+
+
+def get_async_session_factory() -> async_sessionmaker:
+    """获取异步会话工厂"""
+    global _async_session_factory
+    engine = get_async_engine()
+    if _async_session_factory is None:
+        # expire_on_commit=False：提交后仍可读取属性，避免在异步上下文中触发隐式懒加载
+        _async_session_factory = async_sessionmaker(
+            bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+        )
+    return _async_session_factory
+
+
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    """
+    获取异步数据库会话的依赖函数
+    用于FastAPI的Depends注入
+    """
+    async with get_async_session_factory()() as db:
+        yield db
+
+
+async def dispose_async_engine() -> None:
+    """关闭异步引擎的连接池"""
+    global _async_engine, _async_session_factory
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+        _async_session_factory = None
@@ -0,0 +1,241 @@
+"""
+Agent生成结果缓存 - 内容寻址 + LRU + TTL
+
+教师经常用相同的课程信息反复生成，命中缓存时直接回放已生成的Markdown，
+避免再次调用LLM。缓存持久化在应用数据库的 generation_cache 表中（由启动迁移创建）。
+Agent的异步流通过 get_async / set_async 在线程池中读写，不阻塞事件循环。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, AsyncGenerator, Callable, Dict, Optional
+
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.generation_cache import GenerationCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# 回放缓存时每个progress事件携带的字符数
+REPLAY_CHUNK_SIZE = 512
+
+
+class GenerationCache:
+    """
+    生成结果缓存
+
+    - 键：agent + model + phr_version + 渲染后的user prompt + temperature 的SHA-256
+    - 淘汰：超过 max_entries 时按 last_accessed_at 淘汰最久未使用的条目
+    - 过期：created_at 早于 ttl_seconds 的条目视为未命中并删除
+
+    缓存读写失败只记录日志，不影响生成流程。
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable = SessionLocal,
+        max_entries: Optional[int] = None,
+        ttl_seconds: Optional[int] = None,
+        enabled: Optional[bool] = None,
+    ):
+        self.session_factory = session_factory
+        self.max_entries = max_entries if max_entries is not None else settings.generation_cache_max_entries
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else settings.generation_cache_ttl_seconds
+        self.enabled = enabled if enabled is not None else settings.generation_cache_enabled
+
+    @staticmethod
+    def make_key(
+        agent: str,
+        model: str,
+        phr_version: str,
+        user_prompt: str,
+        temperature: float,
+    ) -> str:
+        """
+        计算内容寻址的缓存键
+        """
+        payload = json.dumps(
+            {
+                "agent": agent,
+                "model": model,
+                "phr_version": phr_version,
+                "user_prompt": user_prompt,
+                "temperature": temperature,
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, entry: GenerationCacheEntry, now: datetime) -> bool:
+        return self.ttl_seconds > 0 and entry.created_at < now - timedelta(seconds=self.ttl_seconds)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        读取缓存
+
+        Returns:
+            命中时返回Markdown内容，否则返回None
+        """
+        if not self.enabled:
+            return None
+
+        db = self.session_factory()
+        try:
+            entry = db.get(GenerationCacheEntry, key)
+            if entry is None:
+                return None
+
+            now = datetime.utcnow()
+            if self._is_expired(entry, now):
+                db.delete(entry)
+                db.commit()
+                logger.info(f"[GenerationCache] Expired entry removed: {key[:12]}")
+                return None
+
+            entry.hit_count += 1
+            entry.last_accessed_at = now
+            content = entry.content
+            db.commit()
+
+            logger.info(f"[GenerationCache] Hit {entry.agent}: {key[:12]} (hits: {entry.hit_count})")
+            return content
+
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"[GenerationCache] Read failed: {e}")
+            return None
+        finally:
+            db.close()
+
+    def set(
+        self,
+        key: str,
+        content: str,
+        agent: str,
+        model: str = None,
+        phr_version: str = None,
+    ) -> None:
+        """
+        写入缓存并执行LRU淘汰
+        """
+        if not self.enabled or not content:
+            return
+
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            db.merge(
+                GenerationCacheEntry(
+                    cache_key=key,
+                    agent=agent,
+                    model=model,
+                    phr_version=phr_version,
+                    content=content,
+                    hit_count=0,
+                    created_at=now,
+                    last_accessed_at=now,
+                )
+            )
+            db.flush()
+            self._evict(db)
+            db.commit()
+            logger.info(f"[GenerationCache] Stored {agent}: {key[:12]} ({len(content)} chars)")
+
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"[GenerationCache] Write failed: {e}")
+        finally:
+            db.close()
+
+    async def get_async(self, key: str) -> Optional[str]:
+        """在线程池中读取缓存（命中时的访问计数提交同样不占用事件循环）"""
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self.get, key)
+
+    async def set_async(
+        self,
+        key: str,
+        content: str,
+        agent: str,
+        model: str = None,
+        phr_version: str = None,
+    ) -> None:
+        """在线程池中写入缓存并执行LRU淘汰"""
+        if not self.enabled or not content:
+            return
+        await asyncio.to_thread(self.set, key, content, agent, model, phr_version)
+
+    def _evict(self, db) -> None:
+        """删除过期条目，并按最近访问时间只保留 max_entries 条"""
+        if self.ttl_seconds > 0:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.ttl_seconds)
+            db.query(GenerationCacheEntry).filter(
+                GenerationCacheEntry.created_at < cutoff
+            ).delete(synchronize_session=False)
+
+        if self.max_entries > 0:
+            stale_keys = [
+                row.cache_key
+                for row in db.query(GenerationCacheEntry.cache_key)
+                .order_by(GenerationCacheEntry.last_accessed_at.desc())
+                .offset(self.max_entries)
+                .all()
+            ]
+            if stale_keys:
+                db.query(GenerationCacheEntry).filter(
+                    GenerationCacheEntry.cache_key.in_(stale_keys)
+                ).delete(synchronize_session=False)
+                logger.info(f"[GenerationCache] Evicted {len(stale_keys)} LRU entries")
+
+    def clear(self) -> None:
+        """清空缓存"""
+        db = self.session_factory()
+        try:
+            db.query(GenerationCacheEntry).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+
+async def replay_cached_markdown(
+    content: str, model: str, start_time: float
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    以Agent流式事件的格式回放缓存内容（不做人为延迟）
+
+    Yields:
+        与 generate_stream 相同结构的 progress / complete 事件，complete 事件带 cached=True
+    """
+    for end in range(REPLAY_CHUNK_SIZE, len(content) + REPLAY_CHUNK_SIZE, REPLAY_CHUNK_SIZE):
+        yield {
+            "type": "progress",
+            "content": content[:end],
+            "chunk": content[end - REPLAY_CHUNK_SIZE:end],
+            "progress": min(end / len(content), 0.99),
+        }
+
+    yield {
+        "type": "complete",
+        "content": content,
+        "progress": 1.0,
+        "generation_time": time.time() - start_time,
+        "model": model,
+        "cached": True,
+    }
+
+
+# 全局单例
+_generation_cache = None
+
+
+def get_generation_cache() -> GenerationCache:
+    """获取生成缓存单例"""
+    global _generation_cache
+    if _generation_cache is None:
+        _generation_cache = GenerationCache()
+    return _generation_cache
@@ -0,0 +1,177 @@
+"""
+LLM传输层 - 进程内共享的HTTP连接池
+
+OpenAIClient、OpenAIStreamingClient、AIService、CourseChatAgent 原先各自创建 AsyncOpenAI，
+每个实例都有独立的httpx连接池。这里统一维护一个 httpx.AsyncClient：
+- 显式的最大连接数 / keepalive 策略
+- 安装了 h2 时启用 HTTP/2（可选依赖：pip install h2）
+- 按 (api_key, base_url) 缓存 AsyncOpenAI 实例，全部复用同一个连接池
+- 按Agent路由模型（agent1_model / agent2_model / agent3_model）
+- 暴露连接池指标
+"""
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+# Agent标识 -> 模型配置项
+AGENT_MODEL_SETTINGS = {
+    "agent1": "agent1_model",
+    "agent2": "agent2_model",
+    "agent3": "agent3_model",
+}
+
+
+def resolve_model(agent: Optional[str] = None) -> str:
+    """
+    按Agent路由模型，未单独配置时使用 openai_model
+
+    Args:
+        agent: "agent1" / "agent2" / "agent3"，其他值或None使用默认模型
+    """
+    setting_name = AGENT_MODEL_SETTINGS.get(agent)
+    if setting_name:
+        return getattr(settings, setting_name) or settings.openai_model
+    return settings.openai_model
+
+
+class LLMTransport:
+    """共享的LLM HTTP传输层"""
+
+    def __init__(
+        self,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        http2: Optional[bool] = None,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections or settings.llm_max_connections,
+            max_keepalive_connections=(
+                max_keepalive_connections or settings.llm_max_keepalive_connections
+            ),
+            keepalive_expiry=(
+                keepalive_expiry if keepalive_expiry is not None else settings.llm_keepalive_expiry_seconds
+            ),
+        )
+        wants_http2 = http2 if http2 is not None else settings.llm_http2
+        self.http2 = wants_http2 and HTTP2_AVAILABLE
+        if wants_http2 and not HTTP2_AVAILABLE:
+            logger.info("[LLMTransport] h2 not installed, falling back to HTTP/1.1")
+
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._clients: Dict[Tuple[str, str, Optional[int]], AsyncOpenAI] = {}
+        self._requests_total = 0
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        self._requests_total += 1
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        """共享的httpx客户端（首次使用时创建）"""
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                limits=self.limits,
+                http2=self.http2,
+                timeout=httpx.Timeout(
+                    settings.llm_request_timeout_seconds,
+                    connect=settings.llm_connect_timeout_seconds,
+                    pool=settings.llm_pool_timeout_seconds,
+                ),
+                event_hooks={"request": [self._on_request]},
+            )
+            self._clients.clear()
+            logger.info(
+                f"[LLMTransport] Created shared pool (max_connections={self.limits.max_connections}, "
+                f"keepalive={self.limits.max_keepalive_connections}, http2={self.http2})"
+            )
+        return self._http_client
+
+    def get_client(
+        self,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        max_retries: Optional[int] = None,
+    ) -> AsyncOpenAI:
+        """
+        获取复用共享连接池的 AsyncOpenAI 实例
+
+        Args:
+            api_key: 默认使用 settings.openai_api_key
+            base_url: 默认使用 settings.openai_base_url
+            max_retries: SDK内置重试次数，None使用SDK默认值；自行控制重试的调用方传0
+        """
+        http_client = self.http_client
+        key = (api_key or settings.openai_api_key, base_url or settings.openai_base_url, max_retries)
+        client = self._clients.get(key)
+        if client is None:
+            kwargs = {"max_retries": max_retries} if max_retries is not None else {}
+            client = AsyncOpenAI(api_key=key[0], base_url=key[1], http_client=http_client, **kwargs)
+            self._clients[key] = client
+        return client
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """
+        连接池指标
+
+        Returns:
+            connections / active / idle / queued_requests / requests_total 等
+        """
+        stats = {
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "http2": self.http2,
+            "clients": len(self._clients),
+            "requests_total": self._requests_total,
+            "connections": 0,
+            "active": 0,
+            "idle": 0,
+            "queued_requests": 0,
+        }
+        if self._http_client is None or self._http_client.is_closed:
+            return stats
+
+        # httpx未公开连接池状态，这里读取httpcore连接池；结构变化时只返回基础指标
+        try:
+            pool = self._http_client._transport._pool
+            connections = [c for c in pool.connections if not c.is_closed()]
+            stats["connections"] = len(connections)
+            stats["idle"] = sum(1 for c in connections if c.is_idle())
+            stats["active"] = stats["connections"] - stats["idle"]
+            stats["queued_requests"] = sum(1 for r in pool._requests if r.is_queued())
+        except AttributeError as e:
+            logger.debug(f"[LLMTransport] Pool introspection unavailable: {e}")
+
+        return stats
+
+    async def aclose(self) -> None:
+        """关闭共享连接池"""
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+        self._http_client = None
+        self._clients.clear()
+
+
+# 全局单例
+_llm_transport = None
+
+
+def get_llm_transport() -> LLMTransport:
+    """获取LLM传输层单例"""
+    global _llm_transport
+    if _llm_transport is None:
+        _llm_transport = LLMTransport()
+    return _llm_transport
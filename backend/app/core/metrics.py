@@ -0,0 +1,228 @@
+"""
+LLM调用与生成阶段的Prometheus指标
+
+按 agent/model/stage 记录：
+- 排队等待：准入控制从入队到获得槽位的时间
+- LLM调用：TTFT、总时长、输出速率（tokens/s）、prompt/completion token、重试、提前取消
+- 阶段与工作流：用户可见的总时长，以及相对 agentN_timeout / max_timeout 目标的SLO达标计数
+
+agent标签：agent1/agent2/agent3 对应三个阶段（局部修改时为被修改阶段），chat 为对话Agent。
+指标通过 GET /metrics 以Prometheus文本格式导出。
+"""
+import logging
+import time
+from typing import Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60)
+DURATION_BUCKETS = (1, 2, 5, 10, 15, 20, 25, 30, 40, 60, 90, 120, 180, 300, 600)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+
+OUTCOME_COMPLETED = "completed"
+OUTCOME_ERROR = "error"
+OUTCOME_CANCELLED = "cancelled"
+
+MODE_GENERATE = "generate"
+MODE_SECTION_EDIT = "section_edit"
+
+SLO_MET = "met"
+SLO_MISSED = "missed"
+
+
+def stage_slo_target(stage: int) -> Optional[float]:
+    """阶段的目标时长（agentN_timeout，秒），未配置时返回None"""
+    value = getattr(settings, f"agent{stage}_timeout", None)
+    return float(value) if value else None
+
+
+class LLMMetrics:
+    """
+    指标集合
+
+    每个实例使用独立的CollectorRegistry，测试中可以创建新实例而不与全局单例冲突。
+    """
+
+    def __init__(self, registry: Optional[CollectorRegistry] = None):
+        self.registry = registry or CollectorRegistry()
+        r = self.registry
+
+        self.queue_wait = Histogram(
+            "pbl_llm_queue_wait_seconds", "准入控制排队等待时间",
+            ["agent", "model"], buckets=QUEUE_WAIT_BUCKETS, registry=r,
+        )
+        self.ttft = Histogram(
+            "pbl_llm_ttft_seconds", "发出LLM请求到收到首个文本块的时间",
+            ["agent", "model"], buckets=TTFT_BUCKETS, registry=r,
+        )
+        self.llm_duration = Histogram(
+            "pbl_llm_request_duration_seconds", "单次LLM流式调用总时长（含重试）",
+            ["agent", "model", "outcome"], buckets=DURATION_BUCKETS, registry=r,
+        )
+        self.tokens_per_second = Histogram(
+            "pbl_llm_output_tokens_per_second", "首个文本块之后的输出速率",
+            ["agent", "model"], buckets=TOKENS_PER_SECOND_BUCKETS, registry=r,
+        )
+        self.prompt_tokens = Counter(
+            "pbl_llm_prompt_tokens", "prompt token数（优先使用usage，否则估算）",
+            ["agent", "model"], registry=r,
+        )
+        self.completion_tokens = Counter(
+            "pbl_llm_completion_tokens", "completion token数（优先使用usage，否则估算）",
+            ["agent", "model"], registry=r,
+        )
+        self.retries = Counter(
+            "pbl_llm_retries", "瞬时错误后的重试次数",
+            ["agent", "model"], registry=r,
+        )
+        self.cancellations = Counter(
+            "pbl_llm_cancellations", "客户端断开导致的提前取消次数",
+            ["agent", "model"], registry=r,
+        )
+        self.stage_duration = Histogram(
+            "pbl_stage_duration_seconds", "阶段总时长（含排队；mode=generate/section_edit，缓存回放标记cached=true）",
+            ["stage", "model", "mode", "outcome", "cached"], buckets=DURATION_BUCKETS, registry=r,
+        )
+        self.stage_slo = Counter(
+            "pbl_stage_slo", "阶段相对 agentN_timeout 目标的达标计数（失败计为missed）",
+            ["stage", "result"], registry=r,
+        )
+        self.workflow_duration = Histogram(
+            "pbl_workflow_duration_seconds", "完整工作流总时长",
+            ["outcome"], buckets=DURATION_BUCKETS, registry=r,
+        )
+        self.workflow_slo = Counter(
+            "pbl_workflow_slo", "工作流相对 max_timeout 目标的达标计数",
+            ["result"], registry=r,
+        )
+
+    # ========== 记录 ==========
+
+    def observe_queue_wait(self, agent: str, model: str, seconds: float) -> None:
+        self.queue_wait.labels(agent, model).observe(max(0.0, seconds))
+
+    def record_retry(self, agent: str, model: str) -> None:
+        self.retries.labels(agent, model).inc()
+
+    def record_llm_call(
+        self,
+        agent: str,
+        model: str,
+        outcome: str,
+        duration: float,
+        ttft: Optional[float] = None,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        streaming_seconds: Optional[float] = None,
+    ) -> None:
+        """
+        记录一次LLM调用
+
+        Args:
+            streaming_seconds: 首个文本块到结束的时间，用于计算输出速率
+        """
+        self.llm_duration.labels(agent, model, outcome).observe(duration)
+        if ttft is not None:
+            self.ttft.labels(agent, model).observe(ttft)
+        if prompt_tokens:
+            self.prompt_tokens.labels(agent, model).inc(prompt_tokens)
+        if completion_tokens:
+            self.completion_tokens.labels(agent, model).inc(completion_tokens)
+        if outcome == OUTCOME_CANCELLED:
+            self.cancellations.labels(agent, model).inc()
+        elif outcome == OUTCOME_COMPLETED and completion_tokens and streaming_seconds and streaming_seconds > 0:
+            self.tokens_per_second.labels(agent, model).observe(completion_tokens / streaming_seconds)
+
+    def record_stage(
+        self,
+        stage: int,
+        model: str,
+        outcome: str,
+        duration: float,
+        cached: bool = False,
+        mode: str = MODE_GENERATE,
+    ) -> None:
+        """记录一个阶段；整阶段生成完成或失败时按 agentN_timeout 计入SLO"""
+        self.stage_duration.labels(
+            str(stage), model, mode, outcome, "true" if cached else "false"
+        ).observe(duration)
+        if outcome == OUTCOME_CANCELLED or mode != MODE_GENERATE:
+            return
+        target = stage_slo_target(stage)
+        if target is None:
+            return
+        met = outcome == OUTCOME_COMPLETED and duration <= target
+        self.stage_slo.labels(str(stage), SLO_MET if met else SLO_MISSED).inc()
+
+    def record_workflow(self, outcome: str, duration: float) -> None:
+        self.workflow_duration.labels(outcome).observe(duration)
+        if outcome == OUTCOME_CANCELLED:
+            return
+        met = outcome == OUTCOME_COMPLETED and duration <= settings.max_timeout
+        self.workflow_slo.labels(SLO_MET if met else SLO_MISSED).inc()
+
+    def render(self) -> Tuple[bytes, str]:
+        """Prometheus文本格式（内容, Content-Type）"""
+        return generate_latest(self.registry), CONTENT_TYPE_LATEST
+
+
+class LLMCallTimer:
+    """
+    单次LLM流式调用的计时
+
+    使用方式：
+        timer = LLMCallTimer("agent1", model)
+        ... 每收到文本块调用 timer.token()
+        timer.finish(OUTCOME_COMPLETED, prompt_tokens=..., completion_tokens=...)
+    """
+
+    def __init__(self, agent: str, model: str, metrics: Optional[LLMMetrics] = None):
+        self.agent = agent
+        self.model = model
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.finished = False
+
+    def token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def finish(self, outcome: str, prompt_tokens: int = 0, completion_tokens: int = 0) -> None:
+        """记录结果（只记录一次）"""
+        if self.finished:
+            return
+        self.finished = True
+        now = time.perf_counter()
+        ttft = self.first_token_at - self.started if self.first_token_at is not None else None
+        streaming = now - self.first_token_at if self.first_token_at is not None else None
+        try:
+            (self.metrics or get_metrics()).record_llm_call(
+                self.agent,
+                self.model,
+                outcome,
+                now - self.started,
+                ttft=ttft,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                streaming_seconds=streaming,
+            )
+        except Exception as e:
+            logger.debug(f"[Metrics] Failed to record LLM call: {e}")
+
+
+# 全局单例
+_metrics = None
+
+
+def get_metrics() -> LLMMetrics:
+    """获取指标单例"""
+    global _metrics
+    if _metrics is None:
+        _metrics = LLMMetrics()
+    return _metrics
@@ -0,0 +1,143 @@
+"""
+启动时的幂等数据库迁移
+
+项目没有引入迁移工具，表由 create_all / 按需 create(checkfirst=True) 创建。
+已有数据库不会自动获得后来新增的表、列和索引，这里在启动时补齐；每一步都可重复执行。
+
+也可以单独执行：python -m app.core.migrations
+"""
+import logging
+from datetime import datetime
+from typing import Any, Dict, List
+
+from sqlalchemy import inspect, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from app.models.batch_job import BatchJob, BatchJobItem
+from app.models.conversation_message import CourseConversationMessage
+from app.models.course_project import CourseProject
+from app.models.generation_cache import GenerationCacheEntry
+from app.models.generation_job import GenerationJobEvent
+from app.models.llm_usage import LLMUsageRecord
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_indexes(engine: Engine) -> None:
+    """为已存在的表补建模型中声明的索引"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in (CourseProject.__table__, CourseConversationMessage.__table__):
+        if table.name not in tables:
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+                logger.info(f"[Migrations] Created index {index.name} on {table.name}")
+
+
+def ensure_tables(engine: Engine) -> None:
+    """创建后来新增的表"""
+    for table in (
+        CourseConversationMessage.__table__,
+        BatchJob.__table__,
+        BatchJobItem.__table__,
+        GenerationCacheEntry.__table__,
+        GenerationJobEvent.__table__,
+        LLMUsageRecord.__table__,
+    ):
+        table.create(bind=engine, checkfirst=True)
+
+
+def ensure_columns(engine: Engine) -> None:
+    """为已存在的表补建后来新增的可空列"""
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in (CourseProject.__table__, CourseConversationMessage.__table__):
+        if table.name not in tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+            logger.info(f"[Migrations] Added column {column.name} to {table.name}")
+
+
+def _parse_timestamp(value: Any) -> datetime:
+    try:
+        return datetime.fromisoformat(str(value)).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return datetime.utcnow()
+
+
+def _history_rows(course_id: int, history: List[Dict[str, Any]]) -> List[CourseConversationMessage]:
+    return [
+        CourseConversationMessage(
+            course_id=course_id,
+            role=str(msg.get("role") or "user"),
+            content=str(msg.get("content") or ""),
+            step=msg.get("step"),
+            created_at=_parse_timestamp(msg.get("timestamp")),
+        )
+        for msg in history
+        if isinstance(msg, dict)
+    ]
+
+
+def migrate_conversation_history(engine: Engine) -> int:
+    """
+    把 CourseProject.conversation_history 中的JSON消息搬到 conversation_messages 表
+
+    每门课程在一个事务内写入消息并清空JSON列，因此重复执行不会产生重复消息。
+
+    Returns:
+        迁移的消息条数
+    """
+    if "course_projects" not in inspect(engine).get_table_names():
+        return 0
+
+    migrated = 0
+    with Session(engine) as db:
+        # 只读取ID和JSON列，不加载Markdown正文
+        pending = [
+            (course_id, history)
+            for course_id, history in db.execute(
+                select(CourseProject.id, CourseProject.conversation_history)
+            )
+            if history
+        ]
+        for course_id, history in pending:
+            rows = _history_rows(course_id, history)
+            db.add_all(rows)
+            db.execute(
+                update(CourseProject)
+                .where(CourseProject.id == course_id)
+                .values(conversation_history=[], updated_at=CourseProject.updated_at)
+            )
+            db.commit()
+            migrated += len(rows)
+            logger.info(f"[Migrations] Moved {len(rows)} conversation messages of course {course_id}")
+    return migrated
+
+
+def run_startup_migrations(engine: Engine) -> None:
+    """执行全部启动迁移；失败只记录日志，不阻止服务启动"""
+    try:
+        ensure_tables(engine)
+        ensure_columns(engine)
+        ensure_indexes(engine)
+        migrate_conversation_history(engine)
+    except Exception as e:
+        logger.error(f"[Migrations] Startup migration failed: {e}", exc_info=True)
+
+
+if __name__ == "__main__":
+    from app.core.database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    run_startup_migrations(engine)
@@ -3,19 +3,68 @@ OpenAI客户端管理
 """
 import time
 import asyncio
-from typing import Any, Dict, AsyncGenerator
+import logging
+from typing import Any, Dict, AsyncGenerator, List, Optional
 from openai import AsyncOpenAI
+from app.core.cancellation import close_upstream, estimate_tokens, get_cancellation_stats
 from app.core.config import settings
+from app.core.llm_transport import get_llm_transport
+from app.core.metrics import OUTCOME_CANCELLED, OUTCOME_COMPLETED, OUTCOME_ERROR, LLMCallTimer
+from app.core.prompt_cache import get_prompt_cache_stats, stream_usage_options
+from app.core.retry import RetryBudget
+from app.core.token_usage import TokenUsage
+from app.core.tracing import SpanKind, add_span_event, set_span_attributes, start_span, traced_stream
+
+logger = logging.getLogger(__name__)
+
+# 中途断流后续写时追加的指令
+CONTINUATION_PROMPT = (
+    "你的输出在上面的位置中断了。请从中断处继续输出剩余内容："
+    "不要重复已输出的内容，不要添加任何说明或代码块标记，直接接着最后一个字符继续。"
+)
+# 续写开头与已输出内容比对重叠的窗口（字符）及最小重叠长度
+CONTINUATION_OVERLAP_WINDOW = 200
+CONTINUATION_MIN_OVERLAP = 8
+
+
+def trim_continuation(produced: str, text: str) -> str:
+    """
+    去掉续写开头重复的部分
+
+    模型续写时常会重复中断的那一行或加上代码块标记，这里去掉与已输出内容末尾重叠的前缀。
+    """
+    stripped = text.lstrip()
+    if stripped.startswith("```"):
+        newline = stripped.find("\n")
+        text = stripped[newline + 1:] if newline != -1 else ""
+
+    longest = min(len(text), len(produced), CONTINUATION_OVERLAP_WINDOW)
+    for k in range(longest, CONTINUATION_MIN_OVERLAP - 1, -1):
+        if produced.endswith(text[:k]):
+            return text[k:]
+    return text
 
 
 class OpenAIClient:
     """OpenAI客户端封装类"""
 
-    def __init__(self):
-        self.client = AsyncOpenAI(
-            api_key=settings.openai_api_key,
-            base_url=settings.openai_base_url,
-        )
+    @property
+    def client(self) -> AsyncOpenAI:
+        """复用进程内共享连接池的AsyncOpenAI实例（重试由本类按阶段预算控制）"""
+        return get_llm_transport().get_client(max_retries=0)
+
+    def _build_messages(
+        self, prompt: str, system_prompt: str = None, partial: str = ""
+    ) -> List[Dict[str, str]]:
+        """构建消息列表；partial非空时构建续写请求"""
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": prompt})
+        if partial:
+            messages.append({"role": "assistant", "content": partial})
+            messages.append({"role": "user", "content": CONTINUATION_PROMPT})
+        return messages
 
     async def generate_response(
         self,
@@ -24,7 +73,9 @@ class OpenAIClient:
         model: str = None,
         max_tokens: int = None,
         temperature: float = None,
-        timeout: int = 60
+        timeout: int = 60,
+        retry_budget: Optional[RetryBudget] = None,
+        usage: Optional[TokenUsage] = None,
     ) -> Dict[str, Any]:
         """
         生成AI响应
@@ -36,6 +87,8 @@ class OpenAIClient:
             max_tokens: 最大令牌数，如不指定使用配置中的默认值
             temperature: 温度参数，如不指定使用配置中的默认值
             timeout: 超时时间（秒）
+            retry_budget: 重试预算（429/5xx/连接错误时指数退避重试），默认按配置新建
+            usage: token用量累计（成功时累加本次请求）
 
         Returns:
             包含响应内容和元数据的字典
@@ -47,54 +100,70 @@ class OpenAIClient:
         max_tokens = max_tokens or settings.openai_max_tokens
         temperature = temperature if temperature is not None else settings.openai_temperature
 
-        try:
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-            messages.append({"role": "user", "content": prompt})
-
-            # 使用asyncio.wait_for设置超时
-            response = await asyncio.wait_for(
-                self.client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                ),
-                timeout=timeout
-            )
+        messages = self._build_messages(prompt, system_prompt)
+        budget = retry_budget or RetryBudget()
+        timer = LLMCallTimer(budget.agent, model)
+
+        while True:
+            try:
+                # 使用asyncio.wait_for设置超时
+                with start_span(
+                    "llm.chat.completions.create", kind=SpanKind.CLIENT,
+                    **{"llm.model": model, "llm.agent": budget.agent, "llm.retry": budget.used, "llm.stream": False},
+                ):
+                    response = await asyncio.wait_for(
+                        self.client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                        ),
+                        timeout=timeout
+                    )
+
+                end_time = time.time()
+                response_time = end_time - start_time
+                reported = get_prompt_cache_stats().record(model, response.usage)
+                call_usage = TokenUsage()
+                call_usage.add_request(reported, messages, response.choices[0].message.content or "")
+                timer.finish(
+                    OUTCOME_COMPLETED,
+                    prompt_tokens=call_usage.prompt_tokens,
+                    completion_tokens=call_usage.completion_tokens,
+                )
+                if usage is not None:
+                    usage.merge(call_usage)
 
-            end_time = time.time()
-            response_time = end_time - start_time
-
-            return {
-                "content": response.choices[0].message.content,
-                "response_time": response_time,
-                "token_usage": {
-                    "prompt_tokens": response.usage.prompt_tokens,
-                    "completion_tokens": response.usage.completion_tokens,
-                    "total_tokens": response.usage.total_tokens,
-                },
-                "model": response.model,
-                "success": True,
-            }
-
-        except asyncio.TimeoutError:
-            return {
-                "content": None,
-                "response_time": timeout,
-                "error": f"Request timeout after {timeout} seconds",
-                "success": False,
-            }
-        except Exception as e:
-            end_time = time.time()
-            return {
-                "content": None,
-                "response_time": end_time - start_time,
-                "error": str(e),
-                "success": False,
-            }
+                return {
+                    "content": response.choices[0].message.content,
+                    "response_time": response_time,
+                    "token_usage": call_usage.to_dict(),
+                    "model": response.model,
+                    "success": True,
+                    "retries": budget.used,
+                }
 
+            except asyncio.TimeoutError:
+                timer.finish(OUTCOME_ERROR)
+                return {
+                    "content": None,
+                    "response_time": timeout,
+                    "error": f"Request timeout after {timeout} seconds",
+                    "success": False,
+                }
+            except Exception as e:
+                if await budget.backoff(e, label=model):
+                    continue
+                timer.finish(OUTCOME_ERROR)
+                end_time = time.time()
+                return {
+                    "content": None,
+                    "response_time": end_time - start_time,
+                    "error": str(e),
+                    "success": False,
+                }
+
+    @traced_stream("llm.stream")
     async def generate_response_stream(
         self,
         prompt: str,
@@ -102,11 +171,19 @@ class OpenAIClient:
         model: str = None,
         max_tokens: int = None,
         temperature: float = None,
-        timeout: int = 120
+        timeout: int = 120,
+        retry_budget: Optional[RetryBudget] = None,
+        continuation: Optional[bool] = None,
+        usage: Optional[TokenUsage] = None,
     ) -> AsyncGenerator[str, None]:
         """
         流式生成AI响应（逐块yield文本）
 
+        瞬时错误（429/5xx/连接重置）按重试预算指数退避重试：
+        - 尚未输出任何内容时，重新发起同一请求
+        - 中途断流时（续写模式），把已输出的Markdown作为assistant消息回传并要求模型
+          从中断处继续，续写内容去掉重叠部分后接在同一个流中输出
+
         Args:
             prompt: 用户提示词
             system_prompt: 系统提示词
@@ -114,46 +191,151 @@ class OpenAIClient:
             max_tokens: 最大令牌数
             temperature: 温度参数
             timeout: 超时时间（秒）
+            retry_budget: 重试预算，调用方按阶段创建；默认按配置新建
+            continuation: 是否启用中途断流续写，默认读取 llm_stream_continuation
+            usage: token用量累计（完成、失败或取消时都会累加本次调用的全部请求），
+                优先使用流末尾的usage，缺失时按本地分词器估算
 
         Yields:
             str: 文本块
 
         Raises:
-            Exception: 生成失败时抛出异常
+            Exception: 生成失败（不可重试的错误或重试预算耗尽）时抛出异常
         """
         # 使用配置中的默认值
         model = model or settings.openai_model
         max_tokens = max_tokens or settings.openai_max_tokens
         temperature = temperature if temperature is not None else settings.openai_temperature
+        budget = retry_budget or RetryBudget()
+        if continuation is None:
+            continuation = settings.llm_stream_continuation
 
-        try:
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-            messages.append({"role": "user", "content": prompt})
-
-            # 使用asyncio.wait_for设置超时
-            stream = await asyncio.wait_for(
-                self.client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    stream=True,  # 🔑 启用流式响应
-                ),
-                timeout=timeout
+        produced = ""
+        stream = None
+        timer = LLMCallTimer(budget.agent, model)
+        # 本次调用的token累计：重试、续写各算一次请求，每次请求结束时结算
+        call_usage = TokenUsage()
+        request = {"messages": None, "start": 0, "reported": None}
+
+        def settle_request() -> None:
+            """结算当前请求（已建立流的请求才会消耗token），重复调用无副作用"""
+            if request["messages"] is None:
+                return
+            call_usage.add_request(request["reported"], request["messages"], produced[request["start"]:])
+            request["messages"] = None
+
+        def finish(outcome: str) -> None:
+            settle_request()
+            timer.finish(
+                outcome,
+                prompt_tokens=call_usage.prompt_tokens,
+                completion_tokens=call_usage.completion_tokens,
             )
 
-            # 逐块yield文本
-            async for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+        set_span_attributes(**{"llm.model": model, "llm.agent": budget.agent, "llm.max_tokens": max_tokens})
+        try:
+            while True:
+                try:
+                    messages = self._build_messages(prompt, system_prompt, partial=produced)
+                    # 使用asyncio.wait_for设置超时
+                    # span覆盖建立连接到收到响应头（之后的逐块读取计入 llm.stream）
+                    with start_span(
+                        "llm.chat.completions.create", kind=SpanKind.CLIENT,
+                        **{
+                            "llm.model": model,
+                            "llm.agent": budget.agent,
+                            "llm.retry": budget.used,
+                            "llm.continuation": bool(produced),
+                            "llm.stream": True,
+                        },
+                    ):
+                        stream = await asyncio.wait_for(
+                            self.client.chat.completions.create(
+                                model=model,
+                                messages=messages,
+                                max_tokens=max_tokens,
+                                temperature=temperature,
+                                stream=True,  # 🔑 启用流式响应
+                                extra_body=stream_usage_options() or None,
+                            ),
+                            timeout=timeout
+                        )
+                    request.update(messages=messages, start=len(produced), reported=None)
 
-        except asyncio.TimeoutError:
-            raise Exception(f"Request timeout after {timeout} seconds")
-        except Exception as e:
-            raise Exception(f"Stream generation failed: {str(e)}")
+                    # 续写时先缓冲开头部分，去掉与已输出内容重叠的前缀
+                    resuming = bool(produced)
+                    head = ""
+
+                    # 逐块yield文本
+                    async for chunk in stream:
+                        # include_usage 时最后一个chunk不含choices，只带usage
+                        chunk_usage = getattr(chunk, "usage", None)
+                        if chunk_usage:
+                            request["reported"] = get_prompt_cache_stats().record(model, chunk_usage)
+                        text = chunk.choices[0].delta.content if chunk.choices else None
+                        if not text:
+                            continue
+                        if timer.first_token_at is None:
+                            add_span_event("first_token")
+                        timer.token()
+                        if resuming:
+                            head += text
+                            if len(head) < CONTINUATION_OVERLAP_WINDOW:
+                                continue
+                            text = trim_continuation(produced, head)
+                            resuming = False
+                            if not text:
+                                continue
+                        produced += text
+                        yield text
+
+                    if resuming and head:
+                        text = trim_continuation(produced, head)
+                        if text:
+                            produced += text
+                            yield text
+                    get_cancellation_stats().record_completed(model, estimate_tokens(produced))
+                    finish(OUTCOME_COMPLETED)
+                    return
+
+                except asyncio.TimeoutError:
+                    raise Exception(f"Request timeout after {timeout} seconds")
+                except Exception as e:
+                    await close_upstream(stream)
+                    stream = None
+                    settle_request()
+                    if produced and not continuation:
+                        raise Exception(f"Stream generation failed: {str(e)}")
+                    if not await budget.backoff(e, label=model):
+                        raise Exception(f"Stream generation failed: {str(e)}")
+                    if produced:
+                        logger.warning(
+                            f"[OpenAIClient] Stream dropped after {len(produced)} chars, resuming with continuation"
+                        )
+
+        except (asyncio.CancelledError, GeneratorExit):
+            # 下游已取消（客户端断开），不再继续拉取上游token
+            saved = get_cancellation_stats().record_cancelled(model, estimate_tokens(produced), max_tokens)
+            finish(OUTCOME_CANCELLED)
+            logger.info(
+                f"[OpenAIClient] Stream cancelled by consumer after {len(produced)} chars, "
+                f"~{saved} output tokens saved"
+            )
+            raise
+        finally:
+            # 未完成也未取消即为失败（已记录时不重复记录）
+            finish(OUTCOME_ERROR)
+            set_span_attributes(**{
+                "llm.prompt_tokens": call_usage.prompt_tokens,
+                "llm.completion_tokens": call_usage.completion_tokens,
+                "llm.usage_estimated": call_usage.estimated,
+                "llm.retries": budget.used,
+            })
+            if usage is not None:
+                usage.merge(call_usage)
+            # 无论正常结束还是取消，都关闭上游HTTP响应使连接归还连接池
+            await close_upstream(stream)
 
 
 # 全局客户端实例
-openai_client = OpenAIClient()
\ No newline at end of file
+openai_client = OpenAIClient()
@@ -6,16 +6,16 @@ import asyncio
 from typing import AsyncGenerator
 from openai import AsyncOpenAI
 from app.core.config import settings
+from app.core.llm_transport import get_llm_transport
 
 
 class OpenAIStreamingClient:
     """OpenAI流式客户端封装类"""
 
-    def __init__(self):
-        self.client = AsyncOpenAI(
-            api_key=settings.openai_api_key,
-            base_url=settings.openai_base_url,
-        )
+    @property
+    def client(self) -> AsyncOpenAI:
+        """复用进程内共享连接池的AsyncOpenAI实例"""
+        return get_llm_transport().get_client()
 
     async def generate_stream(
         self,
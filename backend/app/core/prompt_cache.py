@@ -0,0 +1,147 @@
+"""
+提示词前缀缓存布局与缓存命中统计
+
+OpenAI兼容接口（OpenAI、DeepSeek等）会对请求开头相同的token做前缀缓存，
+命中部分首token更快、计费更低。要命中缓存，提示词需要按"稳定在前、易变在后"排列：
+- 稳定前缀：角色与规则、REGENERATE协议、课程信息、完整的阶段文档（按内容版本缓存渲染结果）
+- 易变后缀：当前步骤、按问题筛选的章节摘录、历史摘要、用户消息
+
+本模块提供：
+- stage_version: 阶段文档的内容版本（文本不变则版本不变）
+- PromptPrefixCache: 按（课程信息, 各阶段版本）缓存渲染好的前缀，保证逐字节一致
+- extract_usage / PromptCacheStats: 从usage中读取缓存命中token数（OpenAI的
+  prompt_tokens_details.cached_tokens 与 DeepSeek的 prompt_cache_hit_tokens）
+"""
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def stage_version(markdown: Optional[str]) -> str:
+    """阶段文档的内容版本（空文档为空字符串）"""
+    if not markdown:
+        return ""
+    return hashlib.sha256(markdown.encode("utf-8")).hexdigest()[:12]
+
+
+class PromptPrefixCache:
+    """按键缓存渲染好的提示词前缀（LRU）"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key: Tuple, render: Callable[[], str]) -> str:
+        prefix = self._entries.get(key)
+        if prefix is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prefix
+        self.misses += 1
+        prefix = render()
+        self._entries[key] = prefix
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return prefix
+
+
+def _field(obj: Any, name: str) -> Any:
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def _int_field(obj: Any, name: str) -> int:
+    value = _field(obj, name)
+    return value if isinstance(value, int) else 0
+
+
+def extract_usage(usage: Any) -> Optional[Dict[str, int]]:
+    """
+    从usage对象/字典中读取token数
+
+    Returns:
+        {"prompt_tokens", "completion_tokens", "cached_tokens"}，usage无效时返回None
+    """
+    prompt_tokens = _field(usage, "prompt_tokens")
+    if not isinstance(prompt_tokens, int):
+        return None
+    cached = _int_field(_field(usage, "prompt_tokens_details"), "cached_tokens")
+    cached = cached or _int_field(usage, "prompt_cache_hit_tokens")
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": _int_field(usage, "completion_tokens"),
+        "cached_tokens": cached,
+    }
+
+
+def stream_usage_options() -> Dict[str, Any]:
+    """流式请求的 extra_body：要求在最后一个chunk附带usage"""
+    if not settings.llm_stream_include_usage:
+        return {}
+    return {"stream_options": {"include_usage": True}}
+
+
+class PromptCacheStats:
+    """按模型统计提示词token与前缀缓存命中的token"""
+
+    def __init__(self):
+        self._models: Dict[str, Dict[str, int]] = {}
+
+    def record(self, model: str, usage: Any) -> Optional[Dict[str, int]]:
+        """记录一次请求的usage，返回解析结果"""
+        parsed = extract_usage(usage)
+        if parsed is None:
+            return None
+        stats = self._models.setdefault(model, {
+            "requests": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "completion_tokens": 0,
+        })
+        stats["requests"] += 1
+        for key in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+            stats[key] += parsed[key]
+        logger.debug(
+            f"[PromptCache] {model}: {parsed['cached_tokens']}/{parsed['prompt_tokens']} prompt tokens cached"
+        )
+        return parsed
+
+    def stats(self) -> Dict[str, Any]:
+        models = {
+            model: {
+                **values,
+                "cache_hit_ratio": round(values["cached_tokens"] / values["prompt_tokens"], 3)
+                if values["prompt_tokens"] else 0.0,
+            }
+            for model, values in self._models.items()
+        }
+        prompt_total = sum(m["prompt_tokens"] for m in models.values())
+        cached_total = sum(m["cached_tokens"] for m in models.values())
+        return {
+            "prompt_tokens_total": prompt_total,
+            "cached_tokens_total": cached_total,
+            "cache_hit_ratio": round(cached_total / prompt_total, 3) if prompt_total else 0.0,
+            "models": models,
+        }
+
+
+# 全局单例
+_prompt_cache_stats = None
+
+
+def get_prompt_cache_stats() -> PromptCacheStats:
+    """获取前缀缓存命中统计单例"""
+    global _prompt_cache_stats
+    if _prompt_cache_stats is None:
+        _prompt_cache_stats = PromptCacheStats()
+    return _prompt_cache_stats
@@ -0,0 +1,191 @@
+"""
+PHR提示词注册表 - 启动时一次性加载并解析 app/prompts/phr/*.md
+
+Agent每次生成都从磁盘读取并扫描Markdown会带来不必要的I/O；注册表在启动时解析全部PHR文件、
+校验System Prompt标记，之后从内存读取。后台轮询文件mtime，文件变化时热重载。
+"""
+import asyncio
+import hashlib
+import logging
+import re
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+PHR_DIR = Path(__file__).parent.parent / "prompts" / "phr"
+
+SYSTEM_PROMPT_START_MARKER = "## System Prompt\n\n```"
+SYSTEM_PROMPT_END_MARKER = "```\n\n---"
+VERSION_PATTERN = re.compile(r"^- \*\*Version\*\*:\s*(\S+)", re.M)
+
+
+class PromptRecord:
+    """单个PHR文件的解析结果"""
+
+    def __init__(self, name: str, path: Path, system_prompt: str, version: str, mtime: float):
+        self.name = name
+        self.path = path
+        self.system_prompt = system_prompt
+        self.version = version
+        self.mtime = mtime
+        self.checksum = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:12]
+
+    @property
+    def fingerprint(self) -> str:
+        """版本号 + 内容摘要，未升级版本号的修改也能区分"""
+        return f"{self.version}+{self.checksum}"
+
+    def to_dict(self) -> Dict[str, str]:
+        return {
+            "name": self.name,
+            "version": self.version,
+            "checksum": self.checksum,
+            "chars": len(self.system_prompt),
+        }
+
+
+def parse_phr(path: Path) -> PromptRecord:
+    """
+    解析PHR文件
+
+    Raises:
+        ValueError: 缺少System Prompt起止标记或Version元信息
+    """
+    content = path.read_text(encoding="utf-8")
+
+    start_idx = content.find(SYSTEM_PROMPT_START_MARKER)
+    if start_idx == -1:
+        raise ValueError(f"System Prompt section not found in {path.name}")
+
+    start_idx += len(SYSTEM_PROMPT_START_MARKER)
+    end_idx = content.find(SYSTEM_PROMPT_END_MARKER, start_idx)
+    if end_idx == -1:
+        raise ValueError(f"End of System Prompt not found in {path.name}")
+
+    system_prompt = content[start_idx:end_idx].strip()
+    if not system_prompt:
+        raise ValueError(f"Empty System Prompt in {path.name}")
+
+    version_match = VERSION_PATTERN.search(content)
+    if not version_match:
+        raise ValueError(f"Version not found in Meta Information of {path.name}")
+
+    return PromptRecord(
+        name=path.stem,
+        path=path,
+        system_prompt=system_prompt,
+        version=version_match.group(1),
+        mtime=path.stat().st_mtime,
+    )
+
+
+class PromptRegistry:
+    """
+    PHR提示词注册表
+
+    - load_all(): 解析目录下全部PHR文件，任一文件损坏即抛出ValueError（启动时暴露问题）
+    - reload_if_changed(): 按mtime增量重载；热重载失败时保留旧版本并记录日志
+    - watch(): 后台轮询任务，由应用startup事件启动
+    """
+
+    def __init__(self, phr_dir: Path = PHR_DIR):
+        self.phr_dir = Path(phr_dir)
+        self._records: Dict[str, PromptRecord] = {}
+        self._loaded = False
+
+    def load_all(self) -> None:
+        """加载并校验全部PHR文件"""
+        records = {}
+        for path in sorted(self.phr_dir.glob("*.md")):
+            record = parse_phr(path)
+            records[record.name] = record
+
+        self._records = records
+        self._loaded = True
+        logger.info(f"[PromptRegistry] Loaded {len(records)} PHR prompts from {self.phr_dir}")
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.load_all()
+
+    def get(self, name: str) -> PromptRecord:
+        """
+        按文件名（不含扩展名）获取提示词记录
+
+        Raises:
+            FileNotFoundError: 注册表中没有该PHR文件
+        """
+        self._ensure_loaded()
+        record = self._records.get(name)
+        if record is None:
+            raise FileNotFoundError(f"PHR prompt not registered: {name} (dir: {self.phr_dir})")
+        return record
+
+    def get_system_prompt(self, name: str) -> str:
+        return self.get(name).system_prompt
+
+    def versions(self) -> Dict[str, str]:
+        """返回 {PHR名称: 版本号}"""
+        self._ensure_loaded()
+        return {name: record.version for name, record in self._records.items()}
+
+    def list_prompts(self) -> List[Dict[str, str]]:
+        self._ensure_loaded()
+        return [record.to_dict() for record in self._records.values()]
+
+    def reload_if_changed(self) -> List[str]:
+        """
+        检查mtime并重载新增或变化的文件，移除已删除的文件
+
+        Returns:
+            本次重载的PHR名称列表
+        """
+        self._ensure_loaded()
+        reloaded = []
+        current_paths = {path.stem: path for path in self.phr_dir.glob("*.md")}
+
+        for name, path in current_paths.items():
+            existing = self._records.get(name)
+            try:
+                if existing is not None and path.stat().st_mtime == existing.mtime:
+                    continue
+                self._records[name] = parse_phr(path)
+                reloaded.append(name)
+            except Exception as e:
+                logger.error(f"[PromptRegistry] Failed to reload {path.name}, keeping previous version: {e}")
+
+        for name in set(self._records) - set(current_paths):
+            del self._records[name]
+            logger.warning(f"[PromptRegistry] PHR file removed: {name}")
+
+        if reloaded:
+            logger.info(f"[PromptRegistry] Hot-reloaded: {', '.join(sorted(reloaded))}")
+        return reloaded
+
+    async def watch(self, interval: Optional[float] = None) -> None:
+        """后台轮询PHR目录，直到任务被取消"""
+        interval = interval if interval is not None else settings.prompt_reload_interval_seconds
+        if interval <= 0:
+            return
+
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                logger.error(f"[PromptRegistry] Watcher error: {e}")
+
+
+# 全局单例
+_prompt_registry = None
+
+
+def get_prompt_registry() -> PromptRegistry:
+    """获取提示词注册表单例"""
+    global _prompt_registry
+    if _prompt_registry is None:
+        _prompt_registry = PromptRegistry()
+    return _prompt_registry
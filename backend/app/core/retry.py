@@ -0,0 +1,119 @@
+"""
+LLM调用重试策略 - 指数退避 + 抖动 + 每阶段重试预算
+
+只对瞬时错误重试：429限流、5xx、连接重置/协议中断；参数错误、鉴权失败等直接失败。
+"""
+import asyncio
+import logging
+import random
+from typing import Optional
+
+import httpx
+import openai
+
+from app.core.config import settings
+from app.core.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+# 视为瞬时错误的HTTP状态码
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """判断异常是否为可重试的瞬时错误"""
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in RETRYABLE_STATUS_CODES or exc.status_code >= 500
+    if isinstance(exc, (openai.APIConnectionError, httpx.TransportError, ConnectionError)):
+        return True
+    return False
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """读取429/503响应中的Retry-After头（秒）"""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Agent标识 -> 重试预算配置项
+AGENT_RETRY_SETTINGS = {
+    "agent1": "agent1_max_retries",
+    "agent2": "agent2_max_retries",
+    "agent3": "agent3_max_retries",
+}
+
+
+class RetryBudget:
+    """
+    单个阶段的重试预算
+
+    每个Agent的一次生成创建一个预算，流建立失败与中途断流共享同一预算，
+    避免一个阶段无限重试拖垮整个工作流。agent 用作指标标签。
+    """
+
+    def __init__(
+        self,
+        max_retries: Optional[int] = None,
+        base_delay: Optional[float] = None,
+        max_delay: Optional[float] = None,
+        agent: Optional[str] = None,
+    ):
+        self.agent = agent or "default"
+        self.max_retries = max_retries if max_retries is not None else settings.llm_retry_max_retries
+        self.base_delay = base_delay if base_delay is not None else settings.llm_retry_base_delay_seconds
+        self.max_delay = max_delay if max_delay is not None else settings.llm_retry_max_delay_seconds
+        self.used = 0
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.max_retries - self.used)
+
+    def next_delay(self, exc: Optional[BaseException] = None) -> Optional[float]:
+        """
+        消耗一次重试机会并返回等待时间（full jitter）
+
+        Returns:
+            等待秒数；预算耗尽时返回None
+        """
+        if self.used >= self.max_retries:
+            return None
+        self.used += 1
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (self.used - 1))))
+        server_hint = retry_after_seconds(exc) if exc is not None else None
+        if server_hint is not None:
+            delay = max(delay, min(server_hint, self.max_delay))
+        return delay
+
+    async def backoff(self, exc: BaseException, label: str = "LLM") -> bool:
+        """
+        若异常可重试且仍有预算，则等待退避时间并返回True
+        """
+        if not is_retryable(exc):
+            return False
+        delay = self.next_delay(exc)
+        if delay is None:
+            logger.warning(f"[Retry] {label} retry budget exhausted ({self.max_retries}): {exc}")
+            return False
+
+        get_metrics().record_retry(self.agent, label)
+        logger.warning(
+            f"[Retry] {label} transient error ({type(exc).__name__}: {exc}), "
+            f"retry {self.used}/{self.max_retries} in {delay:.2f}s"
+        )
+        await asyncio.sleep(delay)
+        return True
+
+
+def stage_retry_budget(agent: str) -> RetryBudget:
+    """
+    为一个阶段创建独立的重试预算（agentN_max_retries 未配置时使用 llm_retry_max_retries）
+    """
+    setting_name = AGENT_RETRY_SETTINGS.get(agent)
+    max_retries = getattr(settings, setting_name) if setting_name else None
+    return RetryBudget(max_retries=max_retries, agent=agent)
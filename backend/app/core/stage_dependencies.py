@@ -0,0 +1,229 @@
+"""
+阶段依赖追踪与失效判断
+
+三个阶段的输入关系：
+    Stage 1 <- 课程信息
+    Stage 2 <- 课程信息 + Stage 1
+    Stage 3 <- 课程信息 + Stage 1 + Stage 2
+
+每个阶段生成并保存时，记录其输入的内容哈希（CourseProject.stage_sources）：
+
+    {"2": {"info": "<hash>", "1": "<hash>"}, ...}
+
+哈希基于空白规范化后的文本，只调整空行、缩进或行尾空格的修改不会使下游失效。
+之后比较记录的哈希与当前输入即可判断阶段是否过期，重新生成时只生成过期的阶段。
+没有哈希记录的旧数据退回比较 stage_*_version 时间戳。
+"""
+import hashlib
+import re
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Mapping, Optional
+
+# 阶段 -> 依赖的上游阶段
+STAGE_UPSTREAM = {1: (), 2: (1,), 3: (1, 2)}
+
+# 参与课程信息哈希的字段（与Agent的输入一致）
+COURSE_INFO_FIELDS = (
+    "title",
+    "subject",
+    "grade_level",
+    "total_class_hours",
+    "schedule_description",
+    "description",
+)
+
+INFO_KEY = "info"
+
+STATUS_MISSING = "missing"  # 阶段尚无内容
+STATUS_FRESH = "fresh"  # 输入未变化
+STATUS_STALE = "stale"  # 至少一个输入已变化
+
+_INLINE_SPACE = re.compile(r"[ \t　]+")
+
+
+def normalize_text(text: Optional[str]) -> str:
+    """空白规范化：统一换行、去掉行首尾空白与空行、合并行内连续空白"""
+    lines = []
+    for line in (text or "").replace("\r\n", "\n").replace("\r", "\n").split("\n"):
+        line = _INLINE_SPACE.sub(" ", line).strip()
+        if line:
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def content_hash(text: Optional[str]) -> str:
+    """文本内容哈希（忽略仅空白的差异）"""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()[:16]
+
+
+def course_info_hash(course_info: Mapping[str, Any]) -> str:
+    """课程信息哈希"""
+    parts = []
+    for name in COURSE_INFO_FIELDS:
+        value = course_info.get(name)
+        parts.append(f"{name}={normalize_text('' if value is None else str(value))}")
+    return content_hash("\n".join(parts))
+
+
+def stage_sources(
+    stage: int,
+    course_info: Mapping[str, Any],
+    stages: Mapping[int, Optional[str]],
+) -> Optional[Dict[str, str]]:
+    """
+    计算阶段输入的哈希记录
+
+    Args:
+        stage: 阶段编号
+        course_info: 课程信息
+        stages: 上游阶段的Markdown（阶段编号 -> 文本）
+
+    Returns:
+        {"info": 哈希, "<上游阶段>": 哈希}；上游阶段缺失时返回None（无法记录完整输入）
+    """
+    sources = {INFO_KEY: course_info_hash(course_info)}
+    for upstream in STAGE_UPSTREAM[stage]:
+        if not stages.get(upstream):
+            return None
+        sources[str(upstream)] = content_hash(stages[upstream])
+    return sources
+
+
+@dataclass
+class StageStatus:
+    """单个阶段的失效状态"""
+
+    stage: int
+    status: str
+    basis: Optional[str] = None  # 判断依据："hash" 或 "version"（旧数据）
+    changed_inputs: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "stage": self.stage,
+            "status": self.status,
+            "basis": self.basis,
+            "changed_inputs": self.changed_inputs,
+        }
+
+
+def _naive(value: Optional[datetime]) -> Optional[datetime]:
+    return value.replace(tzinfo=None) if value is not None else None
+
+
+def evaluate_staleness(
+    course_info: Mapping[str, Any],
+    stages: Mapping[int, Optional[str]],
+    sources: Optional[Mapping[str, Mapping[str, str]]] = None,
+    versions: Optional[Mapping[int, Optional[datetime]]] = None,
+) -> Dict[int, StageStatus]:
+    """
+    判断每个阶段是否过期
+
+    Args:
+        course_info: 当前课程信息
+        stages: 当前各阶段Markdown
+        sources: 各阶段生成时记录的输入哈希（CourseProject.stage_sources）
+        versions: 各阶段版本时间戳，用于没有哈希记录的旧数据
+
+    Returns:
+        阶段编号 -> StageStatus
+    """
+    sources = sources or {}
+    versions = versions or {}
+    info_hash = course_info_hash(course_info)
+    result: Dict[int, StageStatus] = {}
+
+    for stage in sorted(STAGE_UPSTREAM):
+        if not stages.get(stage):
+            result[stage] = StageStatus(stage, STATUS_MISSING)
+            continue
+
+        recorded = sources.get(str(stage))
+        if recorded:
+            changed = []
+            if recorded.get(INFO_KEY) != info_hash:
+                changed.append(INFO_KEY)
+            for upstream in STAGE_UPSTREAM[stage]:
+                if recorded.get(str(upstream)) != content_hash(stages.get(upstream)):
+                    changed.append(str(upstream))
+            status = STATUS_STALE if changed else STATUS_FRESH
+            result[stage] = StageStatus(stage, status, "hash", changed)
+            continue
+
+        # 旧数据：上游版本晚于本阶段版本即视为过期（课程信息无法判断）
+        own = _naive(versions.get(stage))
+        changed = []
+        for upstream in STAGE_UPSTREAM[stage]:
+            upstream_version = _naive(versions.get(upstream))
+            if not stages.get(upstream) or (
+                own is not None and upstream_version is not None and upstream_version > own
+            ):
+                changed.append(str(upstream))
+        result[stage] = StageStatus(stage, STATUS_STALE if changed else STATUS_FRESH, "version", changed)
+
+    return result
+
+
+@dataclass
+class RegenerationPlan:
+    """选择性重新生成计划"""
+
+    regenerate: List[int]
+    reused: Dict[int, str]  # 沿用的阶段 -> 已保存的Markdown
+    statuses: Dict[int, StageStatus]
+
+    def reason(self, stage: int) -> str:
+        return self.statuses[stage].status
+
+
+def plan_regeneration(
+    requested: Iterable[int],
+    course_info: Mapping[str, Any],
+    stages: Mapping[int, Optional[str]],
+    sources: Optional[Mapping[str, Mapping[str, str]]] = None,
+    versions: Optional[Mapping[int, Optional[datetime]]] = None,
+    force: Iterable[int] = (),
+) -> RegenerationPlan:
+    """
+    只重新生成请求范围内过期或缺失的阶段
+
+    某阶段重新生成后其内容必然变化，因此请求范围内的下游阶段一并重新生成。
+    请求范围内未过期的阶段沿用已保存内容，作为下游阶段的输入。
+    force 中的阶段（如带编辑指令的请求）无论是否过期都重新生成。
+    """
+    requested = set(requested)
+    force = set(force)
+    statuses = evaluate_staleness(course_info, stages, sources, versions)
+    regenerate: List[int] = []
+    reused: Dict[int, str] = {}
+
+    for stage in sorted(STAGE_UPSTREAM):
+        if stage not in requested:
+            continue
+        upstream_regenerated = any(upstream in regenerate for upstream in STAGE_UPSTREAM[stage])
+        if stage in force or upstream_regenerated or statuses[stage].status != STATUS_FRESH:
+            regenerate.append(stage)
+        else:
+            reused[stage] = stages[stage]
+
+    return RegenerationPlan(regenerate=regenerate, reused=reused, statuses=statuses)
+
+
+def course_state(course: Any) -> Dict[str, Any]:
+    """从 CourseProject 读取失效判断所需的数据"""
+    return {
+        "course_info": {name: getattr(course, name) for name in COURSE_INFO_FIELDS},
+        "stages": {
+            1: course.stage_one_data,
+            2: course.stage_two_data,
+            3: course.stage_three_data,
+        },
+        "sources": course.stage_sources or {},
+        "versions": {
+            1: course.stage_one_version,
+            2: course.stage_two_version,
+            3: course.stage_three_version,
+        },
+    }
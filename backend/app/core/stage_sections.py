@@ -0,0 +1,184 @@
+"""
+阶段文档的章节寻址与补丁合并
+
+局部修改时把阶段Markdown按二、三级标题（ubd_stage_templates 中的 G/U/Q/K/S、
+表现性任务、WHERETO 各项等）切分为带编号的章节，模型只输出需要修改的章节：
+
+    @@ 3
+    ## U: 持续理解 (Enduring Understandings)
+    ...
+
+SectionPatchParser 增量解析模型输出，merge_sections 把补丁合并回原文档，
+未修改的章节逐字节保持不变。
+"""
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_SECTION_HEADING = re.compile(r"^(#{2,3})\s+(.+?)\s*$")
+_SECTION_CODE = re.compile(r"^([A-Z])\s*(?:\([^)]*\))?\s*[:：]")
+_PATCH_MARKER = re.compile(r"^@@\s*(\d+)\s*$")
+_FENCE = re.compile(r"^```[a-zA-Z]*\s*$")
+
+
+@dataclass
+class StageSection:
+    """
+    阶段文档中的一个章节
+
+    index 从1开始编号；0为标题前的文档头（一级标题等），不参与修改。
+    text 为原始文本（含标题行与末尾空行），拼接全部章节即还原原文档。
+    """
+
+    index: int
+    heading: str
+    level: int
+    text: str
+    code: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"index": self.index, "heading": self.heading, "code": self.code}
+
+
+def split_stage_sections(markdown: str) -> List[StageSection]:
+    """按二、三级标题切分阶段文档（代码块内的 # 不视为标题）"""
+    sections = [StageSection(index=0, heading="", level=1, text="")]
+    in_code = False
+    for line in markdown.splitlines(keepends=True):
+        stripped = line.rstrip("\r\n")
+        if stripped.lstrip().startswith("```"):
+            in_code = not in_code
+        match = None if in_code else _SECTION_HEADING.match(stripped)
+        if match:
+            heading = match.group(2)
+            code = _SECTION_CODE.match(heading)
+            sections.append(StageSection(
+                index=len(sections),
+                heading=heading,
+                level=len(match.group(1)),
+                text=line,
+                code=code.group(1) if code else None,
+            ))
+        else:
+            sections[-1].text += line
+    return sections
+
+
+def resolve_sections(sections: List[StageSection], selectors: Iterable[str]) -> List[int]:
+    """把调用方指定的章节（编号、G/U/Q/K/S代码或标题片段）解析为章节编号"""
+    indexes = []
+    for selector in selectors:
+        selector = str(selector).strip()
+        for section in sections[1:]:
+            if (
+                selector == str(section.index)
+                or selector == section.code
+                or (selector and not selector.isdigit() and len(selector) > 1 and selector in section.heading)
+            ):
+                if section.index not in indexes:
+                    indexes.append(section.index)
+    return indexes
+
+
+def format_numbered_document(sections: List[StageSection]) -> str:
+    """渲染带 "@@ 编号" 标记的文档，供模型引用章节"""
+    parts = []
+    if sections[0].text.strip():
+        parts.append(sections[0].text.strip())
+    for section in sections[1:]:
+        parts.append(f"@@ {section.index}\n{section.text.strip()}")
+    return "\n\n".join(parts)
+
+
+def _normalize_patch(section: StageSection, body: str) -> str:
+    """补丁缺少标题行时补上原标题"""
+    body = body.strip("\n")
+    if not body.lstrip().startswith("#"):
+        heading_line = section.text.splitlines()[0]
+        body = f"{heading_line}\n\n{body.strip()}" if body.strip() else heading_line
+    return body.rstrip()
+
+
+def merge_sections(sections: List[StageSection], patches: Dict[int, str]) -> str:
+    """把补丁合并回文档，未修改章节保持原文"""
+    parts = []
+    last = len(sections) - 1
+    for section in sections:
+        patch = patches.get(section.index)
+        if patch is None or section.index == 0:
+            parts.append(section.text)
+            continue
+        trailing = section.text[len(section.text.rstrip()):]
+        if not trailing:
+            trailing = "\n" if section.index == last else "\n\n"
+        parts.append(_normalize_patch(section, patch) + trailing)
+    return "".join(parts)
+
+
+class SectionPatchParser:
+    """
+    增量解析模型输出的章节补丁
+
+    feed() 返回本次新完成的 (编号, Markdown) 列表：遇到下一个 "@@ n" 标记时
+    上一个章节即完成；finish() 返回最后一个章节。不在 allowed 中的编号被忽略。
+    """
+
+    def __init__(self, sections: List[StageSection], allowed: Optional[Iterable[int]] = None):
+        self.sections = {s.index: s for s in sections if s.index > 0}
+        self.allowed = set(allowed) if allowed else set(self.sections)
+        self.ignored: List[int] = []
+        self._tail = ""
+        self._current: Optional[int] = None
+        self._lines: List[str] = []
+
+    @property
+    def current(self) -> Optional[Tuple[int, str]]:
+        """
+        正在输出的章节及其部分内容（用于实时预览）
+
+        内容只会追加：可能是下一个 "@@ n" 标记开头的未完成行暂不计入
+        """
+        if self._current is None:
+            return None
+        tail = self._tail if self._tail.strip() and not self._tail.lstrip().startswith("@") else ""
+        return self._current, "".join(self._lines) + tail
+
+    def feed(self, text: str) -> List[Tuple[int, str]]:
+        done = []
+        data = self._tail + text
+        lines = data.splitlines(keepends=True)
+        self._tail = lines.pop() if lines and not lines[-1].endswith("\n") else ""
+        for line in lines:
+            marker = _PATCH_MARKER.match(line.strip())
+            if marker:
+                finished = self._close_current()
+                if finished:
+                    done.append(finished)
+                index = int(marker.group(1))
+                if index in self.sections and index in self.allowed:
+                    self._current = index
+                else:
+                    self.ignored.append(index)
+                    self._current = None
+            elif self._current is not None:
+                self._lines.append(line)
+        return done
+
+    def finish(self) -> List[Tuple[int, str]]:
+        done = self.feed("\n") if self._tail else []
+        finished = self._close_current()
+        if finished:
+            done.append(finished)
+        return done
+
+    def _close_current(self) -> Optional[Tuple[int, str]]:
+        index, lines = self._current, self._lines
+        self._current, self._lines = None, []
+        if index is None:
+            return None
+        while lines and (not lines[-1].strip() or _FENCE.match(lines[-1].strip())):
+            lines.pop()
+        body = "".join(lines)
+        if not body.strip():
+            return None
+        return index, _normalize_patch(self.sections[index], body)
@@ -0,0 +1,110 @@
+"""
+流式文本合并 - 将LLM逐token的增量合并为批次后再下发
+
+每个token单独生成一个SSE帧时，json.dumps、日志和网络写入的开销
+会随token数线性增长。这里按"每N毫秒或每M字节，先到先刷新"的策略合并。
+"""
+import asyncio
+from typing import AsyncIterator, Optional
+
+from app.core.config import settings
+
+
+async def coalesce_stream(
+    chunks: AsyncIterator[str],
+    flush_interval_ms: Optional[int] = None,
+    flush_bytes: Optional[int] = None,
+) -> AsyncIterator[str]:
+    """
+    合并文本流中的小块
+
+    即使上游暂时没有新chunk，缓冲区中的内容也会在时间窗口到期时刷新，
+    因此不会因为合并而额外增加可感知的延迟。
+
+    Args:
+        chunks: 上游文本块异步迭代器
+        flush_interval_ms: 刷新时间间隔（毫秒），默认使用settings.stream_flush_interval_ms
+        flush_bytes: 刷新字节阈值（UTF-8），默认使用settings.stream_flush_bytes
+
+    两个阈值都 <= 0 时原样透传每个chunk。
+
+    Yields:
+        str: 合并后的文本块，拼接结果与上游完全一致
+    """
+    interval_ms = settings.stream_flush_interval_ms if flush_interval_ms is None else flush_interval_ms
+    max_bytes = settings.stream_flush_bytes if flush_bytes is None else flush_bytes
+
+    if interval_ms <= 0 and max_bytes <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    interval = interval_ms / 1000 if interval_ms > 0 else None
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buffer = []
+    buffered_bytes = 0
+    deadline = None
+    pending = None
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+
+            timeout = None
+            if buffer and deadline is not None:
+                timeout = max(0.0, deadline - loop.time())
+
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+            if not done:
+                # 时间窗口到期，上游仍未产生新chunk
+                yield "".join(buffer)
+                buffer = []
+                buffered_bytes = 0
+                deadline = None
+                continue
+
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                # 上游出错前已缓冲的文本先下发，再抛出异常
+                if buffer:
+                    yield "".join(buffer)
+                    buffer = []
+                raise
+
+            if not chunk:
+                continue
+
+            if not buffer and interval is not None:
+                deadline = loop.time() + interval
+
+            buffer.append(chunk)
+            buffered_bytes += len(chunk.encode("utf-8"))
+
+            if (max_bytes > 0 and buffered_bytes >= max_bytes) or (
+                deadline is not None and loop.time() >= deadline
+            ):
+                yield "".join(buffer)
+                buffer = []
+                buffered_bytes = 0
+                deadline = None
+
+        if buffer:
+            yield "".join(buffer)
+
+    finally:
+        if pending is not None:
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, Exception):
+                pass
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,95 @@
+"""
+LLM调用的token用量累计
+
+流式请求通过 stream_options.include_usage 要求供应商在最后一个chunk返回usage；
+供应商不支持、或流在usage之前中断/被取消时，按本地分词器（见 context_builder.count_tokens）估算，
+并标记 estimated。调用方创建 TokenUsage 传给 OpenAIClient / Agent（与 RetryBudget 相同的用法），
+调用结束后读取累计值，用于 stage_complete/complete 事件与课程用量记录。
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional
+
+from app.core.context_builder import count_tokens
+
+
+@dataclass
+class TokenUsage:
+    """一次或多次LLM请求的token累计（重试、续写各算一次请求）"""
+
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    calls: int = 0
+    estimated_calls: int = 0  # 没有供应商usage、按本地分词器估算的请求数
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def estimated(self) -> bool:
+        return self.estimated_calls > 0
+
+    def add(
+        self,
+        prompt_tokens: int,
+        completion_tokens: int,
+        cached_tokens: int = 0,
+        estimated: bool = False,
+    ) -> None:
+        """累加一次请求"""
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cached_tokens += cached_tokens
+        self.calls += 1
+        if estimated:
+            self.estimated_calls += 1
+
+    def add_request(
+        self,
+        reported: Optional[Dict[str, int]],
+        messages: Iterable[Dict[str, Any]],
+        completion: str,
+    ) -> None:
+        """
+        累加一次请求：优先使用供应商usage（extract_usage 的解析结果），否则按本地分词器估算
+
+        Args:
+            reported: extract_usage 的返回值，None表示没有收到usage
+            messages: 该请求发送的消息（估算prompt token）
+            completion: 该请求输出的文本（估算completion token）
+        """
+        if reported:
+            self.add(
+                reported["prompt_tokens"],
+                reported.get("completion_tokens", 0),
+                reported.get("cached_tokens", 0),
+            )
+            return
+        prompt = "".join(str(message.get("content") or "") for message in messages)
+        self.add(count_tokens(prompt), count_tokens(completion), estimated=True)
+
+    @classmethod
+    def total(cls, usages: Iterable["TokenUsage"]) -> "TokenUsage":
+        """合计多个用量（如工作流各阶段）"""
+        result = cls()
+        for usage in usages:
+            result.merge(usage)
+        return result
+
+    def merge(self, other: "TokenUsage") -> None:
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cached_tokens += other.cached_tokens
+        self.calls += other.calls
+        self.estimated_calls += other.estimated_calls
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "cached_tokens": self.cached_tokens,
+            "calls": self.calls,
+            "estimated": self.estimated,
+        }
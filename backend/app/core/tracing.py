@@ -0,0 +1,400 @@
+"""
+请求级链路追踪（OpenTelemetry）
+
+一次生成请求的span层级：
+    HTTP请求（TracingMiddleware）
+    └─ workflow.stream / workflow.section_edit
+       └─ agentN.generate_stream / section_edit.edit_stream
+          └─ llm.stream
+             └─ llm.chat.completions.create（每次请求/重试/续写一个）
+    ├─ sse.flush（每次SSE写出）
+    └─ db SELECT/INSERT/...（SQLAlchemy查询）
+
+trace_id 通过响应头 X-Trace-Id 返回，工作流的 start 事件中也携带 trace_id；
+请求头带 traceparent 时沿用调用方的trace。
+
+导出方式由 tracing_exporter 配置：
+- none：只生成trace_id，不导出span（默认）
+- file：每行一个span的JSON，写入 tracing_file_path
+- console：输出到标准输出
+- otlp：OTLP/HTTP导出到 tracing_otlp_endpoint（需要安装 opentelemetry-exporter-otlp-proto-http）
+
+异步生成器不能用 start_as_current_span 跨越yield（会把span泄漏给调用方），
+因此用 trace_stream 包装：每次拉取下一项时临时把span设为当前span，
+生成器内部发起的下游span（LLM调用、数据库查询）都挂在它下面。
+"""
+import asyncio
+import functools
+import json
+import logging
+import re
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional, Sequence, TypeVar
+
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    ConsoleSpanExporter,
+    SimpleSpanProcessor,
+    SpanExporter,
+    SpanExportResult,
+)
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import SpanKind, Status, StatusCode, format_span_id, format_trace_id
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+from sqlalchemy import event
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "pbl-course-agent"
+TRACE_ID_HEADER = "X-Trace-Id"
+# 不追踪的路径（Prometheus抓取与健康检查）
+UNTRACED_PATHS = ("/metrics", "/health")
+
+# SSE事件类型：workflow 使用 "event"，对话使用 "type"
+_SSE_EVENT_TYPE = re.compile(r'"(?:event|type)":\s*"(\w+)"')
+
+T = TypeVar("T")
+
+
+# ========== 导出 ==========
+
+
+def span_to_dict(span: ReadableSpan) -> Dict[str, Any]:
+    """span的JSON表示（字段与OTLP对应，ID为十六进制）"""
+    context = span.get_span_context()
+    start, end = span.start_time or 0, span.end_time or 0
+    return {
+        "trace_id": format_trace_id(context.trace_id),
+        "span_id": format_span_id(context.span_id),
+        "parent_span_id": format_span_id(span.parent.span_id) if span.parent else None,
+        "name": span.name,
+        "kind": span.kind.name,
+        "start_time_unix_nano": start,
+        "end_time_unix_nano": end,
+        "duration_ms": round((end - start) / 1e6, 3),
+        "status": span.status.status_code.name,
+        "attributes": dict(span.attributes or {}),
+        "events": [
+            {"name": e.name, "time_unix_nano": e.timestamp, "attributes": dict(e.attributes or {})}
+            for e in span.events
+        ],
+    }
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """把span追加写入本地JSON Lines文件（collector的本地替代）"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        try:
+            lines = "".join(json.dumps(span_to_dict(s), ensure_ascii=False, default=str) + "\n" for s in spans)
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            return SpanExportResult.SUCCESS
+        except Exception as e:
+            logger.warning(f"[Tracing] Failed to write spans to {self.path}: {e}")
+            return SpanExportResult.FAILURE
+
+    def shutdown(self) -> None:
+        pass
+
+
+def build_exporter(name: str) -> Optional[SpanExporter]:
+    """按配置创建导出器；none或不可用时返回None（只生成trace_id）"""
+    name = (name or "none").lower()
+    if name == "file":
+        return JsonLinesSpanExporter(settings.tracing_file_path)
+    if name == "console":
+        return ConsoleSpanExporter()
+    if name == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError as e:
+            logger.warning(f"[Tracing] OTLP exporter unavailable ({e}), spans will not be exported")
+            return None
+        return OTLPSpanExporter(endpoint=settings.tracing_otlp_endpoint)
+    if name != "none":
+        logger.warning(f"[Tracing] Unknown tracing_exporter '{name}', spans will not be exported")
+    return None
+
+
+class Tracing:
+    """
+    TracerProvider 及其导出器
+
+    不注册为OpenTelemetry全局provider，测试中可以创建新实例替换单例。
+    """
+
+    def __init__(
+        self,
+        exporter: Optional[SpanExporter] = None,
+        sample_ratio: float = 1.0,
+        enabled: bool = True,
+        batch: bool = True,
+    ):
+        self.provider: Optional[TracerProvider] = None
+        if not enabled:
+            self.tracer = trace.NoOpTracer()
+            return
+        self.provider = TracerProvider(
+            resource=Resource.create({"service.name": SERVICE_NAME}),
+            sampler=ParentBased(TraceIdRatioBased(sample_ratio)),
+        )
+        if exporter is not None:
+            processor = BatchSpanProcessor(exporter) if batch else SimpleSpanProcessor(exporter)
+            self.provider.add_span_processor(processor)
+        self.tracer = self.provider.get_tracer(__name__)
+
+    def shutdown(self) -> None:
+        """导出剩余span并关闭导出器"""
+        if self.provider is not None:
+            self.provider.shutdown()
+
+
+# 全局单例
+_tracing: Optional[Tracing] = None
+
+
+def get_tracing() -> Tracing:
+    """获取链路追踪单例（按配置创建）"""
+    global _tracing
+    if _tracing is None:
+        _tracing = Tracing(
+            exporter=build_exporter(settings.tracing_exporter) if settings.tracing_enabled else None,
+            sample_ratio=settings.tracing_sample_ratio,
+            enabled=settings.tracing_enabled,
+        )
+    return _tracing
+
+
+def get_tracer() -> trace.Tracer:
+    return get_tracing().tracer
+
+
+def shutdown_tracing() -> None:
+    """应用关闭时导出剩余span；之后再次使用时按配置重新创建"""
+    global _tracing
+    if _tracing is not None:
+        tracing, _tracing = _tracing, None
+        tracing.shutdown()
+
+
+# ========== span辅助 ==========
+
+
+def current_trace_id() -> Optional[str]:
+    """当前span的trace_id（十六进制），不在追踪上下文中时返回None"""
+    context = trace.get_current_span().get_span_context()
+    return format_trace_id(context.trace_id) if context.is_valid else None
+
+
+def set_span_attributes(**attributes: Any) -> None:
+    """给当前span添加属性（忽略None）"""
+    span = trace.get_current_span()
+    if not span.is_recording():
+        return
+    for key, value in attributes.items():
+        if value is not None:
+            span.set_attribute(key, value)
+
+
+def add_span_event(name: str, **attributes: Any) -> None:
+    """给当前span添加事件（如首个token）"""
+    span = trace.get_current_span()
+    if span.is_recording():
+        span.add_event(name, {k: v for k, v in attributes.items() if v is not None})
+
+
+@contextmanager
+def start_span(name: str, kind: SpanKind = SpanKind.INTERNAL, **attributes: Any) -> Iterator[trace.Span]:
+    """同步/单次await范围内的span（不可跨越yield）"""
+    with get_tracer().start_as_current_span(
+        name, kind=kind, attributes={k: v for k, v in attributes.items() if v is not None}
+    ) as span:
+        yield span
+
+
+async def trace_stream(name: str, agen: AsyncIterator[T], **attributes: Any) -> AsyncIterator[T]:
+    """
+    用span包装异步生成器
+
+    span从第一次拉取开始到生成器结束（或被关闭）为止；每次拉取时span为当前span，
+    两次拉取之间不影响调用方的上下文。下游关闭（客户端断开）时标记 cancelled=True。
+    """
+    span = get_tracer().start_span(name, attributes={k: v for k, v in attributes.items() if v is not None})
+    ctx = trace.set_span_in_context(span)
+    try:
+        while True:
+            token = otel_context.attach(ctx)
+            try:
+                item = await agen.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                otel_context.detach(token)
+            yield item
+    except (GeneratorExit, asyncio.CancelledError):
+        span.set_attribute("cancelled", True)
+        raise
+    except Exception as e:
+        span.record_exception(e)
+        span.set_status(Status(StatusCode.ERROR, str(e)))
+        raise
+    finally:
+        # 关闭内层生成器（其清理代码仍在该span下执行）
+        token = otel_context.attach(ctx)
+        try:
+            await agen.aclose()
+        finally:
+            otel_context.detach(token)
+            span.end()
+
+
+def traced_stream(name: str) -> Callable[[Callable[..., AsyncIterator[T]]], Callable[..., AsyncIterator[T]]]:
+    """异步生成器函数的装饰器，见 trace_stream"""
+
+    def decorator(func: Callable[..., AsyncIterator[T]]) -> Callable[..., AsyncIterator[T]]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> AsyncIterator[T]:
+            return trace_stream(name, func(*args, **kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+async def trace_sse(events: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    为每次SSE写出创建 sse.flush span
+
+    span覆盖yield到下一次拉取之间，即StreamingResponse把该事件写入连接的时间
+    （客户端读取慢、发送缓冲区满时变长）。
+    """
+    tracer = get_tracer()
+    seq = 0
+    try:
+        async for payload in events:
+            if not settings.tracing_sse_spans:
+                yield payload
+                continue
+            seq += 1
+            match = _SSE_EVENT_TYPE.search(payload, 0, 200)
+            span = tracer.start_span("sse.flush", attributes={
+                "sse.seq": seq,
+                "sse.bytes": len(payload.encode("utf-8")),
+                "sse.event": match.group(1) if match else "",
+            })
+            try:
+                yield payload
+            finally:
+                span.end()
+    finally:
+        aclose = getattr(events, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+# ========== HTTP ==========
+
+
+class TracingMiddleware:
+    """
+    ASGI中间件：每个HTTP请求一个根span（流式响应直到最后一个事件写出为止），
+    响应头添加 X-Trace-Id
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.propagator = TraceContextTextMapPropagator()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in UNTRACED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        method, path = scope["method"], scope["path"]
+        with get_tracer().start_as_current_span(
+            f"{method} {path}",
+            context=self.propagator.extract(headers),
+            kind=SpanKind.SERVER,
+            attributes={"http.method": method, "http.target": path},
+        ) as span:
+            trace_id = current_trace_id()
+
+            async def send_with_trace_id(message):
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    span.set_attribute("http.status_code", status)
+                    if status >= 500:
+                        span.set_status(Status(StatusCode.ERROR))
+                    if trace_id:
+                        message = dict(message)
+                        message["headers"] = [
+                            *message.get("headers", []),
+                            (TRACE_ID_HEADER.lower().encode("latin-1"), trace_id.encode("latin-1")),
+                        ]
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace_id)
+
+
+# ========== 数据库 ==========
+
+
+def instrument_engine(engine) -> None:
+    """为SQLAlchemy引擎（同步或异步）的每条SQL创建span，重复调用无副作用"""
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if getattr(sync_engine, "_pbl_traced", False):
+        return
+    sync_engine._pbl_traced = True
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(sync_engine, "handle_error", _handle_db_error)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "SQL"
+    context._pbl_span = get_tracer().start_span(
+        f"db {operation}",
+        kind=SpanKind.CLIENT,
+        attributes={
+            "db.system": conn.dialect.name,
+            "db.operation": operation,
+            "db.statement": statement[: settings.tracing_db_statement_max_chars],
+            "db.executemany": executemany,
+        },
+    )
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    span = getattr(context, "_pbl_span", None)
+    if span is not None:
+        if cursor is not None and cursor.rowcount is not None and cursor.rowcount >= 0:
+            span.set_attribute("db.rowcount", cursor.rowcount)
+        span.end()
+        context._pbl_span = None
+
+
+def _handle_db_error(exception_context):
+    context = exception_context.execution_context
+    span = getattr(context, "_pbl_span", None)
+    if span is not None:
+        error = exception_context.original_exception
+        span.record_exception(error)
+        span.set_status(Status(StatusCode.ERROR, str(error)))
+        span.end()
+        context._pbl_span = None
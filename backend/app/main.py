@@ -1,9 +1,12 @@
 """
 FastAPI主应用程序
 """
-from fastapi import FastAPI
+import asyncio
+
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
+from app.core.tracing import TRACE_ID_HEADER, TracingMiddleware
 from app.api.routes import router
 
 
@@ -32,8 +35,12 @@ def create_app() -> FastAPI:
         allow_credentials=True,
         allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
         allow_headers=["*"],
+        expose_headers=[TRACE_ID_HEADER],
     )
 
+    # 链路追踪：每个请求一个根span，响应头返回 X-Trace-Id（最外层，覆盖CORS处理）
+    app.add_middleware(TracingMiddleware)
+
     # 注册路由
     app.include_router(router, prefix="/api/v1")
 
@@ -41,10 +48,93 @@ def create_app() -> FastAPI:
     from app.api.v1.generate import router as workflow_router
     from app.api.v1.course import router as course_router
     from app.api.v1.chat import router as chat_router
+    from app.api.v1.batch import router as batch_router
 
     app.include_router(workflow_router)  # 已包含/api/v1前缀
     app.include_router(course_router)    # 已包含/api/v1/courses前缀
     app.include_router(chat_router)      # 已包含/api/v1前缀
+    app.include_router(batch_router)     # 已包含/api/v1/batches前缀
+
+    # 幂等迁移：为已有数据库补建新增索引等
+    @app.on_event("startup")
+    async def run_migrations():
+        from app.core.database import engine
+        from app.core.migrations import run_startup_migrations
+
+        await asyncio.to_thread(run_startup_migrations, engine)
+
+        # 续跑进程退出前未完成的批量生成任务（跳过已完成的课程）
+        if settings.batch_resume_on_startup:
+            from app.services.batch_generation import get_batch_service
+
+            await get_batch_service().resume_incomplete()
+
+    # PHR提示词注册表：启动时解析并校验全部提示词文件，后台监听文件变化
+    from app.core.prompt_registry import get_prompt_registry
+
+    @app.on_event("startup")
+    async def load_prompt_registry():
+        registry = get_prompt_registry()
+        registry.load_all()
+        app.state.prompt_watcher = asyncio.create_task(registry.watch())
+
+    # 语义验证模型：后台加载并预计算参考示例向量，首次验证无需等待
+    @app.on_event("startup")
+    async def warm_up_validation():
+        if settings.validation_warmup_on_startup:
+            from app.services.validation_service import get_validation_service
+
+            app.state.validation_warmup = asyncio.create_task(get_validation_service().warm_up_async())
+
+    @app.on_event("shutdown")
+    async def stop_prompt_watcher():
+        watcher = getattr(app.state, "prompt_watcher", None)
+        if watcher is not None:
+            watcher.cancel()
+
+    # 关闭顺序：先停止后台生成（正在生成的课程放回待生成状态），再关闭LLM连接池，
+    # 最后写完阶段结果与用量记录
+    @app.on_event("shutdown")
+    async def stop_generation_jobs():
+        from app.services.generation_jobs import get_job_manager
+
+        await get_job_manager().close()
+
+    @app.on_event("shutdown")
+    async def stop_batch_jobs():
+        from app.services.batch_generation import get_batch_service
+
+        await get_batch_service().close()
+
+    @app.on_event("shutdown")
+    async def close_llm_transport():
+        from app.core.llm_transport import get_llm_transport
+
+        await get_llm_transport().aclose()
+
+    @app.on_event("shutdown")
+    async def flush_stage_writer():
+        from app.services.stage_writer import get_stage_writer
+
+        await get_stage_writer().close()
+
+    @app.on_event("shutdown")
+    async def flush_usage_recorder():
+        from app.services.usage_recorder import get_usage_recorder
+
+        await get_usage_recorder().close()
+
+    @app.on_event("shutdown")
+    async def close_async_db():
+        from app.core.database import dispose_async_engine
+
+        await dispose_async_engine()
+
+    @app.on_event("shutdown")
+    async def flush_traces():
+        from app.core.tracing import shutdown_tracing
+
+        await asyncio.to_thread(shutdown_tracing)
 
     return app
 
@@ -56,4 +146,13 @@ app = create_app()
 async def health_check():
     """健康检查端点"""
     from app.models.schemas import HealthCheck
-    return HealthCheck()
\ No newline at end of file
+    return HealthCheck()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus指标：排队等待、TTFT、输出速率、token、重试、取消与阶段SLO"""
+    from app.core.metrics import get_metrics
+
+    content, content_type = get_metrics().render()
+    return Response(content=content, media_type=content_type)
@@ -19,6 +19,11 @@ from app.models.schemas import (
     Stage3Output,
 )
 from app.models.course_project import CourseProject
+from app.models.generation_cache import GenerationCacheEntry
+from app.models.generation_job import GenerationJobEvent
+from app.models.conversation_message import CourseConversationMessage
+from app.models.batch_job import BatchJob, BatchJobItem
+from app.models.llm_usage import LLMUsageRecord
 
 # V3 UbD Data Models
 from app.models.stage_data import (
@@ -64,6 +69,12 @@ __all__ = [
     "Stage3Output",
     # ORM
     "CourseProject",
+    "GenerationCacheEntry",
+    "GenerationJobEvent",
+    "CourseConversationMessage",
+    "BatchJob",
+    "BatchJobItem",
+    "LLMUsageRecord",
     # V3 Stage Models
     "StageOneData",
     "GoalItem",
@@ -0,0 +1,51 @@
+"""
+批量课程生成数据模型 - SQLAlchemy ORM
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, JSON, String, Text
+from app.core.database import Base
+
+
+class BatchJob(Base):
+    """
+    批量生成任务
+    一次提交的多门课程，状态持久化以便进程重启后续跑
+    """
+    __tablename__ = "batch_jobs"
+
+    id = Column(String(32), primary_key=True)
+    status = Column(String(20), nullable=False, default="pending", comment="pending/running/completed/cancelled")
+    concurrency = Column(Integer, nullable=False, default=1, comment="同时生成的课程数上限")
+    use_cache = Column(Integer, nullable=False, default=1, comment="是否使用生成缓存")
+    total = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<BatchJob(id='{self.id}', status='{self.status}')>"
+
+
+class BatchJobItem(Base):
+    """
+    批量任务中的一门课程
+    completed 的条目在续跑时跳过；生成结果与条目状态在同一事务中提交
+    """
+    __tablename__ = "batch_job_items"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    batch_id = Column(String(32), nullable=False)
+    position = Column(Integer, nullable=False, comment="在提交列表中的序号（从0开始）")
+    spec = Column(JSON, nullable=False, comment="课程信息（title/subject/grade_level/...）")
+    status = Column(String(20), nullable=False, default="pending", comment="pending/running/completed/failed")
+    attempts = Column(Integer, nullable=False, default=0)
+    course_id = Column(Integer, nullable=True, comment="生成成功后写入的 CourseProject.id")
+    error = Column(Text, nullable=True)
+    generation_time = Column(Float, nullable=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_batch_job_items_batch_position", "batch_id", "position"),)
+
+    def __repr__(self):
+        return f"<BatchJobItem(batch_id='{self.batch_id}', position={self.position}, status='{self.status}')>"
@@ -0,0 +1,42 @@
+"""
+课程对话消息数据模型 - SQLAlchemy ORM
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index
+from app.core.database import Base
+
+
+class CourseConversationMessage(Base):
+    """
+    课程对话消息（只追加）
+    每条消息一行，取代 CourseProject.conversation_history 整列JSON的读改写
+    """
+    __tablename__ = "conversation_messages"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    course_id = Column(Integer, ForeignKey("course_projects.id", ondelete="CASCADE"), nullable=False)
+    role = Column(String(20), nullable=False, comment="user | assistant | system")
+    content = Column(Text, nullable=False)
+    step = Column(Integer, nullable=True, comment="所属步骤 (1-3)")
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # 按步骤过滤的游标读取
+        Index("ix_conversation_messages_course_step_created", "course_id", "step", "created_at"),
+        # 不按步骤过滤时的游标读取
+        Index("ix_conversation_messages_course_created", "course_id", "created_at"),
+    )
+
+    def to_dict(self) -> dict:
+        """与旧版JSON历史保持相同的消息格式"""
+        return {
+            "id": str(self.id),
+            "role": self.role,
+            "content": self.content,
+            "step": self.step,
+            "timestamp": self.created_at.isoformat() if self.created_at else None,
+        }
+
+    def __repr__(self):
+        return f"<CourseConversationMessage(course_id={self.course_id}, id={self.id}, step={self.step})>"
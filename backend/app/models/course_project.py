@@ -1,7 +1,7 @@
 """
 课程项目数据模型 - SQLAlchemy ORM
 """
-from sqlalchemy import Column, Integer, String, Text, DateTime, JSON
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, Index
 from sqlalchemy.sql import func
 from app.core.database import Base
 
@@ -12,6 +12,10 @@ class CourseProject(Base):
     存储完整的UbD-PBL课程设计项目
     """
     __tablename__ = "course_projects"
+    __table_args__ = (
+        # 课程列表按 (updated_at, id) 键集分页
+        Index("ix_course_projects_updated_at_id", "updated_at", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(255), nullable=False, index=True)
@@ -34,6 +38,7 @@ class CourseProject(Base):
     stage_three_data = Column(Text, nullable=True, comment="Stage Three Markdown: PBL Phases with Activities")
 
     # 对话历史记录 - 用于User Story 3 (会话持久化)
+    # 已迁移到 conversation_messages 表（见 app/core/migrations.py），此列仅保留旧数据兼容
     conversation_history = Column(
         JSON,
         nullable=True,
@@ -46,6 +51,13 @@ class CourseProject(Base):
     stage_two_version = Column(DateTime(timezone=True), nullable=True, server_default=func.now())
     stage_three_version = Column(DateTime(timezone=True), nullable=True, server_default=func.now())
 
+    # 依赖追踪 - 各阶段生成时的输入内容哈希，用于判断阶段是否过期（见 app/core/stage_dependencies.py）
+    stage_sources = Column(
+        JSON,
+        nullable=True,
+        comment="Content hashes of the inputs each stage was generated from",
+    )
+
     # 元数据
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
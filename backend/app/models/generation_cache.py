@@ -0,0 +1,30 @@
+"""
+生成结果缓存数据模型 - SQLAlchemy ORM
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, Text, DateTime
+from app.core.database import Base
+
+
+class GenerationCacheEntry(Base):
+    """
+    Agent生成结果缓存
+    以 (agent, model, phr_version, user_prompt, temperature) 的哈希为键存储最终Markdown
+    """
+    __tablename__ = "generation_cache"
+
+    cache_key = Column(String(64), primary_key=True, comment="SHA-256内容哈希")
+    agent = Column(String(100), nullable=False)
+    model = Column(String(100), nullable=True)
+    phr_version = Column(String(50), nullable=True)
+
+    content = Column(Text, nullable=False, comment="生成的Markdown")
+    hit_count = Column(Integer, nullable=False, default=0)
+
+    # 使用UTC naive时间，便于TTL和LRU比较
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_accessed_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"<GenerationCacheEntry(agent='{self.agent}', key='{self.cache_key[:12]}')>"
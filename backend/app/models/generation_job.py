@@ -0,0 +1,26 @@
+"""
+生成任务事件日志数据模型 - SQLAlchemy ORM
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, Index
+from app.core.database import Base
+
+
+class GenerationJobEvent(Base):
+    """
+    生成任务的SSE事件（内存事件日志溢出时写入）
+    用于客户端以较早的 Last-Event-ID 重连时回放
+    """
+    __tablename__ = "generation_job_events"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    job_id = Column(String(32), nullable=False)
+    seq = Column(Integer, nullable=False, comment="任务内事件序号（即SSE id）")
+    payload = Column(Text, nullable=False, comment="SSE data行内容")
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (Index("ix_generation_job_events_job_seq", "job_id", "seq"),)
+
+    def __repr__(self):
+        return f"<GenerationJobEvent(job_id='{self.job_id}', seq={self.seq})>"
@@ -0,0 +1,34 @@
+"""
+课程LLM用量记录 - SQLAlchemy ORM
+"""
+from datetime import datetime
+
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, String
+from app.core.database import Base
+
+
+class LLMUsageRecord(Base):
+    """
+    课程的LLM token用量（只追加）
+    每次阶段生成、局部修改或对话一行，用于容量规划与按学校的成本核算
+    """
+    __tablename__ = "llm_usage_records"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    course_id = Column(Integer, ForeignKey("course_projects.id", ondelete="CASCADE"), nullable=False)
+    operation = Column(String(20), nullable=False, comment="generate | section_edit | chat")
+    stage = Column(Integer, nullable=True, comment="阶段 (1-3)，对话为空")
+    model = Column(String(100), nullable=True)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    cached_tokens = Column(Integer, nullable=False, default=0)
+    calls = Column(Integer, nullable=False, default=0, comment="上游请求数（含重试与续写）")
+    estimated = Column(Boolean, nullable=False, default=False, comment="部分请求没有usage，按本地分词器估算")
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_llm_usage_records_course_created", "course_id", "created_at"),
+    )
+
+    def __repr__(self):
+        return f"<LLMUsageRecord(course_id={self.course_id}, operation={self.operation}, stage={self.stage})>"
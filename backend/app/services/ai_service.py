@@ -5,6 +5,7 @@ import asyncio
 from typing import Optional, List, Dict, Any
 from openai import AsyncOpenAI
 from app.core.config import settings
+from app.core.llm_transport import get_llm_transport
 
 
 class AIService:
@@ -12,14 +13,15 @@ class AIService:
 
     def __init__(self):
         """初始化AI服务"""
-        self.client = AsyncOpenAI(
-            api_key=settings.openai_api_key,
-            base_url=settings.openai_base_url
-        )
         self.model = settings.openai_model
         self.temperature = settings.openai_temperature
         self.max_tokens = settings.openai_max_tokens
 
+    @property
+    def client(self) -> AsyncOpenAI:
+        """复用进程内共享连接池的AsyncOpenAI实例（每次从传输层获取，连接池关闭重建后不会失效）"""
+        return get_llm_transport().get_client()
+
     async def chat_completion(
         self,
         messages: List[Dict[str, str]],
@@ -0,0 +1,595 @@
+"""
+批量课程生成
+
+学期初一次性生成多门课程：提交课程清单（CSV/JSON）后在后台以有限并发调用
+WorkflowServiceV3.generate_workflow，每门课程完成后写入 CourseProject。
+
+- 批量任务与每门课程的状态持久化在 batch_jobs / batch_job_items 表
+- 课程结果与条目状态在同一事务中提交，续跑时跳过已完成的课程
+- 进程崩溃后，启动时（或通过 CLI / API）续跑中断的任务
+
+命令行：
+    python -m app.services.batch_generation run courses.csv --concurrency 3
+    python -m app.services.batch_generation resume [batch_id]
+    python -m app.services.batch_generation status <batch_id>
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import sys
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from pydantic import BaseModel, Field, ValidationError, field_validator
+
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.core.llm_transport import resolve_model
+from app.core.stage_dependencies import stage_sources
+from app.models.batch_job import BatchJob, BatchJobItem
+from app.models.course_project import CourseProject
+from app.services.usage_recorder import OPERATION_GENERATE, UsageRecorder, get_usage_recorder
+
+logger = logging.getLogger(__name__)
+
+BATCH_PENDING = "pending"
+BATCH_RUNNING = "running"
+BATCH_COMPLETED = "completed"
+BATCH_CANCELLED = "cancelled"
+
+ITEM_PENDING = "pending"
+ITEM_RUNNING = "running"
+ITEM_COMPLETED = "completed"
+ITEM_FAILED = "failed"
+
+
+class CourseSpec(BaseModel):
+    """批量任务中的一门课程（字段与 WorkflowRequest 的课程信息一致）"""
+
+    title: str = Field(..., min_length=1, description="课程名称")
+    subject: str = Field("", description="学科领域")
+    grade_level: str = Field("", description="年级水平")
+    total_class_hours: Optional[int] = Field(None, ge=1, description="总课时数（按45分钟标准课时）")
+    schedule_description: str = Field("", description="上课周期描述")
+    description: str = Field("", description="课程简介")
+
+    @field_validator("total_class_hours", mode="before")
+    @classmethod
+    def _empty_hours(cls, value):
+        # CSV中的空单元格
+        if isinstance(value, str) and not value.strip():
+            return None
+        return value
+
+    @field_validator("title", "subject", "grade_level", "schedule_description", "description", mode="before")
+    @classmethod
+    def _strip_text(cls, value):
+        return "" if value is None else str(value).strip()
+
+
+def parse_course_specs(content: str, fmt: Optional[str] = None) -> List[CourseSpec]:
+    """
+    解析课程清单
+
+    Args:
+        content: CSV（首行为表头，列名与 CourseSpec 字段一致）或 JSON
+            （课程对象数组，或 {"courses": [...]}）
+        fmt: "csv" / "json"，默认按内容判断
+
+    Raises:
+        ValueError: 格式错误或某门课程信息无效（消息中带有序号）
+    """
+    content = content.lstrip("\ufeff")
+    if fmt is None:
+        fmt = "json" if content.lstrip()[:1] in ("[", "{") else "csv"
+
+    if fmt == "json":
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSON格式错误: {e}")
+        if isinstance(data, dict):
+            data = data.get("courses")
+        if not isinstance(data, list):
+            raise ValueError("JSON课程清单应为数组或 {\"courses\": [...]}")
+        rows = data
+    elif fmt == "csv":
+        rows = [
+            {key.strip(): value for key, value in row.items() if key}
+            for row in csv.DictReader(io.StringIO(content))
+        ]
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+    specs = []
+    for number, row in enumerate(rows, start=1):
+        try:
+            specs.append(CourseSpec.model_validate(row))
+        except ValidationError as e:
+            errors = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+            raise ValueError(f"第{number}门课程无效: {errors}")
+    if not specs:
+        raise ValueError("课程清单为空")
+    return specs
+
+
+class BatchGenerationService:
+    """
+    批量生成服务
+
+    使用方式：
+        batch_id = service.create(specs, concurrency=3)
+        service.start(batch_id)          # 后台运行
+        service.status(batch_id)         # 查询每门课程的进度与错误
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable = SessionLocal,
+        workflow_factory: Optional[Callable] = None,
+        usage_recorder: Optional[UsageRecorder] = None,
+    ):
+        self.session_factory = session_factory
+        self._workflow_factory = workflow_factory
+        self.usage_recorder = usage_recorder or get_usage_recorder()
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    @property
+    def workflow(self):
+        if self._workflow_factory is None:
+            from app.services.workflow_service_v3 import get_workflow_service_v3
+
+            self._workflow_factory = get_workflow_service_v3
+        return self._workflow_factory()
+
+    # ========== 任务管理 ==========
+
+    def create(
+        self,
+        specs: Iterable[CourseSpec],
+        concurrency: Optional[int] = None,
+        use_cache: bool = True,
+    ) -> str:
+        """创建批量任务（不启动），返回任务ID"""
+        specs = list(specs)
+        if not specs:
+            raise ValueError("课程清单为空")
+        if len(specs) > settings.batch_max_courses:
+            raise ValueError(f"单个批量任务最多 {settings.batch_max_courses} 门课程")
+        concurrency = concurrency or settings.batch_default_concurrency
+        concurrency = max(1, min(concurrency, settings.batch_max_concurrency))
+
+        batch_id = uuid.uuid4().hex
+        db = self.session_factory()
+        try:
+            db.add(BatchJob(
+                id=batch_id,
+                status=BATCH_PENDING,
+                concurrency=concurrency,
+                use_cache=int(use_cache),
+                total=len(specs),
+            ))
+            db.add_all(
+                BatchJobItem(batch_id=batch_id, position=position, spec=spec.model_dump(), status=ITEM_PENDING)
+                for position, spec in enumerate(specs)
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        logger.info(f"[Batch] Created batch {batch_id}: {len(specs)} courses, concurrency={concurrency}")
+        return batch_id
+
+    def is_running(self, batch_id: str) -> bool:
+        task = self._tasks.get(batch_id)
+        return task is not None and not task.done()
+
+    def start(self, batch_id: str, retry_failed: bool = False) -> bool:
+        """
+        在后台运行（或续跑）批量任务
+
+        Returns:
+            是否启动了新的后台任务（已在运行时返回False）
+        """
+        if self.is_running(batch_id):
+            return False
+        self._tasks[batch_id] = asyncio.get_running_loop().create_task(
+            self.run(batch_id, retry_failed=retry_failed)
+        )
+        return True
+
+    async def resume_incomplete(self) -> List[str]:
+        """续跑所有未结束的批量任务（启动时调用）；失败只记录日志"""
+        try:
+            batch_ids = await asyncio.to_thread(self.incomplete_batches)
+        except Exception as e:
+            logger.error(f"[Batch] Failed to load interrupted batches: {e}")
+            return []
+        started = [batch_id for batch_id in batch_ids if self.start(batch_id)]
+        if started:
+            logger.info(f"[Batch] Resuming {len(started)} interrupted batches: {started}")
+        return started
+
+    async def cancel(self, batch_id: str) -> bool:
+        """取消批量任务；正在生成的课程放回待生成状态，之后可续跑"""
+        task = self._tasks.get(batch_id)
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        return await asyncio.to_thread(self._mark_cancelled, batch_id)
+
+    async def close(self) -> None:
+        """停止全部后台任务；状态保留，下次启动时续跑"""
+        tasks = [task for task in self._tasks.values() if not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # ========== 运行 ==========
+
+    async def run(
+        self,
+        batch_id: str,
+        retry_failed: bool = False,
+        on_update: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Dict[str, Any]:
+        """
+        运行批量任务直到全部课程结束，跳过已完成的课程
+
+        Args:
+            retry_failed: 是否重新生成此前失败的课程
+            on_update: 每门课程状态变化时的回调（参数为该课程的状态字典）
+
+        Returns:
+            任务状态（同 status()）
+        """
+        batch, items = await asyncio.to_thread(self._prepare_run, batch_id, retry_failed)
+        semaphore = asyncio.Semaphore(batch["concurrency"])
+        logger.info(
+            f"[Batch] Running batch {batch_id}: {len(items)} of {batch['total']} courses to generate, "
+            f"concurrency={batch['concurrency']}"
+        )
+
+        async def run_item(item: Dict[str, Any]) -> None:
+            async with semaphore:
+                await self._run_item(batch_id, item, batch["use_cache"], on_update)
+
+        await asyncio.gather(*(run_item(item) for item in items))
+        await asyncio.to_thread(self._finish_batch, batch_id)
+        return await asyncio.to_thread(self.status, batch_id)
+
+    async def _run_item(
+        self,
+        batch_id: str,
+        item: Dict[str, Any],
+        use_cache: bool,
+        on_update: Optional[Callable[[Dict[str, Any]], None]],
+    ) -> None:
+        """生成一门课程；任何错误（含写入数据库失败）只标记该课程失败，不中断整个批量任务"""
+        try:
+            await self._generate_item(batch_id, item, use_cache, on_update)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[Batch] {batch_id} course #{item['position']} could not be saved: {e}", exc_info=True)
+            error = str(e) or type(e).__name__
+            try:
+                await asyncio.to_thread(self._mark_item, item["id"], ITEM_FAILED, error)
+            except Exception as mark_error:
+                logger.error(f"[Batch] {batch_id} course #{item['position']} status update failed: {mark_error}")
+            self._notify(on_update, {**item, "status": ITEM_FAILED, "error": error})
+
+    async def _generate_item(
+        self,
+        batch_id: str,
+        item: Dict[str, Any],
+        use_cache: bool,
+        on_update: Optional[Callable[[Dict[str, Any]], None]],
+    ) -> None:
+        spec = item["spec"]
+        await asyncio.to_thread(self._mark_item, item["id"], ITEM_RUNNING)
+        self._notify(on_update, {**item, "status": ITEM_RUNNING})
+
+        try:
+            result = await self.workflow.generate_workflow(
+                **spec, use_cache=use_cache, tenant=f"batch:{batch_id}"
+            )
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self._mark_item, item["id"], ITEM_PENDING)
+            raise
+        except Exception as e:
+            logger.error(f"[Batch] {batch_id} course #{item['position']} crashed: {e}", exc_info=True)
+            result = {"success": False, "error": str(e)}
+
+        if result.get("success"):
+            course_id = await asyncio.to_thread(self._complete_item, item["id"], spec, result)
+            self._record_usage(course_id, result)
+            logger.info(
+                f"[Batch] {batch_id} course #{item['position']} 《{spec['title']}》 -> course {course_id} "
+                f"({result.get('total_time', 0):.1f}s)"
+            )
+            self._notify(on_update, {**item, "status": ITEM_COMPLETED, "course_id": course_id})
+        else:
+            error = result.get("error") or "unknown error"
+            await asyncio.to_thread(self._mark_item, item["id"], ITEM_FAILED, error)
+            logger.warning(f"[Batch] {batch_id} course #{item['position']} 《{spec['title']}》 failed: {error}")
+            self._notify(on_update, {**item, "status": ITEM_FAILED, "error": error})
+
+    def _record_usage(self, course_id: int, result: Dict[str, Any]) -> None:
+        """课程写入后按阶段记录token用量（命中缓存的阶段不记录）"""
+        for stage, usage in (result.get("token_usage") or {}).items():
+            self.usage_recorder.record(course_id, OPERATION_GENERATE, usage, model=resolve_model(f"agent{stage}"), stage=stage)
+
+    def _notify(self, on_update, item: Dict[str, Any]) -> None:
+        if on_update is None:
+            return
+        try:
+            on_update(item)
+        except Exception as e:
+            logger.warning(f"[Batch] Progress callback failed: {e}")
+
+    # ========== 数据库操作（在线程池中执行） ==========
+
+    def incomplete_batches(self) -> List[str]:
+        """未结束（待运行或运行中断）的批量任务ID"""
+        db = self.session_factory()
+        try:
+            rows = db.query(BatchJob.id).filter(BatchJob.status.in_([BATCH_PENDING, BATCH_RUNNING]))
+            return [batch_id for (batch_id,) in rows.order_by(BatchJob.created_at)]
+        finally:
+            db.close()
+
+    def _prepare_run(self, batch_id: str, retry_failed: bool):
+        """标记任务运行中，返回需要生成的课程（中断时处于running的课程重新生成）"""
+        db = self.session_factory()
+        try:
+            batch = db.get(BatchJob, batch_id)
+            if batch is None:
+                raise KeyError(batch_id)
+            statuses = [ITEM_PENDING, ITEM_RUNNING] + ([ITEM_FAILED] if retry_failed else [])
+            items = (
+                db.query(BatchJobItem)
+                .filter(BatchJobItem.batch_id == batch_id, BatchJobItem.status.in_(statuses))
+                .order_by(BatchJobItem.position)
+                .all()
+            )
+            batch.status = BATCH_RUNNING
+            batch.finished_at = None
+            db.commit()
+            return (
+                {"concurrency": batch.concurrency, "use_cache": bool(batch.use_cache), "total": batch.total},
+                [{"id": item.id, "position": item.position, "spec": item.spec} for item in items],
+            )
+        finally:
+            db.close()
+
+    def _mark_item(self, item_id: int, status: str, error: Optional[str] = None) -> None:
+        db = self.session_factory()
+        try:
+            item = db.get(BatchJobItem, item_id)
+            item.status = status
+            item.error = error
+            if status == ITEM_RUNNING:
+                item.attempts += 1
+                item.started_at = datetime.utcnow()
+                item.finished_at = None
+            elif status == ITEM_FAILED:
+                item.finished_at = datetime.utcnow()
+            db.commit()
+        finally:
+            db.close()
+
+    def _complete_item(self, item_id: int, spec: Dict[str, Any], result: Dict[str, Any]) -> int:
+        """在同一事务中写入课程并标记条目完成，返回课程ID"""
+        stages = {1: result["stage_one"], 2: result["stage_two"], 3: result["stage_three"]}
+        now = datetime.utcnow()
+        db = self.session_factory()
+        try:
+            course = CourseProject(
+                **spec,
+                stage_one_data=stages[1],
+                stage_two_data=stages[2],
+                stage_three_data=stages[3],
+                stage_one_version=now,
+                stage_two_version=now,
+                stage_three_version=now,
+                stage_sources={str(stage): stage_sources(stage, spec, stages) for stage in stages},
+            )
+            db.add(course)
+            db.flush()
+
+            item = db.get(BatchJobItem, item_id)
+            item.status = ITEM_COMPLETED
+            item.course_id = course.id
+            item.error = None
+            item.generation_time = result.get("total_time")
+            item.finished_at = now
+            db.commit()
+            return course.id
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _finish_batch(self, batch_id: str) -> None:
+        db = self.session_factory()
+        try:
+            batch = db.get(BatchJob, batch_id)
+            batch.status = BATCH_COMPLETED
+            batch.finished_at = datetime.utcnow()
+            db.commit()
+        finally:
+            db.close()
+
+    def _mark_cancelled(self, batch_id: str) -> bool:
+        db = self.session_factory()
+        try:
+            batch = db.get(BatchJob, batch_id)
+            if batch is None:
+                return False
+            if batch.status in (BATCH_PENDING, BATCH_RUNNING):
+                batch.status = BATCH_CANCELLED
+                batch.finished_at = datetime.utcnow()
+            db.query(BatchJobItem).filter(
+                BatchJobItem.batch_id == batch_id, BatchJobItem.status == ITEM_RUNNING
+            ).update({BatchJobItem.status: ITEM_PENDING})
+            db.commit()
+            return True
+        finally:
+            db.close()
+
+    def status(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """批量任务状态：整体进度 + 每门课程的状态、课程ID与错误"""
+        db = self.session_factory()
+        try:
+            batch = db.get(BatchJob, batch_id)
+            if batch is None:
+                return None
+            items = (
+                db.query(BatchJobItem)
+                .filter(BatchJobItem.batch_id == batch_id)
+                .order_by(BatchJobItem.position)
+                .all()
+            )
+            counts = {status: 0 for status in (ITEM_PENDING, ITEM_RUNNING, ITEM_COMPLETED, ITEM_FAILED)}
+            for item in items:
+                counts[item.status] = counts.get(item.status, 0) + 1
+            finished = counts[ITEM_COMPLETED] + counts[ITEM_FAILED]
+            return {
+                "batch_id": batch.id,
+                "status": batch.status,
+                "active": self.is_running(batch_id),
+                "concurrency": batch.concurrency,
+                "total": batch.total,
+                "counts": counts,
+                "progress": round(finished / batch.total, 4) if batch.total else 1.0,
+                "created_at": batch.created_at.isoformat() if batch.created_at else None,
+                "finished_at": batch.finished_at.isoformat() if batch.finished_at else None,
+                "courses": [
+                    {
+                        "position": item.position,
+                        "title": item.spec.get("title"),
+                        "status": item.status,
+                        "course_id": item.course_id,
+                        "error": item.error,
+                        "attempts": item.attempts,
+                        "generation_time": item.generation_time,
+                    }
+                    for item in items
+                ],
+            }
+        finally:
+            db.close()
+
+
+# 全局单例
+_batch_service = None
+
+
+def get_batch_service() -> BatchGenerationService:
+    """获取批量生成服务单例"""
+    global _batch_service
+    if _batch_service is None:
+        _batch_service = BatchGenerationService()
+    return _batch_service
+
+
+# ========== 命令行入口 ==========
+
+
+def _print_update(item: Dict[str, Any]) -> None:
+    line = f"[{item['position'] + 1}] {item['spec']['title']}: {item['status']}"
+    if item.get("course_id"):
+        line += f" (course {item['course_id']})"
+    if item.get("error"):
+        line += f" - {item['error']}"
+    print(line, flush=True)
+
+
+def _print_summary(status: Dict[str, Any]) -> None:
+    counts = status["counts"]
+    print(
+        f"batch {status['batch_id']}: {status['status']}, "
+        f"{counts['completed']} completed, {counts['failed']} failed, "
+        f"{counts['pending'] + counts['running']} remaining of {status['total']}",
+        flush=True,
+    )
+
+
+async def _cli(args: argparse.Namespace) -> int:
+    service = get_batch_service()
+
+    if args.command == "run":
+        with open(args.file, encoding="utf-8") as f:
+            specs = parse_course_specs(f.read(), args.format)
+        batch_id = service.create(specs, concurrency=args.concurrency, use_cache=not args.no_cache)
+        print(f"batch {batch_id}: {len(specs)} courses (resume with: resume {batch_id})", flush=True)
+        batch_ids = [batch_id]
+    elif args.command == "resume":
+        batch_ids = [args.batch_id] if args.batch_id else service.incomplete_batches()
+        if not batch_ids:
+            print("no interrupted batches", flush=True)
+            return 0
+    else:
+        status = service.status(args.batch_id)
+        if status is None:
+            print(f"batch {args.batch_id} not found", file=sys.stderr)
+            return 1
+        print(json.dumps(status, ensure_ascii=False, indent=2))
+        return 0
+
+    failed = 0
+    for batch_id in batch_ids:
+        status = await service.run(
+            batch_id, retry_failed=getattr(args, "retry_failed", False), on_update=_print_update
+        )
+        _print_summary(status)
+        failed += status["counts"]["failed"]
+    return 1 if failed else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="批量生成UbD-PBL课程")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="从CSV/JSON课程清单创建并运行批量任务")
+    run.add_argument("file", help="课程清单文件（CSV表头或JSON字段：title, subject, grade_level, "
+                                  "total_class_hours, schedule_description, description）")
+    run.add_argument("--format", choices=["csv", "json"], default=None, help="默认按内容判断")
+    run.add_argument("--concurrency", type=int, default=None, help="同时生成的课程数")
+    run.add_argument("--no-cache", action="store_true", help="不使用生成缓存")
+
+    resume = commands.add_parser("resume", help="续跑中断的批量任务（跳过已完成的课程）")
+    resume.add_argument("batch_id", nargs="?", help="默认续跑所有未结束的任务")
+    resume.add_argument("--retry-failed", action="store_true", help="同时重新生成失败的课程")
+
+    status = commands.add_parser("status", help="查看批量任务状态")
+    status.add_argument("batch_id")
+
+    args = parser.parse_args(argv)
+
+    from app.core.database import engine
+    from app.core.migrations import run_startup_migrations
+
+    run_startup_migrations(engine)
+    try:
+        return asyncio.run(_cli(args))
+    except ValueError as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""
+生成任务管理 - 与HTTP连接解耦的服务端工作流任务
+
+浏览器刷新或网络中断不再导致生成丢失：
+- 每次生成是一个带ID的后台任务，SSE事件追加到任务的有界事件日志
+- 订阅者通过 Last-Event-ID 重连，从最后收到的事件之后回放
+- 内存日志超出上限时，可选地把最早的事件溢出到SQLite
+- 任务可显式取消；所有订阅者断开且超过宽限时间后自动取消
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterable, AsyncGenerator, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.models.generation_job import GenerationJobEvent
+
+logger = logging.getLogger(__name__)
+
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+
+def _format_sse(event_data: Dict) -> str:
+    return f"data: {json.dumps(event_data, ensure_ascii=False)}\n\n"
+
+
+class GenerationJob:
+    """单个生成任务及其事件日志"""
+
+    def __init__(self, job_id: str, max_events: int):
+        self.job_id = job_id
+        self.status = JOB_RUNNING
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.events: Deque[Tuple[int, str]] = deque()
+        self.max_events = max_events
+        self.last_seq = 0
+        self.spilled_until = 0  # 已溢出到SQLite的最大序号
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._orphan_timer: Optional[asyncio.TimerHandle] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status != JOB_RUNNING
+
+    @property
+    def first_seq(self) -> int:
+        """内存中最早事件的序号"""
+        return self.events[0][0] if self.events else self.last_seq + 1
+
+    def append(self, payload: str) -> List[Tuple[int, str]]:
+        """
+        追加事件并唤醒订阅者
+
+        Returns:
+            因超出内存上限被挤出的事件
+        """
+        self.last_seq += 1
+        self.events.append((self.last_seq, payload))
+        evicted = []
+        while len(self.events) > self.max_events:
+            evicted.append(self.events.popleft())
+        self._publish()
+        return evicted
+
+    def _publish(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "last_event_id": self.last_seq,
+            "first_buffered_event_id": self.first_seq,
+            "subscribers": self.subscribers,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    生成任务管理器
+
+    使用方式：
+        job = manager.create(lambda: workflow_service.stream_workflow(...))
+        async for sse in manager.subscribe(job.job_id, last_event_id=0):
+            ...
+    """
+
+    def __init__(
+        self,
+        max_events: Optional[int] = None,
+        spill_enabled: Optional[bool] = None,
+        orphan_grace_seconds: Optional[float] = None,
+        retention_seconds: Optional[float] = None,
+        session_factory: Callable = SessionLocal,
+    ):
+        self.max_events = max_events if max_events is not None else settings.job_event_log_max_events
+        self.spill_enabled = spill_enabled if spill_enabled is not None else settings.job_event_spill_enabled
+        self.orphan_grace_seconds = (
+            orphan_grace_seconds if orphan_grace_seconds is not None else settings.job_orphan_grace_seconds
+        )
+        self.retention_seconds = (
+            retention_seconds if retention_seconds is not None else settings.job_retention_seconds
+        )
+        self.session_factory = session_factory
+        self._jobs: Dict[str, GenerationJob] = {}
+
+    def create(self, source_factory: Callable[[], AsyncIterable[str]]) -> GenerationJob:
+        """
+        创建并启动任务
+
+        Args:
+            source_factory: 返回SSE字符串异步迭代器的工厂（如 stream_workflow 调用）
+        """
+        job = GenerationJob(uuid.uuid4().hex, self.max_events)
+        self._jobs[job.job_id] = job
+        job.task = asyncio.get_running_loop().create_task(self._run(job, source_factory))
+        # 创建后没有订阅者连接时同样按宽限时间自动取消
+        self._schedule_orphan_check(job)
+        logger.info(f"[JobManager] Job {job.job_id} started")
+        return job
+
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        return self._jobs.get(job_id)
+
+    async def _run(self, job: GenerationJob, source_factory: Callable[[], AsyncIterable[str]]) -> None:
+        try:
+            async for payload in source_factory():
+                await self._append(job, payload)
+            self._finish(job, JOB_COMPLETED)
+        except asyncio.CancelledError:
+            await self._append(job, _format_sse({"event": "cancelled", "data": {"job_id": job.job_id}}))
+            self._finish(job, JOB_CANCELLED)
+        except Exception as e:
+            logger.error(f"[JobManager] Job {job.job_id} failed: {e}", exc_info=True)
+            await self._append(job, _format_sse({"event": "error", "data": {"message": str(e), "stage": None}}))
+            self._finish(job, JOB_FAILED)
+
+    async def _append(self, job: GenerationJob, payload: str) -> None:
+        evicted = job.append(payload)
+        if evicted and self.spill_enabled:
+            try:
+                await asyncio.to_thread(self._spill, job.job_id, evicted)
+                job.spilled_until = evicted[-1][0]
+            except Exception as e:
+                logger.warning(f"[JobManager] Spill failed for job {job.job_id}: {e}")
+
+    def _finish(self, job: GenerationJob, status: str) -> None:
+        job.status = status
+        job.finished_at = time.time()
+        job._publish()
+        if job._orphan_timer is not None:
+            job._orphan_timer.cancel()
+        asyncio.get_running_loop().call_later(self.retention_seconds, self._purge, job.job_id)
+        logger.info(f"[JobManager] Job {job.job_id} {status} ({job.last_seq} events)")
+
+    def _purge(self, job_id: str) -> None:
+        job = self._jobs.pop(job_id, None)
+        if job is not None and job.spilled_until and self.spill_enabled:
+            asyncio.get_running_loop().run_in_executor(None, self._delete_spill, job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """取消任务，返回是否确实取消了运行中的任务"""
+        job = self._jobs.get(job_id)
+        if job is None or job.finished or job.task is None:
+            return False
+        job.task.cancel()
+        logger.info(f"[JobManager] Job {job_id} cancel requested")
+        return True
+
+    async def close(self) -> None:
+        """取消全部运行中的任务并等待其退出（关闭上游LLM流、释放槽位）"""
+        tasks = [job.task for job in self._jobs.values() if job.task is not None and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def subscribe(self, job_id: str, last_event_id: int = 0) -> AsyncGenerator[str, None]:
+        """
+        订阅任务事件（带SSE id），从 last_event_id 之后开始回放
+
+        Raises:
+            KeyError: 任务不存在或已过期
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+
+        job.subscribers += 1
+        if job._orphan_timer is not None:
+            job._orphan_timer.cancel()
+            job._orphan_timer = None
+
+        cursor = max(0, last_event_id)
+        try:
+            while True:
+                changed = job._changed
+                for seq, payload in await self._events_after(job, cursor):
+                    cursor = seq
+                    yield f"id: {seq}\n{payload}"
+                if job.finished and cursor >= job.last_seq:
+                    return
+                await changed.wait()
+        finally:
+            job.subscribers -= 1
+            if job.subscribers == 0 and not job.finished:
+                self._schedule_orphan_check(job)
+
+    async def _events_after(self, job: GenerationJob, cursor: int) -> List[Tuple[int, str]]:
+        """返回序号大于cursor的事件；内存中已不存在的部分从SQLite读取或以gap事件提示"""
+        events = []
+        if cursor + 1 < job.first_seq:
+            if self.spill_enabled and job.spilled_until > cursor:
+                events.extend(await asyncio.to_thread(self._load_spill, job.job_id, cursor, job.first_seq))
+            if not events or events[-1][0] < job.first_seq - 1:
+                gap_to = job.first_seq - 1
+                gap = _format_sse({
+                    "event": "gap",
+                    "data": {"missed_from": cursor + 1, "missed_to": gap_to},
+                })
+                events.append((gap_to, gap))
+        events.extend((seq, payload) for seq, payload in job.events if seq > cursor)
+        return events
+
+    def _schedule_orphan_check(self, job: GenerationJob) -> None:
+        if self.orphan_grace_seconds <= 0:
+            return
+        if job._orphan_timer is not None:
+            job._orphan_timer.cancel()
+        job._orphan_timer = asyncio.get_running_loop().call_later(
+            self.orphan_grace_seconds, self._cancel_if_orphaned, job.job_id
+        )
+
+    def _cancel_if_orphaned(self, job_id: str) -> None:
+        job = self._jobs.get(job_id)
+        if job is not None and job.subscribers == 0 and not job.finished:
+            logger.info(f"[JobManager] Job {job_id} has no subscribers, cancelling")
+            self.cancel(job_id)
+
+    # ========== SQLite溢出 ==========
+
+    def _spill(self, job_id: str, events: List[Tuple[int, str]]) -> None:
+        db = self.session_factory()
+        try:
+            db.add_all(GenerationJobEvent(job_id=job_id, seq=seq, payload=payload) for seq, payload in events)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _load_spill(self, job_id: str, after: int, before: int) -> List[Tuple[int, str]]:
+        db = self.session_factory()
+        try:
+            rows = (
+                db.query(GenerationJobEvent.seq, GenerationJobEvent.payload)
+                .filter(
+                    GenerationJobEvent.job_id == job_id,
+                    GenerationJobEvent.seq > after,
+                    GenerationJobEvent.seq < before,
+                )
+                .order_by(GenerationJobEvent.seq)
+                .all()
+            )
+            return [(row.seq, row.payload) for row in rows]
+        finally:
+            db.close()
+
+    def _delete_spill(self, job_id: str) -> None:
+        db = self.session_factory()
+        try:
+            db.query(GenerationJobEvent).filter(GenerationJobEvent.job_id == job_id).delete()
+            db.commit()
+        finally:
+            db.close()
+
+
+# 全局单例
+_job_manager = None
+
+
+def get_job_manager() -> JobManager:
+    """获取生成任务管理器单例"""
+    global _job_manager
+    if _job_manager is None:
+        _job_manager = JobManager()
+    return _job_manager
@@ -0,0 +1,135 @@
+"""
+阶段结果后台写入器
+
+工作流流式生成时，每个阶段完成后把Markdown写入 CourseProject，
+前端无需再通过 PUT /courses/{id}/stage-xxx 回传整份文档。
+写入在后台任务中通过线程池执行，SSE流不等待数据库提交。
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Optional, Tuple
+
+from app.core.database import SessionLocal
+from app.models.course_project import CourseProject
+
+logger = logging.getLogger(__name__)
+
+# 阶段 -> (数据列, 版本列)
+STAGE_COLUMNS = {
+    1: ("stage_one_data", "stage_one_version"),
+    2: ("stage_two_data", "stage_two_version"),
+    3: ("stage_three_data", "stage_three_version"),
+}
+
+
+class StageWriter:
+    """
+    后台阶段写入器
+
+    - submit() 立即返回；同一课程同一阶段的多次提交只写入最新内容
+    - 写入失败只记录日志，不影响生成流程
+    """
+
+    def __init__(self, session_factory: Callable = SessionLocal):
+        self.session_factory = session_factory
+        self._pending: Dict[Tuple[int, int], Tuple[str, Optional[Dict[str, str]]]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop = None
+
+    def _ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = None
+            # 旧事件循环中未写入的条目重新入队
+            for key in self._pending:
+                self._queue.put_nowait(key)
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+
+    def submit(
+        self,
+        course_id: int,
+        stage: int,
+        markdown: str,
+        sources: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """
+        提交一个阶段的写入（不等待提交完成）
+
+        sources 为该阶段输入的内容哈希（见 app/core/stage_dependencies.py），
+        为None时保留已记录的哈希（如局部修改只改变本阶段内容，不改变其输入）
+        """
+        if stage not in STAGE_COLUMNS:
+            raise ValueError(f"Invalid stage: {stage}")
+
+        self._ensure_worker()
+        key = (course_id, stage)
+        is_new = key not in self._pending
+        self._pending[key] = (markdown, sources)
+        if is_new:
+            self._queue.put_nowait(key)
+
+    async def _run(self) -> None:
+        while True:
+            key = await self._queue.get()
+            try:
+                pending = self._pending.pop(key, None)
+                if pending is not None:
+                    await asyncio.to_thread(self._write, key[0], key[1], *pending)
+            except Exception as e:
+                logger.error(f"[StageWriter] Failed to persist course {key[0]} stage {key[1]}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(
+        self, course_id: int, stage: int, markdown: str, sources: Optional[Dict[str, str]] = None
+    ) -> None:
+        data_column, version_column = STAGE_COLUMNS[stage]
+        db = self.session_factory()
+        try:
+            course = db.get(CourseProject, course_id)
+            if course is None:
+                logger.warning(f"[StageWriter] Course {course_id} not found, stage {stage} dropped")
+                return
+
+            setattr(course, data_column, markdown)
+            setattr(course, version_column, datetime.utcnow())
+            if sources is not None:
+                # JSON列需整体赋值才能被检测到变更
+                course.stage_sources = {**(course.stage_sources or {}), str(stage): sources}
+            db.commit()
+            logger.info(f"[StageWriter] Persisted course {course_id} stage {stage} ({len(markdown)} chars)")
+
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def flush(self) -> None:
+        """等待所有已提交的写入完成"""
+        if self._queue is not None and self._loop is asyncio.get_running_loop():
+            await self._queue.join()
+
+    async def close(self) -> None:
+        """写完剩余条目后停止后台任务"""
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+
+# 全局单例
+_stage_writer = None
+
+
+def get_stage_writer() -> StageWriter:
+    """获取阶段写入器单例"""
+    global _stage_writer
+    if _stage_writer is None:
+        _stage_writer = StageWriter()
+    return _stage_writer
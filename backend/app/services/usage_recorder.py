@@ -0,0 +1,180 @@
+"""
+课程token用量后台记录器
+
+每次阶段生成、局部修改和对话结束（含失败与客户端断开）后，把本次消耗的token
+追加写入 llm_usage_records。写入在后台任务中批量执行，SSE流不等待数据库提交。
+"""
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import Integer, Select, cast, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.database import SessionLocal
+from app.core.token_usage import TokenUsage
+from app.models.llm_usage import LLMUsageRecord
+
+logger = logging.getLogger(__name__)
+
+OPERATION_GENERATE = "generate"
+OPERATION_SECTION_EDIT = "section_edit"
+OPERATION_CHAT = "chat"
+
+
+class UsageRecorder:
+    """
+    后台用量记录器
+
+    - record() 立即返回；后台任务每次把已排队的记录在一个事务中写入
+    - 写入失败只记录日志，不影响生成流程
+    """
+
+    def __init__(self, session_factory: Callable = SessionLocal):
+        self.session_factory = session_factory
+        self._pending: List[Dict[str, Any]] = []
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop = None
+
+    def _ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = None
+            # 旧事件循环中未写入的记录重新入队
+            if self._pending:
+                self._queue.put_nowait(None)
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+
+    def record(
+        self,
+        course_id: int,
+        operation: str,
+        usage: TokenUsage,
+        model: Optional[str] = None,
+        stage: Optional[int] = None,
+    ) -> bool:
+        """
+        提交一条用量记录（不等待提交完成），返回是否已提交
+
+        没有发起上游请求（如命中生成缓存）时不记录
+        """
+        if usage.calls == 0:
+            return False
+        self._ensure_worker()
+        self._pending.append({
+            "course_id": course_id,
+            "operation": operation,
+            "stage": stage,
+            "model": model,
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "cached_tokens": usage.cached_tokens,
+            "calls": usage.calls,
+            "estimated": usage.estimated,
+        })
+        self._queue.put_nowait(None)
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            await self._queue.get()
+            batch, self._pending = self._pending, []
+            try:
+                if batch:
+                    await asyncio.to_thread(self._write, batch)
+            except Exception as e:
+                logger.error(f"[UsageRecorder] Failed to persist {len(batch)} usage records: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        db = self.session_factory()
+        try:
+            db.add_all(LLMUsageRecord(**row) for row in batch)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def flush(self) -> None:
+        """等待所有已提交的记录写入完成"""
+        if self._queue is not None and self._loop is asyncio.get_running_loop():
+            await self._queue.join()
+
+    async def close(self) -> None:
+        """写完剩余记录后停止后台任务"""
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+
+def usage_summary_query(course_id: int) -> Select:
+    """
+    按操作、阶段、模型分组汇总的查询
+
+    PostgreSQL没有 max(boolean)，estimated 先转为整数再聚合
+    """
+    columns = (
+        func.coalesce(func.sum(LLMUsageRecord.prompt_tokens), 0),
+        func.coalesce(func.sum(LLMUsageRecord.completion_tokens), 0),
+        func.coalesce(func.sum(LLMUsageRecord.cached_tokens), 0),
+        func.coalesce(func.sum(LLMUsageRecord.calls), 0),
+        func.count(LLMUsageRecord.id),
+        func.coalesce(func.max(cast(LLMUsageRecord.estimated, Integer)), 0),
+    )
+    return (
+        select(LLMUsageRecord.operation, LLMUsageRecord.stage, LLMUsageRecord.model, *columns)
+        .where(LLMUsageRecord.course_id == course_id)
+        .group_by(LLMUsageRecord.operation, LLMUsageRecord.stage, LLMUsageRecord.model)
+        .order_by(LLMUsageRecord.operation, LLMUsageRecord.stage, LLMUsageRecord.model)
+    )
+
+
+async def course_usage_summary(db: AsyncSession, course_id: int) -> Dict[str, Any]:
+    """
+    汇总课程的token用量
+
+    Returns:
+        {"total": {...}, "by_operation": [{"operation", "stage", "model", ...}]}
+    """
+    rows = await db.execute(usage_summary_query(course_id))
+
+    def usage_dict(prompt, completion, cached, calls, records, estimated) -> Dict[str, Any]:
+        return {
+            "prompt_tokens": int(prompt),
+            "completion_tokens": int(completion),
+            "total_tokens": int(prompt) + int(completion),
+            "cached_tokens": int(cached),
+            "calls": int(calls),
+            "records": int(records),
+            "estimated": bool(estimated),
+        }
+
+    by_operation = []
+    total = usage_dict(0, 0, 0, 0, 0, False)
+    for operation, stage, model, *values in rows:
+        entry = usage_dict(*values)
+        by_operation.append({"operation": operation, "stage": stage, "model": model, **entry})
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens", "calls", "records"):
+            total[key] += entry[key]
+        total["estimated"] = total["estimated"] or entry["estimated"]
+    return {"total": total, "by_operation": by_operation}
+
+
+# 全局单例
+_usage_recorder = None
+
+
+def get_usage_recorder() -> UsageRecorder:
+    """获取用量记录器单例"""
+    global _usage_recorder
+    if _usage_recorder is None:
+        _usage_recorder = UsageRecorder()
+    return _usage_recorder
@@ -1,10 +1,21 @@
 """
 UbD元素验证服务
 使用语义相似度检查U (Understandings) 是否是真正的抽象理解，而非知识点
+
+参考示例（GOOD_U_EXAMPLES / BAD_U_EXAMPLES）的向量只计算一次，按模型版本缓存到磁盘；
+待验证的U一次批量编码，用归一化向量的矩阵乘法计算余弦相似度。
 """
-from typing import Dict, List, Any
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Any, Optional, Tuple
 import logging
 
+from app.core.config import settings
+
 logger = logging.getLogger(__name__)
 
 # 优秀的U示例（作为语义基准）
@@ -33,116 +44,232 @@ class ValidationService:
     UbD元素验证服务
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        model_name: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+    ):
         """
         初始化验证服务
-        延迟加载sentence-transformers模型（仅在需要时加载）
+        延迟加载sentence-transformers模型（仅在需要时加载，或启动时后台预热）
+
+        Args:
+            model_name: sentence-transformers模型名称
+            cache_dir: 参考示例向量的磁盘缓存目录，为空字符串时不使用磁盘缓存
         """
+        self.model_name = model_name or settings.validation_model_name
+        self.cache_dir = settings.validation_embedding_cache_dir if cache_dir is None else cache_dir
         self.model = None
         self._model_loaded = False
+        self._load_attempted = False
+        self._lock = threading.Lock()
+        # 参考示例的归一化向量 (good, bad)
+        self._references: Optional[Tuple[Any, Any]] = None
 
     def _load_model(self):
         """
-        延迟加载sentence-transformers模型
+        延迟加载sentence-transformers模型（线程安全，只尝试一次）
         """
-        if self._model_loaded:
+        if self._load_attempted:
             return
 
+        with self._lock:
+            if self._load_attempted:
+                return
+            try:
+                from sentence_transformers import SentenceTransformer
+
+                logger.info(f"Loading sentence-transformers model {self.model_name}...")
+                # 使用轻量级中文模型
+                self.model = SentenceTransformer(self.model_name)
+                self._model_loaded = True
+                logger.info("Sentence-transformers model loaded successfully")
+            except ImportError:
+                logger.warning(
+                    "sentence-transformers not installed. "
+                    "Validation scores will be set to 0.5 (neutral). "
+                    "Install with: uv add sentence-transformers"
+                )
+                self._model_loaded = False
+            except Exception as e:
+                logger.error(f"Error loading sentence-transformers model: {e}")
+                self._model_loaded = False
+            finally:
+                self._load_attempted = True
+
+    def _encode(self, texts: List[str]):
+        """批量编码为L2归一化的numpy向量（单次前向计算）"""
+        return self.model.encode(
+            texts,
+            batch_size=max(len(texts), 1),
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+
+    def _model_version(self) -> str:
+        """模型版本标识：模型名称 + sentence-transformers版本 + 向量维度"""
         try:
-            from sentence_transformers import SentenceTransformer, util
-
-            logger.info("Loading sentence-transformers model...")
-            # 使用轻量级中文模型
-            self.model = SentenceTransformer("paraphrase-multilingual-MiniLM-L12-v2")
-            self.util = util
-            self._model_loaded = True
-            logger.info("Sentence-transformers model loaded successfully")
+            import sentence_transformers
+
+            library_version = sentence_transformers.__version__
         except ImportError:
-            logger.warning(
-                "sentence-transformers not installed. "
-                "Validation scores will be set to 0.5 (neutral). "
-                "Install with: uv add sentence-transformers"
-            )
-            self._model_loaded = False
-        except Exception as e:
-            logger.error(f"Error loading sentence-transformers model: {e}")
-            self._model_loaded = False
+            library_version = "unknown"
+        dimension = None
+        if hasattr(self.model, "get_sentence_embedding_dimension"):
+            dimension = self.model.get_sentence_embedding_dimension()
+        return f"{self.model_name}|{library_version}|{dimension}"
+
+    def _cache_path(self) -> Optional[Path]:
+        """参考向量缓存文件：键为模型版本 + 示例文本，任一变化即重新计算"""
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha256(
+            json.dumps(
+                [self._model_version(), GOOD_U_EXAMPLES, BAD_U_EXAMPLES], ensure_ascii=False
+            ).encode("utf-8")
+        ).hexdigest()[:16]
+        return Path(self.cache_dir) / f"u_examples_{key}.npz"
+
+    def _reference_embeddings(self) -> Tuple[Any, Any]:
+        """参考示例向量：内存 -> 磁盘缓存 -> 编码（一次批量调用）"""
+        if self._references is not None:
+            return self._references
+
+        with self._lock:
+            if self._references is not None:
+                return self._references
+
+            import numpy as np
+
+            path = self._cache_path()
+            if path is not None and path.exists():
+                try:
+                    with np.load(path) as data:
+                        self._references = (data["good"], data["bad"])
+                    logger.info(f"Loaded reference embeddings from {path}")
+                    return self._references
+                except Exception as e:
+                    logger.warning(f"Ignoring unreadable embedding cache {path}: {e}")
+
+            embeddings = self._encode(GOOD_U_EXAMPLES + BAD_U_EXAMPLES)
+            good = embeddings[: len(GOOD_U_EXAMPLES)]
+            bad = embeddings[len(GOOD_U_EXAMPLES):]
+            self._references = (good, bad)
+
+            if path is not None:
+                try:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+                    with open(tmp, "wb") as f:
+                        np.savez(f, good=good, bad=bad)
+                    os.replace(tmp, path)
+                    logger.info(f"Cached reference embeddings to {path}")
+                except OSError as e:
+                    logger.warning(f"Failed to write embedding cache {path}: {e}")
+
+            return self._references
+
+    def warm_up(self) -> bool:
+        """
+        预热：加载模型、载入/计算参考向量并执行一次编码
 
-    def validate_understanding(self, u_text: str) -> Dict[str, Any]:
+        Returns:
+            模型是否可用
         """
-        验证一个U (Understanding) 是否是真正的抽象理解
+        self._load_model()
+        if not self._model_loaded:
+            return False
+        try:
+            self._reference_embeddings()
+            self._encode(["预热"])
+            logger.info("Validation service warmed up")
+            return True
+        except Exception as e:
+            logger.error(f"Validation service warm-up failed: {e}")
+            return False
 
-        Args:
-            u_text: 待验证的理解陈述
+    async def warm_up_async(self) -> bool:
+        """在线程池中预热（启动时后台调用，不阻塞服务启动）"""
+        return await asyncio.to_thread(self.warm_up)
+
+    def score_understandings(self, u_texts: List[str]) -> List[Dict[str, Any]]:
+        """
+        批量验证多个U：一次编码全部待验证文本，矩阵运算计算与参考示例的平均相似度
 
         Returns:
-            {
-                "is_valid": bool,  # 是否通过验证（score >= 0.7）
-                "score": float,  # 验证分数 (0-1)
-                "explanation": str,  # 验证说明
-                "suggestions": List[str]  # 改进建议
-            }
+            与输入顺序一致的验证结果（格式同 validate_understanding）
         """
+        if not u_texts:
+            return []
+
         self._load_model()
 
         # 如果模型未加载，返回中性分数
         if not self._model_loaded or self.model is None:
-            return {
-                "is_valid": True,  # 不阻止流程
-                "score": 0.5,  # 中性分数
-                "explanation": "语义验证服务不可用，使用默认评分",
-                "suggestions": [],
-            }
+            return [
+                {
+                    "is_valid": True,  # 不阻止流程
+                    "score": 0.5,  # 中性分数
+                    "explanation": "语义验证服务不可用，使用默认评分",
+                    "suggestions": [],
+                }
+                for _ in u_texts
+            ]
 
         try:
-            # 计算与优秀U示例的相似度
-            good_embeddings = self.model.encode(
-                GOOD_U_EXAMPLES, convert_to_tensor=True
-            )
-            bad_embeddings = self.model.encode(
-                BAD_U_EXAMPLES, convert_to_tensor=True
-            )
-            u_embedding = self.model.encode([u_text], convert_to_tensor=True)
+            good_embeddings, bad_embeddings = self._reference_embeddings()
+            u_embeddings = self._encode(list(u_texts))
+
+            # 归一化向量的点积即余弦相似度；按行取与各组示例的平均值
+            avg_good = (u_embeddings @ good_embeddings.T).mean(axis=1)
+            avg_bad = (u_embeddings @ bad_embeddings.T).mean(axis=1)
+
+            results = []
+            for u_text, good_sim, bad_sim in zip(u_texts, avg_good, avg_bad):
+                good_sim, bad_sim = float(good_sim), float(bad_sim)
+                # 计算验证分数：优秀相似度高 & 错误相似度低 = 高分
+                score = max(0.0, min(1.0, good_sim * 0.7 + (1 - bad_sim) * 0.3))
+
+                # 判断是否通过
+                is_valid = score >= 0.7
+
+                results.append({
+                    "is_valid": is_valid,
+                    "score": round(score, 2),
+                    "explanation": self._generate_explanation(score, good_sim, bad_sim, u_text),
+                    "suggestions": self._generate_suggestions(u_text) if not is_valid else [],
+                })
+            return results
 
-            # 与优秀示例的相似度
-            good_similarities = self.util.pytorch_cos_sim(u_embedding, good_embeddings)[
-                0
+        except Exception as e:
+            logger.error(f"Error during validation: {e}")
+            return [
+                {
+                    "is_valid": True,  # 出错时不阻止流程
+                    "score": 0.5,
+                    "explanation": f"验证过程出错: {str(e)}",
+                    "suggestions": [],
+                }
+                for _ in u_texts
             ]
-            avg_good_sim = float(good_similarities.mean())
-
-            # 与错误示例的相似度
-            bad_similarities = self.util.pytorch_cos_sim(u_embedding, bad_embeddings)[0]
-            avg_bad_sim = float(bad_similarities.mean())
 
-            # 计算验证分数：优秀相似度高 & 错误相似度低 = 高分
-            score = max(0.0, min(1.0, avg_good_sim * 0.7 + (1 - avg_bad_sim) * 0.3))
-
-            # 判断是否通过
-            is_valid = score >= 0.7
-
-            # 生成解释和建议
-            explanation = self._generate_explanation(
-                score, avg_good_sim, avg_bad_sim, u_text
-            )
-            suggestions = (
-                self._generate_suggestions(u_text) if not is_valid else []
-            )
+    def validate_understanding(self, u_text: str) -> Dict[str, Any]:
+        """
+        验证一个U (Understanding) 是否是真正的抽象理解
 
-            return {
-                "is_valid": is_valid,
-                "score": round(score, 2),
-                "explanation": explanation,
-                "suggestions": suggestions,
-            }
+        Args:
+            u_text: 待验证的理解陈述
 
-        except Exception as e:
-            logger.error(f"Error during validation: {e}")
-            return {
-                "is_valid": True,  # 出错时不阻止流程
-                "score": 0.5,
-                "explanation": f"验证过程出错: {str(e)}",
-                "suggestions": [],
+        Returns:
+            {
+                "is_valid": bool,  # 是否通过验证（score >= 0.7）
+                "score": float,  # 验证分数 (0-1)
+                "explanation": str,  # 验证说明
+                "suggestions": List[str]  # 改进建议
             }
+        """
+        return self.score_understandings([u_text])[0]
 
     def _generate_explanation(
         self, score: float, good_sim: float, bad_sim: float, u_text: str
@@ -232,9 +359,8 @@ class ValidationService:
         validations = []
         warnings = []
 
-        for u in understandings:
-            u_text = u.get("text", "")
-            validation = self.validate_understanding(u_text)
+        texts = [u.get("text", "") for u in understandings]
+        for u_text, validation in zip(texts, self.score_understandings(texts)):
             validations.append({"text": u_text, **validation})
 
             if not validation["is_valid"]:
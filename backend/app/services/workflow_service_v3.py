@@ -4,20 +4,61 @@ Workflow Service V3
 """
 import asyncio
 import json
+import re
 import time
-from typing import Dict, Any, AsyncGenerator
+from contextlib import asynccontextmanager
+from typing import Dict, Any, AsyncGenerator, List, Optional
 import logging
 
 from app.agents import (
     ProjectFoundationAgentV3,
     AssessmentFrameworkAgentV3,
     LearningBlueprintAgentV3,
+    SectionEditAgent,
 )
+from app.core.config import settings
+from app.core.admission import PRIORITY_BULK, QueueFullError, get_admission_controller
+from app.core.llm_transport import resolve_model
+from app.core.metrics import (
+    MODE_GENERATE,
+    MODE_SECTION_EDIT,
+    OUTCOME_CANCELLED,
+    OUTCOME_COMPLETED,
+    OUTCOME_ERROR,
+    get_metrics,
+)
+from app.core.stage_dependencies import plan_regeneration, stage_sources
+from app.core.token_usage import TokenUsage
+from app.core.tracing import current_trace_id, set_span_attributes, trace_stream, traced_stream
+from app.services.stage_writer import get_stage_writer
+from app.services.usage_recorder import get_usage_recorder
 from app.services.validation_service import get_validation_service
 from app.models.stage_data import StageOneData, StageTwoData, StageThreeData
 
 logger = logging.getLogger(__name__)
 
+# progress事件的流式模式
+STREAM_MODE_FULL = "full"  # 每个事件携带完整Markdown（兼容旧前端）
+STREAM_MODE_DELTA = "delta"  # 仅携带增量 + 序号，周期性发送完整快照
+
+# 流水线模式下，下游阶段可以提前启动的标志
+# Stage 1 出现 K 标题 => G/U/Q 已完成，Stage 2 可基于该前缀启动
+STAGE_ONE_READY_PATTERN = re.compile(r"^## K[:：]", re.MULTILINE)
+# Stage 2 出现"其他评估证据"标题 => 驱动性问题与表现性任务已完成，Stage 3 可提前启动
+STAGE_TWO_READY_PATTERN = re.compile(r"^## 其他评估", re.MULTILINE)
+
+# 流水线模式：基于上游前缀生成的草稿，按完整的上游阶段校准
+RECONCILE_INSTRUCTIONS_TEMPLATES = {
+    2: "本文档在阶段一尚未完成时，依据其G/U/Q部分提前生成。以下是完整的阶段一文档，请对照检查驱动性问题、表现性任务与其他评估证据是否覆盖其中的知识（K）与技能（S）目标，只修改需要调整的章节：\n\n{upstream}",
+    3: "本文档在阶段二尚未完成时，依据其驱动性问题与表现性任务提前生成。以下是完整的阶段二文档，请对照检查各学习阶段、活动与评估证据是否与之一致，只修改需要调整的章节：\n\n{upstream}",
+}
+RECONCILE_MESSAGES = {
+    2: "阶段2：根据完整的阶段一校准评估证据...",
+    3: "阶段3：根据完整的阶段二校准学习蓝图...",
+}
+
+EDIT_INSTRUCTIONS_TEMPLATE = "{description}\n\n【重要修改指令】用户在对话中提出了以下修改要求，请在生成时优先考虑：\n{edit_instructions}\n\n请基于现有内容进行针对性的修改，而不是完全重新生成。"
+
 
 class WorkflowServiceV3:
     """
@@ -29,8 +70,14 @@ class WorkflowServiceV3:
         self.agent1 = ProjectFoundationAgentV3()
         self.agent2 = AssessmentFrameworkAgentV3()
         self.agent3 = LearningBlueprintAgentV3()
+        self.section_editor = SectionEditAgent()
         self.validation_service = get_validation_service()
+        self.snapshot_interval = max(1, settings.stream_snapshot_interval)
+        self.admission = get_admission_controller()
+        self.stage_writer = get_stage_writer()
+        self.usage_recorder = get_usage_recorder()
 
+    @traced_stream("workflow.stream")
     async def stream_workflow(
         self,
         title: str,
@@ -43,6 +90,12 @@ class WorkflowServiceV3:
         stage_one_data: str = None,
         stage_two_data: str = None,
         edit_instructions: str = None,  # 🎯 新增：AI对话中的编辑指令
+        stream_mode: str = STREAM_MODE_FULL,
+        pipelined: bool = False,
+        use_cache: bool = True,
+        course_key: Optional[str] = None,
+        course_id: Optional[int] = None,
+        stored_state: Optional[Dict[str, Any]] = None,
     ) -> AsyncGenerator[str, None]:
         """
         流式生成完整工作流
@@ -50,28 +103,43 @@ class WorkflowServiceV3:
         Args:
             stage_one_data: 已有的Stage One Markdown数据（用于重新生成时提供）
             stage_two_data: 已有的Stage Two Markdown数据（用于重新生成时提供）
+            stream_mode: progress事件格式
+                - "full": 每个事件携带完整的markdown_preview（默认）
+                - "delta": 仅携带本次新增的delta + 序号seq，
+                  每 stream_snapshot_interval 个事件附带一次完整快照用于重同步
+            pipelined: 是否启用流水线模式（见 _stream_pipelined）
+            use_cache: 是否使用生成缓存（False时强制调用LLM重新生成）
+            course_key: 准入控制中用于公平排队的课程标识（默认使用课程名称）
+                等待LLM槽位期间发送 queued 事件 (stage, position)
+            course_id: 课程ID；提供时每个阶段完成后由后台写入器保存到 CourseProject，
+                stage_complete 事件带 autosaved=True，并记录该阶段输入的内容哈希
+            stored_state: 课程已保存的状态（见 stage_dependencies.course_state）；
+                提供时只重新生成输入发生变化的阶段，其余阶段沿用已保存内容并发送
+                stage_skipped 事件 (stage, reason, changed_inputs)
 
         Yields:
-            SSE格式的事件字符串
+            SSE格式的事件字符串（start 事件携带 trace_id）
         """
         if stages_to_generate is None:
             stages_to_generate = [1, 2, 3]
 
         start_time = time.time()
+        tenant = course_key or (f"course:{course_id}" if course_id is not None else title)
+        set_span_attributes(
+            **{"course.id": course_id, "workflow.stream_mode": stream_mode, "workflow.pipelined": pipelined}
+        )
+        active_stream = None
+        # 工作流结果（指标），未完成也未失败即视为客户端断开
+        run = {"outcome": OUTCOME_CANCELLED}
+        # 各阶段的token用量（含失败与取消的阶段），complete 事件带合计
+        usages = {stage: TokenUsage() for stage in (1, 2, 3)}
 
         try:
-            # 发送开始事件
-            yield self._format_sse({
-                "event": "start",
-                "data": {
-                    "message": f"开始生成《{title}》的UbD-PBL课程方案",
-                    "stages": stages_to_generate,
-                },
-            })
-
             # 使用提供的数据（用于跳过已有阶段）
             # stage_one_data 和 stage_two_data 已经作为参数传入（都是Markdown格式）
             stage_three_data = None
+            # 注入编辑指令后的课程信息（Stage 2 生成时创建，Stage 3 复用）
+            effective_course_info = None
 
             course_info = {
                 "title": title,
@@ -82,6 +150,74 @@ class WorkflowServiceV3:
                 "description": description,
             }
 
+            # 选择性重新生成：只生成输入发生变化（或缺失）的阶段
+            plan = None
+            if stored_state is not None:
+                current = dict(stored_state.get("stages") or {})
+                if stage_one_data:
+                    current[1] = stage_one_data
+                if stage_two_data:
+                    current[2] = stage_two_data
+                plan = plan_regeneration(
+                    stages_to_generate,
+                    course_info,
+                    current,
+                    stored_state.get("sources"),
+                    stored_state.get("versions"),
+                    # 带编辑指令时请求的阶段必须重新生成，否则修改要求会被静默丢弃
+                    force=stages_to_generate if edit_instructions else (),
+                )
+                stage_one_data = None if 1 in plan.regenerate else current.get(1)
+                stage_two_data = None if 2 in plan.regenerate else current.get(2)
+                stage_three_data = plan.reused.get(3)
+                stages_to_generate = plan.regenerate
+                logger.info(f"Selective regeneration: regenerate={plan.regenerate}, reuse={sorted(plan.reused)}")
+            set_span_attributes(**{"workflow.stages": list(stages_to_generate)})
+
+            # 发送开始事件
+            start_data = {
+                "message": f"开始生成《{title}》的UbD-PBL课程方案",
+                "stages": stages_to_generate,
+                "stream_mode": stream_mode,
+            }
+            trace_id = current_trace_id()
+            if trace_id:
+                start_data["trace_id"] = trace_id
+            if plan is not None:
+                start_data["skipped_stages"] = sorted(plan.reused)
+            yield self._format_sse({"event": "start", "data": start_data})
+
+            if plan is not None:
+                for stage in sorted(plan.reused):
+                    yield self._format_sse({
+                        "event": "stage_skipped",
+                        "data": {
+                            "stage": stage,
+                            "reason": plan.reason(stage),
+                            "changed_inputs": plan.statuses[stage].changed_inputs,
+                        },
+                    })
+
+            if pipelined:
+                active_stream = self._stream_pipelined(
+                    course_info=course_info,
+                    stages_to_generate=stages_to_generate,
+                    stage_one_data=stage_one_data,
+                    stage_two_data=stage_two_data,
+                    stage_three_data=stage_three_data,
+                    edit_instructions=edit_instructions,
+                    stream_mode=stream_mode,
+                    start_time=start_time,
+                    use_cache=use_cache,
+                    tenant=tenant,
+                    course_id=course_id,
+                    run=run,
+                    usages=usages,
+                )
+                async for sse in active_stream:
+                    yield sse
+                return
+
             # ===== Stage 1: 确定预期学习结果 (Markdown版 + 流式) =====
             if 1 in stages_to_generate and not stage_one_data:
                 yield self._format_sse({
@@ -96,29 +232,27 @@ class WorkflowServiceV3:
                 # 🎯 如果有编辑指令，注入到description中
                 effective_description = description
                 if edit_instructions:
-                    effective_description = f"{description}\n\n【重要修改指令】用户在对话中提出了以下修改要求，请在生成时优先考虑：\n{edit_instructions}\n\n请基于现有内容进行针对性的修改，而不是完全重新生成。"
+                    effective_description = self._with_edit_instructions(description, edit_instructions)
                     logger.info(f"Stage 1: Injecting edit_instructions: {edit_instructions}")
 
                 # 使用流式生成
-                async for event in self.agent1.generate_stream(
+                seq = 0
+                active_stream = self._admitted(1, tenant, self.agent1.generate_stream(
                     title=title,
                     subject=subject,
                     grade_level=grade_level,
                     total_class_hours=total_class_hours,
                     schedule_description=schedule_description,
                     description=effective_description,  # 🎯 使用包含编辑指令的描述
-                ):
-                    if event["type"] == "progress":
-                        # 转发进度事件（包含当前markdown内容）
-                        yield self._format_sse({
-                            "event": "progress",
-                            "data": {
-                                "stage": 1,
-                                "progress": event["progress"],
-                                "message": f"生成中... ({int(event['progress'] * 100)}%)",
-                                "markdown_preview": event["content"],  # 实时预览
-                            },
-                        })
+                    use_cache=use_cache,
+                    usage=usages[1],
+                ), usage=usages[1], course_id=course_id)
+                async for event in active_stream:
+                    if event["type"] == "queued":
+                        yield self._format_queued_sse(1, event["position"])
+                    elif event["type"] == "progress":
+                        seq += 1
+                        yield self._format_progress_sse(1, event, seq, stream_mode)
                     elif event["type"] == "complete":
                         # 完成事件
                         stage_one_data = event["content"]
@@ -128,6 +262,11 @@ class WorkflowServiceV3:
                                 "stage": 1,
                                 "markdown": stage_one_data,
                                 "generation_time": event["generation_time"],
+                                "cached": event.get("cached", False),
+                                "token_usage": usages[1].to_dict(),
+                                "autosaved": self._persist_stage(
+                                    course_id, 1, stage_one_data, course_info
+                                ),
                             },
                         })
                         logger.info(
@@ -142,6 +281,7 @@ class WorkflowServiceV3:
                                 "message": f"阶段1生成失败: {event.get('error')}",
                             },
                         })
+                        run["outcome"] = OUTCOME_ERROR
                         return
 
             # ===== Stage 2: 确定可接受的证据 (流式) =====
@@ -158,23 +298,25 @@ class WorkflowServiceV3:
                 # 🎯 如果有编辑指令，注入到course_info中
                 effective_course_info = course_info.copy()
                 if edit_instructions:
-                    effective_course_info["description"] = f"{course_info.get('description', '')}\n\n【重要修改指令】用户在对话中提出了以下修改要求，请在生成时优先考虑：\n{edit_instructions}\n\n请基于现有内容进行针对性的修改，而不是完全重新生成。"
+                    effective_course_info["description"] = self._with_edit_instructions(
+                        course_info.get("description", ""), edit_instructions
+                    )
                     logger.info(f"Stage 2: Injecting edit_instructions: {edit_instructions}")
 
                 # 使用流式生成
-                async for event in self.agent2.generate_stream(
-                    stage_one_data=stage_one_data, course_info=effective_course_info
-                ):
-                    if event["type"] == "progress":
-                        yield self._format_sse({
-                            "event": "progress",
-                            "data": {
-                                "stage": 2,
-                                "progress": event["progress"],
-                                "message": f"生成中... ({int(event['progress'] * 100)}%)",
-                                "markdown_preview": event["content"],
-                            },
-                        })
+                seq = 0
+                active_stream = self._admitted(2, tenant, self.agent2.generate_stream(
+                    stage_one_data=stage_one_data,
+                    course_info=effective_course_info,
+                    use_cache=use_cache,
+                    usage=usages[2],
+                ), usage=usages[2], course_id=course_id)
+                async for event in active_stream:
+                    if event["type"] == "queued":
+                        yield self._format_queued_sse(2, event["position"])
+                    elif event["type"] == "progress":
+                        seq += 1
+                        yield self._format_progress_sse(2, event, seq, stream_mode)
                     elif event["type"] == "complete":
                         stage_two_data = event["content"]
                         yield self._format_sse({
@@ -183,6 +325,11 @@ class WorkflowServiceV3:
                                 "stage": 2,
                                 "markdown": stage_two_data,
                                 "generation_time": event["generation_time"],
+                                "cached": event.get("cached", False),
+                                "token_usage": usages[2].to_dict(),
+                                "autosaved": self._persist_stage(
+                                    course_id, 2, stage_two_data, course_info, {1: stage_one_data}
+                                ),
                             },
                         })
                         logger.info(
@@ -196,6 +343,7 @@ class WorkflowServiceV3:
                                 "message": f"阶段2生成失败: {event.get('error')}",
                             },
                         })
+                        run["outcome"] = OUTCOME_ERROR
                         return
 
             # ===== Stage 3: 规划学习体验 (流式) =====
@@ -213,25 +361,26 @@ class WorkflowServiceV3:
                 # 🎯 如果有编辑指令，注入到course_info中（复用Stage 2的逻辑）
                 if edit_instructions and not effective_course_info:
                     effective_course_info = course_info.copy()
-                    effective_course_info["description"] = f"{course_info.get('description', '')}\n\n【重要修改指令】用户在对话中提出了以下修改要求，请在生成时优先考虑：\n{edit_instructions}\n\n请基于现有内容进行针对性的修改，而不是完全重新生成。"
+                    effective_course_info["description"] = self._with_edit_instructions(
+                        course_info.get("description", ""), edit_instructions
+                    )
                     logger.info(f"Stage 3: Injecting edit_instructions: {edit_instructions}")
 
                 # 使用流式生成
-                async for event in self.agent3.generate_stream(
+                seq = 0
+                active_stream = self._admitted(3, tenant, self.agent3.generate_stream(
                     stage_one_data=stage_one_data,
                     stage_two_data=stage_two_data,
                     course_info=effective_course_info if edit_instructions else course_info,
-                ):
-                    if event["type"] == "progress":
-                        yield self._format_sse({
-                            "event": "progress",
-                            "data": {
-                                "stage": 3,
-                                "progress": event["progress"],
-                                "message": f"生成中... ({int(event['progress'] * 100)}%)",
-                                "markdown_preview": event["content"],
-                            },
-                        })
+                    use_cache=use_cache,
+                    usage=usages[3],
+                ), usage=usages[3], course_id=course_id)
+                async for event in active_stream:
+                    if event["type"] == "queued":
+                        yield self._format_queued_sse(3, event["position"])
+                    elif event["type"] == "progress":
+                        seq += 1
+                        yield self._format_progress_sse(3, event, seq, stream_mode)
                     elif event["type"] == "complete":
                         stage_three_data = event["content"]
                         yield self._format_sse({
@@ -240,6 +389,12 @@ class WorkflowServiceV3:
                                 "stage": 3,
                                 "markdown": stage_three_data,
                                 "generation_time": event["generation_time"],
+                                "cached": event.get("cached", False),
+                                "token_usage": usages[3].to_dict(),
+                                "autosaved": self._persist_stage(
+                                    course_id, 3, stage_three_data, course_info,
+                                    {1: stage_one_data, 2: stage_two_data},
+                                ),
                             },
                         })
                         logger.info(
@@ -253,35 +408,597 @@ class WorkflowServiceV3:
                                 "message": f"阶段3生成失败: {event.get('error')}",
                             },
                         })
+                        run["outcome"] = OUTCOME_ERROR
                         return
 
             # ===== 完成 =====
-            total_time = time.time() - start_time
+            run["outcome"] = OUTCOME_COMPLETED
+            yield self._format_complete_sse(
+                start_time, stage_one_data, stage_two_data, stage_three_data,
+                token_usage=TokenUsage.total(usages.values()),
+            )
+
+        except Exception as e:
+            run["outcome"] = OUTCOME_ERROR
+            logger.error(f"Workflow error: {e}", exc_info=True)
             yield self._format_sse({
-                "event": "complete",
-                "data": {
-                    "message": "课程方案生成完成！",
-                    "total_time": round(total_time, 2),
-                    "summary": {
-                        "stage_one": {
-                            "markdown_length": len(stage_one_data) if isinstance(stage_one_data, str) else 0,
-                        },
-                        "stage_two": {
-                            "markdown_length": len(stage_two_data) if isinstance(stage_two_data, str) else 0,
+                "event": "error",
+                "data": {"message": str(e), "stage": None},
+            })
+        finally:
+            # 客户端断开时生成器在yield处被关闭，立即关闭当前阶段的Agent流并释放LLM槽位
+            if active_stream is not None:
+                await active_stream.aclose()
+            get_metrics().record_workflow(run["outcome"], time.time() - start_time)
+
+    @traced_stream("workflow.section_edit")
+    async def stream_section_edit(
+        self,
+        stage: int,
+        markdown: str,
+        edit_instructions: str,
+        course_info: Optional[Dict[str, Any]] = None,
+        sections: Optional[List[str]] = None,
+        course_key: Optional[str] = None,
+        course_id: Optional[int] = None,
+        stream_mode: str = STREAM_MODE_FULL,
+    ) -> AsyncGenerator[str, None]:
+        """
+        章节级局部修改（替代带编辑指令的整阶段重新生成）
+
+        模型只重写受影响的章节，每完成一个章节发送 section_patch 事件，
+        结束时合并回文档并发送 stage_complete（mode="section"）。
+        progress 事件只描述正在输出的章节 (section)，不携带整篇文档：
+        - "full": section_preview 为该章节目前的完整内容
+        - "delta": delta 为该章节新增的内容（section 变化时客户端开始新的章节缓冲）
+        该章节完成后以 section_patch 的内容为准。
+
+        Args:
+            stage: 要修改的阶段
+            markdown: 已保存的阶段文档
+            edit_instructions: 对话中提出的修改指令
+            course_info: 课程基本信息
+            sections: 限定可修改的章节（编号、G/U/Q/K/S代码或标题片段）
+            course_key: 准入控制中用于公平排队的课程标识
+            course_id: 课程ID；提供时合并后的文档由后台写入器保存
+            stream_mode: progress事件格式 "full" | "delta"
+
+        Yields:
+            SSE格式的事件字符串
+        """
+        start_time = time.time()
+        course_info = course_info or {}
+        tenant = course_key or (f"course:{course_id}" if course_id is not None else course_info.get("title", ""))
+        active_stream = None
+        stages = {1: None, 2: None, 3: None}
+        usage = TokenUsage()
+
+        set_span_attributes(**{"course.id": course_id, "workflow.stages": [stage]})
+
+        try:
+            start_data = {
+                "message": f"开始修改《{course_info.get('title', '')}》阶段{stage}的相关章节",
+                "stages": [stage],
+                "stream_mode": stream_mode,
+                "mode": "section",
+            }
+            trace_id = current_trace_id()
+            if trace_id:
+                start_data["trace_id"] = trace_id
+            yield self._format_sse({"event": "start", "data": start_data})
+
+            seq = 0
+            # 正在输出、尚未完成的章节内容（full模式的 section_preview）
+            previews: Dict[int, str] = {}
+            active_stream = self._admitted(stage, tenant, self.section_editor.edit_stream(
+                stage=stage,
+                markdown=markdown,
+                edit_instructions=edit_instructions,
+                course_info=course_info,
+                sections=sections,
+                usage=usage,
+            ), mode=MODE_SECTION_EDIT, usage=usage, course_id=course_id)
+            async for event in active_stream:
+                if event["type"] == "queued":
+                    yield self._format_queued_sse(stage, event["position"])
+                elif event["type"] == "progress":
+                    seq += 1
+                    previews[event["section"]] = previews.get(event["section"], "") + event["delta"]
+                    yield self._format_section_progress_sse(
+                        stage, event, seq, stream_mode, previews[event["section"]]
+                    )
+                elif event["type"] == "section":
+                    previews.pop(event["index"], None)
+                    yield self._format_section_patch_sse(stage, event)
+                elif event["type"] == "complete":
+                    stages[stage] = event["content"]
+                    patched = event["sections"]
+                    yield self._format_sse({
+                        "event": "stage_complete",
+                        "data": {
+                            "stage": stage,
+                            "markdown": event["content"],
+                            "generation_time": event["generation_time"],
+                            "cached": False,
+                            "token_usage": usage.to_dict(),
+                            "mode": "section",
+                            "patched_sections": patched,
+                            "autosaved": bool(patched) and self._persist_stage(course_id, stage, event["content"]),
                         },
-                        "stage_three": {
-                            "markdown_length": len(stage_three_data) if isinstance(stage_three_data, str) else 0,
+                    })
+                elif event["type"] == "error":
+                    yield self._format_sse({
+                        "event": "error",
+                        "data": {
+                            "stage": stage,
+                            "message": f"阶段{stage}局部修改失败: {event.get('error')}",
                         },
-                    },
-                },
-            })
+                    })
+                    return
+
+            yield self._format_complete_sse(start_time, stages[1], stages[2], stages[3], token_usage=usage)
 
         except Exception as e:
-            logger.error(f"Workflow error: {e}", exc_info=True)
+            logger.error(f"Section edit error: {e}", exc_info=True)
             yield self._format_sse({
                 "event": "error",
-                "data": {"message": str(e), "stage": None},
+                "data": {"message": str(e), "stage": stage},
             })
+        finally:
+            if active_stream is not None:
+                await active_stream.aclose()
+
+    async def _stream_pipelined(
+        self,
+        course_info: Dict[str, Any],
+        stages_to_generate: list,
+        stage_one_data: Optional[str],
+        stage_two_data: Optional[str],
+        edit_instructions: Optional[str],
+        stream_mode: str,
+        start_time: float,
+        use_cache: bool = True,
+        tenant: str = "default",
+        course_id: Optional[int] = None,
+        stage_three_data: Optional[str] = None,
+        run: Optional[Dict[str, str]] = None,
+        usages: Optional[Dict[int, TokenUsage]] = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        流水线模式：下游阶段不再等待上游完全结束
+
+        - Stage 1 的 G/U/Q 部分流式完成后，Stage 2 以该前缀为输入立即启动
+        - Stage 2 的驱动性问题与表现性任务完成后，Stage 3 以该前缀为输入提前启动，
+          先行生成PBL阶段结构
+        - 基于前缀生成的结果只是草稿：上游完成后由章节编辑器按完整的上游校准
+          （只改需要调整的章节），再发送该阶段的 stage_complete
+        - 若上游未出现提前启动标志，则在上游完成后以完整数据启动
+
+        各阶段的事件交错输出，均带有 stage 字段；经过校准的阶段，其 stage_complete
+        带有 reconciled=True 与 patched_sections，upstream_partial 为 False。
+        各阶段记录的是最终结果实际依据的上游数据的哈希。
+
+        Args:
+            run: 调用方的工作流结果记录，完成或失败时写入 outcome
+            usages: 调用方的各阶段token用量，按阶段累加
+        """
+        run = run if run is not None else {}
+        usages = usages if usages is not None else {stage: TokenUsage() for stage in (1, 2, 3)}
+        queue: asyncio.Queue = asyncio.Queue()
+        tasks: Dict[int, asyncio.Task] = {}
+        running = set()
+        seq = {1: 0, 2: 0, 3: 0}
+        partial_input = {2: False, 3: False}
+
+        # 各阶段当前可用的上游数据（完整数据 或 提前启动用的前缀）
+        results = {1: stage_one_data, 2: stage_two_data, 3: stage_three_data}
+        ready_prefix = {1: None, 2: None}
+        # 各阶段启动时实际使用的上游数据，用于记录输入哈希
+        consumed: Dict[int, Dict[int, Optional[str]]] = {1: {}}
+        # 等待校准的草稿，以及校准过程的token用量（存在即表示已开始校准）
+        drafts: Dict[int, str] = {}
+        reconcile_usage: Dict[int, TokenUsage] = {}
+
+        stage_course_info = course_info
+        if edit_instructions:
+            stage_course_info = course_info.copy()
+            stage_course_info["description"] = self._with_edit_instructions(
+                course_info.get("description", ""), edit_instructions
+            )
+            logger.info(f"Pipelined: Injecting edit_instructions: {edit_instructions}")
+
+        need = {
+            1: 1 in stages_to_generate and not stage_one_data,
+            2: 2 in stages_to_generate and not stage_two_data,
+            3: 3 in stages_to_generate,
+        }
+        stage_messages = {
+            1: "阶段1：分析课程目标，构建G/U/Q/K/S框架（Markdown格式）...",
+            2: "阶段2：设计驱动性问题和表现性任务...",
+            3: "阶段3：规划PBL四阶段学习蓝图...",
+        }
+
+        def start_stage(
+            stage: int,
+            agen,
+            mode: str = MODE_GENERATE,
+            usage: Optional[TokenUsage] = None,
+            message: Optional[str] = None,
+        ) -> str:
+            need[stage] = False
+            running.add(stage)
+            usage = usage if usage is not None else usages[stage]
+            tasks[stage] = asyncio.ensure_future(
+                self._pump_stage(
+                    stage, self._admitted(stage, tenant, agen, mode=mode, usage=usage, course_id=course_id), queue
+                )
+            )
+            return self._format_sse({
+                "event": "progress",
+                "data": {"stage": stage, "progress": 0, "message": message or stage_messages[stage]},
+            })
+
+        def startable():
+            """返回当前可以启动的阶段的开始事件"""
+            events = []
+            if need[1]:
+                events.append(start_stage(1, self.agent1.generate_stream(
+                    title=course_info["title"],
+                    subject=course_info["subject"],
+                    grade_level=course_info["grade_level"],
+                    total_class_hours=course_info["total_class_hours"],
+                    schedule_description=course_info["schedule_description"],
+                    description=stage_course_info["description"],
+                    use_cache=use_cache,
+                    usage=usages[1],
+                )))
+            stage_one_input = results[1] or ready_prefix[1]
+            if need[2] and stage_one_input:
+                partial_input[2] = results[1] is None
+                consumed[2] = {1: stage_one_input}
+                events.append(start_stage(2, self.agent2.generate_stream(
+                    stage_one_data=stage_one_input,
+                    course_info=stage_course_info,
+                    use_cache=use_cache,
+                    usage=usages[2],
+                )))
+            stage_two_input = results[2] or ready_prefix[2]
+            if need[3] and results[1] and stage_two_input:
+                partial_input[3] = results[2] is None or partial_input[2]
+                consumed[3] = {1: results[1], 2: stage_two_input}
+                events.append(start_stage(3, self.agent3.generate_stream(
+                    stage_one_data=results[1],
+                    stage_two_data=stage_two_input,
+                    course_info=stage_course_info,
+                    use_cache=use_cache,
+                    usage=usages[3],
+                )))
+            for stage in (2, 3):
+                upstream = stage - 1
+                if stage in drafts and results[upstream] and stage not in running:
+                    consumed[stage] = {u: results[u] for u in consumed[stage]}
+                    reconcile_usage[stage] = TokenUsage()
+                    events.append(start_stage(stage, self.section_editor.edit_stream(
+                        stage=stage,
+                        markdown=drafts.pop(stage),
+                        edit_instructions=RECONCILE_INSTRUCTIONS_TEMPLATES[stage].format(upstream=results[upstream]),
+                        course_info=stage_course_info,
+                        usage=reconcile_usage[stage],
+                    ), mode=MODE_SECTION_EDIT, usage=reconcile_usage[stage], message=RECONCILE_MESSAGES[stage]))
+            return events
+
+        try:
+            for sse in startable():
+                yield sse
+
+            while running:
+                stage, event = await queue.get()
+
+                if event is None:
+                    running.discard(stage)
+                    for sse in startable():
+                        yield sse
+                    continue
+
+                if event["type"] == "queued":
+                    yield self._format_queued_sse(stage, event["position"])
+
+                elif event["type"] == "progress":
+                    if stage in reconcile_usage:
+                        # 校准过程只发送章节补丁，预览以草稿为准
+                        continue
+                    seq[stage] += 1
+                    yield self._format_progress_sse(stage, event, seq[stage], stream_mode)
+
+                    if stage in ready_prefix and ready_prefix[stage] is None:
+                        pattern = STAGE_ONE_READY_PATTERN if stage == 1 else STAGE_TWO_READY_PATTERN
+                        match = pattern.search(event["content"])
+                        if match:
+                            ready_prefix[stage] = event["content"][:match.start()].rstrip()
+                            logger.info(
+                                f"Pipelined: Stage {stage} prefix ready "
+                                f"({len(ready_prefix[stage])} chars), starting downstream"
+                            )
+                            for sse in startable():
+                                yield sse
+
+                elif event["type"] == "section":
+                    yield self._format_section_patch_sse(stage, event)
+
+                elif event["type"] == "complete":
+                    if stage in partial_input and stage not in reconcile_usage and any(
+                        text != results[upstream] for upstream, text in consumed[stage].items()
+                    ):
+                        # 草稿基于上游前缀：上游完成后校准，暂不发送 stage_complete
+                        drafts[stage] = event["content"]
+                        logger.info(
+                            f"Pipelined: Stage {stage} draft ready ({len(event['content'])} chars), reconciling"
+                        )
+                        continue
+
+                    results[stage] = event["content"]
+                    if stage in reconcile_usage:
+                        usages[stage] = TokenUsage.total([usages[stage], reconcile_usage[stage]])
+                        partial_input[stage] = False
+                    data = {
+                        "stage": stage,
+                        "markdown": event["content"],
+                        "generation_time": event["generation_time"],
+                        "cached": event.get("cached", False),
+                        "token_usage": usages[stage].to_dict(),
+                    }
+                    if stage in partial_input:
+                        data["upstream_partial"] = partial_input[stage]
+                    if stage in reconcile_usage:
+                        data["reconciled"] = True
+                        data["patched_sections"] = event["sections"]
+                    data["autosaved"] = self._persist_stage(
+                        course_id, stage, event["content"], course_info, consumed[stage]
+                    )
+                    yield self._format_sse({"event": "stage_complete", "data": data})
+                    logger.info(
+                        f"Pipelined: Stage {stage} complete ({len(event['content'])} chars)"
+                    )
+                    for sse in startable():
+                        yield sse
+
+                elif event["type"] == "error":
+                    yield self._format_sse({
+                        "event": "error",
+                        "data": {
+                            "stage": stage,
+                            "message": f"阶段{stage}生成失败: {event.get('error')}",
+                        },
+                    })
+                    run["outcome"] = OUTCOME_ERROR
+                    return
+
+            run["outcome"] = OUTCOME_COMPLETED
+            yield self._format_complete_sse(
+                start_time, results[1], results[2], results[3], token_usage=TokenUsage.total(usages.values())
+            )
+
+        finally:
+            pending = [task for task in tasks.values() if not task.done()]
+            for task in pending:
+                task.cancel()
+            # 等待各阶段任务退出，确保上游LLM流已关闭、槽位已释放
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _pump_stage(self, stage: int, agen, queue: asyncio.Queue):
+        """
+        将一个Agent的流式事件转发到共享队列，结束时放入 (stage, None) 作为结束标记
+        """
+        try:
+            async for event in agen:
+                await queue.put((stage, event))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Pipelined: Stage {stage} failed: {e}", exc_info=True)
+            await queue.put((stage, {"type": "error", "error": str(e)}))
+        finally:
+            await agen.aclose()
+        await queue.put((stage, None))
+
+    async def _admitted(
+        self,
+        stage: int,
+        tenant: str,
+        agen,
+        mode: str = MODE_GENERATE,
+        usage: Optional[TokenUsage] = None,
+        course_id: Optional[int] = None,
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        在准入控制下运行一个Agent流
+
+        Agent在缓存未命中、即将调用LLM时产出 {"type": "llm_call"}，此时才申请LLM槽位：
+        等待期间产出 {"type": "queued", "position": n}，队列已满时产出 error 事件。
+        命中生成缓存的回放不占用槽位，也不会排队。结束（含客户端断开）时释放槽位。
+
+        同时记录排队等待与阶段总时长指标；整阶段生成（MODE_GENERATE）计入 agentN_timeout SLO。
+        提供 usage 与 course_id 时，结束后（含失败与取消）把该阶段的token用量记入课程用量。
+        """
+        model = resolve_model(f"agent{stage}")
+        started = time.perf_counter()
+        outcome = None
+        cached = False
+        ticket = None
+        try:
+            async for event in agen:
+                if event["type"] == "llm_call":
+                    if ticket is not None:
+                        continue
+                    try:
+                        ticket = self.admission.enqueue(model, tenant=tenant, priority=PRIORITY_BULK)
+                    except QueueFullError as e:
+                        logger.warning(f"Stage {stage} rejected by admission control: {e}")
+                        outcome = OUTCOME_ERROR
+                        yield {"type": "error", "error": "服务繁忙，生成队列已满，请稍后重试"}
+                        return
+                    async for position in trace_stream(
+                        "admission.wait", ticket.wait(), **{"llm.model": model, "workflow.stage": stage}
+                    ):
+                        yield {"type": "queued", "position": position}
+                    get_metrics().observe_queue_wait(f"agent{stage}", model, ticket.wait_seconds)
+                    continue
+                if event["type"] == "complete":
+                    outcome = OUTCOME_COMPLETED
+                    cached = bool(event.get("cached"))
+                elif event["type"] == "error":
+                    outcome = OUTCOME_ERROR
+                yield event
+            if outcome is None:
+                outcome = OUTCOME_ERROR
+        finally:
+            if ticket is not None:
+                ticket.release()
+            await agen.aclose()
+            get_metrics().record_stage(
+                stage, model, outcome or OUTCOME_CANCELLED, time.perf_counter() - started,
+                cached=cached, mode=mode,
+            )
+            if usage is not None and course_id is not None:
+                self.usage_recorder.record(course_id, mode, usage, model=model, stage=stage)
+
+    def _persist_stage(
+        self,
+        course_id: Optional[int],
+        stage: int,
+        markdown: str,
+        course_info: Optional[Dict[str, Any]] = None,
+        upstream: Optional[Dict[int, Optional[str]]] = None,
+    ) -> bool:
+        """
+        提交阶段结果到后台写入器（不等待数据库提交），返回是否已提交
+
+        提供 course_info 时同时记录该阶段输入（课程信息 + 上游阶段）的内容哈希；
+        上游尚不完整时不记录，保留原有记录
+        """
+        if course_id is None:
+            return False
+        sources = None
+        if course_info is not None:
+            sources = stage_sources(stage, course_info, upstream or {})
+        self.stage_writer.submit(course_id, stage, markdown, sources=sources)
+        return True
+
+    def _with_edit_instructions(self, description: str, edit_instructions: str) -> str:
+        """将AI对话中的编辑指令注入到课程描述中"""
+        return EDIT_INSTRUCTIONS_TEMPLATE.format(
+            description=description or "", edit_instructions=edit_instructions
+        )
+
+    def _format_complete_sse(
+        self,
+        start_time: float,
+        stage_one_data: Optional[str],
+        stage_two_data: Optional[str],
+        stage_three_data: Optional[str],
+        token_usage: Optional[TokenUsage] = None,
+    ) -> str:
+        """格式化工作流完成事件（token_usage 为本次工作流各阶段的用量合计）"""
+        total_time = time.time() - start_time
+        data = {
+            "message": "课程方案生成完成！",
+            "total_time": round(total_time, 2),
+            "summary": {
+                "stage_one": {
+                    "markdown_length": len(stage_one_data) if isinstance(stage_one_data, str) else 0,
+                },
+                "stage_two": {
+                    "markdown_length": len(stage_two_data) if isinstance(stage_two_data, str) else 0,
+                },
+                "stage_three": {
+                    "markdown_length": len(stage_three_data) if isinstance(stage_three_data, str) else 0,
+                },
+            },
+        }
+        if token_usage is not None:
+            data["token_usage"] = token_usage.to_dict()
+        return self._format_sse({"event": "complete", "data": data})
+
+    def _format_queued_sse(self, stage: int, position: int) -> str:
+        """格式化排队事件（position=1表示下一个获得LLM槽位）"""
+        return self._format_sse({
+            "event": "queued",
+            "data": {
+                "stage": stage,
+                "position": position,
+                "message": f"阶段{stage}排队中，前面还有{position - 1}个请求...",
+            },
+        })
+
+    def _format_section_progress_sse(
+        self, stage: int, event: Dict[str, Any], seq: int, stream_mode: str, preview: str
+    ) -> str:
+        """
+        格式化局部修改的progress事件（只涉及正在输出的章节）
+
+        Args:
+            event: 章节编辑器的progress事件 {"section", "delta", "progress"}
+            preview: 该章节目前的完整内容（full模式发送）
+        """
+        data = {
+            "stage": stage,
+            "progress": event["progress"],
+            "message": f"修改中... ({int(event['progress'] * 100)}%)",
+            "seq": seq,
+            "section": event["section"],
+        }
+        if stream_mode == STREAM_MODE_DELTA:
+            data["delta"] = event["delta"]
+        else:
+            data["section_preview"] = preview
+        return self._format_sse({"event": "progress", "data": data})
+
+    def _format_section_patch_sse(self, stage: int, event: Dict[str, Any]) -> str:
+        """章节补丁事件：一个章节的完整新内容"""
+        return self._format_sse({
+            "event": "section_patch",
+            "data": {
+                "stage": stage,
+                "index": event["index"],
+                "heading": event["heading"],
+                "code": event["code"],
+                "markdown": event["markdown"],
+            },
+        })
+
+    def _format_progress_sse(
+        self, stage: int, event: Dict[str, Any], seq: int, stream_mode: str
+    ) -> str:
+        """
+        格式化Agent的progress事件
+
+        delta模式下客户端重建规则：
+        - snapshot为True时，用markdown_preview替换本地文档
+        - 否则将delta追加到本地文档
+        - 发现seq不连续时丢弃本地文档，等待下一个快照
+
+        Args:
+            stage: 阶段编号
+            event: Agent产生的progress事件 {"content", "chunk", "progress"}
+            seq: 本阶段内的事件序号（从1开始）
+            stream_mode: "full" | "delta"
+        """
+        data = {
+            "stage": stage,
+            "progress": event["progress"],
+            "message": f"生成中... ({int(event['progress'] * 100)}%)",
+            "seq": seq,
+        }
+
+        if stream_mode == STREAM_MODE_DELTA and seq % self.snapshot_interval != 0:
+            data["delta"] = event["chunk"]
+        else:
+            data["markdown_preview"] = event["content"]  # 实时预览
+            if stream_mode == STREAM_MODE_DELTA:
+                data["snapshot"] = True
+
+        return self._format_sse({"event": "progress", "data": data})
 
     def _format_sse(self, event_data: Dict[str, Any]) -> str:
         """
@@ -303,21 +1020,31 @@ class WorkflowServiceV3:
         total_class_hours: int = None,
         schedule_description: str = "",
         description: str = "",
+        use_cache: bool = True,
+        tenant: Optional[str] = None,
     ) -> Dict[str, Any]:
         """
-        非流式的完整工作流生成（用于测试）
+        非流式的完整工作流生成
+
+        每个阶段在准入控制下以批量优先级运行，不挤占交互式对话的槽位。
+
+        Args:
+            use_cache: 是否使用生成缓存（False时强制调用LLM重新生成）
+            tenant: 准入控制中用于公平排队的标识（默认使用课程名称）
 
         Returns:
             {
                 "success": bool,
-                "stage_one": StageOneData,
-                "stage_two": StageTwoData,
-                "stage_three": StageThreeData,
+                "stage_one": str,  # Stage One Markdown
+                "stage_two": str,  # Stage Two Markdown
+                "stage_three": str,  # Stage Three Markdown
+                "token_usage": {stage: TokenUsage},  # 各阶段的token用量（命中缓存的阶段 calls 为0）
                 "total_time": float,
                 "error": str (if failed)
             }
         """
         start_time = time.time()
+        outcome = OUTCOME_CANCELLED
 
         try:
             course_info = {
@@ -329,44 +1056,90 @@ class WorkflowServiceV3:
                 "description": description,
             }
 
+            tenant = tenant or title
+
             # Stage 1
-            result1 = await self.agent1.generate(
-                title, subject, grade_level, total_class_hours, schedule_description, description
-            )
+            usages = {stage: TokenUsage() for stage in (1, 2, 3)}
+            result1 = await self._generate_stage(1, tenant, lambda admit: self.agent1.generate(
+                title, subject, grade_level, total_class_hours, schedule_description, description,
+                use_cache=use_cache, admit=admit, usage=usages[1],
+            ))
             if not result1["success"]:
+                outcome = OUTCOME_ERROR
                 return {"success": False, "error": f"Stage 1 failed: {result1['error']}"}
 
-            stage_one_data = result1["data"]
+            stage_one_data = result1["markdown"]
 
             # Stage 2
-            result2 = await self.agent2.generate(stage_one_data, course_info)
+            result2 = await self._generate_stage(2, tenant, lambda admit: self.agent2.generate(
+                stage_one_data, course_info, use_cache=use_cache, admit=admit, usage=usages[2]
+            ))
             if not result2["success"]:
+                outcome = OUTCOME_ERROR
                 return {"success": False, "error": f"Stage 2 failed: {result2['error']}"}
 
-            stage_two_data = result2["data"]
+            stage_two_data = result2["markdown"]
 
             # Stage 3
-            result3 = await self.agent3.generate(
-                stage_one_data, stage_two_data, course_info
-            )
+            result3 = await self._generate_stage(3, tenant, lambda admit: self.agent3.generate(
+                stage_one_data, stage_two_data, course_info, use_cache=use_cache, admit=admit,
+                usage=usages[3],
+            ))
             if not result3["success"]:
+                outcome = OUTCOME_ERROR
                 return {"success": False, "error": f"Stage 3 failed: {result3['error']}"}
 
-            stage_three_data = result3["data"]
+            stage_three_data = result3["markdown"]
 
             total_time = time.time() - start_time
+            outcome = OUTCOME_COMPLETED
 
             return {
                 "success": True,
                 "stage_one": stage_one_data,
                 "stage_two": stage_two_data,
                 "stage_three": stage_three_data,
+                "token_usage": usages,
                 "total_time": total_time,
             }
 
         except Exception as e:
+            outcome = OUTCOME_ERROR
             logger.error(f"Workflow generation failed: {e}", exc_info=True)
             return {"success": False, "error": str(e)}
+        finally:
+            get_metrics().record_workflow(outcome, time.time() - start_time)
+
+    async def _generate_stage(self, stage: int, tenant: str, call) -> Dict[str, Any]:
+        """
+        在准入控制下运行一个非流式阶段，记录排队等待与阶段时长指标
+
+        命中生成缓存时不申请槽位；缓存未命中时Agent在调用LLM前进入 admit()。
+
+        Args:
+            call: 接收 admit 并返回Agent generate() 协程的函数
+        """
+        model = resolve_model(f"agent{stage}")
+        started = time.perf_counter()
+        outcome = OUTCOME_CANCELLED
+        cached = False
+
+        @asynccontextmanager
+        async def admit():
+            async with self.admission.slot(model, tenant=tenant, priority=PRIORITY_BULK) as ticket:
+                get_metrics().observe_queue_wait(f"agent{stage}", model, ticket.wait_seconds)
+                yield ticket
+
+        try:
+            result = await call(admit)
+            outcome = OUTCOME_COMPLETED if result["success"] else OUTCOME_ERROR
+            cached = bool(result.get("cached"))
+            return result
+        except Exception:
+            outcome = OUTCOME_ERROR
+            raise
+        finally:
+            get_metrics().record_stage(stage, model, outcome, time.perf_counter() - started, cached=cached)
 
 
 # 全局单例
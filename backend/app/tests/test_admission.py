@@ -0,0 +1,212 @@
+"""
+LLM准入控制测试
+"""
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from app.core.admission import (
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    AdmissionController,
+    QueueFullError,
+)
+from app.agents.project_foundation_v3 import ProjectFoundationAgentV3
+from app.core.generation_cache import replay_cached_markdown
+from app.core.llm_transport import resolve_model
+from app.services.workflow_service_v3 import WorkflowServiceV3
+from app.tests.test_workflow_service_v3 import FakeStreamAgent, parse_sse
+
+
+def make_controller(limit=1, max_queue=10, reserved=0):
+    return AdmissionController(
+        default_limit=limit, model_limits={}, max_queue=max_queue, reserved_interactive=reserved
+    )
+
+
+class TestAdmissionQueue:
+    """测试并发上限、排队顺序与队列上限"""
+
+    @pytest.mark.asyncio
+    async def test_limit_and_fifo(self):
+        controller = make_controller(limit=1)
+        first = controller.enqueue("m", tenant="a")
+        second = controller.enqueue("m", tenant="a")
+        third = controller.enqueue("m", tenant="a")
+
+        assert first.admitted and not second.admitted
+        assert (second.position, third.position) == (1, 2)
+
+        first.release()
+        assert second.admitted and third.position == 1
+
+    @pytest.mark.asyncio
+    async def test_round_robin_across_courses(self):
+        """同一课程的多个请求不会挤占其他课程"""
+        controller = make_controller(limit=1)
+        running = controller.enqueue("m", tenant="a")
+        a2 = controller.enqueue("m", tenant="a")
+        a3 = controller.enqueue("m", tenant="a")
+        b1 = controller.enqueue("m", tenant="b")
+
+        assert (a2.position, b1.position, a3.position) == (1, 2, 3)
+
+        admitted = []
+        current = running
+        for _ in range(3):
+            current.release()
+            current = next(t for t in (a2, a3, b1) if t.admitted and not t.released)
+            admitted.append(current)
+        assert admitted == [a2, b1, a3]
+
+    @pytest.mark.asyncio
+    async def test_interactive_priority_and_reserved_slot(self):
+        """对话优先于批量生成，并且有保留槽位"""
+        controller = make_controller(limit=2, reserved=1)
+        bulk = controller.enqueue("m", tenant="a", priority=PRIORITY_BULK)
+        bulk_waiting = controller.enqueue("m", tenant="b", priority=PRIORITY_BULK)
+        chat = controller.enqueue("m", tenant="c", priority=PRIORITY_INTERACTIVE)
+
+        assert bulk.admitted and not bulk_waiting.admitted
+        assert chat.admitted  # 使用保留槽位
+
+        chat.release()
+        chat2 = controller.enqueue("m", tenant="c", priority=PRIORITY_INTERACTIVE)
+        assert chat2.admitted
+        assert bulk_waiting.position == 1
+
+    @pytest.mark.asyncio
+    async def test_queue_full_fast_fail(self):
+        controller = make_controller(limit=1, max_queue=1)
+        controller.enqueue("m")
+        controller.enqueue("m")
+
+        assert controller.is_full("m")
+        with pytest.raises(QueueFullError):
+            controller.enqueue("m")
+        assert controller.stats()["m"]["rejected_total"] == 1
+
+    @pytest.mark.asyncio
+    async def test_wait_reports_positions_and_cancel_removes(self):
+        controller = make_controller(limit=1)
+        running = controller.enqueue("m", tenant="a")
+        waiting = controller.enqueue("m", tenant="b")
+        leaving = controller.enqueue("m", tenant="c")
+        last = controller.enqueue("m", tenant="d")
+
+        positions = []
+
+        async def waiter():
+            async for position in last.wait():
+                positions.append(position)
+
+        task = asyncio.ensure_future(waiter())
+        await asyncio.sleep(0)
+        leaving.release()  # 排队中离开（如客户端断开）
+        await asyncio.sleep(0)
+        running.release()
+        await asyncio.sleep(0)
+        waiting.release()
+        await asyncio.wait_for(task, timeout=1)
+
+        assert positions == [3, 2, 1]
+        assert last.admitted
+        assert controller.stats()["m"]["active"] == 1
+
+
+class TestWorkflowAdmission:
+    """测试工作流中的排队事件"""
+
+    @pytest.mark.asyncio
+    async def test_queued_events_while_waiting(self):
+        service = WorkflowServiceV3()
+        service.agent1 = FakeStreamAgent(["# 阶段一\n", "## G: 目标\n"])
+        service.admission = make_controller(limit=1)
+        blocker = service.admission.enqueue(resolve_model("agent1"), tenant="other")
+
+        raw = []
+
+        async def consume():
+            async for sse in service.stream_workflow(title="测试课程", stages_to_generate=[1]):
+                raw.append(sse)
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.05)
+        blocker.release()
+        await asyncio.wait_for(task, timeout=1)
+
+        events = parse_sse(raw)
+        queued = [e["data"] for e in events if e["event"] == "queued"]
+        assert queued == [{"stage": 1, "position": 1, "message": "阶段1排队中，前面还有0个请求..."}]
+        assert events[-1]["event"] == "complete"
+        assert service.admission.stats()[resolve_model("agent1")]["active"] == 0
+
+    @pytest.mark.asyncio
+    async def test_cache_replay_skips_admission(self):
+        """命中生成缓存的回放不申请槽位：队列已满时也不排队、不报错"""
+
+        class CachedAgent:
+            async def generate_stream(self, *args, **kwargs):
+                async for event in replay_cached_markdown("# 阶段一\n\n## G: 目标", "m", 0.0):
+                    yield event
+
+        service = WorkflowServiceV3()
+        service.agent1 = CachedAgent()
+        service.admission = make_controller(limit=1, max_queue=1)
+        blocker = service.admission.enqueue(resolve_model("agent1"), tenant="other")
+        waiting = service.admission.enqueue(resolve_model("agent1"), tenant="other")
+
+        raw = [sse async for sse in service.stream_workflow(title="测试课程", stages_to_generate=[1])]
+
+        events = parse_sse(raw)
+        assert [e for e in events if e["event"] in ("queued", "error")] == []
+        stage_complete = [e["data"] for e in events if e["event"] == "stage_complete"]
+        assert stage_complete[0]["cached"] is True
+        assert events[-1]["event"] == "complete"
+        waiting.release()
+        blocker.release()
+
+    @pytest.mark.asyncio
+    async def test_queue_full_rejects_cache_miss(self):
+        service = WorkflowServiceV3()
+        service.agent1 = FakeStreamAgent(["# 阶段一\n"])
+        service.admission = make_controller(limit=1, max_queue=1)
+        blocker = service.admission.enqueue(resolve_model("agent1"), tenant="other")
+        waiting = service.admission.enqueue(resolve_model("agent1"), tenant="other")
+
+        raw = [sse async for sse in service.stream_workflow(title="测试课程", stages_to_generate=[1])]
+
+        errors = [e["data"] for e in parse_sse(raw) if e["event"] == "error"]
+        assert errors[0]["stage"] == 1
+        assert service.admission.stats()[resolve_model("agent1")]["rejected_total"] == 1
+        waiting.release()
+        blocker.release()
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("cached", ["# 阶段一：确定预期学习结果", None])
+    async def test_non_streaming_stage_admits_only_on_cache_miss(self, cached):
+        """非流式阶段：命中缓存时不申请槽位，未命中时在调用LLM前申请（队列已满则失败）"""
+        service = WorkflowServiceV3()
+        service.admission = make_controller(limit=1, max_queue=1)
+        blocker = service.admission.enqueue(resolve_model("agent1"), tenant="other")
+        waiting = service.admission.enqueue(resolve_model("agent1"), tenant="other")
+        cache = MagicMock(get_async=AsyncMock(return_value=cached))
+
+        agent = ProjectFoundationAgentV3()
+        with patch("app.agents.project_foundation_v3.get_generation_cache", return_value=cache), \
+             patch("app.agents.project_foundation_v3.openai_client.generate_response") as llm:
+            result = await service._generate_stage(
+                1, "course:1", lambda admit: agent.generate("AI创意工坊", admit=admit)
+            )
+
+        llm.assert_not_called()
+        rejected = service.admission.stats()[resolve_model("agent1")]["rejected_total"]
+        if cached:
+            assert result["success"] is True and result["cached"] is True
+            assert rejected == 0
+        else:
+            assert result["success"] is False
+            assert rejected == 1
+        waiting.release()
+        blocker.release()
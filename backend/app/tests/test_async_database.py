@@ -0,0 +1,102 @@
+"""
+异步数据库层测试
+"""
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app.api.v1 import course as course_api
+from app.api.v1 import generate as generate_api
+from app.core.database import _pool_options, to_async_url
+from app.models.conversation_message import CourseConversationMessage
+from app.models.course_project import CourseProject
+from app.models.llm_usage import LLMUsageRecord
+
+
+@pytest.fixture
+async def async_session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(CourseProject.__table__.create)
+        await conn.run_sync(CourseConversationMessage.__table__.create)
+        await conn.run_sync(LLMUsageRecord.__table__.create)
+    factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    async with factory() as session:
+        yield session
+    await engine.dispose()
+
+
+class TestAsyncUrl:
+    """测试异步驱动URL转换与连接池参数"""
+
+    @pytest.mark.parametrize(
+        "url, expected",
+        [
+            ("sqlite:///./app.db", "sqlite+aiosqlite:///./app.db"),
+            ("postgresql://u:p@db/pbl", "postgresql+asyncpg://u:p@db/pbl"),
+            ("postgres://u:p@db/pbl", "postgresql+asyncpg://u:p@db/pbl"),
+            ("postgresql+asyncpg://u:p@db/pbl", "postgresql+asyncpg://u:p@db/pbl"),
+        ],
+    )
+    def test_to_async_url(self, url, expected):
+        assert to_async_url(url) == expected
+
+    def test_memory_sqlite_has_no_pool_options(self):
+        assert _pool_options("sqlite:///:memory:") == {}
+        assert _pool_options("postgresql://db/pbl")["pool_size"] > 0
+
+
+class TestAsyncCourseEndpoints:
+    """测试课程端点在异步会话上的读写"""
+
+    @pytest.mark.asyncio
+    async def test_crud_round_trip(self, async_session):
+        created = await course_api.create_course(
+            course_api.CourseCreateRequest(title="AI创意工坊", subject="信息科技"), db=async_session
+        )
+        assert created.id is not None
+
+        await course_api.update_stage_one(
+            created.id, course_api.StageDataUpdate(markdown="# 阶段一"), db=async_session
+        )
+        fetched = await course_api.get_course(created.id, db=async_session)
+        assert fetched.stage_one_data == "# 阶段一"
+
+        courses = await course_api.list_courses(skip=0, limit=10, db=async_session)
+        assert [c.title for c in courses] == ["AI创意工坊"]
+
+        await course_api.delete_course(created.id, db=async_session)
+        with pytest.raises(course_api.HTTPException) as exc_info:
+            await course_api.get_course(created.id, db=async_session)
+        assert exc_info.value.status_code == 404
+
+
+class TestAsyncWorkflowChecks:
+    """测试生成端点的前置检查在异步会话上运行"""
+
+    @pytest.mark.asyncio
+    async def test_missing_course_returns_404(self, async_session):
+        async_session.add(CourseProject(id=1, title="AI创意工坊"))
+        await async_session.commit()
+
+        await generate_api.check_workflow_request(
+            generate_api.WorkflowRequest(title="AI创意工坊", course_id=1), async_session
+        )
+        with pytest.raises(generate_api.HTTPException) as exc_info:
+            await generate_api.check_workflow_request(
+                generate_api.WorkflowRequest(title="AI创意工坊", course_id=2), async_session
+            )
+        assert exc_info.value.status_code == 404
+
+    @pytest.mark.asyncio
+    async def test_load_stored_state(self, async_session):
+        async_session.add(CourseProject(id=1, title="AI创意工坊", stage_one_data="# 阶段一"))
+        await async_session.commit()
+
+        state = await generate_api.load_stored_state(
+            generate_api.WorkflowRequest(title="AI创意工坊", course_id=1, only_stale=True), async_session
+        )
+        assert state["stages"][1] == "# 阶段一"
+        assert await generate_api.load_stored_state(
+            generate_api.WorkflowRequest(title="AI创意工坊", course_id=1), async_session
+        ) is None
@@ -0,0 +1,218 @@
+"""
+批量课程生成测试
+
+使用假的工作流服务替换真实LLM调用，验证清单解析、有限并发、结果持久化与续跑
+"""
+import asyncio
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from app.core.stage_dependencies import course_state, evaluate_staleness
+from app.core.token_usage import TokenUsage
+from app.models.batch_job import BatchJob, BatchJobItem
+from app.models.course_project import CourseProject
+from app.models.llm_usage import LLMUsageRecord
+from app.services.batch_generation import BatchGenerationService, CourseSpec, parse_course_specs
+from app.services.usage_recorder import UsageRecorder
+
+CSV_SPECS = """title,subject,grade_level,total_class_hours,schedule_description,description
+AI创意工坊,信息科技,初二,12,共4周,用AI解决社区问题
+校园植物图鉴,生物,初一,,,
+"""
+
+
+class FakeWorkflow:
+    """记录调用与并发数的假工作流服务"""
+
+    def __init__(self, fail_titles=(), delay=0.01):
+        self.fail_titles = set(fail_titles)
+        self.delay = delay
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+
+    async def generate_workflow(self, title, use_cache=True, tenant=None, **kwargs):
+        self.calls.append(title)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        if title in self.fail_titles:
+            return {"success": False, "error": "Stage 2 failed: timeout"}
+        usages = {stage: TokenUsage() for stage in (1, 2, 3)}
+        usages[1].add(100, 20)
+        usages[2].add(300, 40, cached_tokens=200)  # 阶段三命中生成缓存，没有请求
+        return {
+            "success": True,
+            "stage_one": f"# 阶段一 {title}",
+            "stage_two": f"# 阶段二 {title}",
+            "stage_three": f"# 阶段三 {title}",
+            "token_usage": usages,
+            "total_time": 0.01,
+        }
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """文件数据库：并发的课程在各自线程中使用独立连接"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'batch.db'}", connect_args={"check_same_thread": False})
+    for table in (CourseProject.__table__, BatchJob.__table__, BatchJobItem.__table__, LLMUsageRecord.__table__):
+        table.create(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+def make_service(session_factory, workflow):
+    return BatchGenerationService(
+        session_factory=session_factory,
+        workflow_factory=lambda: workflow,
+        usage_recorder=UsageRecorder(session_factory),
+    )
+
+
+class TestParseCourseSpecs:
+    """测试CSV/JSON课程清单解析"""
+
+    def test_csv(self):
+        specs = parse_course_specs(CSV_SPECS)
+        assert [s.title for s in specs] == ["AI创意工坊", "校园植物图鉴"]
+        assert specs[0].total_class_hours == 12
+        assert specs[1].total_class_hours is None
+
+    def test_json_object_with_courses(self):
+        specs = parse_course_specs('{"courses": [{"title": "AI创意工坊", "subject": "信息科技"}]}')
+        assert specs[0].subject == "信息科技"
+
+    def test_invalid_course_reports_position(self):
+        with pytest.raises(ValueError, match="第2门课程无效"):
+            parse_course_specs('[{"title": "A"}, {"subject": "缺少名称"}]')
+
+
+class TestBatchRun:
+    """测试批量运行、持久化与续跑"""
+
+    @pytest.mark.asyncio
+    async def test_bounded_concurrency_and_persistence(self, session_factory):
+        workflow = FakeWorkflow(fail_titles={"课程3"})
+        service = make_service(session_factory, workflow)
+        specs = [CourseSpec(title=f"课程{i}", grade_level="初二") for i in range(5)]
+        batch_id = service.create(specs, concurrency=2)
+
+        updates = []
+        status = await service.run(batch_id, on_update=updates.append)
+
+        assert workflow.max_active == 2
+        assert status["status"] == "completed"
+        assert status["counts"] == {"pending": 0, "running": 0, "completed": 4, "failed": 1}
+        failed = status["courses"][3]
+        assert failed["status"] == "failed" and "timeout" in failed["error"]
+        assert len([u for u in updates if u["status"] == "running"]) == 5
+
+        db = session_factory()
+        course = db.get(CourseProject, status["courses"][0]["course_id"])
+        assert course.title == "课程0" and course.stage_three_data == "# 阶段三 课程0"
+        statuses = evaluate_staleness(**course_state(course))
+        assert [statuses[s].status for s in (1, 2, 3)] == ["fresh", "fresh", "fresh"]
+        db.close()
+
+    @pytest.mark.asyncio
+    async def test_usage_recorded_for_completed_courses(self, session_factory):
+        service = make_service(session_factory, FakeWorkflow(fail_titles={"课程1"}))
+        batch_id = service.create([CourseSpec(title=f"课程{i}") for i in range(2)])
+
+        status = await service.run(batch_id)
+        await service.usage_recorder.close()
+
+        course_id = status["courses"][0]["course_id"]
+        db = session_factory()
+        records = db.scalars(select(LLMUsageRecord).order_by(LLMUsageRecord.stage)).all()
+        db.close()
+        assert [(r.course_id, r.operation, r.stage, r.prompt_tokens, r.cached_tokens) for r in records] == [
+            (course_id, "generate", 1, 100, 0),
+            (course_id, "generate", 2, 300, 200),
+        ]
+
+    @pytest.mark.asyncio
+    async def test_resume_skips_completed_courses(self, session_factory):
+        service = make_service(session_factory, FakeWorkflow())
+        batch_id = service.create([CourseSpec(title=f"课程{i}") for i in range(3)])
+
+        # 模拟崩溃：课程0已完成，课程1生成到一半
+        await service.run(batch_id)
+        db = session_factory()
+        items = db.query(BatchJobItem).order_by(BatchJobItem.position).all()
+        items[1].status, items[1].course_id = "running", None
+        items[2].status, items[2].course_id = "pending", None
+        db.get(BatchJob, batch_id).status = "running"
+        db.commit()
+        db.close()
+
+        workflow = FakeWorkflow()
+        resumed = make_service(session_factory, workflow)
+        assert resumed.incomplete_batches() == [batch_id]
+        status = await resumed.run(batch_id)
+
+        assert sorted(workflow.calls) == ["课程1", "课程2"]
+        assert status["counts"]["completed"] == 3
+        assert [c["attempts"] for c in status["courses"]] == [1, 2, 2]
+
+    @pytest.mark.asyncio
+    async def test_failed_courses_retried_on_request(self, session_factory):
+        service = make_service(session_factory, FakeWorkflow(fail_titles={"课程1"}))
+        batch_id = service.create([CourseSpec(title="课程0"), CourseSpec(title="课程1")])
+        await service.run(batch_id)
+
+        workflow = FakeWorkflow()
+        retry = make_service(session_factory, workflow)
+        await retry.run(batch_id)
+        assert workflow.calls == []
+
+        status = await retry.run(batch_id, retry_failed=True)
+        assert workflow.calls == ["课程1"]
+        assert status["counts"]["failed"] == 0
+
+    @pytest.mark.asyncio
+    async def test_cancel_returns_running_courses_to_pending(self, session_factory):
+        service = make_service(session_factory, FakeWorkflow(delay=10))
+        batch_id = service.create([CourseSpec(title="课程0")])
+        service.start(batch_id)
+        await asyncio.sleep(0.05)
+
+        assert await service.cancel(batch_id)
+        status = service.status(batch_id)
+        assert status["status"] == "cancelled"
+        assert status["courses"][0]["status"] == "pending"
+
+    @pytest.mark.asyncio
+    async def test_save_error_fails_only_that_course(self, session_factory, monkeypatch):
+        service = make_service(session_factory, FakeWorkflow())
+        batch_id = service.create([CourseSpec(title=f"课程{i}") for i in range(3)], concurrency=3)
+        complete_item = service._complete_item
+
+        def flaky_complete(item_id, spec, result):
+            if spec["title"] == "课程1":
+                raise RuntimeError("database is locked")
+            return complete_item(item_id, spec, result)
+
+        monkeypatch.setattr(service, "_complete_item", flaky_complete)
+        status = await service.run(batch_id)
+
+        assert status["status"] == "completed"
+        assert status["counts"] == {"pending": 0, "running": 0, "completed": 2, "failed": 1}
+        assert status["courses"][1]["error"] == "database is locked"
+
+    @pytest.mark.asyncio
+    async def test_close_keeps_running_courses_pending(self, session_factory):
+        service = make_service(session_factory, FakeWorkflow(delay=10))
+        batch_id = service.create([CourseSpec(title="课程0")])
+        service.start(batch_id)
+        await asyncio.sleep(0.05)
+
+        await service.close()
+        status = service.status(batch_id)
+        assert status["status"] == "running"  # 下次启动时续跑
+        assert status["courses"][0]["status"] == "pending"
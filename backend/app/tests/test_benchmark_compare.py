@@ -0,0 +1,39 @@
+"""
+基准对比工具测试
+"""
+import json
+
+from benchmarks.compare import compare, load_results, main, slim_baseline
+
+
+def write_results(path, stats_by_name):
+    path.write_text(json.dumps({
+        "machine_info": {"python_version": "3.9", "cpu": {"brand_raw": "test"}},
+        "benchmarks": [
+            {"name": name.split("::")[-1], "fullname": name, "stats": dict(stats, rounds=10)}
+            for name, stats in stats_by_name.items()
+        ],
+    }), encoding="utf-8")
+    return path
+
+
+class TestCompare:
+    """测试回归判定与基线更新"""
+
+    def test_flags_regressions_above_threshold(self):
+        baseline = {"a": {"min": 1.0}, "b": {"min": 1.0}, "c": {"min": 1.0}, "gone": {"min": 1.0}}
+        current = {"a": {"min": 1.3}, "b": {"min": 1.1}, "c": {"min": 0.5}, "added": {"min": 1.0}}
+
+        rows = {r["name"]: r["status"] for r in compare(baseline, current, threshold=0.2)}
+        assert rows == {"a": "regression", "b": "ok", "c": "improved", "gone": "missing", "added": "new"}
+
+    def test_update_then_compare_exit_codes(self, tmp_path):
+        baseline = tmp_path / "baseline.json"
+        first = write_results(tmp_path / "first.json", {"t::x": {"min": 1e-5, "median": 2e-5, "mean": 3e-5}})
+        assert main([str(first), "--baseline", str(baseline), "--update"]) == 0
+        assert load_results(baseline) == {"t::x": {"min": 1e-5, "median": 2e-5, "mean": 3e-5}}
+        assert slim_baseline(first)["machine_info"]["cpu"] == "test"
+
+        slower = write_results(tmp_path / "slower.json", {"t::x": {"min": 2e-5, "median": 2e-5, "mean": 3e-5}})
+        assert main([str(slower), "--baseline", str(baseline)]) == 1
+        assert main([str(slower), "--baseline", str(baseline), "--stat", "median"]) == 0
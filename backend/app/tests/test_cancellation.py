@@ -0,0 +1,176 @@
+"""
+客户端断开与提前取消测试
+"""
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import MagicMock, PropertyMock, patch
+
+import pytest
+
+from app.core import cancellation
+from app.core.cancellation import CancellationStats, estimate_tokens, stream_until_disconnect
+from app.core.llm_transport import resolve_model
+from app.core.openai_client import OpenAIClient
+from app.services.workflow_service_v3 import WorkflowServiceV3
+from app.tests.test_admission import make_controller
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+class FakeUpstream:
+    """模拟OpenAI流：产出文本块，记录底层响应是否被关闭"""
+
+    def __init__(self, texts, hang=False):
+        self.texts = texts
+        self.hang = hang
+        self.response = MagicMock()
+        self.closed = False
+
+        async def aclose():
+            self.closed = True
+
+        self.response.aclose = aclose
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for text in self.texts:
+            yield chunk(text)
+        if self.hang:
+            await asyncio.sleep(3600)
+
+
+def patched_client(upstream):
+    async def create(**kwargs):
+        return upstream
+
+    client = MagicMock()
+    client.chat.completions.create = create
+    return patch.object(OpenAIClient, "client", new_callable=PropertyMock, return_value=client)
+
+
+class FakeRequest:
+    """在 disconnect_after 秒后报告客户端断开"""
+
+    def __init__(self, disconnect_after):
+        self.deadline = asyncio.get_running_loop().time() + disconnect_after
+
+    async def is_disconnected(self):
+        return asyncio.get_running_loop().time() >= self.deadline
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = CancellationStats()
+    monkeypatch.setattr(cancellation, "_cancellation_stats", stats)
+    return stats
+
+
+class TestUpstreamClose:
+    """测试LLM流在取消时关闭上游连接"""
+
+    @pytest.mark.asyncio
+    async def test_consumer_close_cancels_upstream(self, stats):
+        upstream = FakeUpstream(["第一段内容", "第二段内容"], hang=True)
+        with patched_client(upstream):
+            gen = OpenAIClient().generate_response_stream(prompt="课程", model="m", max_tokens=1000)
+            assert await gen.__anext__() == "第一段内容"
+            await gen.aclose()
+
+        assert upstream.closed
+        model_stats = stats.stats()["models"]["m"]
+        assert model_stats["cancelled_streams"] == 1
+        assert model_stats["tokens_before_cancel"] == estimate_tokens("第一段内容")
+        assert model_stats["tokens_saved_estimate"] == 1000 - estimate_tokens("第一段内容")
+
+    @pytest.mark.asyncio
+    async def test_completed_stream_releases_connection(self, stats):
+        upstream = FakeUpstream(["完整", "回复"])
+        with patched_client(upstream):
+            chunks = [c async for c in OpenAIClient().generate_response_stream(prompt="课程", model="m")]
+
+        assert chunks == ["完整", "回复"]
+        assert upstream.closed
+        assert stats.stats()["models"]["m"]["completed_streams"] == 1
+        assert stats.stats()["cancelled_streams_total"] == 0
+
+    def test_saved_tokens_use_completed_average(self):
+        stats = CancellationStats()
+        stats.record_completed("m", 800)
+        assert stats.record_cancelled("m", 300, max_tokens=4000) == 500
+        assert stats.record_cancelled("m", 900) == 0
+
+
+class TestDisconnectDetection:
+    """测试SSE断开检测"""
+
+    @pytest.mark.asyncio
+    async def test_disconnect_while_upstream_silent(self, stats):
+        """排队或等待首个token期间断开，也能及时关闭上游"""
+        closed = asyncio.Event()
+
+        async def upstream():
+            try:
+                yield "data: start\n\n"
+                await asyncio.sleep(3600)
+                yield "data: never\n\n"
+            finally:
+                closed.set()
+
+        request = FakeRequest(disconnect_after=0.05)
+        received = [e async for e in stream_until_disconnect(request, upstream(), route="workflow", poll_interval=0.01)]
+
+        assert received == ["data: start\n\n"]
+        assert closed.is_set()
+        assert stats.stats()["client_disconnects"] == {"workflow": 1}
+
+    @pytest.mark.asyncio
+    async def test_connected_client_receives_everything(self, stats):
+        async def upstream():
+            for i in range(3):
+                await asyncio.sleep(0.01)
+                yield f"data: {i}\n\n"
+
+        request = FakeRequest(disconnect_after=3600)
+        received = [e async for e in stream_until_disconnect(request, upstream(), poll_interval=0.005)]
+
+        assert received == ["data: 0\n\n", "data: 1\n\n", "data: 2\n\n"]
+        assert stats.stats()["client_disconnects"] == {}
+
+
+class ClosingAgent:
+    """产出一个progress事件后挂起，记录是否被关闭"""
+
+    def __init__(self):
+        self.closed = False
+
+    async def generate_stream(self, *args, **kwargs):
+        try:
+            yield {"type": "llm_call"}
+            yield {"type": "progress", "content": "# 阶段一\n", "chunk": "# 阶段一\n", "progress": 0.1}
+            await asyncio.sleep(3600)
+        finally:
+            self.closed = True
+
+
+class TestWorkflowCancellation:
+    """测试工作流被关闭时逐层关闭Agent流并释放槽位"""
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("pipelined", [False, True])
+    async def test_close_propagates_to_agent(self, pipelined):
+        service = WorkflowServiceV3()
+        service.agent1 = ClosingAgent()
+        service.admission = make_controller(limit=1)
+
+        gen = service.stream_workflow(title="测试课程", stages_to_generate=[1], pipelined=pipelined)
+        async for sse in gen:
+            if '"stage": 1' in sse and "markdown_preview" in sse:
+                break
+        await gen.aclose()
+
+        assert service.agent1.closed
+        assert service.admission.stats()[resolve_model("agent1")]["active"] == 0
@@ -84,11 +84,11 @@ class TestChatStreamIntegration:
         mock_stream.__aiter__.return_value = [mock_chunk]
 
         with patch(
-            "app.agents.course_chat_agent.AsyncOpenAI"
-        ) as mock_openai_class:
+            "app.agents.course_chat_agent.get_llm_transport"
+        ) as mock_transport:
             mock_client = MagicMock()
             mock_client.chat.completions.create = AsyncMock(return_value=mock_stream)
-            mock_openai_class.return_value = mock_client
+            mock_transport.return_value.get_client.return_value = mock_client
 
             # 重置单例以使用Mock
             from app.agents import course_chat_agent
@@ -157,11 +157,11 @@ class TestChatStreamIntegration:
         mock_stream.__aiter__.return_value = [mock_chunk]
 
         with patch(
-            "app.agents.course_chat_agent.AsyncOpenAI"
-        ) as mock_openai_class:
+            "app.agents.course_chat_agent.get_llm_transport"
+        ) as mock_transport:
             mock_client = MagicMock()
             mock_client.chat.completions.create = AsyncMock(return_value=mock_stream)
-            mock_openai_class.return_value = mock_client
+            mock_transport.return_value.get_client.return_value = mock_client
 
             from app.agents import course_chat_agent
             course_chat_agent._chat_agent_instance = None
@@ -224,11 +224,11 @@ class TestChatNonStreamIntegration:
         mock_response.choices[0].message.content = "完整的AI回复"
 
         with patch(
-            "app.agents.course_chat_agent.AsyncOpenAI"
-        ) as mock_openai_class:
+            "app.agents.course_chat_agent.get_llm_transport"
+        ) as mock_transport:
             mock_client = MagicMock()
             mock_client.chat.completions.create = AsyncMock(return_value=mock_response)
-            mock_openai_class.return_value = mock_client
+            mock_transport.return_value.get_client.return_value = mock_client
 
             from app.agents import course_chat_agent
             course_chat_agent._chat_agent_instance = None
@@ -312,13 +312,13 @@ class TestChatMarkdownContext:
             return mock_stream
 
         with patch(
-            "app.agents.course_chat_agent.AsyncOpenAI"
-        ) as mock_openai_class:
+            "app.agents.course_chat_agent.get_llm_transport"
+        ) as mock_transport:
             mock_client = MagicMock()
             mock_client.chat.completions.create = AsyncMock(
                 side_effect=capture_create_call
             )
-            mock_openai_class.return_value = mock_client
+            mock_transport.return_value.get_client.return_value = mock_client
 
             from app.agents import course_chat_agent
             course_chat_agent._chat_agent_instance = None
@@ -428,11 +428,11 @@ class TestSSEFormat:
         mock_stream.__aiter__.return_value = [mock_chunk]
 
         with patch(
-            "app.agents.course_chat_agent.AsyncOpenAI"
-        ) as mock_openai_class:
+            "app.agents.course_chat_agent.get_llm_transport"
+        ) as mock_transport:
             mock_client = MagicMock()
             mock_client.chat.completions.create = AsyncMock(return_value=mock_stream)
-            mock_openai_class.return_value = mock_client
+            mock_transport.return_value.get_client.return_value = mock_client
 
             from app.agents import course_chat_agent
             course_chat_agent._chat_agent_instance = None
@@ -0,0 +1,115 @@
+"""
+对话上下文预算组装测试
+"""
+from app.core.context_builder import (
+    ChatContextBuilder,
+    count_tokens,
+    get_context_stats,
+    split_sections,
+    truncate_to_tokens,
+)
+
+STAGE_ONE = """# 阶段一：确定预期学习结果
+
+## G - 预期目标
+学生能够独立完成AI项目。
+
+## U - 持久理解
+AI是解决问题的工具。
+
+## Q - 基本问题
+如何用AI解决社区问题？
+"""
+
+STAGE_TWO = """# 阶段二：确定可接受的证据
+
+## 表现性任务
+学生分组设计社区垃圾分类助手，并向居委会展示。
+
+## 评估量规
+从问题定义、方案设计、展示表达三个维度评分。
+"""
+
+STAGE_THREE = """# 阶段三：规划学习体验
+
+## 项目启动
+参观社区回收站，记录垃圾分类中的问题。
+
+## 原型迭代
+""" + "学生反复测试原型并记录改进。" * 200
+
+
+def build(builder, message="请优化评估量规", history=None, step=2):
+    return builder.build(
+        user_message=message,
+        conversation_history=history or [],
+        current_step=step,
+        stages={1: STAGE_ONE, 2: STAGE_TWO, 3: STAGE_THREE},
+        base_tokens=100,
+    )
+
+
+class TestSections:
+    """测试Markdown章节切分与截断"""
+
+    def test_split_by_heading(self):
+        sections = split_sections(STAGE_ONE)
+
+        assert [s.heading for s in sections] == [
+            "阶段一：确定预期学习结果", "G - 预期目标", "U - 持久理解", "Q - 基本问题",
+        ]
+        assert "AI是解决问题的工具" in sections[2].text
+
+    def test_heading_inside_code_block_is_not_split(self):
+        sections = split_sections("## 示例\n```\n# 注释\n```\n")
+        assert len(sections) == 1
+
+    def test_truncate_to_tokens(self):
+        text = "课程设计" * 100
+        truncated = truncate_to_tokens(text, 20)
+
+        assert count_tokens(truncated) <= 20
+        assert truncated.endswith("…")
+
+
+class TestChatContextBuilder:
+    """测试预算分配"""
+
+    def test_everything_fits_keeps_current_stage_whole(self):
+        context = build(ChatContextBuilder(max_tokens=100000))
+
+        assert context.stages[2] == STAGE_TWO
+        assert context.breakdown["total"] <= 100000
+
+    def test_other_stages_keep_only_relevant_sections(self):
+        context = build(ChatContextBuilder(max_tokens=100000), message="社区回收站的参观怎么安排？")
+
+        assert "参观社区回收站" in context.stages[3]
+        assert "学生反复测试原型" not in context.stages[3]
+        assert "原型迭代" in context.stages[3]  # 省略的章节仍列出标题
+        assert context.stages[1] == STAGE_ONE  # 较短的阶段整体保留
+
+    def test_total_stays_within_budget(self):
+        builder = ChatContextBuilder(max_tokens=400, history_tokens=100, summary_tokens=50)
+        history = [{"role": "user", "content": f"第{i}轮：关于社区项目的讨论" * 3} for i in range(30)]
+
+        context = build(builder, history=history, step=3)
+
+        assert context.breakdown["total"] <= 400
+        assert context.stages[3]  # 当前阶段优先保留（截断）
+        assert context.history_summary
+        assert context.breakdown["summarized_messages"] == 30 - len(context.history)
+
+    def test_history_message_cap(self):
+        builder = ChatContextBuilder(max_tokens=100000, history_messages=4)
+        history = [{"role": "user", "content": f"消息{i}"} for i in range(10)]
+
+        context = build(builder, history=history)
+
+        assert [m["content"] for m in context.history] == ["消息6", "消息7", "消息8", "消息9"]
+        assert "消息5" in context.history_summary
+
+    def test_stats_recorded(self):
+        before = get_context_stats().builds
+        build(ChatContextBuilder(max_tokens=100000))
+        assert get_context_stats().builds == before + 1
@@ -0,0 +1,124 @@
+"""
+对话消息表与历史迁移测试
+"""
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from app.api.v1 import course as course_api
+from app.core.migrations import migrate_conversation_history
+from app.models.conversation_message import CourseConversationMessage
+from app.models.course_project import CourseProject
+
+TABLES = [CourseProject.__table__, CourseConversationMessage.__table__]
+
+
+@pytest.fixture
+async def async_session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        for table in TABLES:
+            await conn.run_sync(table.create)
+    factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    async with factory() as session:
+        yield session
+    await engine.dispose()
+
+
+@pytest.fixture
+async def course_id(async_session):
+    course = CourseProject(title="AI创意工坊")
+    async_session.add(course)
+    await async_session.commit()
+    return course.id
+
+
+def add_request(*messages):
+    return course_api.ConversationAddRequest(
+        messages=[course_api.ConversationMessage(role=role, content=content, step=step)
+                  for role, content, step in messages]
+    )
+
+
+class TestConversationMessages:
+    """测试追加、按步骤过滤与游标分页"""
+
+    @pytest.mark.asyncio
+    async def test_append_and_filter_by_step(self, async_session, course_id):
+        await course_api.add_conversation_messages(
+            course_id, add_request(("user", "你好", 1), ("assistant", "你好！", 1)), db=async_session
+        )
+        await course_api.add_conversation_messages(
+            course_id, add_request(("user", "阶段二的问题", 2)), db=async_session
+        )
+
+        all_messages = await course_api.get_conversation_history(course_id, limit=None, cursor=None, db=async_session)
+        step_two = await course_api.get_conversation_history(course_id, step=2, limit=None, cursor=None, db=async_session)
+
+        assert [m["content"] for m in all_messages["messages"]] == ["你好", "你好！", "阶段二的问题"]
+        assert [m["content"] for m in step_two["messages"]] == ["阶段二的问题"]
+        assert all_messages["next_cursor"] is None
+
+    @pytest.mark.asyncio
+    async def test_cursor_pagination(self, async_session, course_id):
+        await course_api.add_conversation_messages(
+            course_id, add_request(*[("user", f"消息{i}", 1) for i in range(5)]), db=async_session
+        )
+
+        contents, cursor = [], None
+        while True:
+            page = await course_api.get_conversation_history(
+                course_id, step=1, limit=2, cursor=cursor, db=async_session
+            )
+            contents.extend(m["content"] for m in page["messages"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        assert contents == [f"消息{i}" for i in range(5)]
+
+    @pytest.mark.asyncio
+    async def test_clear_single_step(self, async_session, course_id):
+        await course_api.add_conversation_messages(
+            course_id, add_request(("user", "一", 1), ("user", "二", 2)), db=async_session
+        )
+
+        await course_api.clear_conversation_history(course_id, step=1, db=async_session)
+
+        remaining = await course_api.get_conversation_history(course_id, limit=None, cursor=None, db=async_session)
+        assert [m["step"] for m in remaining["messages"]] == [2]
+
+    @pytest.mark.asyncio
+    async def test_unknown_course(self, async_session):
+        with pytest.raises(course_api.HTTPException) as exc_info:
+            await course_api.add_conversation_messages(999, add_request(("user", "你好", 1)), db=async_session)
+        assert exc_info.value.status_code == 404
+
+
+class TestConversationMigration:
+    """测试JSON历史迁移"""
+
+    def test_moves_json_history_once(self):
+        engine = create_engine("sqlite:///:memory:", poolclass=StaticPool)
+        for table in TABLES:
+            table.create(bind=engine)
+        with Session(engine) as db:
+            db.add(CourseProject(title="旧课程", conversation_history=[
+                {"id": "1_0", "role": "user", "content": "旧消息1", "step": 1,
+                 "timestamp": "2025-01-01T10:00:00"},
+                {"id": "1_1", "role": "assistant", "content": "旧消息2", "step": 1,
+                 "timestamp": "2025-01-01T10:00:05"},
+            ]))
+            db.add(CourseProject(title="没有对话", conversation_history=[]))
+            db.commit()
+
+        assert migrate_conversation_history(engine) == 2
+        assert migrate_conversation_history(engine) == 0
+
+        with Session(engine) as db:
+            messages = db.scalars(select(CourseConversationMessage).order_by(CourseConversationMessage.id)).all()
+            assert [m.content for m in messages] == ["旧消息1", "旧消息2"]
+            assert messages[1].created_at.isoformat() == "2025-01-01T10:00:05"
+            assert db.scalar(select(CourseProject.conversation_history).where(CourseProject.title == "旧课程")) == []
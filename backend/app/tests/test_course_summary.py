@@ -0,0 +1,102 @@
+"""
+课程列表摘要与键集分页测试
+"""
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app.api.v1 import course as course_api
+from app.core.migrations import ensure_indexes
+from app.models.course_project import CourseProject
+
+
+@pytest.fixture
+async def async_session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        await conn.run_sync(CourseProject.__table__.create)
+    factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    async with factory() as session:
+        yield session
+    await engine.dispose()
+
+
+async def add_courses(session, count):
+    """插入课程；同一秒内插入，updated_at 相同，依靠 id 区分顺序"""
+    for i in range(count):
+        session.add(CourseProject(
+            title=f"课程{i + 1}",
+            stage_one_data="# 阶段一" if i % 2 == 0 else None,
+            conversation_history=[{"role": "user", "content": "很长的对话" * 100}],
+        ))
+    await session.commit()
+
+
+async def all_pages(session, limit):
+    pages, cursor = [], None
+    while True:
+        page = await course_api.list_course_summaries(limit=limit, cursor=cursor, db=session)
+        pages.append([item.id for item in page.items])
+        cursor = page.next_cursor
+        if cursor is None:
+            return pages
+
+
+class TestCourseSummary:
+    """测试摘要投影与键集分页"""
+
+    @pytest.mark.asyncio
+    async def test_keyset_pages_cover_all_courses_once(self, async_session):
+        await add_courses(async_session, 5)
+
+        pages = await all_pages(async_session, limit=2)
+
+        assert pages == [[5, 4], [3, 2], [1]]
+
+    @pytest.mark.asyncio
+    async def test_newer_updates_come_first(self, async_session):
+        await add_courses(async_session, 3)
+        await async_session.execute(
+            text("UPDATE course_projects SET updated_at = '2099-01-01 00:00:00' WHERE id = 1")
+        )
+        await async_session.commit()
+
+        pages = await all_pages(async_session, limit=2)
+
+        assert pages == [[1, 3], [2]]
+
+    @pytest.mark.asyncio
+    async def test_summary_excludes_markdown_and_history(self, async_session):
+        await add_courses(async_session, 2)
+
+        page = await course_api.list_course_summaries(limit=10, cursor=None, db=async_session)
+        first = page.items[-1].model_dump()
+
+        assert first["title"] == "课程1"
+        assert first["has_stage_one"] is True and first["has_stage_two"] is False
+        assert "stage_one_data" not in first and "conversation_history" not in first
+
+    @pytest.mark.asyncio
+    async def test_invalid_cursor(self, async_session):
+        with pytest.raises(course_api.HTTPException) as exc_info:
+            await course_api.list_course_summaries(limit=10, cursor="not-a-cursor", db=async_session)
+        assert exc_info.value.status_code == 400
+
+
+class TestStartupMigrations:
+    """测试为已有数据库补建索引"""
+
+    def test_ensure_indexes_adds_missing_composite_index(self):
+        engine = create_engine("sqlite:///:memory:", poolclass=StaticPool)
+        with engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE course_projects (id INTEGER PRIMARY KEY, title VARCHAR(255), "
+                "updated_at DATETIME)"
+            ))
+
+        ensure_indexes(engine)
+        ensure_indexes(engine)  # 可重复执行
+
+        names = {index["name"] for index in inspect(engine).get_indexes("course_projects")}
+        assert "ix_course_projects_updated_at_id" in names
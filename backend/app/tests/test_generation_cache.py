@@ -0,0 +1,152 @@
+"""
+生成结果缓存测试
+"""
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.agents.project_foundation_v3 import ProjectFoundationAgentV3
+from app.core.generation_cache import GenerationCache, replay_cached_markdown
+from app.core.migrations import ensure_tables
+from app.models.generation_cache import GenerationCacheEntry
+
+
+@pytest.fixture
+def session_factory():
+    """每个测试使用独立的内存数据库（线程池中的读写共享同一连接）"""
+    engine = create_engine(
+        "sqlite:///:memory:", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    GenerationCacheEntry.__table__.create(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def cache(session_factory):
+    return GenerationCache(
+        session_factory=session_factory, max_entries=3, ttl_seconds=3600, enabled=True
+    )
+
+
+class TestCacheKey:
+    """测试内容寻址键"""
+
+    def test_same_inputs_same_key(self):
+        key1 = GenerationCache.make_key("The Strategist", "gpt-4o", "v3.0-markdown", "课程: A", 0.7)
+        key2 = GenerationCache.make_key("The Strategist", "gpt-4o", "v3.0-markdown", "课程: A", 0.7)
+        assert key1 == key2
+
+    @pytest.mark.parametrize(
+        "changed",
+        [
+            ("The Strategist", "gpt-4o-mini", "v3.0-markdown", "课程: A", 0.7),
+            ("The Strategist", "gpt-4o", "v3.1-markdown", "课程: A", 0.7),
+            ("The Strategist", "gpt-4o", "v3.0-markdown", "课程: B", 0.7),
+            ("The Strategist", "gpt-4o", "v3.0-markdown", "课程: A", 0.2),
+        ],
+    )
+    def test_any_input_change_changes_key(self, changed):
+        base = GenerationCache.make_key("The Strategist", "gpt-4o", "v3.0-markdown", "课程: A", 0.7)
+        assert GenerationCache.make_key(*changed) != base
+
+
+class TestCacheStorage:
+    """测试读写、LRU淘汰与TTL过期"""
+
+    def test_roundtrip(self, cache):
+        cache.set("k1", "# 阶段一", agent="The Strategist", model="gpt-4o")
+        assert cache.get("k1") == "# 阶段一"
+        assert cache.get("missing") is None
+
+    def test_lru_eviction(self, cache, session_factory):
+        for i in range(3):
+            cache.set(f"k{i}", f"content {i}", agent="a")
+
+        # 访问k0，使k1成为最久未使用的条目
+        db = session_factory()
+        for i, entry in enumerate(db.query(GenerationCacheEntry).order_by(GenerationCacheEntry.cache_key)):
+            entry.last_accessed_at = datetime.utcnow() - timedelta(minutes=10 - i)
+        db.commit()
+        db.close()
+        assert cache.get("k0") == "content 0"
+
+        cache.set("k3", "content 3", agent="a")
+
+        assert cache.get("k1") is None
+        assert cache.get("k0") == "content 0"
+        assert cache.get("k3") == "content 3"
+
+    def test_ttl_expiry(self, cache, session_factory):
+        cache.set("old", "stale", agent="a")
+
+        db = session_factory()
+        entry = db.get(GenerationCacheEntry, "old")
+        entry.created_at = datetime.utcnow() - timedelta(hours=2)
+        db.commit()
+        db.close()
+
+        assert cache.get("old") is None
+
+    def test_disabled_cache_is_noop(self, session_factory):
+        disabled = GenerationCache(session_factory=session_factory, enabled=False)
+        disabled.set("k", "content", agent="a")
+        assert disabled.get("k") is None
+
+
+class TestAsyncAccess:
+    """测试异步读写与建表迁移"""
+
+    @pytest.mark.asyncio
+    async def test_async_roundtrip(self, cache):
+        await cache.set_async("k1", "# 阶段一", agent="The Strategist", model="gpt-4o")
+        assert await cache.get_async("k1") == "# 阶段一"
+        assert await cache.get_async("missing") is None
+
+    def test_table_created_by_startup_migrations(self):
+        engine = create_engine("sqlite:///:memory:", poolclass=StaticPool)
+        ensure_tables(engine)
+        assert inspect(engine).has_table(GenerationCacheEntry.__tablename__)
+        engine.dispose()
+
+
+class TestCacheReplay:
+    """测试SSE回放路径"""
+
+    @pytest.mark.asyncio
+    async def test_replay_rebuilds_content(self):
+        content = "理解" * 700
+        events = [e async for e in replay_cached_markdown(content, "gpt-4o", 0.0)]
+
+        progress = [e for e in events if e["type"] == "progress"]
+        assert "".join(e["chunk"] for e in progress) == content
+        assert progress[-1]["content"] == content
+        assert events[-1]["type"] == "complete"
+        assert events[-1]["cached"] is True
+
+    @pytest.mark.asyncio
+    async def test_agent_stream_replays_without_llm_call(self, cache):
+        """命中缓存时Agent不调用LLM"""
+        agent = ProjectFoundationAgentV3()
+        user_prompt = agent._build_user_prompt("AI创意工坊")
+        model = "test-model"
+        key = GenerationCache.make_key(
+            agent.agent_name, model, agent.phr_version, user_prompt, agent.temperature
+        )
+        cache.set(key, "# 阶段一：确定预期学习结果", agent=agent.agent_name)
+
+        with patch("app.agents.project_foundation_v3.get_generation_cache", return_value=cache), \
+             patch("app.agents.project_foundation_v3.settings.agent1_model", model), \
+             patch("app.agents.project_foundation_v3.openai_client.generate_response_stream") as llm:
+            events = [e async for e in agent.generate_stream(title="AI创意工坊")]
+
+        llm.assert_not_called()
+        # 回放不产出 llm_call，工作流不会为其申请准入槽位
+        assert "llm_call" not in [e["type"] for e in events]
+        assert events[-1]["type"] == "complete"
+        assert events[-1]["content"] == "# 阶段一：确定预期学习结果"
+        assert events[-1]["cached"] is True
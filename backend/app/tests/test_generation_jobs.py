@@ -0,0 +1,181 @@
+"""
+可恢复生成任务测试
+"""
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.core.migrations import ensure_tables
+from app.models.generation_job import GenerationJobEvent
+from app.services.generation_jobs import JOB_CANCELLED, JOB_COMPLETED, JobManager
+
+
+def sse(event, **data):
+    return f"data: {json.dumps({'event': event, 'data': data}, ensure_ascii=False)}\n\n"
+
+
+def parse(raw):
+    """解析带id的SSE事件 -> [(id, event, data)]"""
+    events = []
+    for block in raw:
+        id_line, data_line = block.strip().split("\n")
+        payload = json.loads(data_line[len("data: "):])
+        events.append((int(id_line[len("id: "):]), payload["event"], payload["data"]))
+    return events
+
+
+def source(count, gate=None):
+    """产出count个progress事件和complete；gate不为空时每个事件前等待"""
+    async def generate():
+        for i in range(count):
+            if gate is not None:
+                await gate.get()
+            yield sse("progress", stage=1, seq=i)
+        yield sse("complete", message="done")
+    return generate
+
+
+async def collect(manager, job_id, last_event_id=0, limit=None):
+    raw = []
+    async for block in manager.subscribe(job_id, last_event_id=last_event_id):
+        raw.append(block)
+        if limit is not None and len(raw) >= limit:
+            break
+    return parse(raw)
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    GenerationJobEvent.__table__.create(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+class TestJobReplay:
+    """测试事件日志与断点回放"""
+
+    @pytest.mark.asyncio
+    async def test_resume_after_last_event_id(self):
+        manager = JobManager(max_events=100, orphan_grace_seconds=0)
+        job = manager.create(source(5))
+        await asyncio.wait_for(job.task, timeout=1)
+
+        assert job.status == JOB_COMPLETED
+        full = await collect(manager, job.job_id)
+        assert [e[0] for e in full] == [1, 2, 3, 4, 5, 6]
+
+        resumed = await collect(manager, job.job_id, last_event_id=3)
+        assert [(e[0], e[2].get("seq")) for e in resumed] == [(4, 3), (5, 4), (6, None)]
+        assert resumed[-1][1] == "complete"
+
+    @pytest.mark.asyncio
+    async def test_live_subscriber_reconnects_without_restart(self):
+        gate = asyncio.Queue()
+        manager = JobManager(max_events=100, orphan_grace_seconds=0)
+        job = manager.create(source(4, gate))
+
+        gate.put_nowait(None)
+        gate.put_nowait(None)
+        first = await asyncio.wait_for(collect(manager, job.job_id, limit=2), timeout=1)
+        assert [e[0] for e in first] == [1, 2]
+
+        # 断开期间任务继续运行
+        gate.put_nowait(None)
+        gate.put_nowait(None)
+        resumed = await asyncio.wait_for(collect(manager, job.job_id, last_event_id=first[-1][0]), timeout=1)
+        assert [e[0] for e in resumed] == [3, 4, 5]
+        assert job.status == JOB_COMPLETED
+
+    @pytest.mark.asyncio
+    async def test_bounded_log_reports_gap(self):
+        manager = JobManager(max_events=3, spill_enabled=False, orphan_grace_seconds=0)
+        job = manager.create(source(5))
+        await asyncio.wait_for(job.task, timeout=1)
+
+        events = await collect(manager, job.job_id, last_event_id=1)
+        assert events[0][1] == "gap"
+        assert events[0][2] == {"missed_from": 2, "missed_to": 3}
+        assert [e[0] for e in events[1:]] == [4, 5, 6]
+
+    @pytest.mark.asyncio
+    async def test_spilled_events_are_replayed(self, session_factory):
+        manager = JobManager(
+            max_events=2, spill_enabled=True, orphan_grace_seconds=0, session_factory=session_factory
+        )
+        job = manager.create(source(5))
+        await asyncio.wait_for(job.task, timeout=1)
+
+        assert len(job.events) == 2
+        events = await collect(manager, job.job_id, last_event_id=1)
+        assert [e[0] for e in events] == [2, 3, 4, 5, 6]
+        assert all(e[1] != "gap" for e in events)
+
+    def test_spill_table_created_by_startup_migrations(self):
+        engine = create_engine("sqlite:///:memory:", poolclass=StaticPool)
+        ensure_tables(engine)
+        assert inspect(engine).has_table(GenerationJobEvent.__tablename__)
+        engine.dispose()
+
+
+class TestJobCancellation:
+    """测试显式取消与无订阅者自动取消"""
+
+    @pytest.mark.asyncio
+    async def test_explicit_cancel(self):
+        gate = asyncio.Queue()
+        manager = JobManager(max_events=100, orphan_grace_seconds=0)
+        job = manager.create(source(3, gate))
+        await asyncio.sleep(0)
+
+        assert manager.cancel(job.job_id)
+        await asyncio.wait_for(asyncio.gather(job.task, return_exceptions=True), timeout=1)
+
+        assert job.status == JOB_CANCELLED
+        events = await collect(manager, job.job_id)
+        assert events[-1][1] == "cancelled"
+        assert not manager.cancel(job.job_id)
+
+    @pytest.mark.asyncio
+    async def test_close_cancels_running_jobs(self):
+        manager = JobManager(max_events=100)
+        job = manager.create(source(3, asyncio.Queue()))
+        await asyncio.sleep(0)
+
+        await asyncio.wait_for(manager.close(), timeout=1)
+        assert job.status == JOB_CANCELLED
+
+    @pytest.mark.asyncio
+    async def test_orphaned_job_is_cancelled_after_grace(self):
+        gate = asyncio.Queue()
+        manager = JobManager(max_events=100, orphan_grace_seconds=0.05)
+        job = manager.create(source(3, gate))
+
+        gate.put_nowait(None)
+        await asyncio.wait_for(collect(manager, job.job_id, limit=1), timeout=1)
+        await asyncio.sleep(0.15)
+
+        assert job.status == JOB_CANCELLED
+
+    @pytest.mark.asyncio
+    async def test_resubscribe_within_grace_keeps_job(self):
+        gate = asyncio.Queue()
+        manager = JobManager(max_events=100, orphan_grace_seconds=0.1)
+        job = manager.create(source(2, gate))
+
+        gate.put_nowait(None)
+        await asyncio.wait_for(collect(manager, job.job_id, limit=1), timeout=1)
+        await asyncio.sleep(0.02)
+
+        gate.put_nowait(None)
+        events = await asyncio.wait_for(collect(manager, job.job_id, last_event_id=1), timeout=1)
+        assert [e[1] for e in events] == ["progress", "complete"]
+        assert job.status == JOB_COMPLETED
@@ -0,0 +1,107 @@
+"""
+共享LLM传输层测试
+"""
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+from app.agents.course_chat_agent import CourseChatAgent
+from app.core.llm_transport import LLMTransport, get_llm_transport, resolve_model
+from app.core.openai_client import OpenAIClient
+from app.core.openai_streaming import OpenAIStreamingClient
+from app.services.ai_service import AIService
+
+
+class TestSharedPool:
+    """测试所有客户端复用同一连接池"""
+
+    def test_clients_share_http_pool(self):
+        shared = get_llm_transport().http_client
+
+        assert OpenAIClient().client._client is shared
+        assert OpenAIStreamingClient().client._client is shared
+        assert AIService().client._client is shared
+        assert CourseChatAgent(api_key="test_key").client._client is shared
+
+    @pytest.mark.asyncio
+    async def test_singletons_follow_rebuilt_pool(self):
+        """传输层关闭后重建连接池，长期存在的客户端不再引用已关闭的连接池"""
+        service = AIService()
+        agent = CourseChatAgent(api_key="test_key")
+        closed = get_llm_transport().http_client
+
+        await get_llm_transport().aclose()
+
+        assert service.client._client is not closed
+        assert agent.client._client is not closed
+        assert not agent.client._client.is_closed
+        assert agent.client.api_key == "test_key"
+
+    def test_client_cached_per_credentials(self):
+        transport = LLMTransport()
+
+        default = transport.get_client()
+        assert transport.get_client() is default
+
+        other = transport.get_client(api_key="other", base_url="https://example.com/v1")
+        assert other is not default
+        assert other._client is default._client
+
+    def test_explicit_limits(self):
+        transport = LLMTransport(max_connections=7, max_keepalive_connections=3, keepalive_expiry=12)
+
+        assert transport.limits.max_connections == 7
+        assert transport.limits.max_keepalive_connections == 3
+        assert transport.limits.keepalive_expiry == 12
+
+    def test_http2_requires_h2(self):
+        with patch("app.core.llm_transport.HTTP2_AVAILABLE", False):
+            assert LLMTransport(http2=True).http2 is False
+
+
+class TestPoolStats:
+    """测试连接池指标"""
+
+    @pytest.mark.asyncio
+    async def test_stats_before_and_after_close(self):
+        transport = LLMTransport(max_connections=5)
+        transport.get_client()
+
+        stats = transport.pool_stats()
+        assert stats["max_connections"] == 5
+        assert stats["clients"] == 1
+        assert stats["connections"] == 0
+        assert stats["queued_requests"] == 0
+
+        await transport.aclose()
+        assert transport.pool_stats()["clients"] == 0
+
+    @pytest.mark.asyncio
+    async def test_request_counter(self):
+        transport = LLMTransport()
+        transport._http_client = httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda request: httpx.Response(200)),
+            event_hooks={"request": [transport._on_request]},
+        )
+
+        await transport.http_client.get("https://example.com")
+        await transport.http_client.get("https://example.com")
+
+        assert transport.pool_stats()["requests_total"] == 2
+        await transport.aclose()
+
+
+class TestModelRouting:
+    """测试按Agent路由模型"""
+
+    def test_agent_specific_model(self):
+        with patch("app.core.llm_transport.settings.agent2_model", "deepseek-reasoner"), \
+             patch("app.core.llm_transport.settings.openai_model", "gpt-4o"):
+            assert resolve_model("agent2") == "deepseek-reasoner"
+            assert resolve_model() == "gpt-4o"
+
+    def test_falls_back_to_default_model(self):
+        with patch("app.core.llm_transport.settings.agent3_model", None), \
+             patch("app.core.llm_transport.settings.openai_model", "gpt-4o"):
+            assert resolve_model("agent3") == "gpt-4o"
@@ -0,0 +1,158 @@
+"""
+离线压测工具测试
+
+模拟LLM服务通过ASGITransport直接调用，验证OpenAI兼容的流式格式、错误注入，
+以及压测驱动的TTFT/块间延迟统计
+"""
+import json
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from openai import AsyncOpenAI
+
+from loadtest.driver import ProcessSampler, build_report, measure_stream, percentile, read_process_stats
+from loadtest.mock_llm_server import MockLLMConfig, create_app, detect_kind, load_canned_markdown
+
+FAST = dict(ttft=0.0, tokens_per_second=0.0, chars_per_token=4, seed=1)
+
+
+def mock_client(config: MockLLMConfig) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app(config)), base_url="http://mock")
+
+
+def system(prompt: str):
+    return [{"role": "system", "content": prompt}, {"role": "user", "content": "生成"}]
+
+
+class TestMockLLMServer:
+    """测试模拟服务的内容选择与流式格式"""
+
+    def test_canned_markdown_split_by_stage(self):
+        canned = load_canned_markdown()
+        assert canned["stage1"].startswith("# 阶段一")
+        assert canned["stage2"].startswith("# 阶段二")
+        assert canned["stage3"].startswith("# 阶段三")
+        assert "# 阶段二" not in canned["stage1"]
+
+    def test_detect_kind_from_system_prompt(self):
+        assert detect_kind(system('You are "The Assessor", an expert')) == "stage2"
+        assert detect_kind(system('You are "The Planner", an expert')) == "stage3"
+        assert detect_kind(system('You are "The Editor", an expert')) == "editor"
+        assert detect_kind(system("你是一位资深的课程设计专家")) == "chat"
+        assert detect_kind(system('You are "Genesis One"')) == "stage1"
+
+    @pytest.mark.asyncio
+    async def test_openai_client_streams_canned_markdown_with_usage(self):
+        async with mock_client(MockLLMConfig(**FAST)) as http_client:
+            client = AsyncOpenAI(api_key="mock", base_url="http://mock/v1", http_client=http_client)
+            stream = await client.chat.completions.create(
+                model="mock-model",
+                messages=system('You are "The Assessor"'),
+                stream=True,
+                extra_body={"stream_options": {"include_usage": True}},
+            )
+            text, usage = "", None
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage  # 旧版SDK中为未建模的dict
+
+        assert text == load_canned_markdown()["stage2"]
+        assert dict(usage)["completion_tokens"] == -(-len(text) // 4)
+
+    @pytest.mark.asyncio
+    async def test_editor_echoes_first_section(self):
+        messages = [
+            {"role": "system", "content": 'You are "The Editor"'},
+            {"role": "user", "content": "@@ 3\n## U: 持续理解\n- U1\n@@ 4\n## Q\n- Q1\n\n请修改U"},
+        ]
+        async with mock_client(MockLLMConfig(**FAST)) as client:
+            response = await client.post("/v1/chat/completions", json={"model": "m", "messages": messages})
+        content = response.json()["choices"][0]["message"]["content"]
+        assert content.startswith("@@ 3\n## U: 持续理解\n- U1")
+        assert "@@ 4" not in content
+
+    @pytest.mark.asyncio
+    async def test_error_injection(self):
+        async with mock_client(MockLLMConfig(**dict(FAST, rate_limit_rate=1.0))) as client:
+            response = await client.post("/v1/chat/completions", json={"model": "m", "messages": []})
+            assert response.status_code == 429
+            assert response.headers["retry-after"] == "1"
+
+            await client.put("/mock/config", json={"rate_limit_rate": 0.0, "abort_rate": 1.0})
+            with pytest.raises(Exception, match="Injected stream abort"):
+                async with client.stream("POST", "/v1/chat/completions", json={
+                    "model": "m", "messages": [], "stream": True,
+                }) as stream:
+                    async for _ in stream.aiter_lines():
+                        pass
+
+            stats = (await client.get("/mock/stats")).json()
+        assert stats["injected"] == {"error": 0, "rate_limit": 1, "abort": 1}
+
+
+def sse_app(events):
+    """按顺序输出给定SSE事件的应用"""
+    app = FastAPI()
+
+    @app.post("/api/v1/workflow/stream")
+    async def stream():
+        async def generate():
+            for event in events:
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+class TestLoadDriver:
+    """测试压测驱动的统计口径"""
+
+    def test_percentile_interpolates(self):
+        values = [float(v) for v in range(1, 101)]
+        assert percentile(values, 50) == pytest.approx(50.5)
+        assert percentile(values, 99) == pytest.approx(99.01)
+        assert percentile([], 50) is None
+
+    @pytest.mark.asyncio
+    async def test_workflow_stream_counts_only_content_events(self):
+        events = [
+            {"event": "start", "data": {}},
+            {"event": "progress", "data": {"stage": 1, "progress": 0.0, "message": "正在生成..."}},
+            {"event": "progress", "data": {"stage": 1, "seq": 1, "markdown_preview": "# 阶段一"}},
+            {"event": "progress", "data": {"stage": 1, "seq": 2, "markdown_preview": "# 阶段一\n\n## G"}},
+            {"event": "stage_complete", "data": {"stage": 1}},
+            {"event": "complete", "data": {}},
+        ]
+        transport = httpx.ASGITransport(app=sse_app(events))
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            result = await measure_stream(client, "workflow", "/api/v1/workflow/stream", {})
+
+        assert result.ok and result.error is None
+        assert result.chunks == 2 and len(result.gaps) == 1
+        assert result.chars == len("# 阶段一\n\n## G")
+
+        report = build_report([result], wall_time=1.0, concurrency=1)
+        assert report["scenarios"]["workflow"]["succeeded"] == 1
+        assert report["scenarios"]["workflow"]["ttft_ms"]["count"] == 1
+
+    @pytest.mark.asyncio
+    async def test_error_event_marks_failure(self):
+        events = [{"event": "error", "data": {"stage": 2, "message": "Stage 2 failed"}}]
+        transport = httpx.ASGITransport(app=sse_app(events))
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            result = await measure_stream(client, "workflow", "/api/v1/workflow/stream", {})
+        assert not result.ok and result.error == "Stage 2 failed"
+
+    def test_process_stats_of_current_process(self):
+        import os
+
+        stats = read_process_stats(os.getpid())
+        if stats is None:
+            pytest.skip("当前平台无法读取进程信息")
+        cpu_seconds, rss = stats
+        assert cpu_seconds > 0 and rss > 0
+        assert ProcessSampler(os.getpid()).report() == {"pid": os.getpid(), "samples": 0}
@@ -18,6 +18,14 @@ def test_health_check():
     assert "version" in data
 
 
+def test_background_generation_stops_before_llm_transport_closes():
+    """关闭时先取消后台生成，再关闭LLM连接池，避免进行中的课程因连接已关闭被标记为失败"""
+    hooks = [handler.__name__ for handler in app.router.on_shutdown]
+    assert hooks.index("stop_generation_jobs") < hooks.index("close_llm_transport")
+    assert hooks.index("stop_batch_jobs") < hooks.index("close_llm_transport")
+    assert hooks.index("close_llm_transport") < hooks.index("flush_stage_writer")
+
+
 def test_api_status():
     """测试API状态端点"""
     response = client.get("/api/v1/status")
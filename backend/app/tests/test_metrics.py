@@ -0,0 +1,159 @@
+"""
+Prometheus指标测试
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.core import metrics as metrics_module
+from app.core.config import settings
+from app.core.llm_transport import resolve_model
+from app.core.metrics import LLMCallTimer, LLMMetrics
+from app.core.openai_client import OpenAIClient
+from app.core.retry import stage_retry_budget
+from app.services.workflow_service_v3 import WorkflowServiceV3
+from app.tests.test_admission import make_controller
+from app.tests.test_cancellation import FakeUpstream, chunk, patched_client
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    metrics = LLMMetrics()
+    monkeypatch.setattr(metrics_module, "_metrics", metrics)
+    return metrics
+
+
+def sample(metrics, name, **labels):
+    return metrics.registry.get_sample_value(name, labels) or 0
+
+
+class TestStageSLO:
+    """测试阶段相对 agentN_timeout 的SLO计数"""
+
+    def test_met_and_missed(self, metrics):
+        target = settings.agent1_timeout
+        metrics.record_stage(1, "m", "completed", target - 1)
+        metrics.record_stage(1, "m", "completed", target + 1)
+        metrics.record_stage(1, "m", "error", 1)
+
+        assert sample(metrics, "pbl_stage_slo_total", stage="1", result="met") == 1
+        assert sample(metrics, "pbl_stage_slo_total", stage="1", result="missed") == 2
+
+    def test_cancelled_and_section_edits_not_counted(self, metrics):
+        metrics.record_stage(2, "m", "cancelled", 1)
+        metrics.record_stage(2, "m", "completed", 1, mode="section_edit")
+
+        assert sample(metrics, "pbl_stage_slo_total", stage="2", result="met") == 0
+        assert sample(
+            metrics, "pbl_stage_duration_seconds_count",
+            stage="2", model="m", mode="section_edit", outcome="completed", cached="false",
+        ) == 1
+
+    def test_workflow_against_max_timeout(self, metrics):
+        metrics.record_workflow("completed", settings.max_timeout + 1)
+        assert sample(metrics, "pbl_workflow_slo_total", result="missed") == 1
+
+
+class TestLLMCallTimer:
+    """测试TTFT与输出速率"""
+
+    def test_records_ttft_and_tokens_per_second(self, metrics, monkeypatch):
+        clock = iter([10.0, 10.5, 12.5])
+        monkeypatch.setattr(metrics_module.time, "perf_counter", lambda: next(clock))
+
+        timer = LLMCallTimer("agent1", "m")
+        timer.token()
+        timer.token()
+        timer.finish("completed", prompt_tokens=300, completion_tokens=100)
+        timer.finish("error")  # 重复调用不再记录
+
+        assert sample(metrics, "pbl_llm_ttft_seconds_sum", agent="agent1", model="m") == 0.5
+        assert sample(metrics, "pbl_llm_output_tokens_per_second_sum", agent="agent1", model="m") == 50
+        assert sample(metrics, "pbl_llm_prompt_tokens_total", agent="agent1", model="m") == 300
+        assert sample(metrics, "pbl_llm_request_duration_seconds_count", agent="agent1", model="m", outcome="error") == 0
+
+
+class TestOpenAIClientInstrumentation:
+    """测试流式调用的token与取消计数"""
+
+    @pytest.mark.asyncio
+    async def test_stream_uses_usage_chunk(self, metrics):
+        upstream = FakeUpstream(["第一段", "第二段"])
+        texts = upstream.texts
+
+        async def iterate():
+            for text in texts:
+                yield chunk(text)
+            yield SimpleNamespace(choices=[], usage={"prompt_tokens": 120, "completion_tokens": 7})
+
+        upstream._iterate = iterate
+        with patched_client(upstream):
+            gen = OpenAIClient().generate_response_stream(
+                prompt="课程", model="m", retry_budget=stage_retry_budget("agent2"), continuation=False
+            )
+            assert [text async for text in gen] == texts
+
+        assert sample(metrics, "pbl_llm_prompt_tokens_total", agent="agent2", model="m") == 120
+        assert sample(metrics, "pbl_llm_completion_tokens_total", agent="agent2", model="m") == 7
+        assert sample(metrics, "pbl_llm_ttft_seconds_count", agent="agent2", model="m") == 1
+
+    @pytest.mark.asyncio
+    async def test_consumer_close_counts_cancellation(self, metrics):
+        upstream = FakeUpstream(["第一段内容"], hang=True)
+        with patched_client(upstream):
+            gen = OpenAIClient().generate_response_stream(
+                prompt="课程", model="m", retry_budget=stage_retry_budget("agent1")
+            )
+            await gen.__anext__()
+            await gen.aclose()
+
+        assert sample(metrics, "pbl_llm_cancellations_total", agent="agent1", model="m") == 1
+        assert sample(metrics, "pbl_llm_completion_tokens_total", agent="agent1", model="m") > 0
+
+
+class TestWorkflowStageMetrics:
+    """测试工作流阶段的排队等待与阶段时长"""
+
+    @pytest.mark.asyncio
+    async def test_admitted_records_queue_wait_and_stage(self, metrics):
+        service = WorkflowServiceV3()
+        service.admission = make_controller(limit=1)
+        blocker = service.admission.enqueue(resolve_model("agent1"), tenant="other")
+
+        async def agent_stream():
+            yield {"type": "llm_call"}
+            yield {"type": "progress", "content": "# 阶段一", "chunk": "# 阶段一", "progress": 0.1}
+            yield {"type": "complete", "content": "# 阶段一", "generation_time": 0.1}
+
+        async def consume():
+            return [event["type"] async for event in service._admitted(1, "course:1", agent_stream())]
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.05)
+        blocker.release()
+        events = await task
+
+        model = resolve_model("agent1")
+        assert events == ["queued", "progress", "complete"]
+        assert sample(metrics, "pbl_llm_queue_wait_seconds_sum", agent="agent1", model=model) >= 0.05
+        assert sample(
+            metrics, "pbl_stage_duration_seconds_count",
+            stage="1", model=model, mode="generate", outcome="completed", cached="false",
+        ) == 1
+        assert sample(metrics, "pbl_stage_slo_total", stage="1", result="met") == 1
+
+
+class TestMetricsEndpoint:
+    """测试 /metrics 导出"""
+
+    def test_prometheus_text_format(self, metrics):
+        from app.main import app
+
+        metrics.record_stage(3, "m", "completed", 12)
+        response = TestClient(app).get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert 'pbl_stage_slo_total{result="met",stage="3"} 1.0' in response.text
@@ -0,0 +1,127 @@
+"""
+提示词前缀缓存布局与缓存命中统计测试
+"""
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.agents.course_chat_agent import CHAT_RULES_PROMPT, CourseChatAgent
+from app.core.prompt_cache import PromptCacheStats, PromptPrefixCache, extract_usage, stage_version
+
+COURSE_INFO = {"title": "AI创意工坊", "subject": "信息科技", "grade_level": "初二"}
+STAGE_ONE = "# 阶段一\n\n## G - 预期目标\n学生能够独立完成AI项目。"
+STAGE_TWO = "# 阶段二\n\n## 表现性任务\n设计社区垃圾分类助手。"
+
+
+def build_messages(agent, message, step, history=None, stage_three=None):
+    return agent._build_messages(
+        user_message=message,
+        conversation_history=history or [],
+        current_step=step,
+        course_info=COURSE_INFO,
+        stage_one_data=STAGE_ONE,
+        stage_two_data=STAGE_TWO,
+        stage_three_data=stage_three,
+    )
+
+
+class TestUsageExtraction:
+    """测试从不同服务商的usage中读取缓存命中token"""
+
+    def test_openai_prompt_tokens_details(self):
+        usage = {"prompt_tokens": 1200, "completion_tokens": 80,
+                 "prompt_tokens_details": {"cached_tokens": 1024}}
+        assert extract_usage(usage) == {"prompt_tokens": 1200, "completion_tokens": 80, "cached_tokens": 1024}
+
+    def test_deepseek_prompt_cache_hit_tokens(self):
+        usage = MagicMock(spec=["prompt_tokens", "completion_tokens", "prompt_cache_hit_tokens"])
+        usage.prompt_tokens, usage.completion_tokens, usage.prompt_cache_hit_tokens = 900, 50, 768
+        assert extract_usage(usage)["cached_tokens"] == 768
+
+    def test_invalid_usage_is_ignored(self):
+        assert extract_usage(None) is None
+        assert extract_usage(MagicMock()) is None
+
+    def test_stats_hit_ratio(self):
+        stats = PromptCacheStats()
+        stats.record("deepseek-chat", {"prompt_tokens": 1000, "prompt_cache_hit_tokens": 800})
+        stats.record("deepseek-chat", {"prompt_tokens": 1000, "prompt_cache_hit_tokens": 0})
+
+        result = stats.stats()
+        assert result["cached_tokens_total"] == 800
+        assert result["models"]["deepseek-chat"]["cache_hit_ratio"] == 0.4
+
+
+class TestPromptPrefixLayout:
+    """测试稳定前缀 + 易变后缀布局"""
+
+    @pytest.fixture
+    def chat_agent(self):
+        return CourseChatAgent(api_key="test_key")
+
+    def test_prefix_identical_across_steps_and_questions(self, chat_agent):
+        first = build_messages(chat_agent, "为什么这样设计？", step=1)
+        second = build_messages(
+            chat_agent, "评估量规怎么改进？", step=2,
+            history=[{"role": "user", "content": "为什么这样设计？"}, {"role": "assistant", "content": "因为……"}],
+        )
+
+        assert first[0]["content"] == second[0]["content"]
+        assert first[0]["content"].startswith(CHAT_RULES_PROMPT)
+        assert "当前阶段" not in first[0]["content"]
+        assert "当前阶段：Stage 2" in second[-1]["content"]
+        assert second[-1]["content"].endswith("评估量规怎么改进？")
+
+    def test_prefix_changes_only_with_stage_version(self, chat_agent):
+        before = build_messages(chat_agent, "你好", step=1)[0]["content"]
+        after = build_messages(chat_agent, "你好", step=1, stage_three="# 阶段三\n\n## 项目启动")[0]["content"]
+
+        assert after.startswith(before)
+        assert stage_version(STAGE_ONE) != stage_version(STAGE_TWO)
+        assert chat_agent.prefix_cache.hits >= 1
+
+    def test_partial_stage_goes_to_suffix(self, chat_agent):
+        chat_agent.context_builder.full_stage_tokens = 0
+        stage_three = "# 阶段三\n\n## 项目启动\n参观社区回收站。\n\n## 原型迭代\n反复测试原型。"
+
+        messages = build_messages(chat_agent, "回收站参观怎么安排？", step=1, stage_three=stage_three)
+
+        assert "参观社区回收站" not in messages[0]["content"]
+        assert "参观社区回收站" in messages[-1]["content"]
+
+    def test_prefix_cache_is_lru(self):
+        cache = PromptPrefixCache(max_entries=1)
+        cache.get_or_render(("a",), lambda: "A")
+        cache.get_or_render(("b",), lambda: "B")
+        assert cache.get_or_render(("a",), lambda: "A2") == "A2"
+
+
+class TestUsageRecording:
+    """测试流式响应末尾的usage被记录"""
+
+    @pytest.mark.asyncio
+    async def test_stream_records_cached_tokens(self):
+        agent = CourseChatAgent(api_key="test_key", model="cache-test-model")
+
+        content_chunk = MagicMock(usage=None)
+        content_chunk.choices = [MagicMock()]
+        content_chunk.choices[0].delta.content = "回复"
+        usage_chunk = MagicMock(choices=[])
+        usage_chunk.usage = {"prompt_tokens": 2000, "completion_tokens": 10,
+                             "prompt_tokens_details": {"cached_tokens": 1536}}
+
+        async def stream():
+            yield content_chunk
+            yield usage_chunk
+
+        async def create(*args, **kwargs):
+            assert kwargs["extra_body"] == {"stream_options": {"include_usage": True}}
+            return stream()
+
+        stats = PromptCacheStats()
+        with patch.object(agent.client.chat.completions, "create", side_effect=create), \
+                patch("app.agents.course_chat_agent.get_prompt_cache_stats", return_value=stats):
+            chunks = [chunk async for chunk in agent.chat_stream("你好", [], current_step=1)]
+
+        assert chunks == ["回复"]
+        assert stats.stats()["models"]["cache-test-model"]["cached_tokens"] == 1536
@@ -0,0 +1,95 @@
+"""
+PHR提示词注册表测试
+"""
+import os
+import textwrap
+
+import pytest
+
+from app.agents.project_foundation_v3 import ProjectFoundationAgentV3
+from app.core.prompt_registry import PromptRegistry, get_prompt_registry
+
+
+def write_phr(path, version="v1.0", prompt="你是课程设计专家。"):
+    path.write_text(
+        textwrap.dedent(
+            f"""\
+            # Prompt History Record: Test
+
+            ## Meta Information
+            - **Version**: {version}
+
+            ## System Prompt
+
+            ```
+            {prompt}
+            ```
+
+            ---
+            """
+        ),
+        encoding="utf-8",
+    )
+
+
+class TestPromptRegistry:
+    """测试加载、校验与热重载"""
+
+    def test_loads_all_repo_prompts(self):
+        """仓库中的全部PHR文件都能通过校验"""
+        registry = PromptRegistry()
+        registry.load_all()
+        versions = registry.versions()
+
+        assert versions["project_foundation_v3_markdown"] == "v3.0-markdown"
+        assert versions["assessment_framework_v3_markdown"] == "v3.0-markdown"
+        assert versions["learning_blueprint_v3_markdown"] == "v3.0-markdown"
+
+    def test_broken_file_fails_at_load(self, tmp_path):
+        """缺少结束标记的文件在加载时报错，而不是生成时"""
+        (tmp_path / "broken.md").write_text("## System Prompt\n\n```\n没有结束标记", encoding="utf-8")
+        with pytest.raises(ValueError, match="End of System Prompt"):
+            PromptRegistry(tmp_path).load_all()
+
+    def test_hot_reload_on_mtime_change(self, tmp_path):
+        path = tmp_path / "demo.md"
+        write_phr(path, version="v1.0", prompt="旧提示词")
+        registry = PromptRegistry(tmp_path)
+        registry.load_all()
+        old_fingerprint = registry.get("demo").fingerprint
+
+        write_phr(path, version="v1.0", prompt="新提示词")
+        stat = path.stat()
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+        assert registry.reload_if_changed() == ["demo"]
+        assert registry.get_system_prompt("demo") == "新提示词"
+        assert registry.get("demo").fingerprint != old_fingerprint
+        assert registry.reload_if_changed() == []
+
+    def test_broken_reload_keeps_previous_version(self, tmp_path):
+        """热重载遇到损坏文件时保留旧版本"""
+        path = tmp_path / "demo.md"
+        write_phr(path, prompt="可用提示词")
+        registry = PromptRegistry(tmp_path)
+        registry.load_all()
+
+        path.write_text("损坏的文件", encoding="utf-8")
+        stat = path.stat()
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+        assert registry.reload_if_changed() == []
+        assert registry.get_system_prompt("demo") == "可用提示词"
+
+    def test_unknown_prompt(self, tmp_path):
+        write_phr(tmp_path / "demo.md")
+        with pytest.raises(FileNotFoundError):
+            PromptRegistry(tmp_path).get("missing")
+
+    def test_agent_reads_from_registry(self):
+        """Agent从注册表获取System Prompt与版本"""
+        agent = ProjectFoundationAgentV3()
+        record = get_prompt_registry().get("project_foundation_v3_markdown")
+
+        assert agent._build_system_prompt() == record.system_prompt
+        assert agent.phr_version.startswith("v3.0-markdown+")
@@ -0,0 +1,152 @@
+"""
+LLM重试与断流续写测试
+"""
+from types import SimpleNamespace
+from unittest.mock import MagicMock, PropertyMock, patch
+
+import httpx
+import openai
+import pytest
+
+from app.core.openai_client import OpenAIClient, trim_continuation
+from app.core.retry import RetryBudget, is_retryable
+
+
+def status_error(cls, status_code, headers=None):
+    request = httpx.Request("POST", "https://api.example.com/v1/chat/completions")
+    response = httpx.Response(status_code, request=request, headers=headers or {})
+    return cls("error", response=response, body=None)
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+class FakeStream:
+    """按顺序产出文本块，可在最后抛出异常模拟断流"""
+
+    def __init__(self, texts, error=None):
+        self.texts = texts
+        self.error = error
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for text in self.texts:
+            yield chunk(text)
+        if self.error is not None:
+            raise self.error
+
+
+def fake_client(*results):
+    """create() 依次返回结果；结果为异常时直接抛出"""
+    calls = []
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+        result = results[len(calls) - 1]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    client = MagicMock()
+    client.chat.completions.create = create
+    return client, calls
+
+
+async def collect(client, **kwargs):
+    with patch.object(OpenAIClient, "client", new_callable=PropertyMock, return_value=client):
+        return [c async for c in OpenAIClient().generate_response_stream(prompt="课程", **kwargs)]
+
+
+class TestRetryClassification:
+    """测试错误分类与退避预算"""
+
+    @pytest.mark.parametrize(
+        "exc, expected",
+        [
+            (status_error(openai.RateLimitError, 429), True),
+            (status_error(openai.InternalServerError, 503), True),
+            (status_error(openai.BadRequestError, 400), False),
+            (status_error(openai.AuthenticationError, 401), False),
+            (httpx.RemoteProtocolError("peer closed connection"), True),
+            (ConnectionResetError(), True),
+            (ValueError("bad"), False),
+        ],
+    )
+    def test_is_retryable(self, exc, expected):
+        assert is_retryable(exc) is expected
+
+    def test_budget_exhaustion_and_backoff_bounds(self):
+        budget = RetryBudget(max_retries=3, base_delay=1.0, max_delay=2.0)
+        delays = [budget.next_delay() for _ in range(4)]
+
+        assert delays[3] is None
+        assert all(0 <= d <= 2.0 for d in delays[:3])
+        assert budget.remaining == 0
+
+    def test_retry_after_header_respected(self):
+        budget = RetryBudget(max_retries=1, base_delay=0.01, max_delay=5.0)
+        exc = status_error(openai.RateLimitError, 429, headers={"retry-after": "3"})
+        assert budget.next_delay(exc) == 3.0
+
+
+class TestStreamRetry:
+    """测试流式调用的重试与续写"""
+
+    @pytest.mark.asyncio
+    async def test_retries_before_first_chunk(self):
+        client, calls = fake_client(
+            status_error(openai.RateLimitError, 429),
+            FakeStream(["# 阶段一\n", "## G: 目标"]),
+        )
+        chunks = await collect(client, retry_budget=RetryBudget(max_retries=2, base_delay=0))
+
+        assert "".join(chunks) == "# 阶段一\n## G: 目标"
+        assert len(calls) == 2
+        assert len(calls[1]["messages"]) == 1
+
+    @pytest.mark.asyncio
+    async def test_mid_stream_drop_resumes_with_continuation(self):
+        partial = "# 阶段一：确定预期学习结果\n\n## G: 迁移目标\n1. 学生能够独立"
+        client, calls = fake_client(
+            FakeStream([partial], error=httpx.RemoteProtocolError("peer closed connection")),
+            FakeStream(["1. 学生能够独立", "完成项目\n"]),
+        )
+        chunks = await collect(client, retry_budget=RetryBudget(max_retries=1, base_delay=0))
+
+        assert "".join(chunks) == partial + "完成项目\n"
+        resume_messages = calls[1]["messages"]
+        assert resume_messages[-2] == {"role": "assistant", "content": partial}
+        assert resume_messages[-1]["role"] == "user"
+
+    @pytest.mark.asyncio
+    async def test_mid_stream_drop_without_continuation_fails(self):
+        client, calls = fake_client(
+            FakeStream(["部分内容"], error=httpx.ReadError("reset")),
+            FakeStream(["不应被调用"]),
+        )
+        with pytest.raises(Exception, match="Stream generation failed"):
+            await collect(client, retry_budget=RetryBudget(max_retries=2, base_delay=0), continuation=False)
+        assert len(calls) == 1
+
+    @pytest.mark.asyncio
+    async def test_non_retryable_error_fails_fast(self):
+        client, calls = fake_client(status_error(openai.BadRequestError, 400), FakeStream(["x"]))
+        with pytest.raises(Exception, match="Stream generation failed"):
+            await collect(client, retry_budget=RetryBudget(max_retries=3, base_delay=0))
+        assert len(calls) == 1
+
+
+class TestTrimContinuation:
+    """测试续写去重"""
+
+    def test_removes_repeated_line(self):
+        assert trim_continuation("...\n- 学生能够理解数据", "- 学生能够理解数据的含义") == "的含义"
+
+    def test_strips_code_fence(self):
+        assert trim_continuation("## G: 目标\n", "```markdown\n## U: 理解\n") == "## U: 理解\n"
+
+    def test_short_overlap_is_kept(self):
+        assert trim_continuation("目标\n", "\n## U") == "\n## U"
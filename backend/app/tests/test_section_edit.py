@@ -0,0 +1,185 @@
+"""
+章节级局部修改测试
+
+使用假的LLM流替换真实调用，验证章节切分、补丁解析与合并、SSE事件
+"""
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from app.api.v1.generate import WorkflowRequest, load_section_edit_target
+from app.core.stage_sections import (
+    SectionPatchParser,
+    merge_sections,
+    resolve_sections,
+    split_stage_sections,
+)
+from app.models.course_project import CourseProject
+from app.services.workflow_service_v3 import WorkflowServiceV3
+from app.tests.test_workflow_service_v3 import STAGE_ONE_FULL_CHUNKS, parse_sse
+
+STAGE_ONE = "".join(STAGE_ONE_FULL_CHUNKS)
+
+
+def fake_llm_stream(chunks):
+    async def generate_response_stream(*args, **kwargs):
+        for chunk in chunks:
+            yield chunk
+    return generate_response_stream
+
+
+class TestStageSections:
+    """测试章节切分与合并"""
+
+    def test_split_addresses_gukqs_sections(self):
+        sections = split_stage_sections(STAGE_ONE)
+
+        assert [s.code for s in sections[1:]] == ["G", "U", "Q", "K", "S"]
+        assert sections[0].text.startswith("# 阶段一")
+        assert merge_sections(sections, {}) == STAGE_ONE
+
+    def test_merge_replaces_only_patched_section(self):
+        sections = split_stage_sections(STAGE_ONE)
+
+        merged = merge_sections(sections, {2: "## U: 持续理解\n- 新的理解"})
+
+        assert "- 新的理解\n\n## Q: 基本问题" in merged
+        assert "- U1" not in merged
+        assert merged.replace("## U: 持续理解\n- 新的理解", "## U: 持续理解\n- U1") == STAGE_ONE
+
+    def test_resolve_sections(self):
+        sections = split_stage_sections(STAGE_ONE)
+        assert resolve_sections(sections, ["U", "基本问题", "5"]) == [2, 3, 5]
+
+
+class TestSectionPatchParser:
+    """测试增量解析模型输出"""
+
+    def test_markers_split_across_chunks(self):
+        parser = SectionPatchParser(split_stage_sections(STAGE_ONE))
+        done = []
+        for chunk in ["@", "@ 2\n## U: 持续理解\n- 新U", "\n\n@@ 4", "\n- 新K\n```\n"]:
+            done.extend(parser.feed(chunk))
+        done.extend(parser.finish())
+
+        assert done == [(2, "## U: 持续理解\n- 新U"), (4, "## K: 学生应掌握的知识\n\n- 新K")]
+
+    def test_unknown_and_disallowed_sections_are_ignored(self):
+        parser = SectionPatchParser(split_stage_sections(STAGE_ONE), allowed=[1])
+        parser.feed("@@ 9\n## 新章节\n@@ 2\n## U\n")
+
+        assert parser.finish() == []
+        assert parser.ignored == [9, 2]
+
+
+class TestSectionEditStream:
+    """测试局部修改的SSE事件流"""
+
+    @pytest.mark.asyncio
+    async def test_stream_emits_patches_and_merged_document(self):
+        service = WorkflowServiceV3()
+        chunks = ["@@ 3\n## Q: 基本问题\n", "- 如何用AI", "改善社区？\n"]
+
+        with patch(
+            "app.agents.section_edit_agent.openai_client.generate_response_stream",
+            side_effect=fake_llm_stream(chunks),
+        ):
+            events = parse_sse([
+                sse async for sse in service.stream_section_edit(
+                    stage=1, markdown=STAGE_ONE, edit_instructions="基本问题聚焦社区",
+                    course_info={"title": "AI创意工坊"},
+                )
+            ])
+
+        types = [e["event"] for e in events]
+        assert types[0] == "start" and types[-1] == "complete"
+        patches = [e["data"] for e in events if e["event"] == "section_patch"]
+        assert [(p["index"], p["code"]) for p in patches] == [(3, "Q")]
+
+        complete = next(e["data"] for e in events if e["event"] == "stage_complete")
+        assert complete["mode"] == "section"
+        assert complete["autosaved"] is False
+        assert "- 如何用AI改善社区？" in complete["markdown"]
+        assert "- Q1" not in complete["markdown"]
+        assert "## U: 持续理解\n- U1" in complete["markdown"]
+
+        # progress 只携带正在修改的章节，不再重复发送整篇文档
+        progress = [e["data"] for e in events if e["event"] == "progress" and "seq" in e["data"]]
+        assert {p["section"] for p in progress} == {3}
+        assert progress[-1]["section_preview"] == "## Q: 基本问题\n- 如何用AI改善社区？\n"
+        assert all("markdown_preview" not in p for p in progress)
+
+    @pytest.mark.asyncio
+    async def test_delta_mode_streams_section_deltas(self):
+        service = WorkflowServiceV3()
+        chunks = ["@@ 2\n## U: 持续理解\n", "- 数据影响决策\n@", "@ 3\n## Q: 基本问题\n", "- 如何改善社区？\n"]
+
+        llm = patch(
+            "app.agents.section_edit_agent.openai_client.generate_response_stream",
+            side_effect=fake_llm_stream(chunks),
+        )
+        # 关闭chunk合并，逐块检查增量
+        with llm, patch("app.core.stream_coalescer.settings.stream_flush_interval_ms", 0), \
+                patch("app.core.stream_coalescer.settings.stream_flush_bytes", 0):
+            events = parse_sse([
+                sse async for sse in service.stream_section_edit(
+                    stage=1, markdown=STAGE_ONE, edit_instructions="聚焦社区", stream_mode="delta",
+                )
+            ])
+
+        assert events[0]["data"]["stream_mode"] == "delta"
+        progress = [e["data"] for e in events if e["event"] == "progress" and "seq" in e["data"]]
+        rebuilt = {}
+        for p in progress:
+            rebuilt[p["section"]] = rebuilt.get(p["section"], "") + p["delta"]
+        # 增量只追加，"@@ 3" 标记的前半部分不会混入上一个章节
+        assert rebuilt == {2: "## U: 持续理解\n- 数据影响决策\n", 3: "## Q: 基本问题\n- 如何改善社区？\n"}
+        patches = [e["data"]["index"] for e in events if e["event"] == "section_patch"]
+        assert patches == [2, 3]
+
+    @pytest.mark.asyncio
+    async def test_unknown_section_selector_is_an_error(self):
+        service = WorkflowServiceV3()
+        events = parse_sse([
+            sse async for sse in service.stream_section_edit(
+                stage=1, markdown=STAGE_ONE, edit_instructions="修改", sections=["不存在的章节"],
+            )
+        ])
+        assert events[-1]["event"] == "error"
+
+
+class TestSectionEditTarget:
+    """测试何时走局部修改"""
+
+    @pytest.fixture
+    async def db(self):
+        engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(CourseProject.__table__.create)
+        async with async_sessionmaker(bind=engine, expire_on_commit=False)() as session:
+            session.add(CourseProject(id=1, title="AI创意工坊", stage_one_data=STAGE_ONE))
+            await session.commit()
+            yield session
+        await engine.dispose()
+
+    def request(self, **kwargs):
+        fields = {"title": "AI创意工坊", "stages_to_generate": [1], "edit_instructions": "修改Q", "course_id": 1}
+        fields.update(kwargs)
+        return WorkflowRequest(**fields)
+
+    @pytest.mark.asyncio
+    async def test_loads_stored_stage(self, db):
+        assert await load_section_edit_target(self.request(), db) == STAGE_ONE
+
+    @pytest.mark.parametrize("kwargs", [
+        {"edit_mode": "full"},
+        {"course_id": None},
+        {"edit_instructions": None},
+        {"stages_to_generate": [2]},
+        {"stages_to_generate": [1, 2]},
+    ])
+    @pytest.mark.asyncio
+    async def test_falls_back_to_full_regeneration(self, db, kwargs):
+        assert await load_section_edit_target(self.request(**kwargs), db) is None
@@ -0,0 +1,283 @@
+"""
+阶段依赖追踪与选择性重新生成测试
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.api.v1 import course as course_api
+from app.core.migrations import ensure_columns
+from app.core.stage_dependencies import (
+    content_hash,
+    course_state,
+    evaluate_staleness,
+    plan_regeneration,
+    stage_sources,
+)
+from app.models.course_project import CourseProject
+from app.services.stage_writer import StageWriter
+from app.services.workflow_service_v3 import WorkflowServiceV3
+from app.tests.test_workflow_service_v3 import (
+    STAGE_ONE_FULL_CHUNKS,
+    STAGE_TWO_FULL_CHUNKS,
+    FakeSectionEditor,
+    FakeStreamAgent,
+    parse_sse,
+)
+
+COURSE_INFO = {"title": "AI创意工坊", "subject": "信息科技", "grade_level": "初二"}
+STAGE_ONE = "# 阶段一\n\n## G: 迁移目标\n1. 独立完成项目"
+STAGE_TWO = "# 阶段二\n\n## 驱动性问题\n如何用AI改善社区？"
+STAGE_THREE = "# 阶段三\n\n## 项目启动\n参观社区回收站。"
+
+
+def recorded_sources(stages=None):
+    stages = stages or {1: STAGE_ONE, 2: STAGE_TWO}
+    return {str(stage): stage_sources(stage, COURSE_INFO, stages) for stage in (1, 2, 3)}
+
+
+class TestContentHash:
+    """测试空白规范化哈希"""
+
+    def test_whitespace_only_edits_keep_hash(self):
+        edited = "# 阶段一\r\n\r\n\r\n##  G: 迁移目标  \n   1. 独立完成项目\n\n"
+        assert content_hash(edited) == content_hash(STAGE_ONE)
+
+    def test_wording_change_changes_hash(self):
+        assert content_hash(STAGE_ONE.replace("独立", "合作")) != content_hash(STAGE_ONE)
+
+
+class TestStaleness:
+    """测试各阶段的失效判断"""
+
+    def test_fresh_stale_and_missing(self):
+        stages = {1: STAGE_ONE.replace("独立", "合作"), 2: STAGE_TWO, 3: None}
+        statuses = evaluate_staleness(COURSE_INFO, stages, recorded_sources())
+
+        assert statuses[1].status == "fresh"
+        assert statuses[2].status == "stale" and statuses[2].changed_inputs == ["1"]
+        assert statuses[3].status == "missing"
+
+    def test_course_info_change_invalidates_all_stages(self):
+        stages = {1: STAGE_ONE, 2: STAGE_TWO, 3: STAGE_THREE}
+        info = {**COURSE_INFO, "grade_level": "初三"}
+        statuses = evaluate_staleness(info, stages, recorded_sources())
+
+        assert [statuses[s].changed_inputs[0] for s in (1, 2, 3)] == ["info", "info", "info"]
+
+    def test_legacy_data_falls_back_to_versions(self):
+        now = datetime.utcnow()
+        stages = {1: STAGE_ONE, 2: STAGE_TWO, 3: STAGE_THREE}
+        versions = {1: now, 2: now - timedelta(hours=1), 3: now + timedelta(hours=1)}
+        statuses = evaluate_staleness(COURSE_INFO, stages, {}, versions)
+
+        assert (statuses[2].status, statuses[2].basis) == ("stale", "version")
+        assert statuses[3].status == "fresh"
+
+
+class TestRegenerationPlan:
+    """测试选择性重新生成计划"""
+
+    def test_whitespace_edit_regenerates_nothing(self):
+        stages = {1: STAGE_ONE + "\n\n\n", 2: STAGE_TWO, 3: STAGE_THREE}
+        plan = plan_regeneration([2, 3], COURSE_INFO, stages, recorded_sources())
+
+        assert plan.regenerate == []
+        assert plan.reused == {2: STAGE_TWO, 3: STAGE_THREE}
+
+    def test_stage_two_edit_regenerates_only_stage_three(self):
+        stages = {1: STAGE_ONE, 2: STAGE_TWO + "\n- 新问题", 3: STAGE_THREE}
+        plan = plan_regeneration([1, 2, 3], COURSE_INFO, stages, recorded_sources())
+
+        assert plan.regenerate == [3]
+        assert sorted(plan.reused) == [1, 2]
+
+    def test_regenerated_stage_cascades_downstream(self):
+        stages = {1: STAGE_ONE, 2: None, 3: STAGE_THREE}
+        plan = plan_regeneration([2, 3], COURSE_INFO, stages, recorded_sources())
+
+        assert plan.regenerate == [2, 3]
+
+    def test_forced_stage_regenerated_even_if_fresh(self):
+        stages = {1: STAGE_ONE, 2: STAGE_TWO, 3: STAGE_THREE}
+        plan = plan_regeneration([2, 3], COURSE_INFO, stages, recorded_sources(), force=[3])
+
+        assert plan.regenerate == [3]
+        assert plan.reused == {2: STAGE_TWO}
+
+
+@pytest.fixture
+def session_factory():
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    CourseProject.__table__.create(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+def load(session_factory, course_id):
+    db = session_factory()
+    course = db.get(CourseProject, course_id)
+    db.close()
+    return course
+
+
+class TestSelectiveWorkflow:
+    """测试工作流记录输入哈希并只重新生成过期阶段"""
+
+    @pytest.fixture
+    def service(self, session_factory):
+        service = WorkflowServiceV3()
+        service.agent1 = FakeStreamAgent(STAGE_ONE_FULL_CHUNKS)
+        service.agent2 = FakeStreamAgent(STAGE_TWO_FULL_CHUNKS)
+        service.agent3 = FakeStreamAgent(["# 阶段三\n\n", "## 项目启动\n参观回收站。\n"])
+        service.section_editor = FakeSectionEditor()
+        service.stage_writer = StageWriter(session_factory)
+        return service
+
+    async def generate(self, service, session_factory, course_id, **kwargs):
+        raw = [
+            sse async for sse in service.stream_workflow(
+                title="AI创意工坊", course_id=course_id, **kwargs
+            )
+        ]
+        await service.stage_writer.flush()
+        return parse_sse(raw), load(session_factory, course_id)
+
+    @pytest.mark.asyncio
+    async def test_only_stale_stages_are_regenerated(self, service, session_factory):
+        db = session_factory()
+        db.add(CourseProject(id=1, title="AI创意工坊"))
+        db.commit()
+        db.close()
+
+        _, course = await self.generate(service, session_factory, 1)
+        assert set(course.stage_sources) == {"1", "2", "3"}
+
+        # 只调整空白：不重新生成任何阶段
+        events, _ = await self.generate(
+            service, session_factory, 1,
+            stage_one_data=course.stage_one_data + "\n\n", stored_state=course_state(course),
+        )
+        skipped = [e["data"]["stage"] for e in events if e["event"] == "stage_skipped"]
+        assert skipped == [1, 2, 3]
+        assert [len(a.calls) for a in (service.agent1, service.agent2, service.agent3)] == [1, 1, 1]
+        assert events[-1]["event"] == "complete"
+
+        # 教师修改并保存Stage 2措辞：只重新生成Stage 3
+        db = session_factory()
+        db.get(CourseProject, 1).stage_two_data = course.stage_two_data + "\n- 补充任务"
+        db.commit()
+        db.close()
+        events, updated = await self.generate(
+            service, session_factory, 1,
+            stages_to_generate=[2, 3],
+            stored_state=course_state(load(session_factory, 1)),
+        )
+        assert events[0]["data"]["stages"] == [3]
+        assert [len(a.calls) for a in (service.agent1, service.agent2, service.agent3)] == [1, 1, 2]
+        assert service.agent3.calls[-1]["stage_two_data"].endswith("- 补充任务")
+        assert evaluate_staleness(**course_state(updated))[3].status == "fresh"
+        await service.stage_writer.close()
+
+    @pytest.mark.asyncio
+    async def test_edit_instructions_regenerate_fresh_stage(self, service, session_factory):
+        db = session_factory()
+        db.add(CourseProject(id=3, title="AI创意工坊"))
+        db.commit()
+        db.close()
+
+        _, course = await self.generate(service, session_factory, 3)
+
+        # 所有阶段都未过期，但带编辑指令的Stage 3仍需重新生成
+        events, _ = await self.generate(
+            service, session_factory, 3,
+            stages_to_generate=[3],
+            edit_instructions="增加一次社区访谈",
+            stored_state=course_state(course),
+        )
+        assert events[0]["data"]["stages"] == [3]
+        assert [e["event"] for e in events if e["event"] == "error"] == []
+        assert len(service.agent3.calls) == 2
+        assert "增加一次社区访谈" in service.agent3.calls[-1]["course_info"]["description"]
+        assert events[-1]["event"] == "complete"
+        await service.stage_writer.close()
+
+    @pytest.mark.asyncio
+    async def test_pipelined_drafts_record_full_upstream(self, service, session_factory):
+        db = session_factory()
+        db.add(CourseProject(id=2, title="AI创意工坊"))
+        db.commit()
+        db.close()
+
+        events, course = await self.generate(service, session_factory, 2, pipelined=True)
+
+        partial = {e["data"]["stage"]: e["data"].get("upstream_partial") for e in events if e["event"] == "stage_complete"}
+        assert partial == {1: None, 2: False, 3: False}
+        # 基于上游前缀生成的草稿已按完整的上游校准，记录的是完整上游的哈希
+        assert course.stage_sources["2"]["1"] == content_hash(course.stage_one_data)
+        assert course.stage_sources["3"]["2"] == content_hash(course.stage_two_data)
+        statuses = evaluate_staleness(**course_state(course))
+        assert [statuses[s].status for s in (1, 2, 3)] == ["fresh", "fresh", "fresh"]
+        await service.stage_writer.close()
+
+
+class TestCourseEndpoints:
+    """测试阶段更新与失效查询端点"""
+
+    @pytest.fixture
+    async def async_session(self):
+        engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+        async with engine.begin() as conn:
+            await conn.run_sync(CourseProject.__table__.create)
+        factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+        async with factory() as session:
+            yield session
+        await engine.dispose()
+
+    @pytest.mark.asyncio
+    async def test_whitespace_edit_keeps_version_and_freshness(self, async_session):
+        async_session.add(CourseProject(
+            id=1, title="AI创意工坊", stage_one_data=STAGE_ONE, stage_two_data=STAGE_TWO,
+            stage_sources={"2": stage_sources(2, {"title": "AI创意工坊"}, {1: STAGE_ONE})},
+        ))
+        await async_session.commit()
+        course = await async_session.get(CourseProject, 1)
+        version = course.stage_one_version
+
+        await course_api.update_stage_one(
+            1, course_api.StageDataUpdate(markdown=STAGE_ONE + "\n\n"), db=async_session
+        )
+        assert course.stage_one_version == version
+        result = await course_api.get_course_staleness(1, db=async_session)
+        assert result["stale_stages"] == []
+
+        await course_api.update_stage_one(
+            1, course_api.StageDataUpdate(markdown=STAGE_ONE + "\n2. 展示作品"), db=async_session
+        )
+        assert course.stage_one_version != version
+        result = await course_api.get_course_staleness(1, db=async_session)
+        assert result["stale_stages"] == [2]
+        assert result["stages"][1]["changed_inputs"] == ["1"]
+
+
+class TestEnsureColumns:
+    """测试为已有数据库补建新增列"""
+
+    def test_adds_stage_sources_column(self):
+        engine = create_engine("sqlite:///:memory:", poolclass=StaticPool)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE course_projects (id INTEGER PRIMARY KEY, title VARCHAR(255))"))
+
+        ensure_columns(engine)
+        ensure_columns(engine)  # 可重复执行
+
+        columns = {column["name"] for column in inspect(engine).get_columns("course_projects")}
+        assert "stage_sources" in columns
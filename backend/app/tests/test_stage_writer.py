@@ -0,0 +1,122 @@
+"""
+阶段结果自动保存测试
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.models.course_project import CourseProject
+from app.services.stage_writer import StageWriter
+from app.services.workflow_service_v3 import WorkflowServiceV3
+from app.tests.test_workflow_service_v3 import (
+    STAGE_ONE_FULL_CHUNKS,
+    STAGE_TWO_FULL_CHUNKS,
+    FakeStreamAgent,
+    parse_sse,
+)
+
+
+@pytest.fixture
+def session_factory():
+    """后台线程与测试共享同一个内存数据库"""
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    CourseProject.__table__.create(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def course_id(session_factory):
+    db = session_factory()
+    course = CourseProject(
+        title="AI创意工坊",
+        stage_one_version=datetime.utcnow() - timedelta(days=1),
+    )
+    db.add(course)
+    db.commit()
+    course_id = course.id
+    db.close()
+    return course_id
+
+
+def load(session_factory, course_id):
+    db = session_factory()
+    course = db.get(CourseProject, course_id)
+    db.close()
+    return course
+
+
+class TestStageWriter:
+    """测试后台写入器"""
+
+    @pytest.mark.asyncio
+    async def test_submit_persists_and_bumps_version(self, session_factory, course_id):
+        before = load(session_factory, course_id).stage_one_version
+        writer = StageWriter(session_factory)
+
+        writer.submit(course_id, 1, "# 阶段一")
+        await writer.flush()
+
+        course = load(session_factory, course_id)
+        assert course.stage_one_data == "# 阶段一"
+        assert course.stage_one_version > before
+        await writer.close()
+
+    @pytest.mark.asyncio
+    async def test_pending_writes_keep_latest(self, session_factory, course_id):
+        writer = StageWriter(session_factory)
+        writer.submit(course_id, 2, "旧版本")
+        writer.submit(course_id, 2, "新版本")
+        await writer.flush()
+
+        assert load(session_factory, course_id).stage_two_data == "新版本"
+        await writer.close()
+
+    @pytest.mark.asyncio
+    async def test_missing_course_is_ignored(self, session_factory):
+        writer = StageWriter(session_factory)
+        writer.submit(99999, 1, "# 阶段一")
+        await writer.flush()
+        await writer.close()
+
+
+class TestWorkflowAutosave:
+    """测试工作流完成阶段后自动保存"""
+
+    @pytest.mark.asyncio
+    async def test_stream_persists_each_stage(self, session_factory, course_id):
+        service = WorkflowServiceV3()
+        service.agent1 = FakeStreamAgent(STAGE_ONE_FULL_CHUNKS)
+        service.agent2 = FakeStreamAgent(STAGE_TWO_FULL_CHUNKS)
+        service.stage_writer = StageWriter(session_factory)
+
+        raw = [
+            sse async for sse in service.stream_workflow(
+                title="AI创意工坊", stages_to_generate=[1, 2], course_id=course_id
+            )
+        ]
+        await service.stage_writer.flush()
+
+        completes = [e["data"] for e in parse_sse(raw) if e["event"] == "stage_complete"]
+        assert [c["autosaved"] for c in completes] == [True, True]
+
+        course = load(session_factory, course_id)
+        assert course.stage_one_data == completes[0]["markdown"]
+        assert course.stage_two_data == completes[1]["markdown"]
+        await service.stage_writer.close()
+
+    @pytest.mark.asyncio
+    async def test_no_course_id_means_no_autosave(self):
+        service = WorkflowServiceV3()
+        service.agent1 = FakeStreamAgent(STAGE_ONE_FULL_CHUNKS)
+
+        raw = [sse async for sse in service.stream_workflow(title="AI创意工坊", stages_to_generate=[1])]
+        completes = [e["data"] for e in parse_sse(raw) if e["event"] == "stage_complete"]
+        assert completes[0]["autosaved"] is False
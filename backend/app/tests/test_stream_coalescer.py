@@ -0,0 +1,100 @@
+"""
+流式文本合并测试
+"""
+import asyncio
+import pytest
+
+from app.core.stream_coalescer import coalesce_stream
+
+
+async def token_stream(tokens, delay: float = 0.0):
+    """模拟LLM逐token输出"""
+    for token in tokens:
+        if delay:
+            await asyncio.sleep(delay)
+        yield token
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+class TestCoalesceStream:
+    """测试按时间/字节阈值合并"""
+
+    @pytest.mark.asyncio
+    async def test_flush_by_bytes(self):
+        """达到字节阈值时立即刷新，拼接结果不变"""
+        tokens = ["ab"] * 10
+        batches = await collect(
+            coalesce_stream(token_stream(tokens), flush_interval_ms=10_000, flush_bytes=6)
+        )
+
+        assert "".join(batches) == "ab" * 10
+        assert batches[:3] == ["ababab", "ababab", "ababab"]
+        assert len(batches) == 4
+
+    @pytest.mark.asyncio
+    async def test_multibyte_characters_count_as_utf8_bytes(self):
+        """中文按UTF-8字节计数（每字3字节）"""
+        batches = await collect(
+            coalesce_stream(token_stream(["理", "解", "迁", "移"]), flush_interval_ms=0, flush_bytes=6)
+        )
+
+        assert batches == ["理解", "迁移"]
+
+    @pytest.mark.asyncio
+    async def test_flush_by_time_when_upstream_stalls(self):
+        """上游停顿时，缓冲内容在时间窗口到期后刷新，而不是等待下一个token"""
+
+        async def stalled():
+            yield "第一段"
+            await asyncio.sleep(0.2)
+            yield "第二段"
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        stream = coalesce_stream(stalled(), flush_interval_ms=20, flush_bytes=10_000)
+
+        first = await stream.__anext__()
+        assert first == "第一段"
+        assert loop.time() - started < 0.15
+
+        rest = await collect(stream)
+        assert rest == ["第二段"]
+
+    @pytest.mark.asyncio
+    async def test_disabled_passthrough(self):
+        """两个阈值都<=0时原样透传"""
+        tokens = ["a", "b", "c"]
+        batches = await collect(
+            coalesce_stream(token_stream(tokens), flush_interval_ms=0, flush_bytes=0)
+        )
+
+        assert batches == tokens
+
+    @pytest.mark.asyncio
+    async def test_upstream_error_propagates(self):
+        """上游异常需要原样抛出，由调用方处理"""
+
+        async def failing():
+            yield "部分内容"
+            raise RuntimeError("upstream failed")
+
+        with pytest.raises(RuntimeError, match="upstream failed"):
+            await collect(coalesce_stream(failing(), flush_interval_ms=10_000, flush_bytes=10_000))
+
+    @pytest.mark.asyncio
+    async def test_buffer_flushed_before_upstream_error(self):
+        """上游出错前缓冲的文本不能丢失"""
+
+        async def failing():
+            yield "部分"
+            yield "内容"
+            raise RuntimeError("upstream failed")
+
+        batches = []
+        with pytest.raises(RuntimeError, match="upstream failed"):
+            async for batch in coalesce_stream(failing(), flush_interval_ms=10_000, flush_bytes=10_000):
+                batches.append(batch)
+        assert batches == ["部分内容"]
@@ -0,0 +1,242 @@
+"""
+token用量统计测试
+
+验证流末尾usage的解析、缺失时的本地估算、工作流事件中的用量，
+以及按课程的用量记录与汇总接口
+"""
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.agents.project_foundation_v3 import ProjectFoundationAgentV3
+from app.api.v1 import course as course_api
+from app.core.openai_client import OpenAIClient
+from app.core.token_usage import TokenUsage
+from app.models.conversation_message import CourseConversationMessage
+from app.models.course_project import CourseProject
+from app.models.llm_usage import LLMUsageRecord
+from app.services.stage_writer import StageWriter
+from app.services.usage_recorder import UsageRecorder, usage_summary_query
+from app.services.workflow_service_v3 import WorkflowServiceV3
+from app.tests.test_cancellation import FakeUpstream, chunk, patched_client
+from app.tests.test_workflow_service_v3 import (
+    STAGE_ONE_FULL_CHUNKS,
+    STAGE_TWO_FULL_CHUNKS,
+    FakeStreamAgent,
+    parse_sse,
+)
+
+TABLES = [CourseProject.__table__, CourseConversationMessage.__table__, LLMUsageRecord.__table__]
+
+
+class UsageStreamAgent(FakeStreamAgent):
+    """每次生成按固定值累加token用量的假Agent"""
+
+    def __init__(self, chunks, prompt_tokens, completion_tokens):
+        super().__init__(chunks)
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    async def generate_stream(self, *args, usage=None, **kwargs):
+        usage.add(self.prompt_tokens, self.completion_tokens)
+        async for event in super().generate_stream(*args, **kwargs):
+            yield event
+
+
+@pytest.fixture
+def session_factory():
+    """后台线程与测试共享同一个内存数据库"""
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    for table in TABLES:
+        table.create(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+@pytest.fixture
+async def async_session():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    async with engine.begin() as conn:
+        for table in TABLES:
+            await conn.run_sync(table.create)
+    factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    async with factory() as session:
+        yield session
+    await engine.dispose()
+
+
+class TestTokenUsage:
+    """测试用量累计与估算"""
+
+    def test_reported_usage_preferred(self):
+        usage = TokenUsage()
+        usage.add_request(
+            {"prompt_tokens": 100, "completion_tokens": 20, "cached_tokens": 64},
+            [{"role": "user", "content": "课程"}],
+            "输出",
+        )
+        assert usage.to_dict() == {
+            "prompt_tokens": 100,
+            "completion_tokens": 20,
+            "total_tokens": 120,
+            "cached_tokens": 64,
+            "calls": 1,
+            "estimated": False,
+        }
+
+    def test_missing_usage_estimated(self):
+        usage = TokenUsage()
+        usage.add_request(None, [{"role": "system", "content": "你是课程设计专家"}], "驱动性问题")
+        assert usage.prompt_tokens > 0
+        assert usage.completion_tokens > 0
+        assert usage.estimated is True
+
+    def test_total_merges_calls(self):
+        first, second = TokenUsage(), TokenUsage()
+        first.add(10, 5)
+        second.add(20, 5, estimated=True)
+        total = TokenUsage.total([first, second])
+        assert (total.total_tokens, total.calls, total.estimated) == (40, 2, True)
+
+
+class TestStreamUsage:
+    """测试流式调用的用量累计"""
+
+    @pytest.mark.asyncio
+    async def test_usage_chunk(self):
+        upstream = FakeUpstream(["第一段", "第二段"])
+
+        async def iterate():
+            for text in upstream.texts:
+                yield chunk(text)
+            yield SimpleNamespace(choices=[], usage={"prompt_tokens": 120, "completion_tokens": 7})
+
+        upstream._iterate = iterate
+        usage = TokenUsage()
+        with patched_client(upstream):
+            gen = OpenAIClient().generate_response_stream(prompt="课程", model="m", usage=usage)
+            assert [text async for text in gen] == upstream.texts
+
+        assert (usage.prompt_tokens, usage.completion_tokens, usage.calls) == (120, 7, 1)
+        assert usage.estimated is False
+
+    @pytest.mark.asyncio
+    async def test_cancelled_stream_estimated(self):
+        usage = TokenUsage()
+        with patched_client(FakeUpstream(["第一段内容"], hang=True)):
+            gen = OpenAIClient().generate_response_stream(prompt="课程", model="m", usage=usage)
+            await gen.__anext__()
+            await gen.aclose()
+
+        assert usage.calls == 1
+        assert usage.completion_tokens > 0
+        assert usage.estimated is True
+
+
+class TestWorkflowUsage:
+    """测试工作流事件中的用量与按课程记录"""
+
+    @pytest.mark.asyncio
+    async def test_stage_and_total_usage_recorded(self, session_factory):
+        db = session_factory()
+        course = CourseProject(title="AI创意工坊")
+        db.add(course)
+        db.commit()
+        course_id = course.id
+        db.close()
+
+        service = WorkflowServiceV3()
+        service.agent1 = UsageStreamAgent(STAGE_ONE_FULL_CHUNKS, 100, 20)
+        service.agent2 = UsageStreamAgent(STAGE_TWO_FULL_CHUNKS, 300, 40)
+        service.stage_writer = StageWriter(session_factory)
+        service.usage_recorder = UsageRecorder(session_factory)
+
+        raw = [sse async for sse in service.stream_workflow(
+            title="AI创意工坊", stages_to_generate=[1, 2], course_id=course_id
+        )]
+        await service.usage_recorder.close()
+        await service.stage_writer.close()
+
+        events = parse_sse(raw)
+        stage_usage = {e["data"]["stage"]: e["data"]["token_usage"] for e in events if e["event"] == "stage_complete"}
+        assert stage_usage[1]["total_tokens"] == 120
+        assert stage_usage[2]["total_tokens"] == 340
+        complete = [e for e in events if e["event"] == "complete"][0]
+        assert complete["data"]["token_usage"]["total_tokens"] == 460
+        assert complete["data"]["token_usage"]["calls"] == 2
+
+        db = session_factory()
+        records = db.scalars(select(LLMUsageRecord).order_by(LLMUsageRecord.stage)).all()
+        db.close()
+        assert [(r.operation, r.stage, r.prompt_tokens) for r in records] == [("generate", 1, 100), ("generate", 2, 300)]
+
+    @pytest.mark.asyncio
+    async def test_non_streaming_agent_returns_usage(self):
+        """非流式生成（批量任务使用）同样累计并返回token用量"""
+        response = SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="# 阶段一"))],
+            usage={"prompt_tokens": 150, "completion_tokens": 30},
+            model="m",
+        )
+        cache = MagicMock(get_async=AsyncMock(return_value=None), set_async=AsyncMock())
+        usage = TokenUsage()
+        with patched_client(response), \
+             patch("app.agents.project_foundation_v3.get_generation_cache", return_value=cache):
+            result = await ProjectFoundationAgentV3().generate("AI创意工坊", usage=usage)
+
+        assert result["success"] is True
+        assert (usage.prompt_tokens, usage.completion_tokens, usage.calls) == (150, 30, 1)
+        assert result["token_usage"]["total_tokens"] == 180
+
+    @pytest.mark.asyncio
+    async def test_without_calls_nothing_recorded(self, session_factory):
+        recorder = UsageRecorder(session_factory)
+        assert recorder.record(1, "chat", TokenUsage()) is False
+
+
+class TestUsageEndpoint:
+    """测试课程用量汇总接口"""
+
+    @pytest.mark.asyncio
+    async def test_summary_and_delete(self, async_session):
+        course = CourseProject(title="AI创意工坊")
+        async_session.add(course)
+        await async_session.commit()
+        async_session.add_all([
+            LLMUsageRecord(course_id=course.id, operation="generate", stage=1, model="m",
+                           prompt_tokens=100, completion_tokens=20, calls=1),
+            LLMUsageRecord(course_id=course.id, operation="generate", stage=1, model="m",
+                           prompt_tokens=100, completion_tokens=30, calls=2, estimated=True),
+            LLMUsageRecord(course_id=course.id, operation="chat", model="m",
+                           prompt_tokens=50, completion_tokens=10, calls=1),
+        ])
+        await async_session.commit()
+
+        summary = await course_api.get_course_usage(course.id, db=async_session)
+
+        assert summary["total"]["total_tokens"] == 310
+        assert summary["total"]["calls"] == 4
+        assert summary["total"]["estimated"] is True
+        by_key = {(row["operation"], row["stage"]): row for row in summary["by_operation"]}
+        assert by_key[("generate", 1)]["records"] == 2
+        assert by_key[("chat", None)]["estimated"] is False
+
+        await course_api.delete_course(course.id, db=async_session)
+        remaining = await async_session.scalars(select(LLMUsageRecord))
+        assert remaining.all() == []
+
+    def test_summary_query_portable_to_postgresql(self):
+        """PostgreSQL没有 max(boolean)：estimated 必须先转为整数再聚合"""
+        sql = str(usage_summary_query(1).compile(dialect=postgresql.dialect()))
+        assert "max(CAST(llm_usage_records.estimated AS INTEGER))" in sql
+        assert "max(llm_usage_records.estimated)" not in sql
@@ -0,0 +1,216 @@
+"""
+链路追踪测试
+
+使用内存导出器收集span，验证异步生成器span的父子关系、取消标记、
+HTTP响应头中的trace_id、数据库span与工作流start事件
+"""
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from opentelemetry import trace
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from sqlalchemy import create_engine, text
+
+from app.core import tracing as tracing_module
+from app.core.tracing import (
+    JsonLinesSpanExporter,
+    Tracing,
+    TracingMiddleware,
+    current_trace_id,
+    instrument_engine,
+    start_span,
+    trace_sse,
+    traced_stream,
+)
+from app.services.workflow_service_v3 import WorkflowServiceV3
+from app.tests.test_workflow_service_v3 import STAGE_ONE_CHUNKS, FakeStreamAgent, parse_sse
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    exporter = InMemorySpanExporter()
+    monkeypatch.setattr(tracing_module, "_tracing", Tracing(exporter, batch=False))
+    return exporter
+
+
+def by_name(exporter):
+    return {span.name: span for span in exporter.get_finished_spans()}
+
+
+@traced_stream("inner")
+async def inner_stream(n):
+    for i in range(n):
+        with start_span("inner.step", index=i):
+            pass
+        yield i
+
+
+@traced_stream("outer")
+async def outer_stream(n):
+    stream = inner_stream(n)
+    try:
+        async for item in stream:
+            yield item
+    finally:
+        await stream.aclose()
+
+
+class TestTracedStream:
+    """测试异步生成器span"""
+
+    @pytest.mark.asyncio
+    async def test_nested_generators_form_parent_chain(self, exporter):
+        with start_span("request") as request:
+            items = []
+            async for item in outer_stream(2):
+                # 两次拉取之间调用方的当前span不变
+                assert trace.get_current_span() is request
+                items.append(item)
+
+        assert items == [0, 1]
+        spans = by_name(exporter)
+        assert spans["outer"].parent.span_id == spans["request"].context.span_id
+        assert spans["inner"].parent.span_id == spans["outer"].context.span_id
+        assert spans["inner.step"].parent.span_id == spans["inner"].context.span_id
+        assert len({s.context.trace_id for s in exporter.get_finished_spans()}) == 1
+
+    @pytest.mark.asyncio
+    async def test_consumer_close_marks_cancelled_and_closes_inner(self, exporter):
+        stream = outer_stream(5)
+        assert await stream.__anext__() == 0
+        await stream.aclose()
+
+        spans = by_name(exporter)
+        assert spans["outer"].attributes["cancelled"] is True
+        assert spans["inner"].attributes["cancelled"] is True
+        assert spans["inner"].end_time is not None
+
+    @pytest.mark.asyncio
+    async def test_error_recorded_on_span(self, exporter):
+        @traced_stream("failing")
+        async def failing():
+            yield 1
+            raise ValueError("上游错误")
+
+        with pytest.raises(ValueError):
+            async for _ in failing():
+                pass
+
+        span = by_name(exporter)["failing"]
+        assert span.status.status_code == trace.StatusCode.ERROR
+        assert span.events[0].name == "exception"
+
+    @pytest.mark.asyncio
+    async def test_sse_flush_spans(self, exporter):
+        async def events():
+            yield 'data: {"event": "start", "data": {}}\n\n'
+            yield 'data: {"type": "chunk", "content": "文本"}\n\n'
+
+        assert [e async for e in trace_sse(events())]
+        flushes = [s for s in exporter.get_finished_spans() if s.name == "sse.flush"]
+        assert [s.attributes["sse.event"] for s in flushes] == ["start", "chunk"]
+        assert [s.attributes["sse.seq"] for s in flushes] == [1, 2]
+
+
+def traced_app():
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+
+    @app.get("/stream")
+    async def stream():
+        async def generate():
+            yield f"data: {json.dumps({'trace_id': current_trace_id()})}\n\n"
+        return StreamingResponse(trace_sse(generate()), media_type="text/event-stream")
+
+    return app
+
+
+class TestTracingMiddleware:
+    """测试请求根span与 X-Trace-Id 响应头"""
+
+    def test_trace_id_header_matches_stream(self, exporter):
+        response = TestClient(traced_app()).get("/stream")
+
+        trace_id = response.headers["X-Trace-Id"]
+        assert json.loads(response.text[len("data: "):])["trace_id"] == trace_id
+
+        spans = by_name(exporter)
+        root = spans["GET /stream"]
+        assert format(root.context.trace_id, "032x") == trace_id
+        assert root.attributes["http.status_code"] == 200
+        assert spans["sse.flush"].parent.span_id == root.context.span_id
+
+    def test_continues_incoming_traceparent(self, exporter):
+        trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+        response = TestClient(traced_app()).get(
+            "/stream", headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"}
+        )
+        assert response.headers["X-Trace-Id"] == trace_id
+
+    def test_disabled_tracing_omits_header(self, monkeypatch):
+        monkeypatch.setattr(tracing_module, "_tracing", Tracing(enabled=False))
+        response = TestClient(traced_app()).get("/stream")
+        assert "X-Trace-Id" not in response.headers
+
+
+class TestDatabaseSpans:
+    """测试SQLAlchemy查询span"""
+
+    def test_query_span_under_current_span(self, exporter):
+        engine = create_engine("sqlite://")
+        instrument_engine(engine)
+        instrument_engine(engine)  # 重复调用不重复注册
+
+        with start_span("request"):
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+
+        queries = [s for s in exporter.get_finished_spans() if s.name == "db SELECT"]
+        assert len(queries) == 1
+        assert queries[0].attributes["db.system"] == "sqlite"
+        assert queries[0].attributes["db.statement"] == "SELECT 1"
+        assert queries[0].parent.span_id == by_name(exporter)["request"].context.span_id
+
+
+class TestJsonLinesExporter:
+    """测试本地文件导出"""
+
+    def test_writes_one_span_per_line(self, tmp_path, monkeypatch):
+        path = tmp_path / "traces.jsonl"
+        tracing = Tracing(JsonLinesSpanExporter(str(path)), batch=False)
+        monkeypatch.setattr(tracing_module, "_tracing", tracing)
+
+        with start_span("parent"):
+            with start_span("child", **{"llm.model": "m"}):
+                pass
+
+        lines = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+        assert [line["name"] for line in lines] == ["child", "parent"]
+        assert lines[0]["parent_span_id"] == lines[1]["span_id"]
+        assert lines[0]["trace_id"] == lines[1]["trace_id"]
+        assert lines[0]["attributes"] == {"llm.model": "m"}
+        assert lines[1]["parent_span_id"] is None
+
+
+class TestWorkflowTrace:
+    """测试工作流的trace_id与span"""
+
+    @pytest.mark.asyncio
+    async def test_start_event_carries_trace_id(self, exporter):
+        service = WorkflowServiceV3()
+        service.agent1 = FakeStreamAgent(STAGE_ONE_CHUNKS)
+
+        with start_span("request"):
+            trace_id = current_trace_id()
+            raw = [sse async for sse in service.stream_workflow(title="测试课程", stages_to_generate=[1])]
+
+        events = parse_sse(raw)
+        assert events[0]["event"] == "start"
+        assert events[0]["data"]["trace_id"] == trace_id
+
+        spans = by_name(exporter)
+        assert spans["workflow.stream"].attributes["workflow.stages"] == (1,)
+        assert spans["admission.wait"].parent.span_id == spans["workflow.stream"].context.span_id
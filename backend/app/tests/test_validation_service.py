@@ -0,0 +1,101 @@
+"""
+语义验证服务测试
+
+使用假的编码模型替换sentence-transformers，验证参考向量的磁盘缓存与批量评分
+"""
+import hashlib
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from app.services.validation_service import BAD_U_EXAMPLES, GOOD_U_EXAMPLES, ValidationService
+
+
+class FakeEncoder:
+    """按文本哈希生成确定性向量，记录每次encode调用"""
+
+    def __init__(self, dimension: int = 16):
+        self.dimension = dimension
+        self.calls = []
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, normalize_embeddings=False, **kwargs):
+        self.calls.append(list(texts))
+        vectors = np.array([
+            np.frombuffer(hashlib.sha256(text.encode("utf-8")).digest()[: self.dimension], dtype=np.uint8)
+            .astype(np.float32) - 127.5
+            for text in texts
+        ])
+        if normalize_embeddings:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+
+def make_service(cache_dir, encoder, model_name="fake-model"):
+    service = ValidationService(model_name=model_name, cache_dir=str(cache_dir))
+    service.model = encoder
+    service._model_loaded = True
+    service._load_attempted = True
+    return service
+
+
+class TestReferenceEmbeddingCache:
+    """测试参考示例向量只计算一次并按模型版本缓存"""
+
+    def test_cached_on_disk_and_reused(self, tmp_path):
+        first = FakeEncoder()
+        make_service(tmp_path, first).validate_understanding("理解数据决定模型的公平性")
+        assert first.calls[0] == GOOD_U_EXAMPLES + BAD_U_EXAMPLES
+        assert len(list(tmp_path.glob("*.npz"))) == 1
+
+        second = FakeEncoder()
+        make_service(tmp_path, second).validate_understanding("理解数据决定模型的公平性")
+        assert second.calls == [["理解数据决定模型的公平性"]]
+
+    def test_model_version_changes_cache_key(self, tmp_path):
+        make_service(tmp_path, FakeEncoder()).warm_up()
+        make_service(tmp_path, FakeEncoder(), model_name="other-model").warm_up()
+        make_service(tmp_path, FakeEncoder(dimension=8)).warm_up()
+
+        assert len(list(tmp_path.glob("*.npz"))) == 3
+
+
+class TestBatchedScoring:
+    """测试整个Stage One只做一次批量编码"""
+
+    def test_stage_one_encodes_all_understandings_at_once(self, tmp_path):
+        encoder = FakeEncoder()
+        service = make_service(tmp_path, encoder)
+        service.warm_up()
+        encoder.calls.clear()
+
+        texts = ["理解AI是模式识别系统", "掌握Python语法", "认识到技术与伦理需要平衡"]
+        result = service.validate_stage_one({"understandings": [{"text": t} for t in texts]})
+
+        assert encoder.calls == [texts]
+        assert [v["text"] for v in result["understandings_validation"]] == texts
+
+    def test_vectorized_scores_match_per_text_cosine(self, tmp_path):
+        encoder = FakeEncoder()
+        service = make_service(tmp_path, encoder)
+        texts = ["理解AI是模式识别系统", "掌握Python语法"]
+
+        batched = service.score_understandings(texts)
+
+        for text, result in zip(texts, batched):
+            u = encoder.encode([text], normalize_embeddings=True)[0]
+            good = encoder.encode(GOOD_U_EXAMPLES, normalize_embeddings=True)
+            bad = encoder.encode(BAD_U_EXAMPLES, normalize_embeddings=True)
+            expected = (good @ u).mean() * 0.7 + (1 - (bad @ u).mean()) * 0.3
+            assert result["score"] == round(max(0.0, min(1.0, float(expected))), 2)
+
+    def test_unavailable_model_returns_neutral_scores(self, tmp_path):
+        service = ValidationService(cache_dir=str(tmp_path))
+        service._load_attempted = True  # 模拟未安装sentence-transformers
+
+        results = service.score_understandings(["a", "b"])
+        assert [r["score"] for r in results] == [0.5, 0.5]
+        assert service.warm_up() is False
@@ -0,0 +1,261 @@
+"""
+WorkflowServiceV3 单元测试
+
+使用假Agent替换真实LLM调用，验证SSE事件流的格式与行为
+"""
+import asyncio
+import json
+import pytest
+
+from app.services.workflow_service_v3 import (
+    WorkflowServiceV3,
+    STREAM_MODE_DELTA,
+    STREAM_MODE_FULL,
+)
+
+
+STAGE_ONE_CHUNKS = ["# 阶段一", "：确定预期", "学习结果\n\n", "## G: 迁移目标\n", "1. 学生能够", "独立完成项目"]
+
+
+STAGE_ONE_FULL_CHUNKS = [
+    "# 阶段一：确定预期学习结果\n\n",
+    "## G: 迁移目标\n1. 独立完成项目\n\n",
+    "## U: 持续理解\n- U1\n\n",
+    "## Q: 基本问题\n- Q1\n\n",
+    "## K: 学生应掌握的知识\n- K1\n\n",
+    "## S: 学生应形成的技能\n- S1\n",
+]
+
+STAGE_TWO_FULL_CHUNKS = [
+    "# 阶段二：确定可接受的证据\n\n",
+    "## 驱动性问题\n如何…？\n\n",
+    "## 表现性任务\n### 任务 1\n\n",
+    "## 其他评估证据\n- 观察\n",
+]
+
+
+class FakeStreamAgent:
+    """按固定chunk序列产生progress/complete事件的假Agent（模拟缓存未命中）"""
+
+    def __init__(self, chunks, delay: float = 0.0):
+        self.chunks = chunks
+        self.delay = delay
+        self.calls = []
+
+    async def generate_stream(self, *args, **kwargs):
+        self.calls.append(kwargs)
+        yield {"type": "llm_call"}
+        accumulated = ""
+        for chunk in self.chunks:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            accumulated += chunk
+            yield {
+                "type": "progress",
+                "content": accumulated,
+                "chunk": chunk,
+                "progress": 0.5,
+            }
+        yield {
+            "type": "complete",
+            "content": accumulated.strip(),
+            "progress": 1.0,
+            "generation_time": 0.01,
+            "model": "fake-model",
+        }
+
+
+class FakeSectionEditor:
+    """按给定章节补丁产生section/complete事件的假章节编辑器（文档中没有该标题时原样返回）"""
+
+    def __init__(self, patches=None):
+        self.patches = patches or {}
+        self.calls = []
+
+    async def edit_stream(self, stage, markdown, edit_instructions, **kwargs):
+        self.calls.append({"stage": stage, "markdown": markdown, "edit_instructions": edit_instructions, **kwargs})
+        yield {"type": "llm_call"}
+        sections = []
+        content = markdown
+        for index, (heading, patch) in sorted(self.patches.items()):
+            if heading not in markdown:
+                continue
+            section = {"index": index, "heading": heading, "code": None}
+            sections.append(section)
+            content = content.replace(heading, patch)
+            yield {"type": "section", **section, "markdown": patch}
+        yield {
+            "type": "complete",
+            "content": content,
+            "sections": sections,
+            "progress": 1.0,
+            "generation_time": 0.01,
+            "model": "fake-model",
+        }
+
+
+def parse_sse(raw_events):
+    """把SSE字符串解析为事件字典列表"""
+    return [json.loads(e[len("data: "):].strip()) for e in raw_events]
+
+
+@pytest.fixture
+def workflow_service():
+    service = WorkflowServiceV3()
+    service.agent1 = FakeStreamAgent(STAGE_ONE_CHUNKS)
+    return service
+
+
+async def collect(service, **kwargs):
+    raw = []
+    async for sse in service.stream_workflow(title="测试课程", stages_to_generate=[1], **kwargs):
+        raw.append(sse)
+    return parse_sse(raw)
+
+
+class TestStreamModes:
+    """测试progress事件的full/delta两种模式"""
+
+    @pytest.mark.asyncio
+    async def test_full_mode_carries_complete_preview(self, workflow_service):
+        """full模式：每个progress事件都携带完整的markdown_preview"""
+        events = await collect(workflow_service, stream_mode=STREAM_MODE_FULL)
+        progress = [e["data"] for e in events if e["event"] == "progress" and "seq" in e["data"]]
+
+        assert len(progress) == len(STAGE_ONE_CHUNKS)
+        assert progress[-1]["markdown_preview"] == "".join(STAGE_ONE_CHUNKS)
+        assert all("delta" not in p for p in progress)
+
+    @pytest.mark.asyncio
+    async def test_delta_mode_rebuilds_document_exactly(self, workflow_service):
+        """delta模式：客户端按规则重建的文档与完整内容一致，且定期收到快照"""
+        workflow_service.snapshot_interval = 4
+        events = await collect(workflow_service, stream_mode=STREAM_MODE_DELTA)
+        progress = [e["data"] for e in events if e["event"] == "progress" and "seq" in e["data"]]
+
+        assert [p["seq"] for p in progress] == list(range(1, len(STAGE_ONE_CHUNKS) + 1))
+
+        document = ""
+        for p in progress:
+            if p.get("snapshot"):
+                document = p["markdown_preview"]
+            else:
+                assert "markdown_preview" not in p
+                document += p["delta"]
+
+        assert document == "".join(STAGE_ONE_CHUNKS)
+        assert [p["seq"] for p in progress if p.get("snapshot")] == [4]
+
+    @pytest.mark.asyncio
+    async def test_delta_mode_announced_in_start_event(self, workflow_service):
+        """start事件中回显协商后的流式模式"""
+        events = await collect(workflow_service, stream_mode=STREAM_MODE_DELTA)
+
+        assert events[0]["event"] == "start"
+        assert events[0]["data"]["stream_mode"] == STREAM_MODE_DELTA
+        assert events[-1]["event"] == "complete"
+
+
+class TestPipelinedWorkflow:
+    """测试流水线模式"""
+
+    @pytest.fixture
+    def pipelined_service(self):
+        service = WorkflowServiceV3()
+        service.agent1 = FakeStreamAgent(STAGE_ONE_FULL_CHUNKS, delay=0.01)
+        service.agent2 = FakeStreamAgent(STAGE_TWO_FULL_CHUNKS, delay=0.01)
+        service.agent3 = FakeStreamAgent(["# 阶段三\n", "## Launch\n"], delay=0.01)
+        service.section_editor = FakeSectionEditor({1: ("## Launch", "## Launch\n- 观察记录")})
+        return service
+
+    async def run(self, service, **kwargs):
+        raw = []
+        async for sse in service.stream_workflow(title="测试课程", pipelined=True, **kwargs):
+            raw.append(sse)
+        return parse_sse(raw)
+
+    @pytest.mark.asyncio
+    async def test_stage_two_starts_after_guq(self, pipelined_service):
+        """Stage 2 在 Stage 1 完成之前启动，输入为G/U/Q前缀"""
+        events = await self.run(pipelined_service)
+        order = [(e["event"], e["data"].get("stage")) for e in events]
+
+        stage_two_first = next(i for i, o in enumerate(order) if o == ("progress", 2))
+        stage_one_done = order.index(("stage_complete", 1))
+        assert stage_two_first < stage_one_done
+
+        stage_one_input = pipelined_service.agent2.calls[0]["stage_one_data"]
+        assert "## Q: 基本问题" in stage_one_input
+        assert "## K" not in stage_one_input
+
+    @pytest.mark.asyncio
+    async def test_all_stages_complete_with_partial_flags(self, pipelined_service):
+        """三个阶段全部完成，提前启动的阶段标记upstream_partial"""
+        events = await self.run(pipelined_service)
+        completes = {e["data"]["stage"]: e["data"] for e in events if e["event"] == "stage_complete"}
+
+        assert set(completes) == {1, 2, 3}
+        # Stage 2/3 草稿基于上游前缀，已按完整的上游校准
+        for stage in (2, 3):
+            assert completes[stage]["upstream_partial"] is False
+            assert completes[stage]["reconciled"] is True
+        assert completes[1]["markdown"] == "".join(STAGE_ONE_FULL_CHUNKS).strip()
+        assert events[-1]["event"] == "complete"
+
+        stage_three_call = pipelined_service.agent3.calls[0]
+        assert stage_three_call["stage_one_data"] == completes[1]["markdown"]
+        assert "## 其他评估" not in stage_three_call["stage_two_data"]
+
+    @pytest.mark.asyncio
+    async def test_stage_three_draft_reconciled_with_full_stage_two(self, pipelined_service):
+        """基于Stage 2前缀的Stage 3草稿在Stage 2完成后校准，stage_complete带校准后的文档"""
+        events = await self.run(pipelined_service)
+        order = [(e["event"], e["data"].get("stage")) for e in events]
+        completes = {e["data"]["stage"]: e["data"] for e in events if e["event"] == "stage_complete"}
+
+        reconcile_call = next(c for c in pipelined_service.section_editor.calls if c["stage"] == 3)
+        assert reconcile_call["markdown"] == "# 阶段三\n## Launch"
+        assert completes[2]["markdown"] in reconcile_call["edit_instructions"]
+
+        assert order.index(("stage_complete", 2)) < order.index(("stage_complete", 3))
+        patches = [e["data"] for e in events if e["event"] == "section_patch"]
+        assert [(p["stage"], p["index"]) for p in patches] == [(3, 1)]
+        assert completes[3]["markdown"] == "# 阶段三\n## Launch\n- 观察记录"
+        assert completes[3]["patched_sections"][0]["index"] == 1
+
+    @pytest.mark.asyncio
+    async def test_stage_two_draft_reconciled_with_full_stage_one(self, pipelined_service):
+        """基于G/U/Q前缀的Stage 2草稿在Stage 1完成后按完整的Stage 1（含K/S）校准"""
+        events = await self.run(pipelined_service)
+        order = [(e["event"], e["data"].get("stage")) for e in events]
+        completes = {e["data"]["stage"]: e["data"] for e in events if e["event"] == "stage_complete"}
+
+        reconcile_call = next(c for c in pipelined_service.section_editor.calls if c["stage"] == 2)
+        assert reconcile_call["markdown"] == "".join(STAGE_TWO_FULL_CHUNKS).strip()
+        assert completes[1]["markdown"] in reconcile_call["edit_instructions"]
+        assert "## K" in reconcile_call["edit_instructions"]
+        assert order.index(("stage_complete", 1)) < order.index(("stage_complete", 2))
+
+    @pytest.mark.asyncio
+    async def test_no_reconcile_with_full_stage_two(self, pipelined_service):
+        """Stage 3 以完整的 Stage 2 启动时不需要校准"""
+        stage_two = "".join(STAGE_TWO_FULL_CHUNKS).strip()
+        events = await self.run(
+            pipelined_service, stages_to_generate=[3],
+            stage_one_data="".join(STAGE_ONE_FULL_CHUNKS).strip(), stage_two_data=stage_two,
+        )
+        completes = {e["data"]["stage"]: e["data"] for e in events if e["event"] == "stage_complete"}
+
+        assert pipelined_service.section_editor.calls == []
+        assert completes[3]["upstream_partial"] is False
+        assert "reconciled" not in completes[3]
+
+    @pytest.mark.asyncio
+    async def test_falls_back_to_full_upstream_without_marker(self, pipelined_service):
+        """上游没有提前启动标志时，等上游完成后再以完整数据启动"""
+        pipelined_service.agent1 = FakeStreamAgent(STAGE_ONE_CHUNKS)
+        events = await self.run(pipelined_service, stages_to_generate=[1, 2])
+        completes = {e["data"]["stage"]: e["data"] for e in events if e["event"] == "stage_complete"}
+
+        assert completes[2]["upstream_partial"] is False
+        assert pipelined_service.agent2.calls[0]["stage_one_data"] == completes[1]["markdown"]
@@ -0,0 +1,13 @@
+"""
+CPU侧热点路径的微基准测试（pytest-benchmark）
+
+覆盖 SSE 事件格式化、Agent逐chunk的进度事件路径、对话系统提示词构建与Markdown导出，
+夹具课程取自 docs/UBD最佳实践教案案例一.md。
+
+    pip install -e ".[bench]"
+    python -m pytest benchmarks --benchmark-json=/tmp/bench.json
+    python -m benchmarks.compare /tmp/bench.json               # 与 benchmarks/baseline.json 对比，回归超过阈值时退出码为1
+    python -m benchmarks.compare /tmp/bench.json --update      # 接受当前结果为新的基线
+
+默认比较每个基准的最小耗时（受机器噪声影响最小）。基线与机器相关，更新基线时请在同一台机器上运行。
+"""
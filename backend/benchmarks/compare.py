@@ -0,0 +1,134 @@
+"""
+基准结果对比
+
+读取 pytest-benchmark 的 --benchmark-json 输出，与仓库中的基线逐项比较，
+指定统计量（默认最小值，受机器噪声影响最小）变慢超过阈值时标记为回归并以退出码1结束。
+
+    python -m benchmarks.compare /tmp/bench.json --threshold 0.2
+    python -m benchmarks.compare /tmp/bench.json --update
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+DEFAULT_THRESHOLD = 0.25
+STATS = ("min", "median", "mean")
+
+
+def load_results(path: Path) -> Dict[str, Dict[str, float]]:
+    """读取基准结果，返回 {基准名: {统计量: 秒}}；兼容完整输出与精简后的基线"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    results = {}
+    for bench in data.get("benchmarks", []):
+        name = bench.get("fullname") or bench["name"]
+        results[name] = {stat: bench["stats"][stat] for stat in STATS if stat in bench["stats"]}
+    return results
+
+
+def slim_baseline(path: Path) -> Dict[str, Any]:
+    """只保留对比需要的字段，减小基线文件的diff"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    machine = data.get("machine_info", {})
+    return {
+        "machine_info": {
+            "python_version": machine.get("python_version"),
+            "processor": machine.get("processor"),
+            "cpu": (machine.get("cpu") or {}).get("brand_raw"),
+        },
+        "datetime": data.get("datetime"),
+        "benchmarks": [
+            {
+                "fullname": bench.get("fullname") or bench["name"],
+                "stats": {stat: bench["stats"][stat] for stat in STATS + ("rounds",) if stat in bench["stats"]},
+            }
+            for bench in data.get("benchmarks", [])
+        ],
+    }
+
+
+def compare(
+    baseline: Dict[str, Dict[str, float]],
+    current: Dict[str, Dict[str, float]],
+    threshold: float = DEFAULT_THRESHOLD,
+    stat: str = "min",
+) -> List[Dict[str, Any]]:
+    """
+    逐项对比，返回每个基准的结果行
+
+    status: regression（变慢超过阈值）/ improved（变快超过阈值）/ ok / new / missing
+    """
+    rows = []
+    for name in sorted(set(baseline) | set(current)):
+        before = baseline.get(name, {}).get(stat)
+        after = current.get(name, {}).get(stat)
+        row: Dict[str, Any] = {"name": name, "baseline": before, "current": after, "change": None}
+        if before is None:
+            row["status"] = "new"
+        elif after is None:
+            row["status"] = "missing"
+        else:
+            change = (after - before) / before if before > 0 else 0.0
+            row["change"] = change
+            if change > threshold:
+                row["status"] = "regression"
+            elif change < -threshold:
+                row["status"] = "improved"
+            else:
+                row["status"] = "ok"
+        rows.append(row)
+    return rows
+
+
+def _format_time(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.2f}ms"
+    return f"{seconds * 1e6:.1f}us"
+
+
+def format_rows(rows: List[Dict[str, Any]], stat: str, threshold: float) -> str:
+    width = max([len(r["name"]) for r in rows] + [4])
+    lines = [f"{'基准'.ljust(width)}  {'基线':>10}  {'当前':>10}  {'变化':>8}  状态（{stat}，阈值 {threshold:.0%}）"]
+    for row in rows:
+        change = f"{row['change']:+.1%}" if row["change"] is not None else "-"
+        lines.append(
+            f"{row['name'].ljust(width)}  {_format_time(row['baseline']):>10}  "
+            f"{_format_time(row['current']):>10}  {change:>8}  {row['status']}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """命令行入口：python -m benchmarks.compare"""
+    parser = argparse.ArgumentParser(description="对比基准结果与基线，标记性能回归")
+    parser.add_argument("current", type=Path, help="pytest --benchmark-json 的输出文件")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="回归阈值（0.25 = 慢25%%）")
+    parser.add_argument("--stat", choices=STATS, default="min")
+    parser.add_argument("--update", action="store_true", help="将当前结果写为新的基线")
+    args = parser.parse_args(argv)
+
+    if args.update:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(slim_baseline(args.current), f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"基线已更新: {args.baseline}")
+        return 0
+
+    rows = compare(load_results(args.baseline), load_results(args.current), args.threshold, args.stat)
+    print(format_rows(rows, args.stat, args.threshold))
+    regressions = [r for r in rows if r["status"] == "regression"]
+    if regressions:
+        print(f"\n{len(regressions)} 个基准回归超过 {args.threshold:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,45 @@
+"""
+基准测试夹具：由教案案例构建的课程
+"""
+import os
+import sys
+
+import pytest
+
+backend_path = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if backend_path not in sys.path:
+    sys.path.insert(0, backend_path)
+
+# 导入 app.core.config 需要API Key，基准测试不会访问LLM
+os.environ.setdefault("PBL_AI_API_KEY", "benchmark")
+
+from loadtest.mock_llm_server import load_canned_markdown  # noqa: E402
+
+COURSE_INFO = {
+    "title": "用技术改变世界",
+    "subject": "信息科技",
+    "grade_level": "初二",
+    "total_class_hours": 12,
+    "schedule_description": "共4周，每周1次，一次半天3个小时",
+    "description": "学生结合AI工具识别身边的问题并设计解决方案",
+}
+
+
+def build_course(scale: int = 1) -> dict:
+    """
+    案例教案的三个阶段；scale>1时重复章节模拟更长的课程
+    """
+    canned = load_canned_markdown()
+    stages = {}
+    for step, key in ((1, "stage1"), (2, "stage2"), (3, "stage3")):
+        text = canned[key]
+        stages[step] = text + "".join(
+            f"\n\n## 扩展单元{i}\n\n" + text.split("\n", 1)[1] for i in range(1, scale)
+        )
+    return {"course_info": dict(COURSE_INFO), "stages": stages}
+
+
+@pytest.fixture(scope="session", params=[1, 4], ids=["case", "case_x4"])
+def course(request):
+    """原始案例与4倍长度的课程"""
+    return build_course(request.param)
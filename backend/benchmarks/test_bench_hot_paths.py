@@ -0,0 +1,146 @@
+"""
+CPU侧热点路径基准
+
+LLM流由固定token序列代替，只测量本服务自身的处理开销。
+"""
+import asyncio
+
+import pytest
+
+from app.agents import project_foundation_v3
+from app.agents.course_chat_agent import CourseChatAgent
+from app.agents.project_foundation_v3 import ProjectFoundationAgentV3
+from app.core.generation_cache import GenerationCache
+from app.core.openai_client import openai_client
+from app.core.prompt_cache import PromptPrefixCache
+from app.services.export_service import ExportService
+from app.services.workflow_service_v3 import STREAM_MODE_DELTA, STREAM_MODE_FULL, WorkflowServiceV3
+
+TOKEN_CHARS = 3  # 中文模型单个token约1-3个字符
+
+
+def tokenize(text: str):
+    return [text[i:i + TOKEN_CHARS] for i in range(0, len(text), TOKEN_CHARS)]
+
+
+@pytest.fixture(scope="module")
+def workflow_service():
+    return WorkflowServiceV3()
+
+
+class TestFormatSSE:
+    """WorkflowServiceV3 的SSE事件格式化"""
+
+    def test_format_sse_stage_complete(self, benchmark, workflow_service, course):
+        event = {
+            "event": "stage_complete",
+            "data": {"stage": 1, "markdown": course["stages"][1], "generation_time": 12.3},
+        }
+        benchmark(workflow_service._format_sse, event)
+
+    @pytest.mark.parametrize("stream_mode", [STREAM_MODE_FULL, STREAM_MODE_DELTA])
+    def test_format_progress_stream(self, benchmark, workflow_service, course, stream_mode):
+        """一个阶段全部progress事件的格式化（full模式每次携带累计文档）"""
+        text = course["stages"][1]
+        events = []
+        content = ""
+        for chunk in tokenize(text):
+            content += chunk
+            events.append({"content": content, "chunk": chunk, "progress": min(len(content) / 2000, 0.99)})
+
+        def run():
+            for seq, event in enumerate(events, start=1):
+                workflow_service._format_progress_sse(1, event, seq, stream_mode)
+
+        benchmark(run)
+
+
+class TestAgentProgressPath:
+    """Agent逐chunk的累积、进度估算与事件产出（含增量合并）"""
+
+    def test_stage_one_generate_stream(self, benchmark, monkeypatch, course):
+        tokens = tokenize(course["stages"][1])
+
+        async def fake_stream(**kwargs):
+            for token in tokens:
+                yield token
+
+        monkeypatch.setattr(openai_client, "generate_response_stream", fake_stream)
+        monkeypatch.setattr(
+            project_foundation_v3, "get_generation_cache", lambda: GenerationCache(enabled=False)
+        )
+        agent = ProjectFoundationAgentV3()
+        info = course["course_info"]
+
+        async def drain():
+            count = 0
+            async for event in agent.generate_stream(
+                title=info["title"],
+                subject=info["subject"],
+                grade_level=info["grade_level"],
+                total_class_hours=info["total_class_hours"],
+                schedule_description=info["schedule_description"],
+                description=info["description"],
+                use_cache=False,
+            ):
+                count += 1
+            return count
+
+        loop = asyncio.new_event_loop()
+        try:
+            events = benchmark(lambda: loop.run_until_complete(drain()))
+        finally:
+            loop.close()
+        assert events > 1
+
+
+class TestChatPromptBuilding:
+    """CourseChatAgent 系统提示词构建"""
+
+    @pytest.fixture
+    def agent(self):
+        return CourseChatAgent(api_key="benchmark")
+
+    def test_build_system_prompt_cold(self, benchmark, agent, course):
+        """前缀缓存未命中：每轮使用新的缓存"""
+        stages = course["stages"]
+
+        def run():
+            agent.prefix_cache = PromptPrefixCache()
+            return agent._build_system_prompt(
+                current_step=2,
+                course_info=course["course_info"],
+                stage_one_data=stages[1],
+                stage_two_data=stages[2],
+                stage_three_data=stages[3],
+            )
+
+        benchmark(run)
+
+    def test_build_system_prompt_warm(self, benchmark, agent, course):
+        """同一课程连续对话：前缀缓存命中"""
+        stages = course["stages"]
+        benchmark(
+            agent._build_system_prompt,
+            current_step=2,
+            course_info=course["course_info"],
+            stage_one_data=stages[1],
+            stage_two_data=stages[2],
+            stage_three_data=stages[3],
+        )
+
+
+class TestExport:
+    """ExportService 完整课程导出"""
+
+    def test_export_for_download(self, benchmark, course):
+        service = ExportService()
+        stages = course["stages"]
+        filename, content = benchmark(
+            service.export_for_download,
+            stage_one_data=stages[1],
+            stage_two_data=stages[2],
+            stage_three_data=stages[3],
+            course_info=course["course_info"],
+        )
+        assert filename.endswith("_完整版.md")
@@ -0,0 +1,11 @@
+"""
+离线压测工具
+
+- mock_llm_server: OpenAI兼容的流式模拟服务（可配置TTFT、token速率、错误注入，返回固定Markdown）
+- driver: 以N并发压测 /api/v1/workflow/stream 与 /api/v1/chat/stream，统计TTFT/块间延迟/吞吐与服务端CPU/RSS
+
+典型用法：
+    python -m loadtest.mock_llm_server --port 9100 --ttft 0.5 --tokens-per-second 80
+    PBL_AI_BASE_URL=http://127.0.0.1:9100/v1 PBL_AI_API_KEY=mock uvicorn app.main:app --port 8000
+    python -m loadtest.driver --base-url http://127.0.0.1:8000 --scenario mixed --concurrency 8 --requests 40 --server-pid <uvicorn pid>
+"""
@@ -0,0 +1,436 @@
+"""
+生成流水线压测驱动
+
+以N并发请求 /api/v1/workflow/stream 与 /api/v1/chat/stream，统计：
+- TTFT：发出请求到收到第一个内容事件（workflow的progress / chat的chunk）
+- 块间延迟：相邻内容事件的时间间隔
+- 吞吐：请求/秒、内容字符/秒
+- 服务端CPU/RSS：指定 --server-pid 时按固定间隔采样（优先psutil，否则读取/proc）
+
+用法：
+    python -m loadtest.driver --base-url http://127.0.0.1:8000 --scenario mixed \\
+        --concurrency 8 --requests 40 --server-pid 12345 --json report.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+SCENARIO_WORKFLOW = "workflow"
+SCENARIO_CHAT = "chat"
+SCENARIO_MIXED = "mixed"
+
+
+@dataclass
+class RequestResult:
+    """单个流式请求的测量结果（时间单位：秒）"""
+
+    scenario: str
+    ok: bool = False
+    status_code: Optional[int] = None
+    error: Optional[str] = None
+    ttft: Optional[float] = None
+    gaps: List[float] = field(default_factory=list)
+    duration: float = 0.0
+    chunks: int = 0
+    chars: int = 0
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """线性插值百分位数，pct取0-100"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(values: List[float]) -> Dict[str, Any]:
+    """秒 -> 毫秒的分布摘要"""
+    if not values:
+        return {"count": 0}
+    ms = [v * 1000 for v in values]
+    return {
+        "count": len(ms),
+        "p50": round(percentile(ms, 50), 1),
+        "p95": round(percentile(ms, 95), 1),
+        "p99": round(percentile(ms, 99), 1),
+        "mean": round(sum(ms) / len(ms), 1),
+        "max": round(max(ms), 1),
+    }
+
+
+# ========== 服务端资源采样 ==========
+
+def read_process_stats(pid: int) -> Optional[Tuple[float, int]]:
+    """返回进程累计CPU秒数与RSS字节数；进程不存在时返回None"""
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            times = process.cpu_times()
+            return times.user + times.system, process.memory_info().rss
+        except psutil.Error:
+            return None
+
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # comm字段可能含空格，从最后一个')'之后开始切分
+            stat = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu_seconds = (int(stat[11]) + int(stat[12])) / ticks  # utime + stime
+    return cpu_seconds, resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class ProcessSampler:
+    """后台按间隔采样服务进程的CPU占用与RSS"""
+
+    def __init__(self, pid: int, interval: float = 0.5, reader: Callable = read_process_stats):
+        self.pid = pid
+        self.interval = interval
+        self.reader = reader
+        self.cpu_percent: List[float] = []
+        self.rss: List[int] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        previous = self.reader(self.pid)
+        previous_at = time.perf_counter()
+        while True:
+            await asyncio.sleep(self.interval)
+            current = self.reader(self.pid)
+            now = time.perf_counter()
+            if current is None or previous is None:
+                previous, previous_at = current, now
+                continue
+            elapsed = now - previous_at
+            if elapsed > 0:
+                self.cpu_percent.append((current[0] - previous[0]) / elapsed * 100)
+            self.rss.append(current[1])
+            previous, previous_at = current, now
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def report(self) -> Dict[str, Any]:
+        if not self.rss:
+            return {"pid": self.pid, "samples": 0}
+        mb = 1024 * 1024
+        return {
+            "pid": self.pid,
+            "samples": len(self.rss),
+            "cpu_percent_mean": round(sum(self.cpu_percent) / len(self.cpu_percent), 1) if self.cpu_percent else None,
+            "cpu_percent_max": round(max(self.cpu_percent), 1) if self.cpu_percent else None,
+            "rss_mb_start": round(self.rss[0] / mb, 1),
+            "rss_mb_max": round(max(self.rss) / mb, 1),
+            "rss_mb_end": round(self.rss[-1] / mb, 1),
+        }
+
+
+# ========== 流式请求 ==========
+
+async def iter_sse_events(response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+    """解析 "data: {...}" 格式的SSE帧"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data: "):
+            continue
+        try:
+            yield json.loads(line[6:])
+        except json.JSONDecodeError:
+            continue
+
+
+class _WorkflowContent:
+    """
+    workflow流的内容事件：带delta或markdown_preview的progress事件
+
+    阶段开始时的progress事件只有提示文字，不计为内容。full模式下markdown_preview
+    是累计文档，按阶段记录长度只统计新增字符。
+    """
+
+    def __init__(self):
+        self.lengths: Dict[Any, int] = {}
+
+    def __call__(self, event: Dict[str, Any]) -> Optional[int]:
+        if event.get("event") != "progress":
+            return None
+        data = event.get("data") or {}
+        stage = data.get("stage")
+        if "delta" in data:
+            self.lengths[stage] = self.lengths.get(stage, 0) + len(data["delta"])
+            return len(data["delta"])
+        if "markdown_preview" in data:
+            length = len(data["markdown_preview"])
+            added = max(0, length - self.lengths.get(stage, 0))
+            self.lengths[stage] = length
+            return added
+        return None
+
+
+def _chat_content(event: Dict[str, Any]) -> Optional[int]:
+    return len(event.get("content", "")) if event.get("type") == "chunk" else None
+
+
+async def measure_stream(
+    client: httpx.AsyncClient,
+    scenario: str,
+    path: str,
+    payload: Dict[str, Any],
+) -> RequestResult:
+    """发起一个SSE请求并记录TTFT、块间延迟与结束状态"""
+    result = RequestResult(scenario=scenario)
+    is_chat = scenario == SCENARIO_CHAT
+    content_of = _chat_content if is_chat else _WorkflowContent()
+    started = time.perf_counter()
+    last_chunk_at = None
+    try:
+        async with client.stream("POST", path, json=payload) as response:
+            result.status_code = response.status_code
+            if response.status_code != 200:
+                result.error = f"HTTP {response.status_code}"
+                await response.aread()
+                return result
+            async for event in iter_sse_events(response):
+                now = time.perf_counter()
+                chars = content_of(event)
+                if chars is not None:
+                    if last_chunk_at is None:
+                        result.ttft = now - started
+                    else:
+                        result.gaps.append(now - last_chunk_at)
+                    last_chunk_at = now
+                    result.chunks += 1
+                    result.chars += chars
+                    continue
+                kind = event.get("type") if is_chat else event.get("event")
+                if kind == "error":
+                    data = event if is_chat else (event.get("data") or {})
+                    result.error = str(data.get("message") or data.get("error") or "error event")
+                elif kind in ("done", "complete"):
+                    result.ok = result.error is None
+    except httpx.HTTPError as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        result.duration = time.perf_counter() - started
+    if not result.ok and result.error is None:
+        result.error = "stream ended without completion event"
+    return result
+
+
+def workflow_payload(index: int, stream_mode: str = "full") -> Dict[str, Any]:
+    """每个请求使用不同课程名并关闭生成缓存，确保真正经过LLM调用路径"""
+    return {
+        "title": f"压测课程{index}",
+        "subject": "信息科技",
+        "grade_level": "初二",
+        "total_class_hours": 12,
+        "description": "用AI解决社区真实问题",
+        "use_cache": False,
+        "stream_mode": stream_mode,
+    }
+
+
+def chat_payload(course_id: int, index: int) -> Dict[str, Any]:
+    return {
+        "course_id": course_id,
+        "message": f"请帮我把第{index % 3 + 1}条持续理解改得更具体一些",
+        "current_step": 1,
+        "conversation_history": [],
+    }
+
+
+async def create_chat_course(client: httpx.AsyncClient) -> int:
+    """对话压测需要一门已存在的课程"""
+    response = await client.post("/api/v1/courses", json={
+        "title": "压测对话课程",
+        "subject": "信息科技",
+        "grade_level": "初二",
+        "total_class_hours": 12,
+    })
+    response.raise_for_status()
+    return response.json()["id"]
+
+
+def _scenario_for(scenario: str, index: int) -> str:
+    if scenario == SCENARIO_MIXED:
+        return SCENARIO_CHAT if index % 2 else SCENARIO_WORKFLOW
+    return scenario
+
+
+async def run_load(
+    base_url: str,
+    scenario: str = SCENARIO_WORKFLOW,
+    concurrency: int = 4,
+    requests: int = 20,
+    server_pid: Optional[int] = None,
+    course_id: Optional[int] = None,
+    stream_mode: str = "full",
+    timeout: float = 600.0,
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+) -> Dict[str, Any]:
+    """
+    以固定并发执行压测并返回报告
+
+    Args:
+        transport: 测试时注入ASGITransport直接压测应用对象
+    """
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=httpx.Timeout(timeout), limits=limits, transport=transport
+    ) as client:
+        if course_id is None and scenario in (SCENARIO_CHAT, SCENARIO_MIXED):
+            course_id = await create_chat_course(client)
+
+        sampler = ProcessSampler(server_pid) if server_pid else None
+        if sampler:
+            sampler.start()
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for index in range(requests):
+            queue.put_nowait(index)
+        results: List[RequestResult] = []
+
+        async def worker() -> None:
+            while True:
+                try:
+                    index = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                kind = _scenario_for(scenario, index)
+                if kind == SCENARIO_CHAT:
+                    result = await measure_stream(client, kind, "/api/v1/chat/stream", chat_payload(course_id, index))
+                else:
+                    result = await measure_stream(
+                        client, kind, "/api/v1/workflow/stream", workflow_payload(index, stream_mode)
+                    )
+                results.append(result)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        wall_time = time.perf_counter() - started
+
+        if sampler:
+            await sampler.stop()
+
+    return build_report(results, wall_time, concurrency, sampler.report() if sampler else None)
+
+
+def build_report(
+    results: List[RequestResult],
+    wall_time: float,
+    concurrency: int,
+    server: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """按场景汇总测量结果"""
+    scenarios: Dict[str, Any] = {}
+    for name in sorted({r.scenario for r in results}):
+        group = [r for r in results if r.scenario == name]
+        ok = [r for r in group if r.ok]
+        errors: Dict[str, int] = {}
+        for r in group:
+            if not r.ok:
+                errors[r.error] = errors.get(r.error, 0) + 1
+        scenarios[name] = {
+            "requests": len(group),
+            "succeeded": len(ok),
+            "failed": len(group) - len(ok),
+            "errors": errors,
+            "ttft_ms": summarize([r.ttft for r in group if r.ttft is not None]),
+            "inter_chunk_ms": summarize([gap for r in group for gap in r.gaps]),
+            "duration_ms": summarize([r.duration for r in ok]),
+        }
+
+    completed = sum(1 for r in results if r.ok)
+    chars = sum(r.chars for r in results)
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "wall_time_s": round(wall_time, 2),
+        "throughput": {
+            "requests_per_s": round(completed / wall_time, 2) if wall_time > 0 else None,
+            "chunks_per_s": round(sum(r.chunks for r in results) / wall_time, 1) if wall_time > 0 else None,
+            "chars_per_s": round(chars / wall_time, 1) if wall_time > 0 else None,
+        },
+        "scenarios": scenarios,
+        "server": server,
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """人类可读的报告文本"""
+    lines = [
+        f"并发 {report['concurrency']}，请求 {report['requests']}，耗时 {report['wall_time_s']}s",
+        "吞吐: {requests_per_s} req/s, {chunks_per_s} chunks/s, {chars_per_s} chars/s".format(**report["throughput"]),
+    ]
+    for name, stats in report["scenarios"].items():
+        lines.append(f"\n[{name}] 成功 {stats['succeeded']}/{stats['requests']}")
+        for label, key in (("TTFT", "ttft_ms"), ("块间延迟", "inter_chunk_ms"), ("总时长", "duration_ms")):
+            s = stats[key]
+            if s["count"]:
+                lines.append(f"  {label}(ms): p50={s['p50']} p95={s['p95']} p99={s['p99']} max={s['max']} n={s['count']}")
+        for error, count in stats["errors"].items():
+            lines.append(f"  错误 x{count}: {error}")
+    server = report.get("server")
+    if server and server.get("samples"):
+        lines.append(
+            f"\n服务端 pid={server['pid']}: CPU 平均 {server['cpu_percent_mean']}% 峰值 {server['cpu_percent_max']}%, "
+            f"RSS {server['rss_mb_start']} -> {server['rss_mb_end']} MB（峰值 {server['rss_mb_max']} MB）"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """命令行入口：python -m loadtest.driver"""
+    parser = argparse.ArgumentParser(description="压测 workflow/chat 流式接口")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--scenario", choices=[SCENARIO_WORKFLOW, SCENARIO_CHAT, SCENARIO_MIXED], default=SCENARIO_WORKFLOW)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--server-pid", type=int, default=None, help="被测服务进程ID，用于采样CPU/RSS")
+    parser.add_argument("--course-id", type=int, default=None, help="对话压测使用的课程（默认自动创建）")
+    parser.add_argument("--stream-mode", choices=["full", "delta"], default="full")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--json", dest="json_path", default=None, help="将报告写入JSON文件")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_load(
+        base_url=args.base_url,
+        scenario=args.scenario,
+        concurrency=args.concurrency,
+        requests=args.requests,
+        server_pid=args.server_pid,
+        course_id=args.course_id,
+        stream_mode=args.stream_mode,
+        timeout=args.timeout,
+    ))
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+"""
+OpenAI兼容的模拟LLM服务
+
+不调用真实模型，按配置的首token延迟（TTFT）与token速率流式返回固定的UbD教案Markdown，
+用于测量本服务自身的开销与回归。支持错误注入：500、429与流中途断开。
+
+根据system prompt识别调用方，返回对应内容：
+- Stage 1/2/3 Agent：docs/UBD最佳实践教案案例一.md 中对应阶段的Markdown
+- The Editor：回显用户消息中的第一个 "@@ N" 章节（局部修改补丁）
+- 对话Agent：一段简短回复
+
+启动：
+    python -m loadtest.mock_llm_server --port 9100 --ttft 0.5 --tokens-per-second 80 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+import uuid
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DOCS_PATH = Path(__file__).resolve().parents[2] / "docs" / "UBD最佳实践教案案例一.md"
+
+KIND_STAGE_ONE = "stage1"
+KIND_STAGE_TWO = "stage2"
+KIND_STAGE_THREE = "stage3"
+KIND_EDITOR = "editor"
+KIND_CHAT = "chat"
+
+# system prompt 中的角色标识 -> 调用方
+_KIND_MARKERS = (
+    ('"The Assessor"', KIND_STAGE_TWO),
+    ('"Genesis Two"', KIND_STAGE_TWO),
+    ("创世二号", KIND_STAGE_TWO),
+    ('"The Planner"', KIND_STAGE_THREE),
+    ('"Genesis Three"', KIND_STAGE_THREE),
+    ("创世三号", KIND_STAGE_THREE),
+    ('"The Editor"', KIND_EDITOR),
+    ('"Genesis One"', KIND_STAGE_ONE),
+    ('"The Strategist"', KIND_STAGE_ONE),
+    ("创世一号", KIND_STAGE_ONE),
+    ("资深的课程设计专家", KIND_CHAT),
+)
+
+_STAGE_HEADINGS = {
+    KIND_STAGE_ONE: "# 阶段一",
+    KIND_STAGE_TWO: "# 阶段二",
+    KIND_STAGE_THREE: "# 阶段三",
+}
+
+_FALLBACK_MARKDOWN = {
+    KIND_STAGE_ONE: "# 阶段一：确定预期学习结果\n\n## G 迁移目标\n\n学生能够识别真实问题并结合AI工具设计解决方案。\n\n"
+    "## U 持续理解\n\n- U1: AI是基于数据的模式识别系统，其能力与局限取决于数据。\n\n"
+    "## Q 基本问题\n\n- Q1: AI能替代人类的创造性思维吗？\n",
+    KIND_STAGE_TWO: "# 阶段二：确定恰当的评估方法\n\n## 表现性任务\n\n学生以小组为单位为社区问题设计AI辅助方案并公开展示。\n\n"
+    "## 评估量规\n\n| 维度 | 优秀 | 合格 |\n|---|---|---|\n| 问题定义 | 清晰具体 | 基本清楚 |\n",
+    KIND_STAGE_THREE: "# 阶段三：规划相关教学过程\n\n## 第1课时：入项\n\n- 驱动问题发布与分组\n\n"
+    "## 第2课时：探究\n\n- 体验AI工具并记录观察\n",
+}
+
+_CHAT_REPLY = (
+    "好的，我理解您的需求。建议先明确学生需要持续理解的核心观念（U），"
+    "再围绕它设计表现性任务，确保评估证据能够真正体现理解。"
+    "如果需要，我可以帮您重新生成对应阶段的内容。"
+)
+
+
+@dataclass
+class MockLLMConfig:
+    """模拟服务配置，可通过 PUT /mock/config 在运行时调整"""
+
+    ttft: float = 0.3  # 首token延迟（秒）
+    tokens_per_second: float = 60.0  # 输出速率（0表示不限速）
+    chunk_tokens: int = 1  # 每个流式chunk包含的token数
+    chars_per_token: int = 2  # 按中文约2字符/token切分
+    jitter: float = 0.0  # 延迟随机抖动比例（0.2 = ±20%）
+    error_rate: float = 0.0  # 直接返回500的概率
+    rate_limit_rate: float = 0.0  # 返回429的概率
+    abort_rate: float = 0.0  # 流中途断开连接的概率
+    max_output_tokens: Optional[int] = None  # 输出token上限（默认输出完整文档）
+    seed: Optional[int] = None
+    docs_path: Optional[str] = None  # 固定Markdown来源，默认 docs/UBD最佳实践教案案例一.md
+
+
+class MockStreamAbort(RuntimeError):
+    """错误注入：流式输出中途断开"""
+
+
+def load_canned_markdown(path: Optional[str] = None) -> Dict[str, str]:
+    """
+    从教案案例文档中按 "# 阶段X" 标题切分出三个阶段的Markdown
+
+    文档不存在或缺少某阶段时使用内置的简短示例。
+    """
+    canned = dict(_FALLBACK_MARKDOWN)
+    doc_path = Path(path) if path else DEFAULT_DOCS_PATH
+    try:
+        text = doc_path.read_text(encoding="utf-8")
+    except OSError:
+        logger.warning(f"[MockLLM] Canned document not found: {doc_path}, using built-in markdown")
+        return canned
+
+    positions = {}
+    for kind, heading in _STAGE_HEADINGS.items():
+        match = re.search(rf"^{re.escape(heading)}", text, re.MULTILINE)
+        if match:
+            positions[kind] = match.start()
+
+    ordered = sorted(positions.items(), key=lambda item: item[1])
+    for index, (kind, start) in enumerate(ordered):
+        end = ordered[index + 1][1] if index + 1 < len(ordered) else len(text)
+        section = text[start:end].strip()
+        if section:
+            canned[kind] = section + "\n"
+    return canned
+
+
+def detect_kind(messages: List[Dict[str, Any]]) -> str:
+    """根据system prompt中的角色标识判断调用方，无法识别时按Stage 1处理"""
+    system = "\n".join(
+        str(message.get("content") or "") for message in messages if message.get("role") == "system"
+    )
+    for marker, kind in _KIND_MARKERS:
+        if marker in system:
+            return kind
+    return KIND_STAGE_ONE
+
+
+def _editor_patch(messages: List[Dict[str, Any]]) -> str:
+    """回显用户消息中的第一个章节作为局部修改补丁"""
+    user = next(
+        (str(m.get("content") or "") for m in reversed(messages) if m.get("role") == "user"), ""
+    )
+    match = re.search(r"^@@ \d+\n.*?(?=^@@ \d+$|\Z)", user, re.MULTILINE | re.DOTALL)
+    if not match:
+        return ""
+    return match.group(0).rstrip() + "\n\n（已根据修改要求调整）\n"
+
+
+def split_tokens(text: str, chars_per_token: int) -> List[str]:
+    """按固定字符数把文本切成伪token"""
+    size = max(1, chars_per_token)
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _estimate_prompt_tokens(messages: List[Dict[str, Any]], chars_per_token: int) -> int:
+    chars = sum(len(str(m.get("content") or "")) for m in messages)
+    return max(1, chars // max(1, chars_per_token))
+
+
+class MockLLM:
+    """模拟服务状态：配置、固定内容、随机源与统计"""
+
+    def __init__(self, config: Optional[MockLLMConfig] = None):
+        self.config = config or MockLLMConfig()
+        self.canned = load_canned_markdown(self.config.docs_path)
+        self.random = random.Random(self.config.seed)
+        self.stats: Dict[str, Any] = {
+            "requests": 0,
+            "active_streams": 0,
+            "completed": 0,
+            "injected": {"error": 0, "rate_limit": 0, "abort": 0},
+            "by_kind": {},
+        }
+
+    def update(self, values: Dict[str, Any]) -> None:
+        known = {f.name for f in fields(MockLLMConfig)}
+        for key, value in values.items():
+            if key in known:
+                setattr(self.config, key, value)
+        if "docs_path" in values:
+            self.canned = load_canned_markdown(self.config.docs_path)
+        if "seed" in values:
+            self.random = random.Random(self.config.seed)
+
+    def response_text(self, messages: List[Dict[str, Any]]) -> str:
+        kind = detect_kind(messages)
+        self.stats["by_kind"][kind] = self.stats["by_kind"].get(kind, 0) + 1
+        if kind == KIND_CHAT:
+            return _CHAT_REPLY
+        if kind == KIND_EDITOR:
+            return _editor_patch(messages)
+        return self.canned[kind]
+
+    def delay(self, seconds: float) -> float:
+        if seconds <= 0:
+            return 0.0
+        jitter = self.config.jitter
+        if jitter > 0:
+            seconds *= 1 + self.random.uniform(-jitter, jitter)
+        return max(0.0, seconds)
+
+    def roll(self, probability: float) -> bool:
+        return probability > 0 and self.random.random() < probability
+
+
+def _error_response(status_code: int, message: str, error_type: str) -> JSONResponse:
+    headers = {"Retry-After": "1"} if status_code == 429 else None
+    return JSONResponse(
+        status_code=status_code,
+        content={"error": {"message": message, "type": error_type, "code": status_code}},
+        headers=headers,
+    )
+
+
+def _chunk(completion_id: str, created: int, model: str, delta: Dict[str, Any], finish_reason=None) -> str:
+    payload = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def create_app(config: Optional[MockLLMConfig] = None) -> FastAPI:
+    """创建模拟服务应用"""
+    mock = MockLLM(config)
+    app = FastAPI(title="Mock OpenAI-compatible LLM")
+    app.state.mock = mock
+
+    @app.get("/v1/models")
+    async def list_models():
+        return {"object": "list", "data": [{"id": "mock-model", "object": "model", "owned_by": "loadtest"}]}
+
+    @app.get("/mock/stats")
+    async def get_stats():
+        return mock.stats
+
+    @app.get("/mock/config")
+    async def get_config():
+        return asdict(mock.config)
+
+    @app.put("/mock/config")
+    async def put_config(request: Request):
+        mock.update(await request.json())
+        return asdict(mock.config)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        cfg = mock.config
+        mock.stats["requests"] += 1
+
+        if mock.roll(cfg.error_rate):
+            mock.stats["injected"]["error"] += 1
+            return _error_response(500, "Injected server error", "server_error")
+        if mock.roll(cfg.rate_limit_rate):
+            mock.stats["injected"]["rate_limit"] += 1
+            return _error_response(429, "Injected rate limit", "rate_limit_exceeded")
+
+        messages = body.get("messages") or []
+        model = body.get("model") or "mock-model"
+        tokens = split_tokens(mock.response_text(messages), cfg.chars_per_token)
+        limit = body.get("max_tokens") or cfg.max_output_tokens
+        if limit:
+            tokens = tokens[: int(limit)]
+        usage = {
+            "prompt_tokens": _estimate_prompt_tokens(messages, cfg.chars_per_token),
+            "completion_tokens": len(tokens),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(mock.delay(cfg.ttft))
+            if cfg.tokens_per_second > 0:
+                await asyncio.sleep(mock.delay(len(tokens) / cfg.tokens_per_second))
+            mock.stats["completed"] += 1
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        abort_at = mock.random.randint(0, max(0, len(tokens) - 1)) if mock.roll(cfg.abort_rate) else None
+        step = max(1, cfg.chunk_tokens)
+        interval = step / cfg.tokens_per_second if cfg.tokens_per_second > 0 else 0.0
+
+        async def stream() -> AsyncIterator[str]:
+            mock.stats["active_streams"] += 1
+            try:
+                await asyncio.sleep(mock.delay(cfg.ttft))
+                yield _chunk(completion_id, created, model, {"role": "assistant", "content": ""})
+                for start in range(0, len(tokens), step):
+                    if abort_at is not None and start >= abort_at:
+                        mock.stats["injected"]["abort"] += 1
+                        raise MockStreamAbort("Injected stream abort")
+                    if start:
+                        await asyncio.sleep(mock.delay(interval))
+                    content = "".join(tokens[start:start + step])
+                    yield _chunk(completion_id, created, model, {"content": content})
+                yield _chunk(completion_id, created, model, {}, finish_reason="stop")
+                if include_usage:
+                    payload = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [],
+                        "usage": usage,
+                    }
+                    yield f"data: {json.dumps(payload)}\n\n"
+                yield "data: [DONE]\n\n"
+                mock.stats["completed"] += 1
+            finally:
+                mock.stats["active_streams"] -= 1
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """命令行入口：python -m loadtest.mock_llm_server"""
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="OpenAI兼容的模拟LLM流式服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft", type=float, default=MockLLMConfig.ttft, help="首token延迟（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=MockLLMConfig.tokens_per_second)
+    parser.add_argument("--chunk-tokens", type=int, default=MockLLMConfig.chunk_tokens)
+    parser.add_argument("--chars-per-token", type=int, default=MockLLMConfig.chars_per_token)
+    parser.add_argument("--jitter", type=float, default=MockLLMConfig.jitter)
+    parser.add_argument("--error-rate", type=float, default=MockLLMConfig.error_rate)
+    parser.add_argument("--rate-limit-rate", type=float, default=MockLLMConfig.rate_limit_rate)
+    parser.add_argument("--abort-rate", type=float, default=MockLLMConfig.abort_rate)
+    parser.add_argument("--max-output-tokens", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--docs-path", default=None, help="固定Markdown来源文档")
+    args = parser.parse_args(argv)
+
+    config = MockLLMConfig(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        chunk_tokens=args.chunk_tokens,
+        chars_per_token=args.chars_per_token,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        abort_rate=args.abort_rate,
+        max_output_tokens=args.max_output_tokens,
+        seed=args.seed,
+        docs_path=args.docs_path,
+    )
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()